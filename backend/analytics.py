@@ -0,0 +1,544 @@
+"""
+Columnar analytics cache of the transaction lines.
+
+Every line, archived years included, is kept in a directory of .npy files,
+one per column, that are memory-mapped when read:
+
+    line            transaction_lines.id, ascending
+    day             days since 1970-01-01
+    account         account_id (-1 when missing)
+    amount          debit - credit in minor units (hundredths)
+    classification  classification_id (-1 when unclassified)
+    transaction     transaction_id
+    live            False once the line was deleted
+
+Totals per account, classification, transaction or period, trends,
+percentiles and top-N lists are then plain vectorized NumPy operations over
+a few contiguous arrays instead of SQL scans that decode every row.
+
+The cache is refreshed incrementally. Lines with an id above the watermark
+(the largest id cached) are appended. Updates and deletes of older lines are
+logged by triggers in analytics_line_changes, only once a cache exists for
+the database (analytics_cache), and patched by line id; the log is pruned
+as it is consumed. Moving lines into an archive partition sets the delete
+trigger aside (archive.py), since archived lines stay in the cache. A
+missing or foreign cache directory, or one with too many deleted lines, is
+rebuilt from scratch.
+
+Every refresh that changes anything writes a new generation of the files
+(<column>.<generation>.npy), copied from the last one and patched, so the
+arrays readers have mapped never change under them. Arrays are allocated
+with spare capacity so appends rarely need more than that copy; the
+generation, the number of rows in use, the watermark and the last change
+applied are kept in state.json, which is replaced atomically after the
+arrays are written, and older generations are deleted then. Refreshes hold
+a file lock on the directory and reread state.json first, so several
+server processes can share one cache (workers.py). Readers take no lock:
+latest() maps whatever generation state.json names.
+"""
+import datetime
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+import archive
+import workers
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS analytics_cache (id INTEGER PRIMARY KEY CHECK (id = 1), token TEXT NOT NULL)",
+    """
+    CREATE TABLE IF NOT EXISTS analytics_line_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        line_id INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS analytics_line_update
+    AFTER UPDATE OF transaction_id, account_id, debit, credit, date, classification_id ON transaction_lines
+    WHEN EXISTS (SELECT 1 FROM analytics_cache)
+    BEGIN
+        INSERT INTO analytics_line_changes (line_id) VALUES (OLD.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS analytics_line_delete
+    AFTER DELETE ON transaction_lines
+    WHEN EXISTS (SELECT 1 FROM analytics_cache)
+    BEGIN
+        INSERT INTO analytics_line_changes (line_id) VALUES (OLD.id);
+    END
+    """,
+]
+
+COLUMNS = {
+    "line": np.int64,
+    "day": np.int32,
+    "account": np.int32,
+    "amount": np.int64,
+    "classification": np.int32,
+    "transaction": np.int64,
+}
+# Files of a generation: the columns plus the live flags
+ARRAYS = tuple(COLUMNS) + ("live",)
+# Values of the columns above, in the same order
+LINE_VALUES = """
+    id,
+    COALESCE(CAST(julianday(substr(date, 1, 10)) - 2440587.5 AS INTEGER), 0),
+    COALESCE(account_id, -1),
+    CAST(ROUND((COALESCE(debit, 0) - COALESCE(credit, 0)) * 100) AS INTEGER),
+    COALESCE(classification_id, -1),
+    COALESCE(transaction_id, -1)
+"""
+GROUPINGS = ("account", "classification", "transaction", "day", "month", "year")
+MEASURES = ("debit", "credit", "net", "lines")
+SIDES = ("any", "debit", "credit")
+
+EPOCH = datetime.date(1970, 1, 1)
+# Rows read from SQLite per batch
+BATCH_SIZE = 50000
+# Spare capacity allocated when the arrays are (re)written
+GROWTH = 1.25
+MIN_CAPACITY = 1024
+# A cache whose deleted lines exceed this share of its rows is rebuilt compact
+REBUILD_DEAD_FRACTION = 0.25
+
+
+def create_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+def forget(conn):
+    """Unregister any cache of `conn`'s database (replaced by a backup), so the next refresh rebuilds it"""
+    create_schema(conn.cursor())
+    conn.execute("DELETE FROM analytics_cache")
+    conn.execute("DELETE FROM analytics_line_changes")
+
+
+def day_number(value):
+    """Days since 1970-01-01 of a YYYY-MM-DD date"""
+    return (datetime.date.fromisoformat(str(value)[:10]) - EPOCH).days
+
+
+def period_label(granularity, key):
+    """Display form of a day, month or year key"""
+    if granularity == "day":
+        return (EPOCH + datetime.timedelta(days=int(key))).isoformat()
+    if granularity == "month":
+        return f"{1970 + key // 12:04d}-{key % 12 + 1:02d}"
+    return str(1970 + key)
+
+
+def read_lines(cursor):
+    """Arrays of every row a `SELECT {LINE_VALUES}` cursor returns"""
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=np.int64))
+    values = np.concatenate(chunks) if chunks else np.empty((0, len(COLUMNS)), dtype=np.int64)
+    return {name: values[:, index].astype(dtype) for index, (name, dtype) in enumerate(COLUMNS.items())}
+
+
+class Columns:
+    """The cached lines as read-only arrays, all of the same length"""
+
+    def __init__(self, arrays, count):
+        self.line = arrays["line"][:count]
+        self.day = arrays["day"][:count]
+        self.account = arrays["account"][:count]
+        self.amount = arrays["amount"][:count]
+        self.classification = arrays["classification"][:count]
+        self.transaction = arrays["transaction"][:count]
+        self.live = arrays["live"][:count]
+        self.derived = {}
+
+    def __len__(self):
+        return len(self.line)
+
+    def keys(self, by):
+        """Grouping key of every line: a column, or months / years since 1970 derived from the day"""
+        if by in ("account", "classification", "transaction", "day"):
+            return getattr(self, by)
+        if by not in self.derived:
+            months = self.day.astype("datetime64[D]").astype("datetime64[M]").astype(np.int32)
+            self.derived = {"month": months, "year": months // 12}
+        return self.derived[by]
+
+    def select(self, date_from=None, date_to=None, account_ids=None, classification_id=None):
+        """
+        Mask of the live lines matching the filters
+
+        Args:
+            date_from, date_to: Inclusive YYYY-MM-DD bounds
+            account_ids: Iterable of account ids
+            classification_id: Only lines with this classification
+
+        Raises:
+            ValueError: a bad date
+        """
+        mask = self.live.copy()
+        if date_from:
+            mask &= self.day >= day_number(date_from)
+        if date_to:
+            mask &= self.day <= day_number(date_to)
+        if account_ids is not None:
+            mask &= np.isin(self.account, np.fromiter(account_ids, dtype=np.int32))
+        if classification_id is not None:
+            mask &= self.classification == classification_id
+        return mask
+
+
+def group_totals(columns, by, mask=None):
+    """
+    Debit, credit and line count per `by` key of the selected lines
+
+    Dense keys (accounts, periods, mostly transactions) are counted with
+    bincount in one pass; sparse ones are sorted with np.unique.
+
+    Returns:
+        (keys, debit, credit, lines) arrays ordered by key, amounts in minor units
+    """
+    if by not in GROUPINGS:
+        raise ValueError(f"by must be one of {', '.join(GROUPINGS)}")
+    keys = columns.keys(by)
+    amount = columns.amount
+    if mask is not None:
+        keys, amount = keys[mask], amount[mask]
+    if not len(keys):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, empty
+    low = int(keys.min())
+    span = int(keys.max()) - low + 1
+    if span <= 4 * len(keys) + 1024:
+        index = (keys - low).astype(np.intp)
+        lines = np.bincount(index, minlength=span)
+        present = np.flatnonzero(lines)
+        key_values, lines = present + low, lines[present]
+    else:
+        key_values, index, lines = np.unique(keys, return_inverse=True, return_counts=True)
+        present, span = slice(None), len(key_values)
+    debit = np.bincount(index, weights=np.maximum(amount, 0), minlength=span)[present]
+    credit = np.bincount(index, weights=np.maximum(-amount, 0), minlength=span)[present]
+    return key_values, np.rint(debit).astype(np.int64), np.rint(credit).astype(np.int64), lines
+
+
+# Columns of labelled_rows()
+LABELLED_FIELDS = ("key", "label", "debit", "credit", "net", "lines")
+
+
+def labelled_rows(by, keys, debit, credit, lines, reference):
+    """
+    LABELLED_FIELDS rows of group totals in major units; accounts and
+    classifications are labelled by name from a refdata Snapshot
+    """
+    keys = keys.tolist()
+    if by == "account":
+        labels = [reference.accounts.name(key) for key in keys]
+    elif by == "classification":
+        labels = [reference.classifications.name(key) for key in keys]
+    elif by == "transaction":
+        labels = [None] * len(keys)
+    else:
+        labels = [period_label(by, key) for key in keys]
+    if by in ("account", "classification"):
+        # -1 stands for lines without one
+        keys = [None if key == -1 else key for key in keys]
+    return list(zip(keys, labels, (debit / 100).round(2).tolist(), (credit / 100).round(2).tolist(),
+                    ((debit - credit) / 100).round(2).tolist(), lines.tolist()))
+
+
+def trend(columns, granularity, mask=None):
+    """
+    Totals per day, month or year from the first to the last selected line,
+    periods without lines included
+
+    Returns:
+        (keys, debit, credit, lines, cumulative net) arrays
+    """
+    if granularity not in ("day", "month", "year"):
+        raise ValueError("granularity must be day, month or year")
+    keys, debit, credit, lines = group_totals(columns, granularity, mask)
+    if len(keys):
+        periods = np.arange(keys[0], keys[-1] + 1)
+        index = keys - keys[0]
+        filled = []
+        for values in (debit, credit, lines):
+            full = np.zeros(len(periods), dtype=np.int64)
+            full[index] = values
+            filled.append(full)
+        keys, (debit, credit, lines) = periods, filled
+    return keys, debit, credit, lines, np.cumsum(debit - credit)
+
+
+def top(columns, by, n=10, measure="debit", mask=None):
+    """
+    The `n` keys with the largest `measure` (debit, credit, net or lines),
+    largest first and by key among equals
+
+    Returns:
+        (keys, debit, credit, lines) arrays
+    """
+    if measure not in MEASURES:
+        raise ValueError(f"measure must be one of {', '.join(MEASURES)}")
+    keys, debit, credit, lines = group_totals(columns, by, mask)
+    values = {"debit": debit, "credit": credit, "net": debit - credit, "lines": lines}[measure]
+    picked = np.arange(len(keys))
+    if len(keys) > n:
+        picked = np.argpartition(-values, n)[:n]
+    picked = picked[np.lexsort((keys[picked], -values[picked]))]
+    return keys[picked], debit[picked], credit[picked], lines[picked]
+
+
+def percentiles(columns, quantiles, mask=None, side="any"):
+    """
+    Percentiles (0-100, linear interpolation) of the line amounts
+
+    Args:
+        side: "debit" or "credit" for only that side's amounts, "any" for
+            every line's absolute amount
+
+    Returns:
+        (list of values in minor units, or None when nothing is selected;
+        number of amounts considered)
+    """
+    if side not in SIDES:
+        raise ValueError(f"side must be one of {', '.join(SIDES)}")
+    amount = columns.amount if mask is None else columns.amount[mask]
+    if side == "debit":
+        amount = amount[amount > 0]
+    elif side == "credit":
+        amount = -amount[amount < 0]
+    else:
+        amount = np.abs(amount)
+    if not len(amount):
+        return None, 0
+    return np.percentile(amount, quantiles).tolist(), len(amount)
+
+
+class ColumnCache:
+    """
+    The cache directory of one database; refresh() brings it up to date,
+    latest() serves what the last refresh left without writing anything
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = workers.FileLock(directory + ".lock")
+        # (state, Columns) last mapped by this process, replaced as a whole
+        self.loaded = (None, None)
+
+    @property
+    def state(self):
+        return self.loaded[0]
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def array_path(self, name, generation):
+        return self.path(f"{name}.{generation}.npy")
+
+    def load_state(self):
+        try:
+            with open(self.path("state.json")) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if "generation" not in state or \
+                not all(os.path.exists(self.array_path(name, state["generation"])) for name in ARRAYS):
+            return None
+        return state
+
+    def save_state(self, state):
+        """Switch readers to `state` and its generation of files, then delete the older generations"""
+        temporary = self.path("state.json.tmp")
+        with open(temporary, "w") as f:
+            json.dump(state, f)
+        os.replace(temporary, self.path("state.json"))
+        suffix = f".{state['generation']}.npy"
+        for entry in os.listdir(self.directory):
+            if entry.endswith(".npy") and not entry.endswith(suffix):
+                try:
+                    os.remove(self.path(entry))
+                except OSError:
+                    # Still mapped by a reader (Windows); the next save retries
+                    pass
+
+    def open_arrays(self, state):
+        return {name: np.load(self.array_path(name, state["generation"]), mmap_mode="r") for name in ARRAYS}
+
+    def map(self, state):
+        """Columns of `state`, remembered as the loaded ones"""
+        columns = Columns(self.open_arrays(state), state["count"])
+        self.loaded = (state, columns)
+        return columns
+
+    def write_arrays(self, values, capacity):
+        """A new generation of column files holding `values` followed by spare capacity; returns its name"""
+        os.makedirs(self.directory, exist_ok=True)
+        generation = uuid.uuid4().hex[:12]
+        for name, dtype in list(COLUMNS.items()) + [("live", np.bool_)]:
+            array = np.lib.format.open_memmap(self.array_path(name, generation), mode="w+", dtype=dtype,
+                                              shape=(capacity,))
+            array[:len(values[name])] = values[name]
+            array.flush()
+            del array
+        return generation
+
+    def copy_arrays(self, state):
+        """A new generation copied from that of `state`, opened for writing; returns (name, arrays)"""
+        generation = uuid.uuid4().hex[:12]
+        for name in ARRAYS:
+            shutil.copyfile(self.array_path(name, state["generation"]), self.array_path(name, generation))
+        return generation, {name: np.load(self.array_path(name, generation), mmap_mode="r+") for name in ARRAYS}
+
+    def latest(self, conn):
+        """
+        The Columns of the last complete refresh (None before the first one)
+        and whether they are up to date with the database behind `conn`
+
+        Only reads: the files of a refresh never change once state.json
+        names them, and a refresh under way writes a new generation.
+        """
+        state = columns = None
+        for _ in range(3):
+            state = self.load_state()
+            loaded_state, loaded_columns = self.loaded
+            if state is None or state == loaded_state:
+                columns = loaded_columns if state is not None else None
+                break
+            try:
+                columns = self.map(state)
+                break
+            except FileNotFoundError:
+                # Replaced by a newer generation between reading state.json and mapping its files
+                continue
+        if columns is None:
+            return None, False
+        current = conn.execute("""
+            SELECT (SELECT token FROM analytics_cache WHERE id = 1) IS ?
+               AND NOT EXISTS (SELECT 1 FROM analytics_line_changes WHERE seq > ?)
+               AND NOT EXISTS (SELECT 1 FROM transaction_lines WHERE id > ?)
+        """, (state["token"], state["change_seq"], state["watermark"])).fetchone()[0]
+        return columns, bool(current)
+
+    def refresh(self, conn):
+        """
+        Bring the cache up to date with the database behind `conn` and return its Columns
+
+        Commits on `conn`: the first call registers the cache (which turns on
+        change logging) and later ones prune the changes they applied. The
+        server runs it only in the refresh-analytics job, under the write lock.
+        """
+        with self.lock:
+            state = self.load_state()
+            token = conn.execute("SELECT token FROM analytics_cache WHERE id = 1").fetchone()
+            if state is None or token is None or token[0] != state["token"] \
+                    or state["dead"] > REBUILD_DEAD_FRACTION * max(state["count"], 1):
+                return self.rebuild(conn)
+            return self.update(conn, state)
+
+    def rebuild(self, conn):
+        token = uuid.uuid4().hex
+        conn.execute("INSERT OR REPLACE INTO analytics_cache (id, token) VALUES (1, ?)", (token,))
+        conn.commit()
+        # Changes logged from here on are applied by the next refresh; those
+        # already logged are in the rows read below
+        conn.execute("BEGIN")
+        try:
+            change_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM analytics_line_changes").fetchone()[0]
+            values = read_lines(conn.execute(f"SELECT {LINE_VALUES} FROM {archive.lines_table(conn)}"))
+        finally:
+            conn.commit()
+        order = np.argsort(values["line"], kind="stable")
+        values = {name: column[order] for name, column in values.items()}
+        count = len(values["line"])
+        values["live"] = np.ones(count, dtype=np.bool_)
+        capacity = max(int(count * GROWTH), MIN_CAPACITY)
+        generation = self.write_arrays(values, capacity)
+        watermark = int(values["line"][-1]) if count else 0
+        state = {"token": token, "generation": generation, "count": count, "capacity": capacity,
+                 "watermark": watermark, "change_seq": change_seq, "dead": 0}
+        self.save_state(state)
+        self.prune(conn, change_seq)
+        return self.map(state)
+
+    def update(self, conn, state):
+        conn.execute("BEGIN")
+        try:
+            change_seq = conn.execute("SELECT COALESCE(MAX(seq), ?) FROM analytics_line_changes WHERE seq > ?",
+                                      (state["change_seq"], state["change_seq"])).fetchone()[0]
+            changed = [row[0] for row in conn.execute("""
+                SELECT DISTINCT line_id FROM analytics_line_changes WHERE seq > ? AND seq <= ? AND line_id <= ?
+            """, (state["change_seq"], change_seq, state["watermark"]))]
+            patched = read_lines(conn.execute(f"""
+                SELECT {LINE_VALUES} FROM transaction_lines WHERE id IN (SELECT value FROM json_each(?))
+            """, (json.dumps(changed),)))
+            added = read_lines(conn.execute(f"SELECT {LINE_VALUES} FROM transaction_lines WHERE id > ? ORDER BY id",
+                                            (state["watermark"],)))
+        finally:
+            conn.commit()
+        if not changed and not len(added["line"]):
+            if change_seq != state["change_seq"]:
+                state = {**state, "change_seq": change_seq}
+                self.save_state(state)
+                self.prune(conn, change_seq)
+            loaded_state, loaded_columns = self.loaded
+            return loaded_columns if state == loaded_state else self.map(state)
+
+        count, dead, capacity = state["count"], state["dead"], state["capacity"]
+        added_count = len(added["line"])
+        if count + added_count > capacity:
+            # Grown past the spare capacity: every column is written out anew below
+            capacity = max(int((count + added_count) * GROWTH), MIN_CAPACITY)
+            arrays = {name: np.array(array[:count]) for name, array in self.open_arrays(state).items()}
+            generation = None
+        else:
+            # Readers keep the files they mapped; patches and appends go to a copy
+            generation, arrays = self.copy_arrays(state)
+        if changed:
+            ids = np.sort(np.array(changed, dtype=np.int64))
+            positions = np.searchsorted(arrays["line"][:count], ids)
+            found = positions < count
+            found[found] = arrays["line"][positions[found]] == ids[found]
+            ids, positions = ids[found], positions[found]
+            # Lines that were changed are overwritten; those no longer there are dropped
+            updated = np.searchsorted(ids, patched["line"])
+            kept = updated < len(ids)
+            kept[kept] = ids[updated[kept]] == patched["line"][kept]
+            updated = updated[kept]
+            for name in COLUMNS:
+                arrays[name][positions[updated]] = patched[name][kept]
+            gone = np.ones(len(positions), dtype=np.bool_)
+            gone[updated] = False
+            dead += int(arrays["live"][positions[gone]].sum())
+            arrays["live"][positions[gone]] = False
+
+        if generation is None:
+            values = {name: np.concatenate([arrays[name], added[name]]) for name in COLUMNS}
+            values["live"] = np.concatenate([arrays["live"], np.ones(added_count, dtype=np.bool_)])
+            del arrays
+            generation = self.write_arrays(values, capacity)
+        else:
+            if added_count:
+                for name in COLUMNS:
+                    arrays[name][count:count + added_count] = added[name]
+                arrays["live"][count:count + added_count] = True
+            for array in arrays.values():
+                array.flush()
+            del arrays
+        if added_count:
+            state = {**state, "watermark": int(added["line"][-1])}
+        state = {**state, "generation": generation, "capacity": capacity, "count": count + added_count,
+                 "change_seq": change_seq, "dead": dead}
+        self.save_state(state)
+        self.prune(conn, change_seq)
+        return self.map(state)
+
+    def prune(self, conn, change_seq):
+        conn.execute("DELETE FROM analytics_line_changes WHERE seq <= ?", (change_seq,))
+        conn.commit()
@@ -0,0 +1,353 @@
+"""
+Year-partitioned archive of closed transactions.
+
+archive_year() moves every transaction whose last line falls in a closed
+year out of the main database and into its own SQLite file next to it
+(finance-2019.db for finance.db), then records the partition in
+archive_partitions together with its date and id ranges. Per-account totals
+of the archived lines go to archive_account_totals, so all-time balances
+never have to open an archive.
+
+Readers ask this module for the tables to query instead of naming
+transaction_lines / transactions directly. When the requested date range
+(or transaction id) does not reach into an archived partition they get the
+plain table names back; otherwise the partitions involved are ATTACHed
+read-only and a UNION ALL over them and the main table is returned. Archived
+years stay closed: their lines cannot be written, so the partitions never
+change once created.
+
+Usage (from the backend directory):
+    python archive.py 2019 [--db finance.db] [--vacuum]
+"""
+import argparse
+import datetime
+import os
+import sqlite3
+import urllib.parse
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS archive_partitions (
+        year INTEGER PRIMARY KEY,
+        path TEXT NOT NULL,
+        first_date DATE NOT NULL,
+        last_date DATE NOT NULL,
+        first_transaction_id INTEGER NOT NULL,
+        last_transaction_id INTEGER NOT NULL,
+        transactions INTEGER NOT NULL,
+        lines INTEGER NOT NULL,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS archive_account_totals (
+        year INTEGER NOT NULL,
+        account_id INTEGER NOT NULL,
+        debit REAL NOT NULL,
+        credit REAL NOT NULL,
+        lines INTEGER NOT NULL,
+        PRIMARY KEY (year, account_id)
+    ) WITHOUT ROWID
+    """,
+]
+
+LINE_COLUMNS = "id, transaction_id, account_id, debit, credit, date, classification_id"
+TRANSACTION_COLUMNS = "id, description, currency_id"
+
+# Triggers that would block or undo moving closed lines out of the main database
+# (archived lines stay in the analytics cache and the recurring occurrences as well)
+ARCHIVE_BLOCKING_TRIGGERS = ["closed_period_line_delete", "balance_checkpoints_line_delete", "analytics_line_delete",
+                             "recurring_line_delete", "recurring_transaction_delete", "line_month_totals_line_delete"]
+
+
+def create_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+def partitions(conn, start=None, end=None):
+    """
+    Archived partitions whose lines overlap [start, end)
+
+    Returns:
+        List of (year, path, first_date, last_date, first_transaction_id,
+        last_transaction_id) tuples, oldest first
+    """
+    cursor = conn.execute("""
+        SELECT year, path, first_date, last_date, first_transaction_id, last_transaction_id
+        FROM archive_partitions
+        WHERE last_date >= ? AND first_date < ?
+        ORDER BY year
+    """, (start[:10] if start else "", end or "9999-12-31"))
+    return cursor.fetchall()
+
+
+def archived_through(conn):
+    """Last date covered by an archive partition, or None"""
+    return conn.execute("SELECT MAX(last_date) FROM archive_partitions").fetchone()[0]
+
+
+def archived_year_end(conn):
+    """Last day of the last archived year, or None; its periods stay closed"""
+    year = conn.execute("SELECT MAX(year) FROM archive_partitions").fetchone()[0]
+    return None if year is None else datetime.date(year, 12, 31).isoformat()
+
+
+def archived_transaction_count(conn):
+    return conn.execute("SELECT COALESCE(SUM(transactions), 0) FROM archive_partitions").fetchone()[0]
+
+
+def database_directory(conn):
+    for _, name, path in conn.execute("PRAGMA database_list").fetchall():
+        if name == "main":
+            return os.path.dirname(os.path.abspath(path)) if path else os.getcwd()
+    return os.getcwd()
+
+
+def attach(conn, partition):
+    """ATTACH a partition read-only (once per connection) and return its schema name"""
+    year, path = partition[0], partition[1]
+    schema = f"archive_{year}"
+    attached = {row[1] for row in conn.execute("PRAGMA database_list").fetchall()}
+    if schema not in attached:
+        full_path = os.path.join(database_directory(conn), path)
+        if not os.path.exists(full_path):
+            raise FileNotFoundError(f"Archive partition for {year} is missing: {full_path}")
+        conn.execute(f"ATTACH DATABASE ? AS {schema}",
+                     (f"file:{urllib.parse.quote(full_path)}?mode=ro",))
+    return schema
+
+
+def union_tables(conn, selected):
+    """(lines, transactions) table expressions over the main tables plus `selected` partitions"""
+    if not selected:
+        return "transaction_lines", "transactions"
+    schemas = [attach(conn, partition) for partition in selected]
+    lines = " UNION ALL ".join([f"SELECT {LINE_COLUMNS} FROM main.transaction_lines"] +
+                               [f"SELECT {LINE_COLUMNS} FROM {schema}.transaction_lines" for schema in schemas])
+    transactions = " UNION ALL ".join([f"SELECT {TRANSACTION_COLUMNS} FROM main.transactions"] +
+                                      [f"SELECT {TRANSACTION_COLUMNS} FROM {schema}.transactions"
+                                       for schema in schemas])
+    return f"({lines})", f"({transactions})"
+
+
+def tables(conn, start=None, end=None):
+    """
+    (lines, transactions) table expressions for lines dated in [start, end)
+
+    Args:
+        start: ISO date or None for the beginning of history
+        end: Exclusive ISO date or None for no upper bound
+    """
+    return union_tables(conn, partitions(conn, start, end))
+
+
+def lines_table(conn, start=None, end=None):
+    return tables(conn, start, end)[0]
+
+
+def transaction_partitions(conn, transaction_id):
+    """Partitions whose id range contains `transaction_id`"""
+    cursor = conn.execute("""
+        SELECT year, path, first_date, last_date, first_transaction_id, last_transaction_id
+        FROM archive_partitions
+        WHERE first_transaction_id <= ? AND last_transaction_id >= ?
+        ORDER BY year
+    """, (transaction_id, transaction_id))
+    return cursor.fetchall()
+
+
+def transaction_tables(conn, transaction_id):
+    """(lines, transactions) that hold `transaction_id`, whether it is archived or not"""
+    return union_tables(conn, transaction_partitions(conn, transaction_id))
+
+
+def archived_year(conn, transaction_id):
+    """Year of the partition holding `transaction_id`, or None when it is not archived"""
+    for partition in transaction_partitions(conn, transaction_id):
+        schema = attach(conn, partition)
+        if conn.execute(f"SELECT 1 FROM {schema}.transactions WHERE id = ?", (transaction_id,)).fetchone():
+            return partition[0]
+    return None
+
+
+def page_tables(conn, rows_needed):
+    """
+    (lines, transactions) for the newest `rows_needed` transactions by date
+
+    Transactions in the main database whose first line is after the last
+    archived date sort ahead of every archived one, so as long as there are
+    enough of them the partitions are not needed.
+    """
+    through = archived_through(conn)
+    if through is None:
+        return "transaction_lines", "transactions"
+    boundary = (datetime.date.fromisoformat(through) + datetime.timedelta(days=1)).isoformat()
+    cursor = conn.cursor()
+    # Main-database transactions that reach back into the archived range
+    cursor.execute("SELECT COUNT(DISTINCT transaction_id) FROM transaction_lines WHERE date < ?", (boundary,))
+    reaching_back = cursor.fetchone()[0]
+    cursor.execute("""
+        SELECT COUNT(*) FROM (
+            SELECT DISTINCT transaction_id FROM transaction_lines WHERE date >= ? LIMIT ?
+        )
+    """, (boundary, rows_needed + reaching_back))
+    if cursor.fetchone()[0] - reaching_back >= rows_needed:
+        return "transaction_lines", "transactions"
+    return tables(conn)
+
+
+def account_lines(conn):
+    """
+    Table expression of (account_id, debit, credit) rows whose sums per
+    account are all-time totals: the main lines plus the archived totals
+    """
+    if archived_through(conn) is None:
+        return "transaction_lines"
+    return """(
+        SELECT account_id, debit, credit FROM transaction_lines
+        UNION ALL
+        SELECT account_id, debit, credit FROM archive_account_totals
+    )"""
+
+
+def count_archived(conn, table, condition, params=()):
+    """Rows of an archived `table` (transactions or transaction_lines) matching `condition`"""
+    total = 0
+    for partition in partitions(conn):
+        schema = attach(conn, partition)
+        total += conn.execute(f"SELECT COUNT(*) FROM {schema}.{table} WHERE {condition}", params).fetchone()[0]
+    return total
+
+
+def partition_path(conn, year):
+    main_path = conn.execute("PRAGMA database_list").fetchone()[2]
+    stem = os.path.splitext(os.path.basename(main_path))[0] if main_path else "finance"
+    return f"{stem}-{year}.db"
+
+
+def archive_year(conn, year, vacuum=False):
+    """
+    Move the transactions whose last line falls in `year` into a partition file
+
+    The year must be closed (see periods.py) and not archived yet. The copy,
+    the bookkeeping rows and the delete from the main database happen in one
+    transaction; the partition file is removed again if anything fails.
+
+    Returns:
+        Dict with the partition path and the transactions and lines moved
+    """
+    year_end = datetime.date(year, 12, 31)
+    through = conn.execute("SELECT MAX(period_end) FROM closed_periods").fetchone()[0]
+    if through is None or through < year_end.isoformat():
+        raise ValueError(f"{year} must be closed before it can be archived")
+    if conn.execute("SELECT 1 FROM archive_partitions WHERE year = ?", (year,)).fetchone():
+        raise ValueError(f"{year} is already archived")
+
+    path = partition_path(conn, year)
+    full_path = os.path.join(database_directory(conn), path)
+    if os.path.exists(full_path):
+        raise FileExistsError(full_path)
+
+    # Same table and index definitions as the main database
+    partition = sqlite3.connect(full_path)
+    cursor = conn.execute("""
+        SELECT sql FROM sqlite_master
+        WHERE tbl_name IN ('transactions', 'transaction_lines') AND type IN ('table', 'index') AND sql IS NOT NULL
+        ORDER BY type DESC
+    """)
+    for (statement,) in cursor.fetchall():
+        partition.execute(statement)
+    partition.commit()
+    partition.close()
+
+    start = datetime.date(year, 1, 1).isoformat()
+    end = datetime.date(year + 1, 1, 1).isoformat()
+    conn.execute("ATTACH DATABASE ? AS archive_target", (full_path,))
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("DROP TABLE IF EXISTS temp.archive_ids")
+        cursor.execute("""
+            CREATE TEMP TABLE archive_ids AS
+            SELECT transaction_id AS id
+            FROM transaction_lines
+            WHERE transaction_id IN (
+                SELECT transaction_id FROM transaction_lines WHERE date >= ? AND date < ?
+            )
+            GROUP BY transaction_id
+            HAVING MAX(date) < ?
+        """, (start, end, end))
+        cursor.execute(f"""
+            INSERT INTO archive_target.transactions ({TRANSACTION_COLUMNS})
+            SELECT {TRANSACTION_COLUMNS} FROM main.transactions WHERE id IN (SELECT id FROM temp.archive_ids)
+        """)
+        transaction_count = cursor.rowcount
+        cursor.execute(f"""
+            INSERT INTO archive_target.transaction_lines ({LINE_COLUMNS})
+            SELECT {LINE_COLUMNS} FROM main.transaction_lines
+            WHERE transaction_id IN (SELECT id FROM temp.archive_ids)
+            ORDER BY account_id, date, id
+        """)
+        line_count = cursor.rowcount
+        if not line_count:
+            raise ValueError(f"No transactions to archive for {year}")
+
+        cursor.execute("""
+            INSERT INTO archive_account_totals (year, account_id, debit, credit, lines)
+            SELECT ?, account_id, TOTAL(debit), TOTAL(credit), COUNT(*)
+            FROM archive_target.transaction_lines
+            GROUP BY account_id
+        """, (year,))
+        cursor.execute("""
+            INSERT INTO archive_partitions
+                (year, path, first_date, last_date, first_transaction_id, last_transaction_id, transactions, lines)
+            SELECT ?, ?, MIN(date(date)), MAX(date(date)), MIN(transaction_id), MAX(transaction_id), ?, COUNT(*)
+            FROM archive_target.transaction_lines
+        """, (year, path, transaction_count))
+
+        # Closed lines may not be deleted, and the balance checkpoints, the
+        # analytics cache, the recurring occurrences and the month totals
+        # still count the archived lines, so those triggers are set aside meanwhile
+        cursor.execute(f"""
+            SELECT name, sql FROM main.sqlite_master
+            WHERE type = 'trigger' AND name IN ({', '.join('?' * len(ARCHIVE_BLOCKING_TRIGGERS))})
+        """, ARCHIVE_BLOCKING_TRIGGERS)
+        triggers = cursor.fetchall()
+        for name, _ in triggers:
+            cursor.execute(f"DROP TRIGGER main.{name}")
+        cursor.execute("DELETE FROM main.transaction_lines WHERE transaction_id IN (SELECT id FROM temp.archive_ids)")
+        cursor.execute("DELETE FROM main.transactions WHERE id IN (SELECT id FROM temp.archive_ids)")
+        for _, sql in triggers:
+            cursor.execute(sql)
+        cursor.execute("DROP TABLE temp.archive_ids")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        conn.execute("DETACH DATABASE archive_target")
+        os.remove(full_path)
+        raise
+    conn.execute("DETACH DATABASE archive_target")
+
+    if vacuum:
+        conn.execute("VACUUM")
+    return {"year": year, "path": full_path, "transactions": transaction_count, "lines": line_count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("year", type=int, help="Closed year to archive")
+    parser.add_argument("--db", default=os.environ.get("FINANCE_DB", "finance.db"))
+    parser.add_argument("--vacuum", action="store_true", help="Shrink the main database file afterwards")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    create_schema(conn.cursor())
+    conn.commit()
+    result = archive_year(conn, args.year, vacuum=args.vacuum)
+    conn.close()
+    print(f"archived {result['transactions']} transactions ({result['lines']} lines) to {result['path']}")
+
+
+if __name__ == "__main__":
+    main()
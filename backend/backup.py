@@ -0,0 +1,415 @@
+"""
+Online backups, compact snapshots and restore.
+
+Two kinds of backup are written to the backup directory (FINANCE_BACKUP_DIR,
+default backups/ next to the database):
+
+- online: sqlite3's backup API copies the database a few hundred pages at a
+  time and pauses between steps, so writers only ever wait for one step. If
+  another connection writes meanwhile, SQLite restarts the copy, so the
+  result is always a consistent image. Under a steady stream of writes that
+  could go on forever, so after MAX_RESTARTS the rest is copied in a single
+  step, which holds the read lock for as long as the copy takes.
+- compact: VACUUM INTO writes a defragmented copy in one read transaction.
+  Slower on a busy database, but the file has no free pages.
+
+Backups are written under a .part name and renamed when complete. Archive
+partitions (see archive.py) never change once written, so each one is copied
+into the backup directory once and shared by every backup. Progress and
+durations are kept in `status` and exposed by /api/backups and /api/metrics.
+
+BackupScheduler runs backups on an interval and keeps the newest `keep` of
+them. restore() checks the backup's integrity before copying it over the
+database, and checks the result again afterwards.
+
+Usage (from the backend directory):
+    python backup.py backup [--compact] [--keep N]
+    python backup.py list
+    python backup.py restore backups/finance-20240101T000000-online.db
+"""
+import argparse
+import datetime
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+
+import analytics
+import versions
+
+BACKUP_DIR = os.environ.get("FINANCE_BACKUP_DIR", "backups")
+KINDS = ("online", "compact")
+# Pages copied per backup step, and the pause after each step during which
+# writers can take the lock
+PAGES_PER_STEP = 256
+STEP_PAUSE = 0.005
+MAX_RESTARTS = 3
+HISTORY_SIZE = 20
+
+_BACKUP_NAME = re.compile(r"^(?P<stem>.+)-(?P<taken>\d{8}T\d{6})-(?P<kind>online|compact)\.db$")
+
+
+class BackupInProgress(RuntimeError):
+    pass
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+class BackupStatus:
+    """Progress of the running backup and the results of recent ones"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = None
+        self.history = []
+        self.failures = {kind: 0 for kind in KINDS}
+
+    def start(self, kind, path):
+        with self.lock:
+            if self.running is not None:
+                raise BackupInProgress(f"A {self.running['kind']} backup is already running")
+            self.running = {"kind": kind, "path": path, "started_at": now_iso(), "started": time.monotonic(),
+                            "pages_total": None, "pages_remaining": None, "restarts": 0}
+
+    def progress(self, remaining, total):
+        with self.lock:
+            if self.running is None:
+                return
+            # The remaining page count only goes up when a write restarted the copy
+            previous = self.running["pages_remaining"]
+            if previous is not None and remaining > previous:
+                self.running["restarts"] += 1
+            self.running["pages_total"] = total
+            self.running["pages_remaining"] = remaining
+            return self.running["restarts"]
+
+    def finish(self, size=None, error=None):
+        with self.lock:
+            running, self.running = self.running, None
+            result = {
+                "kind": running["kind"],
+                "path": running["path"],
+                "started_at": running["started_at"],
+                "duration_seconds": round(time.monotonic() - running["started"], 3),
+                "pages": running["pages_total"],
+                "restarts": running["restarts"],
+                "size_bytes": size,
+                "error": error,
+            }
+            if error is not None:
+                self.failures[running["kind"]] += 1
+            self.history = [result] + self.history[:HISTORY_SIZE - 1]
+            return result
+
+    def snapshot(self):
+        with self.lock:
+            running = None
+            if self.running is not None:
+                running = {key: value for key, value in self.running.items() if key != "started"}
+                running["elapsed_seconds"] = round(time.monotonic() - self.running["started"], 3)
+                total, remaining = self.running["pages_total"], self.running["pages_remaining"]
+                running["percent"] = round(100 * (total - remaining) / total, 1) if total else 0.0
+            return {"running": running, "history": list(self.history)}
+
+    def render_metrics(self):
+        """Backup gauges in Prometheus text format"""
+        with self.lock:
+            lines = [
+                "# HELP finance_backup_in_progress Whether a backup is running.",
+                "# TYPE finance_backup_in_progress gauge",
+                f"finance_backup_in_progress {int(self.running is not None)}",
+                "# HELP finance_backup_progress_ratio Share of pages copied by the running backup.",
+                "# TYPE finance_backup_progress_ratio gauge",
+            ]
+            total = self.running and self.running["pages_total"]
+            ratio = (total - self.running["pages_remaining"]) / total if total else 0.0
+            lines.append(f"finance_backup_progress_ratio {ratio:.4f}")
+            last = {}
+            for result in reversed(self.history):
+                if result["error"] is None:
+                    last[result["kind"]] = result
+            lines += [
+                "# HELP finance_backup_last_duration_seconds Duration of the last successful backup, by kind.",
+                "# TYPE finance_backup_last_duration_seconds gauge",
+            ]
+            lines += [f'finance_backup_last_duration_seconds{{kind="{kind}"}} {result["duration_seconds"]}'
+                      for kind, result in sorted(last.items())]
+            lines += [
+                "# HELP finance_backup_last_size_bytes Size of the last successful backup, by kind.",
+                "# TYPE finance_backup_last_size_bytes gauge",
+            ]
+            lines += [f'finance_backup_last_size_bytes{{kind="{kind}"}} {result["size_bytes"]}'
+                      for kind, result in sorted(last.items())]
+            lines += [
+                "# HELP finance_backup_failures_total Failed backups, by kind.",
+                "# TYPE finance_backup_failures_total counter",
+            ]
+            lines += [f'finance_backup_failures_total{{kind="{kind}"}} {count}'
+                      for kind, count in sorted(self.failures.items())]
+        return "\n".join(lines) + "\n"
+
+
+status = BackupStatus()
+
+
+def now_iso():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def backup_directory(db_path, directory=None):
+    directory = directory or BACKUP_DIR
+    if not os.path.isabs(directory):
+        directory = os.path.join(os.path.dirname(os.path.abspath(db_path)), directory)
+    return directory
+
+
+def backup_path(db_path, kind, directory=None):
+    stem = os.path.splitext(os.path.basename(db_path))[0]
+    taken = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    return os.path.join(backup_directory(db_path, directory), f"{stem}-{taken}-{kind}.db")
+
+
+def run_backup(db_path, kind="online", directory=None, pages=PAGES_PER_STEP, pause=STEP_PAUSE):
+    """
+    Back up `db_path` into the backup directory
+
+    Args:
+        kind: "online" (backup API in steps of `pages` pages) or "compact"
+            (VACUUM INTO)
+
+    Returns:
+        The result recorded in status.history
+
+    Raises:
+        BackupInProgress: another backup is running
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Backup kind must be one of {', '.join(KINDS)}")
+    path = backup_path(db_path, kind, directory)
+    status.start(kind, path)
+    partial = path + ".part"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(partial):
+            os.remove(partial)
+        source = sqlite3.connect(db_path)
+        try:
+            if kind == "online":
+                online_backup(source, partial, pages, pause)
+            else:
+                page_count = source.execute("PRAGMA page_count").fetchone()[0]
+                status.progress(page_count, page_count)
+                source.execute("VACUUM INTO ?", (partial,))
+                status.progress(0, page_count)
+            copy_partitions(source, os.path.dirname(path))
+        finally:
+            source.close()
+        os.replace(partial, path)
+    except Exception as e:
+        if os.path.exists(partial):
+            os.remove(partial)
+        status.finish(error=f"{type(e).__name__}: {e}")
+        raise
+    return status.finish(size=os.path.getsize(path))
+
+
+def online_backup(source, path, pages, pause):
+    """Copy `source` into `path` in steps of `pages` pages, finishing in one step after MAX_RESTARTS"""
+    def progress(_, remaining, total):
+        if status.progress(remaining, total) >= MAX_RESTARTS:
+            # Raising from the callback aborts the stepped copy
+            raise _TooManyRestarts
+
+    target = sqlite3.connect(path)
+    try:
+        try:
+            source.backup(target, pages=pages, sleep=pause, progress=progress)
+        except _TooManyRestarts:
+            source.backup(target)
+            status.progress(0, source.execute("PRAGMA page_count").fetchone()[0])
+    finally:
+        target.close()
+
+
+def partition_files(conn):
+    """Archive partition file names recorded in `conn`'s database"""
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archive_partitions'").fetchone():
+        return []
+    return [row[0] for row in conn.execute("SELECT path FROM archive_partitions ORDER BY year").fetchall()]
+
+
+def copy_partitions(conn, directory):
+    """Copy archive partitions missing from `directory` (they are never modified once written)"""
+    db_path = conn.execute("PRAGMA database_list").fetchone()[2]
+    source_directory = os.path.dirname(os.path.abspath(db_path))
+    for name in partition_files(conn):
+        target = os.path.join(directory, name)
+        if not os.path.exists(target):
+            shutil.copyfile(os.path.join(source_directory, name), target + ".part")
+            os.replace(target + ".part", target)
+
+
+def list_backups(db_path, directory=None):
+    """Backups of `db_path`, newest first"""
+    directory = backup_directory(db_path, directory)
+    if not os.path.isdir(directory):
+        return []
+    stem = os.path.splitext(os.path.basename(db_path))[0]
+    backups = []
+    for name in os.listdir(directory):
+        match = _BACKUP_NAME.match(name)
+        if not match or match.group("stem") != stem:
+            continue
+        path = os.path.join(directory, name)
+        backups.append({
+            "name": name,
+            "path": path,
+            "kind": match.group("kind"),
+            "taken_at": datetime.datetime.strptime(match.group("taken"), "%Y%m%dT%H%M%S").isoformat(),
+            "size_bytes": os.path.getsize(path),
+        })
+    return sorted(backups, key=lambda backup: backup["taken_at"], reverse=True)
+
+
+def prune_backups(db_path, keep, directory=None):
+    """Delete all but the newest `keep` backups; returns the names removed"""
+    removed = []
+    for backup in list_backups(db_path, directory)[keep:]:
+        os.remove(backup["path"])
+        removed.append(backup["name"])
+    return removed
+
+
+def integrity_problems(path):
+    """Problems PRAGMA integrity_check reports for the database at `path` (empty when sound)"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = [row[0] for row in conn.execute("PRAGMA integrity_check").fetchall()]
+    except sqlite3.DatabaseError as e:
+        # Damage to the header or schema pages stops the check itself
+        rows = [str(e)]
+    finally:
+        conn.close()
+    return [] if rows == ["ok"] else rows
+
+
+def restore(path, db_path):
+    """
+    Replace the contents of `db_path` with the backup at `path`
+
+    The backup is checked with PRAGMA integrity_check first, then copied with
+    the backup API (which holds the database's write lock while it runs), and
+    the restored database is checked again. Archive partitions the restored
+    database needs are copied back from the backup directory. The backup's
+    table version epoch is replaced, which servers running on the database
+    notice on their next request in either mode (versions.py), so no ETag
+    or cached job result from before the restore is served afterwards. The
+    analytics cache is unregistered, so the next refresh rebuilds it from
+    the restored lines.
+
+    Raises:
+        ValueError: the backup or the restored database failed the check
+    """
+    problems = integrity_problems(path)
+    if problems:
+        raise ValueError(f"Backup failed the integrity check: {'; '.join(problems[:5])}")
+    source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    target = sqlite3.connect(db_path)
+    try:
+        source.backup(target)
+        versions.create_schema(target.cursor())
+        versions.rotate_epoch(target)
+        analytics.forget(target)
+        target.commit()
+        missing = [name for name in partition_files(target)
+                   if not os.path.exists(os.path.join(os.path.dirname(os.path.abspath(db_path)), name))]
+    finally:
+        source.close()
+        target.close()
+    for name in missing:
+        shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(path)), name),
+                        os.path.join(os.path.dirname(os.path.abspath(db_path)), name))
+    problems = integrity_problems(db_path)
+    if problems:
+        raise ValueError(f"Restored database failed the integrity check: {'; '.join(problems[:5])}")
+
+
+class BackupScheduler:
+    """Run a backup every `interval` seconds on a daemon thread, keeping the newest `keep`"""
+
+    def __init__(self, db_path, interval, kind="online", keep=7, directory=None):
+        self.db_path = db_path
+        self.interval = interval
+        self.kind = kind
+        self.keep = keep
+        self.directory = directory
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="backup-scheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                run_backup(self.db_path, self.kind, self.directory)
+                prune_backups(self.db_path, self.keep, self.directory)
+            except Exception as e:
+                # Recorded in status.history; the next interval tries again
+                print(f"Scheduled backup failed: {type(e).__name__}: {e}")
+
+
+def scheduler_from_environment(db_path):
+    """
+    BackupScheduler configured by FINANCE_BACKUP_INTERVAL (minutes),
+    FINANCE_BACKUP_KIND and FINANCE_BACKUP_KEEP, or None when no interval is set
+    """
+    interval = os.environ.get("FINANCE_BACKUP_INTERVAL")
+    if not interval:
+        return None
+    return BackupScheduler(db_path, float(interval) * 60, kind=os.environ.get("FINANCE_BACKUP_KIND", "online"),
+                           keep=int(os.environ.get("FINANCE_BACKUP_KEEP", "7")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=os.environ.get("FINANCE_DB", "finance.db"))
+    parser.add_argument("--dir", help=f"Backup directory (default: {BACKUP_DIR} next to the database)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backup_command = commands.add_parser("backup", help="Take a backup now")
+    backup_command.add_argument("--compact", action="store_true", help="VACUUM INTO instead of the backup API")
+    backup_command.add_argument("--keep", type=int, help="Then delete all but the newest KEEP backups")
+    commands.add_parser("list", help="List backups, newest first")
+    restore_command = commands.add_parser("restore", help="Restore a backup over the database")
+    restore_command.add_argument("backup")
+    args = parser.parse_args()
+
+    if args.command == "backup":
+        result = run_backup(args.db, "compact" if args.compact else "online", args.dir)
+        print(f"{result['path']}: {result['size_bytes']} bytes in {result['duration_seconds']}s")
+        if args.keep is not None:
+            for name in prune_backups(args.db, args.keep, args.dir):
+                print(f"removed {name}")
+    elif args.command == "list":
+        for backup in list_backups(args.db, args.dir):
+            print(f"{backup['taken_at']}  {backup['kind']:8} {backup['size_bytes']:>12}  {backup['name']}")
+    else:
+        try:
+            restore(args.backup, args.db)
+        except ValueError as e:
+            parser.exit(1, f"{e}\n")
+        print(f"restored {args.backup} into {args.db}")
+
+
+if __name__ == "__main__":
+    main()
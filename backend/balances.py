@@ -0,0 +1,329 @@
+"""
+As-of-date balances backed by month-end balance checkpoints.
+
+balance_checkpoints holds, per account and month end, the cumulative debit
+and credit of every line dated on or before that day. A row exists for each
+month an account had activity in, so an account's latest checkpoint on or
+before any date already covers all of its lines up to that date. An as-of
+balance is then that checkpoint plus the few lines dated after it.
+
+Triggers on transaction_lines delete every checkpoint at or after the date of
+a line that is inserted, changed or deleted, whoever writes it. Writes in the
+current month touch no checkpoint; a back-dated write drops the checkpoints it
+invalidated, and refresh_checkpoints() rebuilds them incrementally, from the
+last remaining checkpoint up to the end of the previous month.
+
+Reads never write: the remaining checkpoints plus the lines after them give
+the same balances, only with more lines to add up. When checkpoints_stale()
+says the previous month end is not covered, the API refreshes them in a
+background job, which takes the ledger's write lock like write requests do.
+
+Lines are read through archive.py, so ranges that reach into an archived
+year include its partition.
+"""
+import base64
+import datetime
+
+import archive
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS balance_checkpoints (
+        account_id INTEGER NOT NULL,
+        as_of DATE NOT NULL,
+        debit REAL NOT NULL,
+        credit REAL NOT NULL,
+        PRIMARY KEY (account_id, as_of)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_balance_checkpoints_as_of ON balance_checkpoints (as_of)",
+    # Delta lines of one account between a checkpoint and the requested date
+    "CREATE INDEX IF NOT EXISTS idx_transaction_lines_account_date ON transaction_lines (account_id, date)",
+    """
+    CREATE TRIGGER IF NOT EXISTS balance_checkpoints_line_insert
+    AFTER INSERT ON transaction_lines
+    WHEN NEW.date IS NOT NULL
+    BEGIN
+        DELETE FROM balance_checkpoints WHERE as_of >= date(NEW.date);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS balance_checkpoints_line_update
+    AFTER UPDATE OF account_id, debit, credit, date ON transaction_lines
+    WHEN COALESCE(OLD.date, NEW.date) IS NOT NULL
+    BEGIN
+        DELETE FROM balance_checkpoints
+        WHERE as_of >= MIN(COALESCE(date(OLD.date), date(NEW.date)), COALESCE(date(NEW.date), date(OLD.date)));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS balance_checkpoints_line_delete
+    AFTER DELETE ON transaction_lines
+    WHEN OLD.date IS NOT NULL
+    BEGIN
+        DELETE FROM balance_checkpoints WHERE as_of >= date(OLD.date);
+    END
+    """,
+]
+
+REGISTER_FIELDS = ("id", "transaction_id", "date", "description", "debit", "credit", "classification",
+                   "balance")
+TRIAL_BALANCE_FIELDS = ("account_id", "account_name", "category", "currency", "total_debit", "total_credit",
+                        "balance")
+
+
+def create_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+def parse_date(value):
+    """Parse a YYYY-MM-DD date, raising ValueError otherwise"""
+    return datetime.date.fromisoformat(value)
+
+
+def next_day(day):
+    """Exclusive upper bound for lines dated on `day` (dates may carry a time)"""
+    return (day + datetime.timedelta(days=1)).isoformat()
+
+
+def last_month_end(today=None):
+    today = today or datetime.date.today()
+    return today.replace(day=1) - datetime.timedelta(days=1)
+
+
+def refresh_checkpoints(conn, through=None):
+    """
+    Add the missing month-end checkpoints up to `through` (default: the end
+    of the previous month) and commit
+
+    Returns:
+        Number of checkpoint rows written
+    """
+    through = through or last_month_end()
+    cursor = conn.cursor()
+    cursor.execute("SELECT MAX(as_of) FROM balance_checkpoints")
+    latest = cursor.fetchone()[0]
+    if latest is not None and latest >= through.isoformat():
+        return 0
+    start = next_day(parse_date(latest)) if latest else ""
+    end = next_day(through)
+
+    # Monthly totals since the last checkpoint, accumulated on top of each
+    # account's latest checkpoint
+    cursor.execute(f"""
+        INSERT OR REPLACE INTO balance_checkpoints (account_id, as_of, debit, credit)
+        WITH monthly AS (
+            SELECT account_id,
+                   date(date, 'start of month', '+1 month', '-1 day') AS as_of,
+                   TOTAL(debit) AS debit,
+                   TOTAL(credit) AS credit
+            FROM {archive.lines_table(conn, start, end)}
+            WHERE date >= ? AND date < ? AND account_id IS NOT NULL
+            GROUP BY account_id, date(date, 'start of month', '+1 month', '-1 day')
+        ),
+        base AS (
+            SELECT cp.account_id, cp.debit, cp.credit
+            FROM balance_checkpoints cp
+            WHERE cp.as_of = (SELECT MAX(as_of) FROM balance_checkpoints WHERE account_id = cp.account_id)
+        )
+        SELECT m.account_id,
+               m.as_of,
+               COALESCE(b.debit, 0) + SUM(m.debit) OVER running,
+               COALESCE(b.credit, 0) + SUM(m.credit) OVER running
+        FROM monthly m
+        LEFT JOIN base b ON b.account_id = m.account_id
+        WINDOW running AS (PARTITION BY m.account_id ORDER BY m.as_of)
+    """, (start, end))
+    written = cursor.rowcount
+    conn.commit()
+    return written
+
+
+def checkpoints_stale(conn, through=None):
+    """Whether refresh_checkpoints() has checkpoints to add up to `through` (default: the previous month end)"""
+    through = through or last_month_end()
+    latest = conn.execute("SELECT MAX(as_of) FROM balance_checkpoints").fetchone()[0]
+    if latest is not None:
+        return latest < through.isoformat()
+    return (archive.archived_through(conn) is not None or conn.execute(
+        "SELECT 1 FROM transaction_lines WHERE date < ? LIMIT 1", (next_day(through),)).fetchone() is not None)
+
+
+def account_balance(conn, account_id, as_of):
+    """
+    Balance of one account at the end of `as_of`
+
+    Returns:
+        Dict with total_debit, total_credit, balance and the checkpoint used
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT as_of, debit, credit
+        FROM balance_checkpoints
+        WHERE account_id = ? AND as_of <= ?
+        ORDER BY as_of DESC
+        LIMIT 1
+    """, (account_id, as_of.isoformat()))
+    checkpoint = cursor.fetchone()
+    checkpoint_date, debit, credit = checkpoint if checkpoint else (None, 0.0, 0.0)
+
+    start = next_day(parse_date(checkpoint_date)) if checkpoint_date else ""
+    end = next_day(as_of)
+    cursor.execute(f"""
+        SELECT TOTAL(debit), TOTAL(credit), COUNT(*)
+        FROM {archive.lines_table(conn, start, end)}
+        WHERE account_id = ? AND date >= ? AND date < ?
+    """, (account_id, start, end))
+    delta_debit, delta_credit, delta_lines = cursor.fetchone()
+
+    debit += delta_debit
+    credit += delta_credit
+    return {
+        "account_id": account_id,
+        "as_of": as_of.isoformat(),
+        "total_debit": round(debit, 2),
+        "total_credit": round(credit, 2),
+        "balance": round(debit - credit, 2),
+        "checkpoint": checkpoint_date,
+        "delta_lines": delta_lines,
+    }
+
+
+def trial_balance(conn, as_of):
+    """
+    Balances of every account at the end of `as_of`
+
+    Returns:
+        (rows as TRIAL_BALANCE_FIELDS tuples, checkpoint date used or None)
+    """
+    cursor = conn.cursor()
+    # Every account's latest checkpoint on or before the newest checkpoint
+    # date covers all of its lines up to that date, so one range of lines
+    # after it completes the picture for all accounts
+    cursor.execute("SELECT MAX(as_of) FROM balance_checkpoints WHERE as_of <= ?", (as_of.isoformat(),))
+    checkpoint_date = cursor.fetchone()[0]
+    rows = trial_balance_rows(conn, """
+        SELECT cp.account_id, cp.debit, cp.credit
+        FROM balance_checkpoints cp
+        WHERE cp.as_of = (
+            SELECT MAX(as_of) FROM balance_checkpoints
+            WHERE account_id = cp.account_id AND as_of <= :base_date
+        )
+    """, checkpoint_date, as_of)
+    return rows, checkpoint_date
+
+
+def trial_balance_rows(conn, base_sql, base_date, as_of):
+    """
+    Trial balance rows from cumulative totals through `base_date` plus the
+    lines dated after it up to `as_of`
+
+    Args:
+        base_sql: SELECT of account_id, debit and credit cumulative through
+            the :base_date parameter
+        base_date: ISO date the base totals cover, or None for no base
+        as_of: datetime.date the balances are wanted for
+    """
+    bounds = {
+        "base_date": base_date or "",
+        "start": next_day(parse_date(base_date)) if base_date else "",
+        "end": next_day(as_of),
+    }
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        WITH base AS ({base_sql}),
+        delta AS (
+            SELECT account_id, TOTAL(debit) AS debit, TOTAL(credit) AS credit
+            FROM {archive.lines_table(conn, bounds["start"], bounds["end"])}
+            WHERE date >= :start AND date < :end
+            GROUP BY account_id
+        ),
+        totals AS (
+            SELECT account_id, TOTAL(debit) AS debit, TOTAL(credit) AS credit
+            FROM (SELECT * FROM base UNION ALL SELECT * FROM delta)
+            GROUP BY account_id
+        )
+        SELECT a.id, a.name, c.name, COALESCE(cu.name, 'USD'),
+               ROUND(t.debit, 2), ROUND(t.credit, 2), ROUND(t.debit - t.credit, 2)
+        FROM totals t
+        JOIN accounts a ON a.id = t.account_id
+        JOIN cat c ON a.cat_id = c.id
+        LEFT JOIN currency cu ON a.default_currency_id = cu.id
+        ORDER BY c.id, a.name
+    """, bounds)
+    return cursor.fetchall()
+
+
+def encode_cursor(date, line_id):
+    return base64.urlsafe_b64encode(f"{date}|{line_id}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(date, line id) from a register cursor, raising ValueError if it is malformed"""
+    try:
+        date, line_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return date, int(line_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def register(conn, account_id, limit, after=None, start=None):
+    """
+    One page of an account's lines in (date, id) order with a running balance
+
+    The opening balance of a page comes from account_balance() (a checkpoint
+    plus at most a month of lines) and the lines of that day up to the
+    cursor, and the page itself is a keyset range over (account_id, date),
+    whose index ends in the rowid, so every page costs the same however deep
+    it is.
+
+    Args:
+        limit: Lines per page
+        after: Cursor returned as next_cursor by the previous page
+        start: datetime.date to start the register at (first page only)
+
+    Returns:
+        (rows as REGISTER_FIELDS tuples, opening balance, next cursor or None)
+    """
+    cursor = conn.cursor()
+    if after:
+        after_date, after_id = decode_cursor(after)
+        day = parse_date(after_date[:10])
+        # Lines of the cursor's day up to and including the cursor line
+        cursor.execute(f"""
+            SELECT TOTAL(debit) - TOTAL(credit)
+            FROM {archive.lines_table(conn, day.isoformat(), next_day(day))}
+            WHERE account_id = ? AND date >= ? AND (date, id) <= (?, ?)
+        """, (account_id, day.isoformat(), after_date, after_id))
+        same_day = cursor.fetchone()[0]
+        opening = account_balance(conn, account_id, day - datetime.timedelta(days=1))["balance"] + same_day
+    elif start:
+        after_date, after_id = start.isoformat(), 0
+        opening = account_balance(conn, account_id, start - datetime.timedelta(days=1))["balance"]
+    else:
+        after_date, after_id = "", 0
+        opening = 0.0
+
+    lines, transactions = archive.tables(conn, after_date)
+    cursor.execute(f"""
+        SELECT page.id, page.transaction_id, page.date, t.description, page.debit, page.credit, c.name,
+               ROUND(? + SUM(COALESCE(page.debit, 0) - COALESCE(page.credit, 0))
+                   OVER (ORDER BY page.date, page.id ROWS UNBOUNDED PRECEDING), 2)
+        FROM (
+            SELECT id, transaction_id, date, debit, credit, classification_id
+            FROM {lines}
+            WHERE account_id = ? AND (date, id) > (?, ?)
+            ORDER BY date, id
+            LIMIT ?
+        ) page
+        LEFT JOIN {transactions} t ON t.id = page.transaction_id
+        LEFT JOIN classifications c ON c.id = page.classification_id
+        ORDER BY page.date, page.id
+    """, (opening, account_id, after_date, after_id, limit + 1))
+    rows = cursor.fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][2], rows[-1][0])
+    return rows, round(opening, 2), next_cursor
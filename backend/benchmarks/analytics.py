@@ -0,0 +1,132 @@
+"""
+Analytics benchmark: NumPy columns against the equivalent SQL.
+
+Builds the analytics cache (analytics.py) of a generated ledger in a scratch
+directory, then times each report both ways: group-by totals, a one-account
+monthly trend, top-N transactions and amount percentiles. Every pair is
+checked to return the same numbers before it is timed.
+
+Usage (from the backend directory):
+    python -m benchmarks.analytics [--size 100k] [--repeat 10]
+"""
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.ledger import SIZES, ensure_ledger
+from benchmarks.run import load_app
+from benchmarks.serialization import best_of
+
+# Signed line amount in minor units, as the cache stores it
+AMOUNT = "CAST(ROUND((COALESCE(debit, 0) - COALESCE(credit, 0)) * 100) AS INTEGER)"
+QUANTILES = [50, 90, 99]
+
+
+def sql_totals(conn, lines, key, where="", params=()):
+    rows = conn.execute(f"""
+        SELECT {key}, SUM(MAX({AMOUNT}, 0)), SUM(MAX(-{AMOUNT}, 0)), COUNT(*)
+        FROM {lines}
+        {where}
+        GROUP BY 1
+        ORDER BY 1
+    """, params).fetchall()
+    return [tuple(row) for row in rows]
+
+
+def numpy_totals(analytics, columns, by, mask=None, label=None):
+    keys, debit, credit, lines = analytics.group_totals(columns, by, mask)
+    keys = [label(key) for key in keys.tolist()] if label else keys.tolist()
+    return list(zip(keys, debit.tolist(), credit.tolist(), lines.tolist()))
+
+
+def sql_percentiles(conn, lines):
+    """Linear-interpolated percentiles of the debits: count, then two neighbours per quantile"""
+    count = conn.execute(f"SELECT COUNT(*) FROM {lines} WHERE {AMOUNT} > 0").fetchone()[0]
+    values = []
+    for quantile in QUANTILES:
+        position = quantile / 100 * (count - 1)
+        low = int(position)
+        pair = [row[0] for row in conn.execute(f"""
+            SELECT {AMOUNT} AS amount FROM {lines} WHERE {AMOUNT} > 0 ORDER BY amount LIMIT 2 OFFSET ?
+        """, (low,))]
+        upper = pair[1] if len(pair) > 1 else pair[0]
+        values.append(pair[0] + (upper - pair[0]) * (position - low))
+    return values
+
+
+def same(expected, actual):
+    """Equal rows, or equal numbers up to float rounding for the percentiles"""
+    if expected and isinstance(expected[0], tuple):
+        return expected == actual
+    return np.allclose(expected, actual)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=SIZES, default="100k")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    api = load_app(ensure_ledger(args.size))
+    analytics, archive = api.analytics, api.archive
+    conn = api.get_db_connection()
+    lines = archive.lines_table(conn)
+    account_id = conn.execute(
+        "SELECT account_id FROM transaction_lines GROUP BY account_id ORDER BY COUNT(*) DESC LIMIT 1").fetchone()[0]
+
+    directory = tempfile.mkdtemp(prefix="analytics-")
+    try:
+        cache = analytics.ColumnCache(directory)
+        start = time.perf_counter()
+        columns = cache.refresh(conn)
+        build = (time.perf_counter() - start) * 1000
+        refresh = best_of(args.repeat, lambda: cache.refresh(conn))
+        print(f"{args.size} ledger, {len(columns)} lines, best of {args.repeat} (ms)")
+        print(f"cache build {build:.1f}, refresh with nothing new {refresh:.2f}")
+
+        def month(key):
+            return analytics.period_label("month", key)
+
+        reports = {
+            "totals by account": (
+                lambda: sql_totals(conn, lines, "COALESCE(account_id, -1)"),
+                lambda: numpy_totals(analytics, columns, "account", columns.live)),
+            "totals by month": (
+                lambda: sql_totals(conn, lines, "strftime('%Y-%m', date)"),
+                lambda: numpy_totals(analytics, columns, "month", columns.live, month)),
+            "one account by month": (
+                lambda: sql_totals(conn, lines, "strftime('%Y-%m', date)", "WHERE account_id = ?", (account_id,)),
+                lambda: numpy_totals(analytics, columns, "month", columns.select(account_ids=[account_id]), month)),
+            "top 20 transactions": (
+                lambda: [tuple(row) for row in conn.execute(f"""
+                    SELECT transaction_id, SUM(MAX({AMOUNT}, 0)) AS debit, SUM(MAX(-{AMOUNT}, 0)), COUNT(*)
+                    FROM {lines}
+                    GROUP BY transaction_id
+                    ORDER BY debit DESC, transaction_id
+                    LIMIT 20
+                """)],
+                lambda: list(zip(*(values.tolist() for values in analytics.top(columns, "transaction", 20,
+                                                                               mask=columns.live))))),
+            "debit percentiles": (
+                lambda: sql_percentiles(conn, lines),
+                lambda: analytics.percentiles(columns, QUANTILES, columns.live, "debit")[0]),
+        }
+
+        print(f"{'report':<24}{'sql':>10}{'numpy':>10}{'speedup':>10}")
+        for name, (sql, vectorized) in reports.items():
+            expected, actual = sql(), vectorized()
+            if not same(expected, actual):
+                raise SystemExit(f"{name}: results differ")
+            sql_ms = best_of(args.repeat, sql)
+            numpy_ms = best_of(args.repeat, vectorized)
+            print(f"{name:<24}{sql_ms:>10.2f}{numpy_ms:>10.2f}{sql_ms / numpy_ms:>9.1f}x")
+    finally:
+        conn.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
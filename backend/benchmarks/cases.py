@@ -0,0 +1,920 @@
+"""
+Benchmark cases for every API route and every public Database method.
+
+A case is a function that receives the shared Fixture, does any setup it
+needs (untimed) and returns what to time:
+
+- route cases return a dict with "url" and optionally "params" / "json"
+- Database cases return an (args, kwargs) tuple
+
+Routes and methods without a registered case are reported by the runner, so
+new endpoints show up as uncovered until a case is added here.
+"""
+import time
+
+ROUTE_CASES = {}
+DATABASE_CASES = {}
+
+
+def route_case(method, path, variant=None):
+    """Register a case for the route `method path` (optionally a named variant)"""
+    def register(func):
+        ROUTE_CASES[(method, path, variant)] = func
+        return func
+    return register
+
+
+def database_case(name):
+    """Register a case for the Database method `name`"""
+    def register(func):
+        DATABASE_CASES[name] = func
+        return func
+    return register
+
+
+class Fixture:
+    """Sample ids from the generated ledger plus helpers for throwaway rows"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        cursor = conn.cursor()
+        self.busy_account_id = cursor.execute("""
+            SELECT account_id FROM transaction_lines GROUP BY account_id ORDER BY COUNT(*) DESC LIMIT 1
+        """).fetchone()[0]
+        self.transaction_id = cursor.execute("SELECT MAX(id) / 2 FROM transactions").fetchone()[0]
+        self.line_id = cursor.execute(
+            "SELECT MIN(id) FROM transaction_lines WHERE transaction_id = ?", (self.transaction_id,)).fetchone()[0]
+        self.credit_card_account_id = cursor.execute("SELECT MIN(account_id) FROM ccards").fetchone()[0]
+        self.credit_card_id = cursor.execute("SELECT MIN(id) FROM ccards").fetchone()[0]
+        self.classification_id, self.classification_name = cursor.execute(
+            "SELECT id, name FROM classifications ORDER BY id LIMIT 1").fetchone()
+        self.category_id, self.category_name = cursor.execute(
+            "SELECT id, name FROM cat ORDER BY id LIMIT 1").fetchone()
+        self.currency_id, self.currency_name = cursor.execute(
+            "SELECT id, name FROM currency ORDER BY id LIMIT 1").fetchone()
+        self.account_name = cursor.execute(
+            "SELECT name FROM accounts WHERE id = ?", (self.busy_account_id,)).fetchone()[0]
+        self.description = cursor.execute(
+            "SELECT description FROM transactions WHERE id = ?", (self.transaction_id,)).fetchone()[0]
+        self.orphan_transaction_id = cursor.execute("SELECT MIN(id) FROM orphan_transactions").fetchone()[0]
+        self.date = cursor.execute(
+            "SELECT date FROM transaction_lines WHERE id = ?", (self.line_id,)).fetchone()[0]
+        # End of the ledger's first month, the cheapest period to close
+        self.first_period_end = cursor.execute(
+            "SELECT date(MIN(date), 'start of month', '+1 month', '-1 day') FROM transaction_lines").fetchone()[0]
+        self.counter = 0
+
+    def unique(self, prefix):
+        self.counter += 1
+        return f"{prefix} {self.counter}"
+
+    def lines(self, amount=125.5):
+        return [
+            {"account_id": self.busy_account_id, "debit": amount, "date": self.date,
+             "classification_id": self.classification_id},
+            {"account_id": self.credit_card_account_id, "credit": amount, "date": self.date},
+        ]
+
+    def scratch_transaction(self):
+        """Insert a committed two-line transaction and return its id"""
+        cursor = self.conn.cursor()
+        cursor.execute("INSERT INTO transactions (description, currency_id) VALUES (?, ?)",
+                       (self.unique("Scratch"), self.currency_id))
+        transaction_id = cursor.lastrowid
+        for line in self.lines():
+            cursor.execute("""
+                INSERT INTO transaction_lines (transaction_id, account_id, debit, credit, date, classification_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (transaction_id, line["account_id"], line.get("debit"), line.get("credit"), line["date"],
+                  line.get("classification_id")))
+        self.conn.commit()
+        return transaction_id
+
+    def scratch_line(self):
+        """First line of a fresh scratch transaction"""
+        transaction_id = self.scratch_transaction()
+        return self.conn.execute(
+            "SELECT MIN(id) FROM transaction_lines WHERE transaction_id = ?", (transaction_id,)).fetchone()[0]
+
+    def scratch_row(self, sql, params):
+        cursor = self.conn.execute(sql, params)
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def scratch_account(self, credit_card=False):
+        account_id = self.scratch_row("INSERT INTO accounts (name, cat_id, default_currency_id) VALUES (?, ?, ?)",
+                                      (self.unique("Scratch account"), self.category_id, self.currency_id))
+        if credit_card:
+            self.scratch_row("INSERT INTO ccards (account_id, credit_limit, close_day, due_day) VALUES (?, 1000, 1, 5)",
+                             (account_id,))
+        return account_id
+
+    def scratch_category(self):
+        return self.scratch_row("INSERT INTO cat (name) VALUES (?)", (self.unique("Scratch category"),))
+
+    def scratch_currency(self):
+        return self.scratch_row("INSERT INTO currency (name, exchange_rate) VALUES (?, 1.5)",
+                                (self.unique("SCR"),))
+
+    def scratch_classification(self):
+        return self.scratch_row("INSERT INTO classifications (name) VALUES (?)",
+                                (self.unique("Scratch classification"),))
+
+    def scratch_rule(self):
+        return self.scratch_row("""
+            INSERT INTO classification_rules (name, keyword, min_amount, classification_id) VALUES (?, ?, 10, ?)
+        """, (self.unique("Scratch rule"), self.description.split()[0], self.classification_id))
+
+    def scratch_budget(self, classification_id=None):
+        return self.scratch_row("INSERT INTO budgets (period, classification_id, amount) VALUES (?, ?, 500)",
+                                (self.date[:7], classification_id or self.scratch_classification()))
+
+    def scratch_orphan_line(self):
+        orphan_transaction_id = self.scratch_row(
+            "INSERT INTO orphan_transactions (reference, import_date, status) VALUES (?, '2025-01-01', 'new')",
+            (self.unique("scratch.csv"),))
+        return self.scratch_row("""
+            INSERT INTO orphan_transaction_lines (orphan_transaction_id, description, account_id, debit, status)
+            VALUES (?, 'Scratch POS', ?, 42.0, 'new')
+        """, (orphan_transaction_id, self.busy_account_id))
+
+    def open_periods(self):
+        """Reopen every closed period so write cases keep working"""
+        import periods
+        periods.reopen_periods(self.conn, "")
+
+    def close_first_period(self):
+        import balances
+        import periods
+        self.open_periods()
+        periods.close_periods(self.conn, balances.parse_date(self.first_period_end))
+
+    def job(self, wait=True):
+        """Id of a monthly-trends job, finished unless `wait` is False (then a fresh, uncached one)"""
+        import jobs
+        import main
+        params = {"months": 12} if wait else {"months": 1000 + self.counter}
+        self.counter += 1
+        job, _ = main.job_queue.submit("monthly-trends", params)
+        while wait and main.job_queue.get(job["id"])["status"] not in jobs.FINISHED:
+            time.sleep(0.01)
+        return job["id"]
+
+    def account_payload(self, credit_card=False):
+        payload = {"name": self.unique("Bench account"), "category_id": self.category_id,
+                   "currency_id": self.currency_id, "nature": "both", "term": "undefined",
+                   "is_credit_card": credit_card}
+        if credit_card:
+            payload.update({"credit_limit": 5000, "close_day": 20, "due_day": 5})
+        return payload
+
+
+# --- Routes ---------------------------------------------------------------
+
+@route_case("GET", "/")
+def _(fx):
+    return {"url": "/"}
+
+
+@route_case("GET", "/api/metrics")
+def _(fx):
+    return {"url": "/api/metrics"}
+
+
+@route_case("GET", "/api/backups")
+def _(fx):
+    return {"url": "/api/backups"}
+
+
+@route_case("POST", "/api/backups")
+def _(fx):
+    import backup
+
+    # Measure starting a backup, not the 409 of finding the last one still running
+    while backup.status.snapshot()["running"]:
+        time.sleep(0.01)
+    return {"url": "/api/backups", "json": {"kind": "online"}}
+
+
+@route_case("POST", "/api/jobs")
+def _(fx):
+    # An identical finished job exists after the first run, so this times the cache hit
+    return {"url": "/api/jobs", "json": {"kind": "monthly-trends", "params": {"months": 12}}}
+
+
+@route_case("GET", "/api/jobs")
+def _(fx):
+    return {"url": "/api/jobs"}
+
+
+@route_case("GET", "/api/jobs/{job_id}")
+def _(fx):
+    return {"url": f"/api/jobs/{fx.job()}"}
+
+
+@route_case("GET", "/api/jobs/{job_id}/result")
+def _(fx):
+    return {"url": f"/api/jobs/{fx.job()}/result"}
+
+
+@route_case("DELETE", "/api/jobs/{job_id}")
+def _(fx):
+    return {"url": f"/api/jobs/{fx.job(wait=False)}"}
+
+
+@route_case("GET", "/api/transactions")
+def _(fx):
+    return {"url": "/api/transactions", "params": {"skip": 0, "limit": 100}}
+
+
+@route_case("GET", "/api/transactions", variant="deep page")
+def _(fx):
+    return {"url": "/api/transactions", "params": {"skip": fx.transaction_id, "limit": 100}}
+
+
+@route_case("GET", "/api/transactions", variant="columnar 1000")
+def _(fx):
+    return {"url": "/api/transactions", "params": {"skip": 0, "limit": 1000, "format": "columnar"}}
+
+
+@route_case("GET", "/api/transactions/{transaction_id}/lines")
+def _(fx):
+    return {"url": f"/api/transactions/{fx.transaction_id}/lines"}
+
+
+@route_case("POST", "/api/transactions")
+def _(fx):
+    return {"url": "/api/transactions",
+            "json": {"description": fx.unique("Bench"), "currency_id": fx.currency_id, "lines": fx.lines()}}
+
+
+@route_case("PUT", "/api/transactions/{transaction_id}")
+def _(fx):
+    transaction_id = fx.scratch_transaction()
+    return {"url": f"/api/transactions/{transaction_id}",
+            "json": {"description": fx.unique("Bench"), "currency_id": fx.currency_id, "lines": fx.lines(99.0)}}
+
+
+@route_case("PATCH", "/api/transactions/{transaction_id}")
+def _(fx):
+    transaction_id = fx.scratch_transaction()
+    debit_line, credit_line = fx.conn.execute(
+        "SELECT id FROM transaction_lines WHERE transaction_id = ? ORDER BY id", (transaction_id,)).fetchall()
+    return {"url": f"/api/transactions/{transaction_id}",
+            "json": {"lines": [{"id": debit_line[0], "debit": 99.0}, {"id": credit_line[0], "credit": 99.0}]}}
+
+
+@route_case("DELETE", "/api/transactions/{transaction_id}")
+def _(fx):
+    return {"url": f"/api/transactions/{fx.scratch_transaction()}"}
+
+
+@route_case("POST", "/api/transaction-lines/reclassify")
+def _(fx):
+    return {"url": "/api/transaction-lines/reclassify",
+            "json": {"filter": {"account_id": fx.busy_account_id, "date_from": fx.date[:7] + "-01"},
+                     "classification_id": fx.classification_id}}
+
+
+@route_case("POST", "/api/transaction-lines/reclassify", variant="dry run")
+def _(fx):
+    return {"url": "/api/transaction-lines/reclassify",
+            "json": {"filter": {"account_id": fx.busy_account_id, "min_amount": 100},
+                     "classification_id": None, "dry_run": True}}
+
+
+@route_case("POST", "/api/transactions/bulk-delete")
+def _(fx):
+    fx.scratch_transaction()
+    description = fx.conn.execute("SELECT description FROM transactions ORDER BY id DESC LIMIT 1").fetchone()[0]
+    return {"url": "/api/transactions/bulk-delete", "json": {"filter": {"description": description}}}
+
+
+@route_case("POST", "/api/transactions/bulk-delete", variant="dry run")
+def _(fx):
+    return {"url": "/api/transactions/bulk-delete",
+            "json": {"filter": {"description": fx.description, "max_amount": 500}, "dry_run": True}}
+
+
+@route_case("GET", "/api/accounts")
+def _(fx):
+    return {"url": "/api/accounts"}
+
+
+@route_case("GET", "/api/accounts/detailed")
+def _(fx):
+    return {"url": "/api/accounts/detailed"}
+
+
+@route_case("GET", "/api/bootstrap")
+def _(fx):
+    return {"url": "/api/bootstrap"}
+
+
+@route_case("GET", "/api/bootstrap", variant="accounts changed")
+def _(fx):
+    import main
+    versions = ",".join(f"{name}:{main.table_versions.tag(tables)}"
+                        for name, (tables, _) in main.BOOTSTRAP_SECTIONS.items() if name != "accounts")
+    return {"url": "/api/bootstrap", "params": {"versions": versions}}
+
+
+@route_case("POST", "/api/accounts")
+def _(fx):
+    return {"url": "/api/accounts", "json": fx.account_payload(credit_card=True)}
+
+
+@route_case("PUT", "/api/accounts/{account_id}")
+def _(fx):
+    account_id = fx.scratch_account(credit_card=True)
+    return {"url": f"/api/accounts/{account_id}", "json": fx.account_payload(credit_card=True)}
+
+
+@route_case("DELETE", "/api/accounts/{account_id}")
+def _(fx):
+    return {"url": f"/api/accounts/{fx.scratch_account(credit_card=True)}"}
+
+
+@route_case("GET", "/api/currencies")
+def _(fx):
+    return {"url": "/api/currencies"}
+
+
+@route_case("GET", "/api/currencies/detailed")
+def _(fx):
+    return {"url": "/api/currencies/detailed"}
+
+
+@route_case("POST", "/api/currencies")
+def _(fx):
+    return {"url": "/api/currencies", "json": {"name": fx.unique("BEN"), "exchange_rate": 2.5}}
+
+
+@route_case("PUT", "/api/currencies/{currency_id}")
+def _(fx):
+    return {"url": f"/api/currencies/{fx.scratch_currency()}",
+            "json": {"name": fx.unique("BEN"), "exchange_rate": 3.5}}
+
+
+@route_case("DELETE", "/api/currencies/{currency_id}")
+def _(fx):
+    return {"url": f"/api/currencies/{fx.scratch_currency()}"}
+
+
+@route_case("GET", "/api/categories")
+def _(fx):
+    return {"url": "/api/categories"}
+
+
+@route_case("POST", "/api/categories")
+def _(fx):
+    return {"url": "/api/categories", "json": {"name": fx.unique("Bench category")}}
+
+
+@route_case("PUT", "/api/categories/{category_id}")
+def _(fx):
+    return {"url": f"/api/categories/{fx.scratch_category()}", "json": {"name": fx.unique("Bench category")}}
+
+
+@route_case("DELETE", "/api/categories/{category_id}")
+def _(fx):
+    return {"url": f"/api/categories/{fx.scratch_category()}"}
+
+
+@route_case("GET", "/api/classifications")
+def _(fx):
+    return {"url": "/api/classifications"}
+
+
+@route_case("GET", "/api/classifications/detailed")
+def _(fx):
+    return {"url": "/api/classifications/detailed"}
+
+
+@route_case("POST", "/api/classifications")
+def _(fx):
+    return {"url": "/api/classifications", "json": {"name": fx.unique("Bench classification")}}
+
+
+@route_case("PUT", "/api/classifications/{classification_id}")
+def _(fx):
+    return {"url": f"/api/classifications/{fx.scratch_classification()}",
+            "json": {"name": fx.unique("Bench classification")}}
+
+
+@route_case("DELETE", "/api/classifications/{classification_id}")
+def _(fx):
+    return {"url": f"/api/classifications/{fx.scratch_classification()}"}
+
+
+@route_case("GET", "/api/classification-rules")
+def _(fx):
+    return {"url": "/api/classification-rules"}
+
+
+@route_case("POST", "/api/classification-rules")
+def _(fx):
+    return {"url": "/api/classification-rules",
+            "json": {"name": fx.unique("Bench rule"), "pattern": r"\bbench\s*\d+",
+                     "classification_id": fx.classification_id}}
+
+
+@route_case("PUT", "/api/classification-rules/{rule_id}")
+def _(fx):
+    return {"url": f"/api/classification-rules/{fx.scratch_rule()}",
+            "json": {"keyword": "bench", "max_amount": 100, "classification_id": fx.classification_id}}
+
+
+@route_case("DELETE", "/api/classification-rules/{rule_id}")
+def _(fx):
+    return {"url": f"/api/classification-rules/{fx.scratch_rule()}"}
+
+
+@route_case("POST", "/api/classification-rules/test")
+def _(fx):
+    fx.scratch_rule()
+    return {"url": "/api/classification-rules/test",
+            "json": {"description": fx.description, "account_id": fx.busy_account_id, "amount": 50}}
+
+
+@route_case("POST", "/api/classification-rules/apply")
+def _(fx):
+    fx.scratch_rule()
+    return {"url": "/api/classification-rules/apply",
+            "json": {"filter": {"account_id": fx.busy_account_id}, "overwrite": True}}
+
+
+@route_case("POST", "/api/classification-rules/apply", variant="dry run")
+def _(fx):
+    fx.scratch_rule()
+    return {"url": "/api/classification-rules/apply", "json": {"dry_run": True}}
+
+
+@route_case("GET", "/api/accounts/{account_id}/classifications")
+def _(fx):
+    return {"url": f"/api/accounts/{fx.busy_account_id}/classifications"}
+
+
+@route_case("GET", "/api/accounts/{account_id}/balance")
+def _(fx):
+    return {"url": f"/api/accounts/{fx.busy_account_id}/balance", "params": {"as_of": fx.date}}
+
+
+@route_case("GET", "/api/accounts/{account_id}/register")
+def _(fx):
+    return {"url": f"/api/accounts/{fx.busy_account_id}/register", "params": {"limit": 100}}
+
+
+@route_case("GET", "/api/accounts/{account_id}/register", variant="deep page")
+def _(fx):
+    import balances
+    line_id, date = fx.conn.execute("""
+        SELECT id, date FROM transaction_lines WHERE account_id = ? ORDER BY date DESC, id DESC LIMIT 1 OFFSET 200
+    """, (fx.busy_account_id,)).fetchone()
+    return {"url": f"/api/accounts/{fx.busy_account_id}/register",
+            "params": {"limit": 100, "cursor": balances.encode_cursor(date, line_id)}}
+
+
+@route_case("GET", "/api/reports/trial-balance")
+def _(fx):
+    return {"url": "/api/reports/trial-balance", "params": {"as_of": fx.date}}
+
+
+
+@route_case("GET", "/api/reports/classifications")
+def _(fx):
+    return {"url": "/api/reports/classifications", "params": {"granularity": "quarter"}}
+
+
+@route_case("GET", "/api/reports/classifications", variant="partial months drill-down")
+def _(fx):
+    return {"url": "/api/reports/classifications",
+            "params": {"from": "2019-01-15", "to": fx.date, "classification_id": fx.classification_id}}
+
+
+@route_case("GET", "/api/periods")
+def _(fx):
+    return {"url": "/api/periods"}
+
+
+@route_case("POST", "/api/periods/close")
+def _(fx):
+    fx.open_periods()
+    return {"url": "/api/periods/close", "json": {"through": fx.first_period_end}}
+
+
+@route_case("DELETE", "/api/periods/{period_end}")
+def _(fx):
+    fx.close_first_period()
+    return {"url": f"/api/periods/{fx.first_period_end}"}
+
+
+@route_case("POST", "/api/accounts/{account_id}/classifications/{classification_id}")
+def _(fx):
+    return {"url": f"/api/accounts/{fx.busy_account_id}/classifications/{fx.scratch_classification()}"}
+
+
+@route_case("DELETE", "/api/accounts/{account_id}/classifications/{classification_id}")
+def _(fx):
+    classification_id = fx.scratch_classification()
+    fx.scratch_row("INSERT INTO account_classifications (account_id, classification_id) VALUES (?, ?)",
+                   (fx.busy_account_id, classification_id))
+    return {"url": f"/api/accounts/{fx.busy_account_id}/classifications/{classification_id}"}
+
+
+@route_case("GET", "/api/dashboard")
+def _(fx):
+    return {"url": "/api/dashboard"}
+
+
+@route_case("GET", "/api/account-balances")
+def _(fx):
+    return {"url": "/api/account-balances"}
+
+
+@route_case("GET", "/api/credit-card-dues")
+def _(fx):
+    return {"url": "/api/credit-card-dues"}
+
+
+@route_case("GET", "/api/dashboard/monthly-trends")
+def _(fx):
+    return {"url": "/api/dashboard/monthly-trends", "params": {"months": 120}}
+
+
+@route_case("GET", "/api/dashboard/yearly-trends")
+def _(fx):
+    return {"url": "/api/dashboard/yearly-trends", "params": {"years": 10}}
+
+
+@route_case("GET", "/api/dashboard/monthly-liabilities")
+def _(fx):
+    return {"url": "/api/dashboard/monthly-liabilities"}
+
+
+@route_case("GET", "/api/analytics/totals")
+def _(fx):
+    return {"url": "/api/analytics/totals", "params": {"group_by": "account"}}
+
+
+@route_case("GET", "/api/analytics/totals", variant="one account by month")
+def _(fx):
+    return {"url": "/api/analytics/totals", "params": {"group_by": "month", "account_id": fx.busy_account_id}}
+
+
+@route_case("GET", "/api/analytics/trend")
+def _(fx):
+    return {"url": "/api/analytics/trend", "params": {"granularity": "day"}}
+
+
+@route_case("GET", "/api/analytics/top")
+def _(fx):
+    return {"url": "/api/analytics/top", "params": {"by": "transaction", "n": 20}}
+
+
+@route_case("GET", "/api/analytics/percentiles")
+def _(fx):
+    return {"url": "/api/analytics/percentiles", "params": {"q": "50,90,99", "side": "debit"}}
+
+
+@route_case("GET", "/api/recurring")
+def _(fx):
+    return {"url": "/api/recurring"}
+
+
+@route_case("POST", "/api/recurring/detect")
+def _(fx):
+    # Catching up with one new transaction
+    fx.scratch_transaction()
+    return {"url": "/api/recurring/detect", "json": {}}
+
+
+@route_case("POST", "/api/recurring/detect", variant="full")
+def _(fx):
+    return {"url": "/api/recurring/detect", "json": {"full": True}}
+
+
+@route_case("GET", "/api/forecast")
+def _(fx):
+    return {"url": "/api/forecast", "params": {"days": 180, "as_of": fx.date}}
+
+
+
+@route_case("GET", "/api/budgets")
+def _(fx):
+    return {"url": "/api/budgets", "params": {"period": fx.date[:7]}}
+
+
+@route_case("POST", "/api/budgets")
+def _(fx):
+    return {"url": "/api/budgets",
+            "json": {"period": fx.date[:7], "classification_id": fx.scratch_classification(), "amount": 500}}
+
+
+@route_case("PUT", "/api/budgets/{budget_id}")
+def _(fx):
+    classification_id = fx.scratch_classification()
+    return {"url": f"/api/budgets/{fx.scratch_budget(classification_id)}",
+            "json": {"period": fx.date[:7], "classification_id": classification_id, "amount": 750}}
+
+
+@route_case("DELETE", "/api/budgets/{budget_id}")
+def _(fx):
+    return {"url": f"/api/budgets/{fx.scratch_budget()}"}
+
+
+@route_case("GET", "/api/budgets/{period}/status")
+def _(fx):
+    fx.scratch_budget()
+    return {"url": f"/api/budgets/{fx.date[:7]}/status"}
+
+
+# --- Database methods -----------------------------------------------------
+
+def no_args(*names):
+    for name in names:
+        database_case(name)(lambda fx: ((), {}))
+
+
+no_args("get_transactions", "get_categories", "get_currencies", "get_accounts", "get_all_classifications",
+        "get_all_categories", "get_all_currencies", "get_all_accounts", "get_all_credit_cards",
+        "get_orphan_transactions", "get_accounts_by_nature", "create_tables", "reference_data")
+
+
+@database_case("get_transaction_count")
+def _(fx):
+    return ((), {})
+
+
+@database_case("get_orphan_lines")
+def _(fx):
+    return ((), {"orphan_transaction_id": fx.orphan_transaction_id})
+
+
+def by_transaction(*names):
+    for name in names:
+        database_case(name)(lambda fx: ((fx.transaction_id,), {}))
+
+
+by_transaction("get_transaction_lines", "get_transaction_by_id", "get_transaction_lines_by_type")
+
+
+def by_account(*names):
+    for name in names:
+        database_case(name)(lambda fx: ((fx.busy_account_id,), {}))
+
+
+by_account("get_account_by_id", "get_account_details", "account_has_transactions", "get_classifications_for_account",
+           "get_credit_card_by_account_id", "get_credit_card_details", "is_credit_card")
+
+
+@database_case("get_category_id")
+def _(fx):
+    return ((fx.category_name,), {})
+
+
+@database_case("get_category_by_id")
+def _(fx):
+    return ((fx.category_id,), {})
+
+
+@database_case("get_category_by_name")
+def _(fx):
+    return ((fx.category_name,), {})
+
+
+@database_case("get_currency_id")
+def _(fx):
+    return ((fx.currency_name,), {})
+
+
+@database_case("get_currency_by_id")
+def _(fx):
+    return ((fx.currency_id,), {})
+
+
+@database_case("get_account_id")
+def _(fx):
+    return ((fx.account_name,), {})
+
+
+@database_case("get_classification_by_id")
+def _(fx):
+    return ((fx.classification_id,), {})
+
+
+@database_case("get_classification_by_name")
+def _(fx):
+    return ((fx.classification_name,), {})
+
+
+@database_case("get_credit_card_by_id")
+def _(fx):
+    return ((fx.credit_card_id,), {})
+
+
+@database_case("get_credit_card_statement")
+def _(fx):
+    year, month = fx.date[:4], fx.date[5:7]
+    return ((fx.busy_account_id, int(month), int(year)), {})
+
+
+@database_case("get_transaction_line")
+def _(fx):
+    return ((fx.line_id,), {})
+
+
+@database_case("get_orphan_line_by_id")
+def _(fx):
+    return ((fx.scratch_orphan_line(),), {})
+
+
+@database_case("get_account_suggestions_for_description")
+def _(fx):
+    return ((fx.description,), {})
+
+
+@database_case("execute_query")
+def _(fx):
+    return (("SELECT COUNT(*) FROM transaction_lines WHERE account_id = ?", (fx.busy_account_id,)), {})
+
+
+@database_case("insert_category")
+def _(fx):
+    return ((fx.unique("Bench category"),), {})
+
+
+@database_case("update_category")
+def _(fx):
+    return ((fx.scratch_category(), fx.unique("Bench category")), {})
+
+
+@database_case("delete_category")
+def _(fx):
+    return ((fx.scratch_category(),), {})
+
+
+@database_case("insert_currency")
+def _(fx):
+    return ((fx.unique("BEN"), 1.25), {})
+
+
+@database_case("update_currency")
+def _(fx):
+    return ((fx.scratch_currency(), fx.unique("BEN"), 1.75), {})
+
+
+@database_case("delete_currency")
+def _(fx):
+    return ((fx.scratch_currency(),), {})
+
+
+@database_case("insert_account")
+def _(fx):
+    return ((fx.unique("Bench account"), fx.category_id, fx.currency_id), {})
+
+
+@database_case("update_account")
+def _(fx):
+    return ((fx.scratch_account(), fx.unique("Bench account"), fx.category_id, fx.currency_id), {})
+
+
+@database_case("delete_account")
+def _(fx):
+    return ((fx.scratch_account(),), {})
+
+
+@database_case("insert_credit_card")
+def _(fx):
+    return ((fx.scratch_account(), 5000, 20, 5), {})
+
+
+@database_case("update_credit_card")
+def _(fx):
+    return ((fx.scratch_account(credit_card=True), 7500, 21, 6), {})
+
+
+@database_case("delete_credit_card")
+def _(fx):
+    return ((fx.scratch_account(credit_card=True),), {})
+
+
+@database_case("insert_classification")
+def _(fx):
+    return ((fx.unique("Bench classification"),), {})
+
+
+@database_case("update_classification")
+def _(fx):
+    return ((fx.scratch_classification(), fx.unique("Bench classification")), {})
+
+
+@database_case("delete_classification")
+def _(fx):
+    return ((fx.scratch_classification(),), {})
+
+
+@database_case("link_account_classification")
+def _(fx):
+    return ((fx.busy_account_id, fx.scratch_classification()), {})
+
+
+@database_case("unlink_account_classification")
+def _(fx):
+    classification_id = fx.scratch_classification()
+    fx.scratch_row("INSERT INTO account_classifications (account_id, classification_id) VALUES (?, ?)",
+                   (fx.busy_account_id, classification_id))
+    return ((fx.busy_account_id, classification_id), {})
+
+
+@database_case("update_transaction_line_classification")
+def _(fx):
+    return ((fx.line_id, fx.classification_id), {})
+
+
+@database_case("reclassify_transaction_lines")
+def _(fx):
+    return (({"account_id": fx.busy_account_id, "date_from": fx.date[:7] + "-01"}, fx.classification_id), {})
+
+
+@database_case("delete_transactions_matching")
+def _(fx):
+    fx.scratch_transaction()
+    description = fx.conn.execute("SELECT description FROM transactions ORDER BY id DESC LIMIT 1").fetchone()[0]
+    return (({"description": description},), {})
+
+
+@database_case("insert_transaction")
+def _(fx):
+    return ((fx.unique("Bench"), fx.currency_id), {})
+
+
+@database_case("update_transaction")
+def _(fx):
+    return ((fx.scratch_transaction(), fx.unique("Bench"), fx.currency_id), {})
+
+
+@database_case("delete_transaction")
+def _(fx):
+    return ((fx.scratch_transaction(),), {})
+
+
+@database_case("insert_transaction_line")
+def _(fx):
+    return ((fx.scratch_transaction(), fx.busy_account_id), {"debit": 10.0, "date": fx.date})
+
+
+@database_case("update_transaction_line")
+def _(fx):
+    return ((fx.scratch_line(), fx.busy_account_id), {"debit": 10.0, "date": fx.date})
+
+
+@database_case("delete_transaction_line")
+def _(fx):
+    return ((fx.scratch_line(),), {})
+
+
+@database_case("consume_orphan_line")
+def _(fx):
+    return ((fx.scratch_orphan_line(), fx.transaction_id), {})
+
+
+def statement_lines(fx, count):
+    """Lines no earlier run imported (fingerprints would skip them otherwise)"""
+    batch = fx.conn.execute("SELECT COALESCE(MAX(id), 0) FROM orphan_transaction_lines").fetchone()[0]
+    return [{"description": f"Bench POS {batch}-{i}", "account_id": fx.busy_account_id, "debit": 10.0 + i}
+            for i in range(count)]
+
+
+@database_case("insert_orphan_transaction")
+def _(fx):
+    return ((fx.unique("bench.csv"), statement_lines(fx, 50)), {})
+
+
+@database_case("import_orphan_transaction")
+def _(fx):
+    # An overlapping statement: half of it was imported before
+    overlap = [{"description": f"Bench overlap POS {i}", "account_id": fx.busy_account_id, "debit": 5.0 + i}
+               for i in range(25)]
+    return ((fx.unique("overlap.csv"), overlap + statement_lines(fx, 25)), {})
+
+
+@database_case("update_orphan_line")
+def _(fx):
+    return ((fx.scratch_orphan_line(),), {"description": "Updated POS", "debit": 12.5})
+
+
+@database_case("create_transaction_from_orphans")
+def _(fx):
+    orphan_line_ids = [fx.scratch_orphan_line() for _ in range(3)]
+    return ((fx.unique("Bench"), fx.currency_id, orphan_line_ids, fx.credit_card_account_id, fx.date), {})
+
+
+@database_case("update_orphan_transaction_status")
+def _(fx):
+    return ((fx.orphan_transaction_id, "new"), {})
+
+
+@database_case("update_orphan_line_status")
+def _(fx):
+    return ((fx.scratch_orphan_line(), "ignored"), {})
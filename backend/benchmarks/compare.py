@@ -0,0 +1,86 @@
+"""
+Compare two benchmark result files and flag regressions.
+
+A case regresses when its median got slower by more than --threshold (a
+fraction) and by more than --min-delta milliseconds, which keeps sub-
+millisecond noise out of the report. Exits with status 1 when anything
+regressed, so it can gate CI.
+
+Usage (from the backend directory):
+    python -m benchmarks.compare baseline.json candidate.json [--threshold 0.15]
+"""
+import argparse
+import json
+import sys
+
+
+def compare(baseline, candidate, threshold, min_delta_ms, metric="median_ms"):
+    """
+    Returns:
+        List of (name, baseline_ms, candidate_ms, verdict) tuples, where
+        verdict is one of "regression", "improvement", "ok", "new", "removed"
+        or "error" (the candidate run failed on that case)
+    """
+    rows = []
+    for name in sorted(set(baseline) | set(candidate)):
+        if "error" in candidate.get(name, {}):
+            rows.append((name, baseline.get(name, {}).get(metric), None, "error"))
+            continue
+        if name not in baseline or "error" in baseline[name]:
+            rows.append((name, None, candidate[name][metric], "new"))
+            continue
+        if name not in candidate:
+            rows.append((name, baseline[name][metric], None, "removed"))
+            continue
+        before = baseline[name][metric]
+        after = candidate[name][metric]
+        delta = after - before
+        if delta > min_delta_ms and after > before * (1 + threshold):
+            verdict = "regression"
+        elif -delta > min_delta_ms and before > after * (1 + threshold):
+            verdict = "improvement"
+        else:
+            verdict = "ok"
+        rows.append((name, before, after, verdict))
+    return rows
+
+
+def format_ms(value):
+    return f"{value:.2f}" if value is not None else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Allowed relative slowdown (default 0.15)")
+    parser.add_argument("--min-delta", type=float, default=0.5, help="Ignore changes below this many ms")
+    parser.add_argument("--metric", default="median_ms", choices=["min_ms", "median_ms", "mean_ms"])
+    parser.add_argument("--all", action="store_true", help="Also list unchanged cases")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    if baseline["meta"].get("size") != candidate["meta"].get("size"):
+        print(f"warning: comparing different ledger sizes "
+              f"({baseline['meta'].get('size')} vs {candidate['meta'].get('size')})")
+
+    rows = compare(baseline["results"], candidate["results"], args.threshold, args.min_delta, args.metric)
+    print(f"{'case':<78}{'before':>10}{'after':>10}{'change':>9}  verdict")
+    for name, before, after, verdict in rows:
+        if verdict == "ok" and not args.all:
+            continue
+        change = f"{(after - before) / before:+.0%}" if before and after is not None else ""
+        print(f"{name:<78}{format_ms(before):>10}{format_ms(after):>10}{change:>9}  {verdict}")
+
+    regressions = [row for row in rows if row[3] in ("regression", "error")]
+    print(f"{len(rows)} cases, {len(regressions)} regression(s), "
+          f"{sum(row[3] == 'improvement' for row in rows)} improvement(s)")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Deterministic synthetic ledger generator.
+
+Builds a finance database with the same schema as the app (via the Database
+class) and fills it with a realistic-looking ledger: a handful of categories,
+accounts whose usage follows a long-tailed distribution, credit cards,
+classifications that are mostly set on expense lines, multi-line
+transactions spread over several years, and batches of imported orphan lines.
+
+The same (lines, seed) pair always produces the same database.
+
+Usage (from the backend directory):
+    python -m benchmarks.ledger --size 10k --output /tmp/ledger-10k.db
+"""
+import argparse
+import datetime
+import itertools
+import os
+import random
+import tempfile
+
+SIZES = {
+    "10k": 10_000,
+    "100k": 100_000,
+    "1m": 1_000_000,
+    "10m": 10_000_000,
+}
+
+CATEGORIES = ["Asset", "Equity", "Liability", "Revenue", "Expense"]
+CURRENCIES = [("EGP", 1.0), ("USD", 50.5), ("EUR", 55.2)]
+CLASSIFICATIONS = [
+    "Groceries", "Utilities", "Cleaning", "Salary", "Bonus", "Incentive", "Freelance", "Withdrawal",
+    "Deposit", "Health", "Hospitality", "Luxury", "Fees", "Fuel", "Maintenance", "Settlement",
+    "Payment", "Refund", "Apartment", "Entertainment", "Telecom", "Food and Beverages",
+    "Applications", "Electronics", "Licensing", "Books", "Activities", "Courses", "Insurance",
+]
+MERCHANTS = [
+    "Carrefour", "Spinneys", "Vodafone", "Orange", "Shell", "TotalEnergies", "Amazon", "Noon",
+    "Talabat", "Uber", "Careem", "Netflix", "Spotify", "Apple", "Google", "IKEA", "Zara",
+    "Pharmacy 19011", "Cairo Electricity", "Water Company", "Gym Membership", "Cinema",
+    "Bookstore", "Udemy", "Insurance Premium", "Rent", "Salary", "Bonus", "Freelance Invoice",
+]
+# Transactions with 2, 3 and 4 lines
+LINE_COUNT_WEIGHTS = [0.85, 0.1, 0.05]
+START_DATE = datetime.date(2019, 1, 1)
+END_DATE = datetime.date(2025, 12, 31)
+BATCH_SIZE = 50_000
+
+
+def account_count(lines):
+    """Ledgers grow more accounts as they grow more lines, but slowly"""
+    return 40 + lines // 50_000
+
+
+def zipf_weights(count, exponent=1.1):
+    return [1 / (rank ** exponent) for rank in range(1, count + 1)]
+
+
+def generate_ledger(path, lines, seed=0, orphan_ratio=0.01):
+    """
+    Create `path` and fill it with about `lines` transaction lines
+
+    Args:
+        path: Database file to create (must not exist)
+        lines: Target number of transaction lines
+        seed: Random seed; the same seed produces the same ledger
+        orphan_ratio: Orphan lines generated per transaction line
+
+    Returns:
+        Dict with the number of rows generated per table
+    """
+    if os.path.exists(path):
+        raise FileExistsError(path)
+
+    from database import Database
+
+    database = Database(path)
+    conn = database.conn
+    cursor = database.cursor
+    rng = random.Random(seed)
+
+    # Bulk load: durability does not matter for a throwaway file
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+
+    cursor.executemany("INSERT INTO cat (name) VALUES (?)", [(name,) for name in CATEGORIES])
+    cursor.executemany("INSERT INTO currency (name, exchange_rate) VALUES (?, ?)", CURRENCIES)
+    cursor.executemany("INSERT INTO classifications (name) VALUES (?)", [(name,) for name in CLASSIFICATIONS])
+
+    # Accounts: mostly expense and asset accounts, a few of everything else
+    category_weights = [0.3, 0.05, 0.15, 0.1, 0.4]
+    accounts = []
+    for index in range(account_count(lines)):
+        cat_id = rng.choices(range(1, len(CATEGORIES) + 1), category_weights)[0]
+        currency_id = 1 if rng.random() < 0.85 else rng.randint(2, len(CURRENCIES))
+        nature = rng.choice(["debit", "credit", "both", "both"])
+        term = rng.choice(["long term", "medium term", "short term", "undefined", "undefined"])
+        accounts.append((f"{CATEGORIES[cat_id - 1]} {index + 1}", cat_id, currency_id, nature, term))
+    cursor.executemany(
+        "INSERT INTO accounts (name, cat_id, default_currency_id, nature, term) VALUES (?, ?, ?, ?, ?)", accounts)
+    account_ids = list(range(1, len(accounts) + 1))
+    expense_accounts = [i for i, account in enumerate(accounts, 1) if account[1] == 5]
+    liability_accounts = [i for i, account in enumerate(accounts, 1) if account[1] == 3]
+
+    # About half of the liability accounts are credit cards
+    credit_cards = [(account_id, rng.choice([10_000, 25_000, 50_000, 100_000]), rng.randint(1, 28),
+                     rng.randint(1, 28)) for account_id in liability_accounts if rng.random() < 0.5]
+    cursor.executemany("INSERT INTO ccards (account_id, credit_limit, close_day, due_day) VALUES (?, ?, ?, ?)",
+                       credit_cards)
+
+    # Each expense account may use a few classifications
+    links = set()
+    for account_id in expense_accounts:
+        for classification_id in rng.sample(range(1, len(CLASSIFICATIONS) + 1), 3):
+            links.add((account_id, classification_id))
+    cursor.executemany("INSERT INTO account_classifications (account_id, classification_id) VALUES (?, ?)",
+                       sorted(links))
+    classifications_by_account = {}
+    for account_id, classification_id in sorted(links):
+        classifications_by_account.setdefault(account_id, []).append(classification_id)
+
+    # Account usage is long-tailed: a few accounts carry most of the lines
+    account_weights = zipf_weights(len(account_ids))
+    rng.shuffle(account_weights)
+    account_cumulative = list(itertools.accumulate(account_weights))
+    merchant_cumulative = list(itertools.accumulate(zipf_weights(len(MERCHANTS))))
+    day_span = (END_DATE - START_DATE).days
+
+    def transactions():
+        generated = 0
+        transaction_id = 0
+        while generated < lines:
+            transaction_id += 1
+            line_count = rng.choices((2, 3, 4), LINE_COUNT_WEIGHTS)[0]
+            merchant = rng.choices(MERCHANTS, cum_weights=merchant_cumulative)[0]
+            description = f"{merchant} {rng.randint(1, 400)}" if rng.random() < 0.5 else merchant
+            currency_id = 1 if rng.random() < 0.9 else rng.randint(2, len(CURRENCIES))
+            # Recent years are busier than old ones
+            day = int(day_span * (rng.random() ** 0.7))
+            date = (START_DATE + datetime.timedelta(days=day)).isoformat()
+            chosen = rng.choices(account_ids, cum_weights=account_cumulative, k=line_count)
+            amount = round(rng.lognormvariate(5, 1.2) + 0.01, 2)
+            # One credit line balanced by one or more debit lines
+            split = [round(amount / (line_count - 1), 2)] * (line_count - 1)
+            split[-1] = round(amount - sum(split[:-1]), 2)
+            transaction_lines = [(chosen[0], None, amount, date, None)]
+            for account_id, debit in zip(chosen[1:], split):
+                classification_id = None
+                options = classifications_by_account.get(account_id)
+                if options and rng.random() < 0.7:
+                    classification_id = rng.choice(options)
+                transaction_lines.append((account_id, max(debit, 0.01), None, date, classification_id))
+            generated += line_count
+            yield transaction_id, description, currency_id, transaction_lines
+
+    transaction_batch = []
+    line_batch = []
+    transaction_total = 0
+    line_total = 0
+    for transaction_id, description, currency_id, transaction_lines in transactions():
+        transaction_batch.append((transaction_id, description, currency_id))
+        for line in transaction_lines:
+            line_batch.append((transaction_id,) + line)
+        if len(line_batch) >= BATCH_SIZE:
+            transaction_total += flush_transactions(cursor, transaction_batch, line_batch)
+            line_total += len(line_batch)
+            transaction_batch, line_batch = [], []
+    transaction_total += flush_transactions(cursor, transaction_batch, line_batch)
+    line_total += len(line_batch)
+
+    orphan_total = generate_orphans(cursor, rng, int(line_total * orphan_ratio), account_ids)
+
+    conn.commit()
+    cursor.execute("ANALYZE")
+    database.close_connection()
+
+    return {
+        "accounts": len(accounts),
+        "credit_cards": len(credit_cards),
+        "classifications": len(CLASSIFICATIONS),
+        "transactions": transaction_total,
+        "transaction_lines": line_total,
+        "orphan_lines": orphan_total,
+    }
+
+
+def flush_transactions(cursor, transaction_batch, line_batch):
+    cursor.executemany("INSERT INTO transactions (id, description, currency_id) VALUES (?, ?, ?)",
+                       transaction_batch)
+    cursor.executemany("""
+        INSERT INTO transaction_lines (transaction_id, account_id, debit, credit, date, classification_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, line_batch)
+    return len(transaction_batch)
+
+
+def generate_orphans(cursor, rng, count, account_ids):
+    """Imported statement batches: mostly new, some consumed or ignored lines"""
+    # insert_orphan_transaction adds this column on first use
+    cursor.execute("PRAGMA table_info(orphan_transaction_lines)")
+    if "notes" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE orphan_transaction_lines ADD COLUMN notes TEXT")
+
+    generated = 0
+    batch_number = 0
+    while generated < count:
+        batch_number += 1
+        size = min(rng.randint(20, 80), count - generated)
+        import_date = f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 10:00:00"
+        cursor.execute("INSERT INTO orphan_transactions (reference, import_date, status) VALUES (?, ?, ?)",
+                       (f"statement-{batch_number}.csv", import_date, rng.choice(["new", "new", "processed"])))
+        orphan_transaction_id = cursor.lastrowid
+        rows = []
+        for _ in range(size):
+            amount = round(rng.lognormvariate(5, 1.2) + 0.01, 2)
+            is_debit = rng.random() < 0.6
+            status = rng.choices(["new", "consumed", "ignored"], [0.6, 0.3, 0.1])[0]
+            account_id = rng.choice(account_ids) if rng.random() < 0.95 else None
+            notes = None if account_id else "Original account name: Unknown Card"
+            rows.append((orphan_transaction_id, f"{rng.choice(MERCHANTS)} POS", account_id,
+                         amount if is_debit else None, None if is_debit else amount, status, notes))
+        cursor.executemany("""
+            INSERT INTO orphan_transaction_lines
+            (orphan_transaction_id, description, account_id, debit, credit, status, notes)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        generated += size
+    return generated
+
+
+def ledger_path(size, seed=0, directory=None):
+    """Where the cached ledger for a size preset lives"""
+    directory = directory or os.path.join(tempfile.gettempdir(), "finance-ledgers")
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"ledger-{size}-seed{seed}.db")
+
+
+def ensure_ledger(size, seed=0, directory=None):
+    """Return the path of a generated ledger, building it on first use"""
+    path = ledger_path(size, seed, directory)
+    if not os.path.exists(path):
+        building = path + ".building"
+        if os.path.exists(building):
+            os.remove(building)
+        generate_ledger(building, SIZES[size], seed=seed)
+        os.replace(building, path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=SIZES, default="10k")
+    parser.add_argument("--lines", type=int, help="Exact line count (overrides --size)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    counts = generate_ledger(args.output, args.lines or SIZES[args.size], seed=args.seed)
+    for table, count in counts.items():
+        print(f"{table:<20}{count:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Multi-ledger benchmark: pooled connections and LRU churn.
+
+Copies a generated ledger into --ledgers named ledgers in a scratch
+directory, then times opening a connection and running a first query
+without the pool and with it, and serves /api/accounts/{id}/balance
+round-robin over every ledger with at most --max-ledgers of them open. The
+open file handles of the process are reported before and after, to show
+they stay bounded however many ledgers are served.
+
+Usage (from the backend directory):
+    python -m benchmarks.ledgers [--size 10k] [--ledgers 200] [--max-ledgers 16] [--requests 2000]
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from fastapi.testclient import TestClient
+
+from benchmarks.ledger import SIZES, ensure_ledger
+from benchmarks.run import load_app
+from benchmarks.serialization import best_of
+
+
+def open_files():
+    return len(os.listdir("/proc/self/fd")) if os.path.isdir("/proc/self/fd") else -1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=SIZES, default="10k")
+    parser.add_argument("--ledgers", type=int, default=200)
+    parser.add_argument("--max-ledgers", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    source = ensure_ledger(args.size)
+    directory = tempfile.mkdtemp(prefix="ledgers-")
+    try:
+        for number in range(args.ledgers):
+            shutil.copyfile(source, os.path.join(directory, f"ledger{number}.db"))
+        os.environ["FINANCE_LEDGER_DIR"] = directory
+        api = load_app(source)
+        pool = api.ledger_pool
+        pool.max_ledgers = args.max_ledgers
+
+        def fresh():
+            conn = sqlite3.connect(source)
+            conn.execute("SELECT id FROM accounts LIMIT 1").fetchone()
+            conn.close()
+
+        def pooled():
+            conn = pool.connect(pool.default)
+            conn.execute("SELECT id FROM accounts LIMIT 1").fetchone()
+            conn.close()
+
+        print(f"{args.size} ledger x {args.ledgers}, at most {args.max_ledgers} open, best of {args.repeat} (ms)")
+        print(f"connect + first query: fresh {best_of(args.repeat, fresh):.3f}, "
+              f"pooled {best_of(args.repeat, pooled):.3f}")
+
+        conn = pool.connect(pool.default)
+        account_id = conn.execute("SELECT id FROM accounts ORDER BY id LIMIT 1").fetchone()[0]
+        conn.close()
+        before = open_files()
+        with TestClient(api.app) as client:
+            start = time.perf_counter()
+            for number in range(args.requests):
+                response = client.get(f"/ledgers/ledger{number % args.ledgers}/api/accounts/{account_id}/balance")
+                if response.status_code != 200:
+                    raise SystemExit(f"request {number}: {response.status_code} {response.text}")
+            elapsed = time.perf_counter() - start
+        print(f"{args.requests} requests over {args.ledgers} ledgers: {args.requests / elapsed:.0f}/s")
+        print(f"open files before {before}, after {open_files()}; pool {pool.stats()}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
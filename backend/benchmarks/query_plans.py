@@ -0,0 +1,300 @@
+"""
+Audit the query plans of every SQL statement the backend issues.
+
+Runs every benchmark case (all API routes and public Database methods)
+against a generated ledger and collects the statements they execute via the
+metrics trace hook. Each one is run through EXPLAIN QUERY PLAN, and every
+full scan of a table is reported with the filter columns it could use and a
+suggested index, or the reason no index can help (LIKE, a column wrapped in a
+function, no filter at all).
+
+Scans already accepted in query_plans.json are reported but tolerated. A new
+scan on a hot path (any API route, or anything with --all) makes the script
+exit with status 1, so it can gate CI; tests/test_query_plans.py runs the
+same audit under pytest. After adding a scan on purpose, accept it with
+--update.
+
+Usage (from the backend directory):
+    python -m benchmarks.query_plans [--size 10k] [--all] [--update]
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_plans.json")
+
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+# Scanning reference tables this small costs less than an index lookup would
+SMALL_TABLE_ROWS = 1000
+
+_SCAN = re.compile(r"^SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?")
+_TABLE_REFERENCE = re.compile(
+    r"\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)"
+    r"(?:\s+(?:AS\s+)?(?!(?:ON|WHERE|JOIN|LEFT|INNER|CROSS|GROUP|ORDER|LIMIT|SET|USING|VALUES|UNION)\b)(\w+))?",
+    re.IGNORECASE)
+_FILTER_OPERATOR = r"\s*(=|==|<=|>=|<|>|IN\b|BETWEEN\b|IS\b)\s*(?:\?|NULL\b|\()"
+_RANGE_OPERATORS = ("<", ">", "<=", ">=", "BETWEEN")
+# Keywords that can precede a parenthesis without calling a function: FROM (SELECT ...), IN (...), ...
+_SQL_KEYWORDS = ("ALL", "AND", "AS", "BETWEEN", "BY", "CASE", "ELSE", "EXISTS", "FROM", "HAVING", "IN", "INTO",
+                 "IS", "JOIN", "LIKE", "NOT", "ON", "OR", "OVER", "SELECT", "SET", "THEN", "UNION", "USING", "VALUES",
+                 "WHEN", "WHERE", "WITH")
+_WRAPPING_FUNCTION = r"\b(?!(?:" + "|".join(_SQL_KEYWORDS) + r")\b)(\w+)\s*\([^()]*?{column}\b"
+# Functions that wrap a column without keeping an index from filtering on it
+_TRANSPARENT_FUNCTIONS = ("SUM", "TOTAL", "COUNT", "MIN", "MAX", "AVG", "COALESCE", "GROUP_CONCAT", "IFNULL", "NULLIF",
+                          "ROUND", "ABS")
+
+
+def collect_statements(app, db_path, fixture):
+    """
+    Run every benchmark case and return the statements it issued
+
+    Returns:
+        Dict of statement id -> {"sql": normalized SQL, "sources": set of
+        route templates and Database.<method> names}
+    """
+    import metrics
+
+    from benchmarks.cases import DATABASE_CASES, ROUTE_CASES
+    from database import Database
+
+    metrics.registry.reset()
+
+    async def run_routes():
+        import httpx
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://audit") as client:
+            for (method, path, variant), case in ROUTE_CASES.items():
+                spec = case(fixture)
+                await client.request(method, spec["url"], params=spec.get("params"),
+                                     json=spec.get("json"), headers=spec.get("headers"))
+
+    asyncio.run(run_routes())
+
+    database = Database(db_path)
+    for name, case in DATABASE_CASES.items():
+        with metrics.track(f"Database.{name}"):
+            try:
+                args, kwargs = case(fixture)
+                getattr(database, name)(*args, **kwargs)
+            except Exception as e:
+                print(f"warning: Database.{name} failed: {type(e).__name__}: {e}")
+            if database.conn.in_transaction:
+                database.conn.rollback()
+    database.close_connection()
+
+    statements = {}
+    for source, statement_id in metrics.registry.statement_latency.series:
+        sql = metrics.registry.statement_sql.get(statement_id)
+        if sql is None or statement_id == "other":
+            continue
+        statements.setdefault(statement_id, {"sql": sql, "sources": set()})["sources"].add(source)
+    return statements
+
+
+def table_references(sql, tables):
+    """Map each alias (or bare table name) used in `sql` to its table"""
+    references = {}
+    for table, alias in _TABLE_REFERENCE.findall(sql):
+        if table.lower() not in tables:
+            continue
+        references.setdefault(table, table.lower())
+        if alias:
+            references.setdefault(alias, table.lower())
+    return references
+
+
+def schema_info(conn):
+    """Columns and index key columns of every table"""
+    tables = {}
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({name})")]
+        indexes = {}
+        for index in conn.execute(f"PRAGMA index_list({name})").fetchall():
+            indexes[index[1]] = [row[2] for row in conn.execute(f"PRAGMA index_info({index[1]})")]
+        rows = conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+        tables[name.lower()] = {"name": name, "columns": columns, "indexes": indexes, "rows": rows}
+    return tables
+
+
+def analyze_scan(sql, alias, table, info, single_table):
+    """Work out why `table` is scanned and which index, if any, would help"""
+    qualifier = rf"\b{re.escape(alias)}\." if not single_table else rf"(?:\b{re.escape(alias)}\.|(?<![\w.]))"
+    equality, ranges, blocked = [], [], []
+    for column in info["columns"]:
+        reference = qualifier + re.escape(column)
+        for match in re.finditer(reference + _FILTER_OPERATOR, sql, re.IGNORECASE):
+            target = ranges if match.group(1).upper() in _RANGE_OPERATORS else equality
+            if column not in target:
+                target.append(column)
+        if re.search(reference + r"\s+(?:NOT\s+)?LIKE\b", sql, re.IGNORECASE):
+            blocked.append(f"{column} LIKE (needs an exact or prefix match)")
+        for function in re.findall(_WRAPPING_FUNCTION.format(column=reference), sql, re.IGNORECASE):
+            if function.upper() not in _TRANSPARENT_FUNCTIONS:
+                blocked.append(f"{function}({column}) (an expression index or a stored column would be needed)")
+
+    columns = equality + [column for column in ranges if column not in equality]
+    if columns:
+        covered = [name for name, keys in info["indexes"].items() if keys[:len(columns)] == columns]
+        if covered:
+            return (f"filters on ({', '.join(columns)}) already match {covered[0]}; "
+                    f"the planner prefers a scan here (low selectivity or stale ANALYZE)")
+        # Equality columns first, then at most one range column
+        keys = equality + ranges[:1] if equality else ranges[:1]
+        return (f"CREATE INDEX idx_{info['name']}_{'_'.join(keys)} "
+                f"ON {info['name']} ({', '.join(keys)})")
+    if blocked:
+        return "not indexable: " + "; ".join(dict.fromkeys(blocked))
+    return "no filter on this table: every row is read (narrow the query or pre-aggregate)"
+
+
+def audit(conn, statements):
+    """
+    Returns:
+        List of findings {"statement", "sql", "sources", "table", "rows", "index",
+        "suggestion"}, one per full scan of a table
+    """
+    from metrics import statement_identity
+
+    tables = schema_info(conn)
+    findings = []
+    for statement_id, statement in sorted(statements.items()):
+        sql = statement["sql"]
+        if statement_identity(sql)[1] not in EXPLAINABLE:
+            continue
+        try:
+            plan = conn.execute("EXPLAIN QUERY PLAN " + sql, [None] * sql.count("?")).fetchall()
+        except sqlite3.Error as e:
+            print(f"warning: cannot explain {statement_id}: {e}")
+            continue
+        references = table_references(sql, tables)
+        single_table = len(set(references.values())) == 1
+        for _, _, _, detail in plan:
+            match = _SCAN.match(detail)
+            if not match or match.group(1) not in references:
+                # Constant rows, subqueries and CTEs are scans of temporary results
+                continue
+            alias, index = match.groups()
+            table = references[alias]
+            findings.append({
+                "statement": statement_id,
+                "sql": sql,
+                "sources": sorted(statement["sources"]),
+                "table": tables[table]["name"],
+                "rows": tables[table]["rows"],
+                "index": index,
+                "suggestion": analyze_scan(sql, alias, table, tables[table], single_table),
+            })
+    return findings
+
+
+def is_hot(finding, everything=False):
+    if finding["rows"] < SMALL_TABLE_ROWS:
+        return False
+    return everything or any(source.startswith("/") for source in finding["sources"])
+
+
+def is_accepted(finding, accepted):
+    return finding["table"] in accepted.get(finding["statement"], {}).get("scans", [])
+
+
+def run_audit(app, db_path):
+    """
+    Run every benchmark case through `app` (main.app, serving `db_path`)
+    and audit the statements they issued
+
+    Returns:
+        (statements, findings) as from collect_statements() and audit()
+    """
+    from benchmarks.cases import Fixture
+
+    fixture_conn = sqlite3.connect(db_path)
+    try:
+        statements = collect_statements(app, db_path, Fixture(fixture_conn))
+        return statements, audit(fixture_conn, statements)
+    finally:
+        fixture_conn.close()
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)["accepted"]
+
+
+def write_baseline(path, findings):
+    accepted = {}
+    for finding in findings:
+        entry = accepted.setdefault(finding["statement"], {"sql": finding["sql"], "scans": []})
+        if finding["table"] not in entry["scans"]:
+            entry["scans"].append(finding["table"])
+    with open(path, "w") as f:
+        json.dump({"accepted": accepted}, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def main():
+    from benchmarks.ledger import SIZES, ensure_ledger
+    from benchmarks.run import load_app
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=SIZES, default="10k")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ledger-dir", help="Where generated ledgers are cached")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--all", action="store_true", help="Treat Database methods as hot paths too")
+    parser.add_argument("--update", action="store_true", help="Accept every current scan into the baseline")
+    parser.add_argument("--verbose", action="store_true", help="Also list accepted scans")
+    args = parser.parse_args()
+
+    source = ensure_ledger(args.size, seed=args.seed, directory=args.ledger_dir)
+    workdir = tempfile.mkdtemp(prefix="finance-plans-")
+    db_path = os.path.join(workdir, "ledger.db")
+    shutil.copyfile(source, db_path)
+
+    api = load_app(db_path)
+    statements, findings = run_audit(api.app, db_path)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.update:
+        write_baseline(args.baseline, findings)
+        print(f"{len(findings)} scan(s) in {len(statements)} statements accepted into {args.baseline}")
+        return
+
+    accepted = load_baseline(args.baseline)
+    failures = 0
+    for finding in findings:
+        known = is_accepted(finding, accepted)
+        hot = is_hot(finding, args.all)
+        small = finding["rows"] < SMALL_TABLE_ROWS
+        if (known or small) and not args.verbose:
+            continue
+        if known:
+            verdict = "accepted"
+        elif hot:
+            verdict = "NEW"
+        else:
+            verdict = "new (small table)" if small else "new (cold path)"
+        failures += hot and not known
+        using = f" using {finding['index']}" if finding["index"] else ""
+        print(f"[{verdict}] SCAN {finding['table']} ({finding['rows']} rows){using} "
+              f"in statement {finding['statement']}")
+        print(f"    from: {', '.join(finding['sources'])}")
+        print(f"    sql: {finding['sql'][:300]}")
+        print(f"    suggestion: {finding['suggestion']}")
+
+    scanning = {finding["statement"] for finding in findings}
+    print(f"{len(statements)} statements, {len(scanning)} with full scans "
+          f"({len(findings)} scan(s)), {failures} new on hot paths")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Benchmark every API route and every public Database method.
+
+Routes are driven through an in-process ASGI client (httpx), so the numbers
+include routing, validation and serialization but no network. Each case runs
+once to warm up and is then timed `--repeat` times. Results are written as
+JSON; compare two runs with `python -m benchmarks.compare`.
+
+Usage (from the backend directory):
+    python -m benchmarks.run --size 10k [--repeat 5] [--output results.json]
+"""
+import argparse
+import asyncio
+import datetime
+import inspect
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmarks", "results")
+
+# Lifecycle and transaction-control methods that make no sense to time on their own
+EXCLUDED_DATABASE_METHODS = {"close_connection", "begin_transaction", "commit_transaction", "rollback_transaction"}
+# Streams that stay open until the client leaves, so there is no response time to measure
+EXCLUDED_ROUTES = {("GET", "/api/events")}
+
+
+def load_app(db_path):
+    """Import main.py against `db_path` and return the module"""
+    os.environ["FINANCE_DB"] = db_path
+    # database.py opens finance.db in the working directory on import
+    os.chdir(os.path.dirname(db_path))
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    import main
+    # httpx's ASGI transport does not run the app's lifespan
+    main.prepare_database()
+    return main
+
+
+def summarize(timings, status=None):
+    timings_ms = [t * 1000 for t in timings]
+    summary = {
+        "runs": len(timings_ms),
+        "min_ms": round(min(timings_ms), 4),
+        "median_ms": round(statistics.median(timings_ms), 4),
+        "mean_ms": round(statistics.fmean(timings_ms), 4),
+        "max_ms": round(max(timings_ms), 4),
+    }
+    if status is not None:
+        summary["status"] = status
+    return summary
+
+
+def route_key(method, path, variant):
+    key = f"{method} {path}"
+    return f"{key} [{variant}]" if variant else key
+
+
+async def run_routes(app, fixture, repeat, only=None):
+    import httpx
+    from fastapi.routing import APIRoute
+
+    from benchmarks.cases import ROUTE_CASES
+
+    results = {}
+    covered = set()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for (method, path, variant), case in ROUTE_CASES.items():
+            covered.add((method, path))
+            key = route_key(method, path, variant)
+            if only and only not in key:
+                continue
+            timings = []
+            status = None
+            for iteration in range(repeat + 1):
+                spec = case(fixture)
+                start = time.perf_counter()
+                response = await client.request(method, spec["url"], params=spec.get("params"),
+                                                json=spec.get("json"), headers=spec.get("headers"))
+                await response.aread()
+                elapsed = time.perf_counter() - start
+                status = response.status_code
+                if iteration:
+                    timings.append(elapsed)
+            results[key] = summarize(timings, status)
+            print(f"{key:<78}{results[key]['median_ms']:>10.2f} ms  {status}")
+
+    uncovered = sorted(
+        f"{method} {route.path}"
+        for route in app.routes if isinstance(route, APIRoute)
+        for method in route.methods
+        if (method, route.path) not in covered and (method, route.path) not in EXCLUDED_ROUTES
+    )
+    return results, uncovered
+
+
+def run_database(db_path, fixture, repeat, only=None):
+    from database import Database
+
+    from benchmarks.cases import DATABASE_CASES
+
+    database = Database(db_path)
+    results = {}
+    for name, case in DATABASE_CASES.items():
+        key = f"Database.{name}"
+        if only and only not in key:
+            continue
+        method = getattr(database, name)
+        timings = []
+        try:
+            for iteration in range(repeat + 1):
+                args, kwargs = case(fixture)
+                start = time.perf_counter()
+                method(*args, **kwargs)
+                elapsed = time.perf_counter() - start
+                # Several methods leave their transaction open for the caller
+                if database.conn.in_transaction:
+                    database.conn.rollback()
+                if iteration:
+                    timings.append(elapsed)
+        except Exception as e:
+            if database.conn.in_transaction:
+                database.conn.rollback()
+            results[key] = {"error": f"{type(e).__name__}: {e}"}
+            print(f"{key:<78}{'error':>10}  {results[key]['error']}")
+            continue
+        results[key] = summarize(timings)
+        print(f"{key:<78}{results[key]['median_ms']:>10.2f} ms")
+    database.close_connection()
+
+    public = {
+        name for name, _ in inspect.getmembers(Database, inspect.isfunction)
+        if not name.startswith("_") and name not in EXCLUDED_DATABASE_METHODS
+    }
+    return results, sorted(f"Database.{name}" for name in public - set(DATABASE_CASES))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    from benchmarks.ledger import SIZES, ensure_ledger
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=SIZES, default="10k")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", help="Only run cases whose name contains this text")
+    parser.add_argument("--ledger-dir", help="Where generated ledgers are cached")
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/<size>-<time>.json)")
+    args = parser.parse_args()
+
+    started = datetime.datetime.now()
+    source = ensure_ledger(args.size, seed=args.seed, directory=args.ledger_dir)
+    # Write cases modify the ledger, so always benchmark a fresh copy
+    workdir = tempfile.mkdtemp(prefix="finance-bench-")
+    db_path = os.path.join(workdir, "ledger.db")
+    shutil.copyfile(source, db_path)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{args.size}-{started:%Y%m%d-%H%M%S}.json")
+    output = os.path.abspath(output)
+
+    api = load_app(db_path)
+    from benchmarks.cases import Fixture
+
+    fixture_conn = sqlite3.connect(db_path)
+    fixture = Fixture(fixture_conn)
+
+    route_results, uncovered_routes = asyncio.run(run_routes(api.app, fixture, args.repeat, args.only))
+    database_results, uncovered_methods = run_database(db_path, fixture, args.repeat, args.only)
+    fixture_conn.close()
+
+    uncovered = uncovered_routes + uncovered_methods
+    for name in uncovered:
+        print(f"no benchmark case: {name}")
+
+    report = {
+        "meta": {
+            "size": args.size,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "started": started.isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+        },
+        "results": {**route_results, **database_results},
+        "uncovered": uncovered,
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    shutil.rmtree(workdir, ignore_errors=True)
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Serialization benchmark for the large list endpoints.
+
+Compares the cost of turning the /api/transactions, /api/accounts/detailed and
+/api/dashboard payloads into bytes the way FastAPI did before (jsonable_encoder
+followed by the stdlib json encoder) against the orjson response class, for
+both the row and the columnar formats.
+
+Usage (from the backend directory):
+    python -m benchmarks.serialization [--size 100k] [--rows 10000] [--repeat 20]
+"""
+import argparse
+import time
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from benchmarks.ledger import SIZES, ensure_ledger
+from benchmarks.run import load_app
+
+
+def best_of(repeat, func):
+    """Best wall time of `repeat` runs, in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=SIZES, default="100k")
+    parser.add_argument("--rows", type=int, default=10000, help="Page size for /api/transactions")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    api = load_app(ensure_ledger(args.size))
+
+    endpoints = {
+        "/api/transactions": lambda fmt: orjson.loads(
+            api.get_transactions(skip=0, limit=args.rows, response_format=fmt).body),
+        "/api/accounts/detailed": lambda fmt: api.load_accounts_detailed(columnar=fmt == "columnar"),
+        "/api/dashboard": lambda fmt: api.get_dashboard_data(columnar=fmt == "columnar"),
+    }
+
+    print(f"{args.size} ledger, {args.rows} transaction rows, best of {args.repeat} (ms)")
+    print(f"{'endpoint':<24}{'before':>10}{'orjson':>10}{'columnar':>10}{'bytes':>10}{'col bytes':>11}")
+    for path_name, route in endpoints.items():
+        rows = route("rows")
+        columns = route("columnar")
+
+        before = best_of(args.repeat, lambda: JSONResponse(jsonable_encoder(rows)))
+        after = best_of(args.repeat, lambda: ORJSONResponse(rows))
+        columnar = best_of(args.repeat, lambda: ORJSONResponse(columns))
+
+        print(f"{path_name:<24}{before:>10.2f}{after:>10.2f}{columnar:>10.2f}"
+              f"{len(orjson.dumps(rows)):>10}{len(orjson.dumps(columns)):>11}")
+
+
+if __name__ == "__main__":
+    main()
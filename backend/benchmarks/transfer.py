@@ -0,0 +1,82 @@
+"""
+Bulk import benchmark: lines per second by number of parser processes.
+
+Writes a statement CSV of --lines lines, then imports it with cli.py's
+import path (transfer.import_file) into a scratch copy of a generated
+ledger, once per worker count in --workers: as orphan lines, and as
+transactions against a contra account. Parsing scales with the worker
+count up to the number of cores; the single writer bounds the total.
+
+Usage (from the backend directory):
+    python -m benchmarks.transfer [--size 10k] [--lines 200000] [--workers 1,2,4] [--ledger-dir DIR]
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import transfer
+from benchmarks.ledger import SIZES, ensure_ledger
+from database import Database
+
+DESCRIPTIONS = ("Carrefour", "Talabat", "Uber", "Vodafone", "Salary", "Rent", "Coffee")
+
+
+def write_statement(path, lines):
+    generator = random.Random(7)
+    with open(path, "w") as f:
+        f.write("date,description,amount\n")
+        for number in range(lines):
+            day = f"2024-{number * 12 // lines + 1:02d}-{number % 28 + 1:02d}"
+            amount = round(generator.uniform(-500, 500), 2) or 1
+            f.write(f"{day},{generator.choice(DESCRIPTIONS)} {number % 97},{amount}\n")
+
+
+def timed_import(source, statement, target, workers, account, contra):
+    directory = tempfile.mkdtemp(prefix="transfer-")
+    try:
+        db_path = os.path.join(directory, "ledger.db")
+        shutil.copyfile(source, db_path)
+        db = Database(db_path)
+        db.conn.set_progress_handler(None, 0)
+        start = time.perf_counter()
+        result = transfer.import_file(db.conn, db.reference, statement, target=target, account=account,
+                                      contra=contra if target == "transactions" else None, workers=workers)
+        elapsed = time.perf_counter() - start
+        db.close_connection()
+        return result, elapsed
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=SIZES, default="10k")
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts")
+    parser.add_argument("--ledger-dir", help="Where generated ledgers are cached")
+    args = parser.parse_args()
+
+    source = ensure_ledger(args.size, directory=args.ledger_dir)
+    directory = tempfile.mkdtemp(prefix="statement-")
+    try:
+        statement = os.path.join(directory, "statement.csv")
+        write_statement(statement, args.lines)
+        db = Database(source)
+        account, contra = (row[1] for row in db.conn.execute("SELECT id, name FROM accounts ORDER BY id LIMIT 2"))
+        db.close_connection()
+        print(f"{args.lines} lines ({os.path.getsize(statement) / 2 ** 20:.1f} MB) into a {args.size} ledger, "
+              f"{os.cpu_count()} cores")
+        print(f"{'target':<14}{'workers':>8}{'seconds':>10}{'lines/s':>10}")
+        for target in transfer.TARGETS:
+            for workers in (int(count) for count in args.workers.split(",")):
+                result, elapsed = timed_import(source, statement, target, workers, account, contra)
+                print(f"{target:<14}{workers:>8}{elapsed:>10.2f}{args.lines / elapsed:>10.0f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Multi-worker load test: read throughput by number of server processes.
+
+For every worker count in --workers, starts `uvicorn main:app --workers N`
+in multi-worker mode (workers.py) on a scratch copy of a generated ledger
+and drives it with --clients client processes for --seconds each. Every
+client keeps one connection open and cycles through read endpoints that
+need SQLite (transactions page, dashboard, trial balance) plus one served
+from the ETag cache. Requests per second and latency percentiles are
+printed per worker count; throughput should grow with the worker count up
+to the number of cores.
+
+Usage (from the backend directory):
+    python -m benchmarks.workers [--size 10k] [--workers 1,2,4] [--clients 8] [--seconds 10]
+        [--ledger-dir DIR]
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.ledger import SIZES, ensure_ledger
+from benchmarks.run import BACKEND_DIR
+
+PATHS = [
+    "/api/transactions?limit=50",
+    "/api/dashboard",
+    "/api/reports/trial-balance",
+    "/api/accounts/detailed",
+]
+
+
+def client(url, seconds, results):
+    """Request PATHS round-robin until `seconds` have passed; report (count, latencies, failures)"""
+    latencies = []
+    failures = 0
+    with httpx.Client(base_url=url, timeout=60) as session:
+        deadline = time.perf_counter() + seconds
+        number = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            response = session.get(PATHS[number % len(PATHS)])
+            latencies.append(time.perf_counter() - start)
+            failures += response.status_code != 200
+            number += 1
+    results.put((latencies, failures))
+
+
+def wait_until_up(url, server, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"server exited with {server.returncode}")
+        try:
+            if httpx.get(url + "/").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit("server did not start")
+
+
+def run(db_path, workers, clients, seconds, port):
+    url = f"http://127.0.0.1:{port}"
+    env = {**os.environ, "FINANCE_DB": db_path, "FINANCE_WORKERS": str(workers)}
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                               "--workers", str(workers), "--log-level", "warning"], cwd=BACKEND_DIR, env=env)
+    try:
+        wait_until_up(url, server)
+        # Warm every worker's caches and connections
+        with httpx.Client(base_url=url) as session:
+            for _ in range(workers * 4):
+                for path in PATHS:
+                    session.get(path)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=client, args=(url, seconds, results)) for _ in range(clients)]
+        for process in processes:
+            process.start()
+        latencies, failures = [], 0
+        for _ in processes:
+            client_latencies, client_failures = results.get()
+            latencies.extend(client_latencies)
+            failures += client_failures
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+    latencies.sort()
+    return {
+        "requests_per_second": len(latencies) / seconds,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+        "failures": failures,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=SIZES, default="10k")
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ledger-dir", help="Where generated ledgers are cached")
+    args = parser.parse_args()
+
+    source = ensure_ledger(args.size, directory=args.ledger_dir)
+    directory = tempfile.mkdtemp(prefix="workers-")
+    try:
+        db_path = os.path.join(directory, "ledger.db")
+        shutil.copyfile(source, db_path)
+        print(f"{args.size} ledger, {args.clients} clients, {args.seconds:g} s per run, {os.cpu_count()} cores")
+        print(f"{'workers':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'failed':>8}")
+        for workers in (int(count) for count in args.workers.split(",")):
+            result = run(db_path, workers, args.clients, args.seconds, args.port)
+            print(f"{workers:>8}{result['requests_per_second']:>10.0f}{result['p50_ms']:>10.2f}"
+                  f"{result['p99_ms']:>10.2f}{result['failures']:>8}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
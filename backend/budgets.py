@@ -0,0 +1,292 @@
+"""
+Monthly budgets and the per-month line totals their actuals come from.
+
+A budget caps one month's spending on a classification, on an account, or
+on one classification within one account. Its actual is the net (debit
+minus credit) of the matching lines dated in that month.
+
+line_month_totals holds the debit, credit and line count of every month,
+classification and account that has lines. Triggers on transaction_lines
+keep it current on every insert, update and delete, whoever writes, so a
+month's budget status reads that month's few totals rows and never the
+lines themselves, however large the ledger. The table is filled from the
+existing lines (archived years included) when it is first created;
+rebuild() refills it. archive.py sets the delete trigger aside while it
+moves a year out, so archived lines stay counted.
+
+The classification report reads the same totals: whole months come from
+their totals rows, and only the days of a partly covered first or last
+month are summed from the lines.
+
+Lines without a classification or account are totalled under 0.
+"""
+import datetime
+import re
+
+import archive
+import balances
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS budgets (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        period TEXT NOT NULL,
+        classification_id INTEGER,
+        account_id INTEGER,
+        amount REAL NOT NULL,
+        FOREIGN KEY (classification_id) REFERENCES classifications (id) ON DELETE CASCADE,
+        FOREIGN KEY (account_id) REFERENCES accounts (id) ON DELETE CASCADE,
+        CHECK (classification_id IS NOT NULL OR account_id IS NOT NULL)
+    )
+    """,
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_budgets_period_target
+    ON budgets (period, COALESCE(classification_id, 0), COALESCE(account_id, 0))
+    """,
+]
+
+TOTALS_TABLE = """
+    CREATE TABLE line_month_totals (
+        month TEXT NOT NULL,
+        classification_id INTEGER NOT NULL,
+        account_id INTEGER NOT NULL,
+        debit REAL NOT NULL,
+        credit REAL NOT NULL,
+        lines INTEGER NOT NULL,
+        PRIMARY KEY (month, classification_id, account_id)
+    ) WITHOUT ROWID
+"""
+
+
+def line_totals_statement(row, sign):
+    """Upsert adding (sign 1) or removing (sign -1) the line `row` (NEW or OLD) to its month's totals"""
+    operator = "+" if sign > 0 else "-"
+    return f"""
+        INSERT INTO line_month_totals (month, classification_id, account_id, debit, credit, lines)
+        VALUES (substr({row}.date, 1, 7), COALESCE({row}.classification_id, 0), COALESCE({row}.account_id, 0),
+                {operator}COALESCE({row}.debit, 0), {operator}COALESCE({row}.credit, 0), {sign})
+        ON CONFLICT (month, classification_id, account_id) DO UPDATE SET
+            debit = debit + excluded.debit, credit = credit + excluded.credit, lines = lines + excluded.lines;
+    """
+
+
+TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS line_month_totals_line_insert
+    AFTER INSERT ON transaction_lines
+    BEGIN
+        {line_totals_statement("NEW", 1)}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS line_month_totals_line_update
+    AFTER UPDATE OF account_id, debit, credit, date, classification_id ON transaction_lines
+    BEGIN
+        {line_totals_statement("OLD", -1)}
+        {line_totals_statement("NEW", 1)}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS line_month_totals_line_delete
+    AFTER DELETE ON transaction_lines
+    BEGIN
+        {line_totals_statement("OLD", -1)}
+    END
+    """,
+]
+
+BUDGET_FIELDS = ("id", "period", "classification_id", "account_id", "amount")
+STATUS_FIELDS = ("id", "classification_id", "classification_name", "account_id", "account_name", "amount",
+                 "debit", "credit", "actual", "remaining", "used")
+PERIOD = re.compile(r"\d{4}-(0[1-9]|1[0-2])")
+REPORT_FIELDS = ("period", "classification_id", "classification_name", "spend", "income", "lines")
+DRILL_DOWN_FIELDS = ("period", "account_id", "account_name", "spend", "income", "lines")
+# Period label of a YYYY-MM month, by report granularity
+GRANULARITIES = {
+    "month": "{month}",
+    "quarter": "substr({month}, 1, 4) || '-Q' || ((CAST(substr({month}, 6, 2) AS INTEGER) + 2) / 3)",
+    "year": "substr({month}, 1, 4)",
+}
+
+
+def create_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'line_month_totals'")
+    if not exists.fetchone():
+        cursor.execute(TOTALS_TABLE)
+        fill(cursor.connection)
+    for statement in TRIGGERS:
+        cursor.execute(statement)
+
+
+def fill(conn):
+    """Total every line, archived ones included, into the (empty) line_month_totals"""
+    if conn.in_transaction:
+        # Archive partitions cannot be attached inside a transaction
+        conn.commit()
+    conn.execute(f"""
+        INSERT INTO line_month_totals (month, classification_id, account_id, debit, credit, lines)
+        SELECT substr(date, 1, 7), COALESCE(classification_id, 0), COALESCE(account_id, 0),
+               TOTAL(debit), TOTAL(credit), COUNT(*)
+        FROM {archive.lines_table(conn)}
+        WHERE date IS NOT NULL
+        GROUP BY 1, 2, 3
+    """)
+
+
+def rebuild(conn):
+    """Recompute line_month_totals from the lines and commit; returns the number of rows"""
+    conn.execute("DELETE FROM line_month_totals")
+    fill(conn)
+    conn.commit()
+    return conn.execute("SELECT COUNT(*) FROM line_month_totals").fetchone()[0]
+
+
+def validate_period(period):
+    """Raise ValueError unless `period` is a YYYY-MM month"""
+    if not isinstance(period, str) or not PERIOD.fullmatch(period):
+        raise ValueError("period must be a YYYY-MM month")
+
+
+def validate(budget):
+    """Raise ValueError for a budget dict that cannot be stored"""
+    validate_period(budget.get('period'))
+    if budget.get('classification_id') is None and budget.get('account_id') is None:
+        raise ValueError("A budget needs a classification_id, an account_id or both")
+    amount = budget.get('amount')
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)) or amount <= 0:
+        raise ValueError("amount must be a positive number")
+
+
+def list_budgets(conn, period=None):
+    """BUDGET_FIELDS rows, of one period or all of them"""
+    where, params = ("WHERE period = ?", (period,)) if period else ("", ())
+    return conn.execute(f"""
+        SELECT {', '.join(BUDGET_FIELDS)} FROM budgets {where}
+        ORDER BY period, classification_id IS NULL, classification_id, account_id
+    """, params).fetchall()
+
+
+def month_totals(conn, month):
+    """
+    (debit, credit) of one month's lines by budget target: keyed by
+    (classification id, account id), (classification id, None) and
+    (None, account id)
+    """
+    totals = {}
+    for classification_id, account_id, debit, credit in conn.execute("""
+        SELECT classification_id, account_id, debit, credit FROM line_month_totals WHERE month = ? AND lines > 0
+    """, (month,)):
+        for target in ((classification_id, account_id), (classification_id, None), (None, account_id)):
+            total = totals.get(target, (0.0, 0.0))
+            totals[target] = (total[0] + debit, total[1] + credit)
+    return totals
+
+
+def status(conn, period, reference):
+    """
+    STATUS_FIELDS rows of every budget of `period` (YYYY-MM)
+
+    Args:
+        reference: refdata Snapshot for the names
+    """
+    totals = month_totals(conn, period)
+    rows = []
+    for budget_id, _, classification_id, account_id, amount in list_budgets(conn, period):
+        debit, credit = totals.get((classification_id, account_id), (0.0, 0.0))
+        actual = round(debit - credit, 2)
+        rows.append((budget_id, classification_id, reference.classifications.name(classification_id), account_id,
+                     reference.accounts.name(account_id), amount, round(debit, 2), round(credit, 2), actual,
+                     round(amount - actual, 2), round(actual / amount, 4)))
+    return rows
+
+
+def next_month(day):
+    return (day.replace(day=1) + datetime.timedelta(days=31)).replace(day=1)
+
+
+def report_ranges(date_from, date_to):
+    """
+    Split the days from date_from to date_to (dates, None for unbounded)
+    into whole months, answered by the totals, and partly covered months,
+    summed from their lines
+
+    Returns:
+        (first, last) YYYY-MM months (None for unbounded), or None when no
+        month is whole; and a list of (start, exclusive end) ISO day ranges
+    """
+    days = []
+    whole_from = date_from
+    if date_from and date_from.day > 1:
+        whole_from = next_month(date_from)
+        if date_to and date_to < whole_from:
+            return None, [(date_from.isoformat(), balances.next_day(date_to))]
+        days.append((date_from.isoformat(), whole_from.isoformat()))
+    whole_to = date_to
+    if date_to and next_month(date_to) != date_to + datetime.timedelta(days=1):
+        start = date_to.replace(day=1)
+        whole_to = start - datetime.timedelta(days=1)
+        days.append((start.isoformat(), balances.next_day(date_to)))
+    if whole_from and whole_to and whole_from > whole_to:
+        return None, days
+    return (whole_from and whole_from.isoformat()[:7], whole_to and whole_to.isoformat()[:7]), days
+
+
+def classification_report(conn, reference, date_from=None, date_to=None, granularity="month",
+                          classification_id=None):
+    """
+    Spend (debit) and income (credit) per period and classification, or
+    per period and account of one classification (0 for unclassified lines)
+
+    Args:
+        reference: refdata Snapshot for the names
+        date_from, date_to: Inclusive dates, None for unbounded
+        granularity: month, quarter or year
+
+    Returns:
+        REPORT_FIELDS rows, or DRILL_DOWN_FIELDS rows with a classification_id
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    months, days = report_ranges(date_from, date_to)
+    if months and None in months:
+        # Open ends stop at the first and last month on record, so the totals are read by key range
+        first, last = conn.execute("""
+            SELECT (SELECT MIN(month) FROM line_month_totals), (SELECT MAX(month) FROM line_month_totals)
+        """).fetchone()
+        months = (months[0] or first, months[1] or last)
+    target = "classification_id" if classification_id is None else "account_id"
+    parts, params = [], []
+    if months:
+        conditions = []
+        for operator, month in zip((">=", "<="), months):
+            if month:
+                conditions.append(f"month {operator} ?")
+                params.append(month)
+        if classification_id is not None:
+            conditions.append("classification_id = ?")
+            params.append(classification_id)
+        parts.append(f"""
+            SELECT month, {target} AS target, debit, credit, lines FROM line_month_totals
+            {f"WHERE {' AND '.join(conditions)}" if conditions else ""}
+        """)
+    for start, end in days:
+        parts.append(f"""
+            SELECT substr(date, 1, 7) AS month, COALESCE({target}, 0) AS target, COALESCE(debit, 0) AS debit,
+                   COALESCE(credit, 0) AS credit, 1 AS lines
+            FROM {archive.lines_table(conn, start, end)}
+            WHERE date >= ? AND date < ?{"" if classification_id is None else " AND COALESCE(classification_id, 0) = ?"}
+        """)
+        params += [start, end] + ([] if classification_id is None else [classification_id])
+    if not parts:
+        return []
+    period = GRANULARITIES[granularity].format(month="month")
+    names = reference.classifications if classification_id is None else reference.accounts
+    return [(label, key or None, names.name(key), round(debit, 2), round(credit, 2), lines)
+            for label, key, debit, credit, lines in conn.execute(f"""
+                SELECT {period}, target, TOTAL(debit), TOTAL(credit), SUM(lines)
+                FROM ({' UNION ALL '.join(parts)})
+                GROUP BY 1, 2 HAVING SUM(lines) > 0
+                ORDER BY 1, 2
+            """, params)]
@@ -0,0 +1,161 @@
+"""
+Set-based bulk changes selected by a filter.
+
+A filter is a dict using the keys the transaction filters already use:
+account_id, description (substring of the transaction's description),
+date_from and date_to (inclusive), min_amount and max_amount (the line's
+debit or credit), plus classification_id (null selects unclassified lines).
+It selects transaction lines; reclassify() changes the classification of
+every selected line and delete_transactions() deletes every transaction
+with a selected line, lines included. Each runs as a handful of set-based
+statements in one database transaction, and dry_run only counts.
+
+Only the hot database is touched: archived years are read-only. Changes
+that would touch a closed period are refused as a whole (ClosedPeriodError)
+before anything is written, and so are their dry runs. Balance checkpoints follow the deleted lines
+through their triggers (balances.py); reclassifying does not move balances.
+"""
+import json
+
+import balances
+import periods
+
+FILTER_KEYS = ("account_id", "description", "date_from", "date_to", "min_amount", "max_amount",
+               "classification_id")
+AMOUNT = "(COALESCE(debit, 0) + COALESCE(credit, 0))"
+
+
+class ClosedPeriodError(Exception):
+    def __init__(self, through):
+        super().__init__(f"Books are closed through {through}")
+        self.through = through
+
+
+def line_condition(filters):
+    """
+    WHERE clause (over transaction_lines, unaliased) and parameters for a filter
+
+    Raises:
+        ValueError: unknown keys, bad dates or an empty filter
+    """
+    filters = filters or {}
+    unknown = sorted(set(filters) - set(FILTER_KEYS))
+    if unknown:
+        raise ValueError(f"Unknown filter keys: {', '.join(unknown)}")
+    clauses, params = [], []
+    if filters.get('account_id') is not None:
+        clauses.append("account_id = ?")
+        params.append(filters['account_id'])
+    if filters.get('description'):
+        clauses.append("transaction_id IN (SELECT id FROM transactions WHERE description LIKE ?)")
+        params.append(f"%{filters['description']}%")
+    if filters.get('date_from'):
+        clauses.append("date >= ?")
+        params.append(balances.parse_date(str(filters['date_from'])[:10]).isoformat())
+    if filters.get('date_to'):
+        clauses.append("date < ?")
+        params.append(balances.next_day(balances.parse_date(str(filters['date_to'])[:10])))
+    if filters.get('min_amount') is not None:
+        clauses.append(f"{AMOUNT} >= ?")
+        params.append(float(filters['min_amount']))
+    if filters.get('max_amount') is not None:
+        clauses.append(f"{AMOUNT} <= ?")
+        params.append(float(filters['max_amount']))
+    if 'classification_id' in filters:
+        clauses.append("classification_id IS ?")
+        params.append(filters['classification_id'])
+    if not clauses:
+        # Never rewrite the whole ledger by accident
+        raise ValueError("A filter needs at least one condition")
+    return " AND ".join(clauses), params
+
+
+def check_open(conn, condition, params):
+    """Raise ClosedPeriodError if any line matching `condition` lies in a closed period"""
+    through = periods.closed_through(conn)
+    if through is None:
+        return
+    closed = conn.execute(f"""
+        SELECT 1 FROM transaction_lines
+        WHERE ({condition}) AND date(date) <= ?
+        LIMIT 1
+    """, params + [through]).fetchone()
+    if closed:
+        raise ClosedPeriodError(through)
+
+
+def reclassify(conn, filters, classification_id, dry_run=False):
+    """
+    Set the classification of every line matching `filters` and commit
+
+    Lines that already carry `classification_id` are not rewritten.
+
+    Returns:
+        {"lines": lines changed (or that would change), "dry_run": dry_run}
+    """
+    condition, params = line_condition(filters)
+    condition = f"({condition}) AND classification_id IS NOT ?"
+    params = params + [classification_id]
+    if dry_run:
+        # Preview what the real run would do, refusal included
+        check_open(conn, condition, params)
+        count = conn.execute(f"SELECT COUNT(*) FROM transaction_lines WHERE {condition}", params).fetchone()[0]
+        return {"lines": count, "dry_run": True}
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        check_open(conn, condition, params)
+        count = conn.execute(f"UPDATE transaction_lines SET classification_id = ? WHERE {condition}",
+                             [classification_id] + params).rowcount
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return {"lines": count, "dry_run": False}
+
+
+def delete_transactions(conn, filters, dry_run=False):
+    """
+    Delete every transaction with a line matching `filters`, with all its lines, and commit
+
+    Returns:
+        {"transactions": count, "lines": count, "dry_run": dry_run, "deleted": ids,
+        "deltas": {account_id: removed debit - credit}}, without the last
+        two for a dry run
+    """
+    condition, params = line_condition(filters)
+    if dry_run:
+        selected = f"transaction_id IN (SELECT transaction_id FROM transaction_lines WHERE {condition})"
+        check_open(conn, selected, params)
+        transactions, lines = conn.execute(f"""
+            SELECT COUNT(DISTINCT transaction_id), COUNT(*) FROM transaction_lines WHERE {selected}
+        """, params).fetchone()
+        return {"transactions": transactions, "lines": lines, "dry_run": True}
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        deleted = [row[0] for row in conn.execute(f"""
+            SELECT DISTINCT transaction_id FROM transaction_lines WHERE {condition} ORDER BY transaction_id
+        """, params)]
+        # The ids travel as one JSON array parameter, however many there are
+        selected = "transaction_id IN (SELECT value FROM json_each(?))"
+        ids = [json.dumps(deleted)]
+        # Whole transactions go, so their other lines must be open as well
+        check_open(conn, selected, ids)
+        deltas = dict(conn.execute(f"""
+            SELECT account_id, SUM(COALESCE(debit, 0)) - SUM(COALESCE(credit, 0)) FROM transaction_lines
+            WHERE {selected}
+            GROUP BY account_id
+        """, ids).fetchall())
+        lines = conn.execute(f"DELETE FROM transaction_lines WHERE {selected}", ids).rowcount
+        # Imported lines these transactions consumed can be matched again
+        conn.execute(f"""
+            UPDATE orphan_transaction_lines SET status = 'new', transaction_id = NULL
+            WHERE {selected}
+        """, ids)
+        transactions = conn.execute("DELETE FROM transactions WHERE id IN (SELECT value FROM json_each(?))",
+                                    ids).rowcount
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return {"transactions": transactions, "lines": lines, "dry_run": False, "deleted": deleted,
+            "deltas": deltas}
@@ -0,0 +1,260 @@
+"""
+Bulk work on a ledger from the command line, straight against the database.
+
+Imports read CSV or OFX files of any size: worker processes parse them in
+chunks while this process writes, and an interrupted import carries on
+where it stopped when the same command is run again (see transfer.py).
+Progress and skipped lines go to stderr; exports and reports go to stdout
+or --output.
+
+The server can keep running meanwhile. Every command that writes bumps the
+shared table version counters of what it wrote (announce()), and servers
+notice them on their next request, whether in multi-worker mode
+(workers.py) or not (versions.WatchedTableVersions), so they drop what they
+cached about the changed tables.
+
+Usage (from the backend directory):
+    python cli.py import statement.csv --into orphans --account Checking
+    python cli.py import bank.ofx --account Checking --contra "Uncleared"
+    python cli.py import transactions.csv            (an export, back into transactions)
+    python cli.py export [--from 2024-01-01] [--to 2024-12-31] [--output transactions.csv]
+    python cli.py rebuild [checkpoints] [month-totals] [analytics] [recurring] [classifications]
+    python cli.py report trial-balance [--as-of 2024-12-31]
+    python cli.py report totals --by classification [--from 2024-01-01] [--to 2024-12-31]
+    python cli.py report trend [--granularity month]
+    python cli.py report recurring
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import sys
+import time
+
+import analytics
+import balances
+import budgets
+import recurring
+import rules
+import transfer
+import versions
+from database import Database
+
+REBUILDS = ("checkpoints", "month-totals", "analytics", "recurring", "classifications")
+REPORTS = ("trial-balance", "totals", "trend", "recurring")
+# Tables a rebuild writes, announced once it is done (classifications only when it changed lines)
+REBUILD_TABLES = {
+    "checkpoints": ("balance_checkpoints",),
+    "month-totals": ("line_month_totals",),
+    "recurring": ("recurring_occurrences", "recurring_series"),
+}
+# Tables an import writes, by target
+IMPORT_TABLES = {
+    "transactions": ("transactions", "transaction_lines"),
+    "orphans": ("orphan_transactions", "orphan_transaction_lines"),
+}
+
+
+class Progress:
+    """Progress line on stderr, rewritten in place"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+
+    def __call__(self, position, size, counters):
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        print(f"\r{position / max(size, 1):6.1%}  {position / 2 ** 20:,.0f}/{size / 2 ** 20:,.0f} MB  "
+              f"{counters['lines']:,} lines  {position / 2 ** 20 / elapsed:,.1f} MB/s", end="", file=sys.stderr,
+              flush=True)
+
+    def skip(self, line, reason):
+        print(f"\rline {line}: {reason}", file=sys.stderr)
+
+    def done(self):
+        print(file=sys.stderr)
+
+
+def announce(db_path, *tables):
+    """Bump the shared version counters of `tables` for running servers"""
+    table_versions = versions.SharedTableVersions(db_path)
+    try:
+        table_versions.bump(*tables)
+    finally:
+        table_versions.close()
+
+
+def analytics_dir(args):
+    return args.analytics_dir or os.path.splitext(args.db)[0] + "-analytics"
+
+
+def write_rows(args, fields, rows):
+    """Report rows to --output (default stdout) as CSV or JSON"""
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        if args.format == "json":
+            json.dump([dict(zip(fields, row)) for row in rows], output, indent=2, default=str)
+            output.write("\n")
+        else:
+            writer = csv.writer(output)
+            writer.writerow(fields)
+            writer.writerows(rows)
+    finally:
+        if args.output:
+            output.close()
+
+
+def run_import(db, args):
+    progress = Progress()
+    result = None
+    try:
+        result = transfer.import_file(db.conn, db.reference, args.file, target=args.into, file_format=args.format,
+                                      account=args.account, contra=args.contra, currency=args.currency,
+                                      reference=args.reference, date_format=args.date_format,
+                                      encoding=args.encoding, workers=args.workers,
+                                      chunk_bytes=int(args.chunk_mb * 2 ** 20), restart=args.restart,
+                                      progress=progress, skip=progress.skip)
+    finally:
+        progress.done()
+        # Whatever was committed, finished or not
+        announce(args.db, *IMPORT_TABLES[args.into])
+    if result["already_imported"]:
+        print(f"{args.file} was imported already (--restart imports it again)")
+        return
+    elapsed = time.perf_counter() - progress.started
+    print(f"{'resumed and ' if result['resumed'] else ''}imported {args.file} into {args.into} in {elapsed:.1f}s: "
+          f"{result['lines']} lines, {result['transactions']} transactions, {result['duplicates']} duplicates, "
+          f"{result['skipped']} skipped")
+
+
+def run_export(db, args):
+    cursor = transfer.export_rows(db.conn, args.date_from, args.date_to, by_transaction=True)
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        count = transfer.write_csv(cursor, output, progress=lambda rows: print(
+            f"\r{rows:,} lines", end="", file=sys.stderr, flush=True))
+    finally:
+        if args.output:
+            output.close()
+    print(f"\rexported {count} lines", file=sys.stderr)
+
+
+def run_rebuild(db, args):
+    conn = db.conn
+    for target in args.targets or REBUILDS:
+        started = time.perf_counter()
+        if target == "checkpoints":
+            conn.execute("DELETE FROM balance_checkpoints")
+            result = {"checkpoints_written": balances.refresh_checkpoints(conn)}
+        elif target == "month-totals":
+            result = {"rows": budgets.rebuild(conn)}
+        elif target == "analytics":
+            cache = analytics.ColumnCache(analytics_dir(args))
+            with cache.lock:
+                cache.rebuild(conn)
+            result = {"lines": cache.state["count"]}
+        elif target == "recurring":
+            result = recurring.detect(conn, full=True)
+        else:
+            result = rules.apply(conn, overwrite=args.overwrite)
+            result = {key: result[key] for key in ("lines", "classified")}
+            if result["classified"]:
+                announce(args.db, "transaction_lines")
+        if target in REBUILD_TABLES:
+            announce(args.db, *REBUILD_TABLES[target])
+        print(f"{target}: {json.dumps(result)} in {time.perf_counter() - started:.1f}s")
+
+
+def run_report(db, args):
+    conn = db.conn
+    if args.report == "trial-balance":
+        as_of = balances.parse_date(args.as_of) if args.as_of else datetime.date.today()
+        if balances.refresh_checkpoints(conn):
+            announce(args.db, *REBUILD_TABLES["checkpoints"])
+        rows, _ = balances.trial_balance(conn, as_of)
+        write_rows(args, balances.TRIAL_BALANCE_FIELDS, rows)
+    elif args.report == "recurring":
+        recurring.detect(conn)
+        announce(args.db, *REBUILD_TABLES["recurring"])
+        write_rows(args, recurring.SERIES_FIELDS, recurring.series(conn))
+    else:
+        columns = analytics.ColumnCache(analytics_dir(args)).refresh(conn)
+        mask = columns.select(args.date_from, args.date_to)
+        reference = db.reference.snapshot(conn)
+        if args.report == "totals":
+            keys, debit, credit, lines = analytics.group_totals(columns, args.by, mask)
+            write_rows(args, analytics.LABELLED_FIELDS,
+                       analytics.labelled_rows(args.by, keys, debit, credit, lines, reference))
+        else:
+            keys, debit, credit, lines, cumulative = analytics.trend(columns, args.granularity, mask)
+            rows = analytics.labelled_rows(args.granularity, keys, debit, credit, lines, reference)
+            write_rows(args, analytics.LABELLED_FIELDS + ("cumulative_net",),
+                       [row + (value,) for row, value in zip(rows, (cumulative / 100).round(2).tolist())])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=os.environ.get("FINANCE_DB", "finance.db"))
+    parser.add_argument("--analytics-dir", help="Analytics cache (default: <db>-analytics next to the database)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_command = commands.add_parser("import", help="Import a CSV or OFX file")
+    import_command.add_argument("file")
+    import_command.add_argument("--into", choices=transfer.TARGETS, default="transactions")
+    import_command.add_argument("--format", choices=transfer.FORMATS, help="Default: by the file's extension")
+    import_command.add_argument("--account", help="Account of every statement line (default: the account "
+                                                  "column, or the OFX account id)")
+    import_command.add_argument("--contra", help="Account balancing each statement line (into transactions)")
+    import_command.add_argument("--currency", help="Currency of every transaction")
+    import_command.add_argument("--reference", help="Reference of the orphan transaction (default: file name)")
+    import_command.add_argument("--date-format", help="strptime format of CSV dates (default: YYYY-MM-DD)")
+    import_command.add_argument("--encoding", default="utf-8")
+    import_command.add_argument("--workers", type=int, help="Parser processes (default: one per core)")
+    import_command.add_argument("--chunk-mb", type=float, default=transfer.CHUNK_BYTES / 2 ** 20)
+    import_command.add_argument("--restart", action="store_true", help="Import from the start, even if the "
+                                                                       "file was (partly) imported before")
+
+    export_command = commands.add_parser("export", help="Export transaction lines as CSV")
+    export_command.add_argument("--from", dest="date_from")
+    export_command.add_argument("--to", dest="date_to")
+    export_command.add_argument("--output", help="Default: stdout")
+
+    rebuild_command = commands.add_parser("rebuild", help="Rebuild derived tables (default: all)")
+    rebuild_command.add_argument("targets", nargs="*", metavar="TARGET", help=", ".join(REBUILDS))
+    rebuild_command.add_argument("--overwrite", action="store_true",
+                                 help="Reclassify lines that have a classification too")
+
+    report_command = commands.add_parser("report", help="Print a report")
+    report_command.add_argument("report", choices=REPORTS)
+    report_command.add_argument("--as-of", help="Trial balance date (default: today)")
+    report_command.add_argument("--from", dest="date_from")
+    report_command.add_argument("--to", dest="date_to")
+    report_command.add_argument("--by", choices=analytics.GROUPINGS, default="account")
+    report_command.add_argument("--granularity", choices=("day", "month", "year"), default="month")
+    report_command.add_argument("--format", choices=("csv", "json"), default="csv")
+    report_command.add_argument("--output", help="Default: stdout")
+    args = parser.parse_args()
+
+    if args.command == "rebuild" and set(args.targets) - set(REBUILDS):
+        rebuild_command.error(f"targets are {', '.join(REBUILDS)}")
+    if not os.path.isfile(args.db):
+        parser.exit(1, f"{args.db}: no such database\n")
+    db = Database(args.db)
+    # Wait for the server's writes rather than fail
+    db.conn.execute("PRAGMA busy_timeout = 30000")
+    # VM step metrics are only reported by the server
+    db.conn.set_progress_handler(None, 0)
+    try:
+        {"import": run_import, "export": run_export, "rebuild": run_rebuild, "report": run_report}[args.command](
+            db, args)
+    except ValueError as e:
+        parser.exit(1, f"{e}\n")
+    except KeyboardInterrupt:
+        message = "; run the same command again to resume" if args.command == "import" else ""
+        parser.exit(130, f"\ninterrupted{message}\n")
+    finally:
+        db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
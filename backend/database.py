@@ -1,10 +1,26 @@
 import sqlite3
 import datetime
 
+import analytics
+import archive
+import balances
+import budgets
+import bulk
+import fingerprints
+import periods
+import recurring
+import refdata
+import rules
+import transfer
+import versions
+from metrics import InstrumentedConnection
+
 class Database:
     def __init__(self, db_name):
-        self.conn = sqlite3.connect(db_name, isolation_level="DEFERRED")
+        self.conn = sqlite3.connect(db_name, isolation_level="DEFERRED", factory=InstrumentedConnection)
         self.cursor = self.conn.cursor()
+        # Shared with every Database on the same file; lookups by id and name go through it
+        self.reference = refdata.for_path(db_name)
         self.create_tables()
 
     def create_tables(self):
@@ -149,6 +165,17 @@ class Database:
         self.cursor.execute('''CREATE INDEX IF NOT EXISTS idx_transaction_lines_date ON transaction_lines (date)''')
         self.cursor.execute('''CREATE INDEX IF NOT EXISTS idx_transaction_lines_transaction_date 
                                ON transaction_lines (transaction_id, date)''')
+        balances.create_schema(self.cursor)
+        periods.create_schema(self.cursor)
+        archive.create_schema(self.cursor)
+        rules.create_schema(self.cursor)
+        refdata.create_schema(self.cursor)
+        analytics.create_schema(self.cursor)
+        recurring.create_schema(self.cursor)
+        fingerprints.create_schema(self.cursor)
+        versions.create_schema(self.cursor)
+        transfer.create_schema(self.cursor)
+        budgets.create_schema(self.cursor)
 
         # Create triggers
         self.cursor.execute('''CREATE TRIGGER IF NOT EXISTS ensure_debit_credit_positive
@@ -231,41 +258,41 @@ class Database:
         return self.cursor.fetchall()
 
     def get_transactions(self):
-        self.cursor.execute("SELECT * FROM transactions")
+        transactions = archive.tables(self.conn)[1]
+        self.cursor.execute(f"SELECT * FROM {transactions}")
         return self.cursor.fetchall()
 
     def get_transaction_lines(self, transaction_id):
-        self.cursor.execute('''
+        lines, transactions = archive.transaction_tables(self.conn, transaction_id)
+        self.cursor.execute(f'''
             SELECT tl.id, tl.transaction_id, tl.account_id, tl.debit, tl.credit, tl.date, t.currency_id, tl.classification_id
-            FROM transaction_lines tl
-            JOIN transactions t ON tl.transaction_id = t.id
+            FROM {lines} tl
+            JOIN {transactions} t ON tl.transaction_id = t.id
             WHERE tl.transaction_id = ?
         ''', (transaction_id,))
         return self.cursor.fetchall()
 
+    def reference_data(self):
+        """Snapshot of the reference tables (see refdata.py); take one for many lookups"""
+        return self.reference.snapshot(self.conn)
+
     def get_categories(self):
-        self.cursor.execute("SELECT name FROM cat")
-        return [row[0] for row in self.cursor.fetchall()]
+        return [row[1] for row in self.reference_data().categories]
 
     def get_category_id(self, name):
-        self.cursor.execute("SELECT id FROM cat WHERE name = ?", (name,))
-        return self.cursor.fetchone()[0]
+        return self.reference_data().categories.by_name[name][0]
 
     def get_currencies(self):
-        self.cursor.execute("SELECT name FROM currency")
-        return [row[0] for row in self.cursor.fetchall()]
+        return [row[1] for row in self.reference_data().currencies]
 
     def get_currency_id(self, name):
-        self.cursor.execute("SELECT id FROM currency WHERE name = ?", (name,))
-        return self.cursor.fetchone()[0]
+        return self.reference_data().currencies.by_name[name][0]
 
     def get_accounts(self):
-        self.cursor.execute("SELECT name FROM accounts")
-        return [row[0] for row in self.cursor.fetchall()]
+        return [row[1] for row in self.reference_data().accounts]
 
     def get_account_id(self, name):
-        self.cursor.execute("SELECT id FROM accounts WHERE name = ?", (name,))
-        return self.cursor.fetchone()[0]
+        return self.reference_data().accounts.by_name[name][0]
 
     # Add these methods to the Database class
 
@@ -306,41 +333,31 @@ class Database:
         self.conn.commit()
 
     def get_credit_card_by_account_id(self, account_id):
-        self.cursor.execute("SELECT * FROM ccards WHERE account_id = ?", (account_id,))
-        return self.cursor.fetchone()
+        return self.reference_data().credit_cards_by_account.get(account_id)
 
     # Add to database.py
     def get_credit_card_details(self, account_id):
-        self.cursor.execute("""
-            SELECT id, credit_limit, close_day, due_day
-            FROM ccards
-            WHERE account_id = ?
-        """, (account_id,))
-        result = self.cursor.fetchone()
+        result = self.reference_data().credit_cards_by_account.get(account_id)
         if result:
             return {
                 'id': result[0],
-                'credit_limit': result[1],
-                'close_day': result[2],
-                'due_day': result[3]
+                'credit_limit': result[2],
+                'close_day': result[3],
+                'due_day': result[4]
             }
         return None
 
     def is_credit_card(self, account_id):
-        self.cursor.execute("SELECT COUNT(*) FROM ccards WHERE account_id = ?", (account_id,))
-        return self.cursor.fetchone()[0] > 0
+        return account_id in self.reference_data().credit_cards_by_account
 
     def get_all_classifications(self):
-        self.cursor.execute("SELECT id, name FROM classifications")
-        return self.cursor.fetchall()
+        return [row[:2] for row in self.reference_data().classifications]
 
     def get_classification_by_id(self, id):
-        self.cursor.execute("SELECT * FROM classifications WHERE id = ?", (id,))
-        return self.cursor.fetchone()
+        return self.reference_data().classifications.by_id.get(id)
 
     def get_classification_by_name(self, name):
-        self.cursor.execute("SELECT * FROM classifications WHERE name = ?", (name,))
-        return self.cursor.fetchone()
+        return self.reference_data().classifications.by_name.get(name)
 
     def update_classification(self, id, name):
         self.cursor.execute("UPDATE classifications SET name = ? WHERE id = ?", (name, id))
@@ -351,54 +368,42 @@ class Database:
         self.conn.commit()
 
     def get_account_by_id(self, id):
-        self.cursor.execute("SELECT * FROM accounts WHERE id = ?", (id,))
-        return self.cursor.fetchone()
+        return self.reference_data().accounts.by_id.get(id)
 
     def get_category_by_id(self, id):
-        self.cursor.execute("SELECT * FROM cat WHERE id = ?", (id,))
-        return self.cursor.fetchone()
+        return self.reference_data().categories.by_id.get(id)
 
     def get_currency_by_id(self, id):
-        self.cursor.execute("SELECT * FROM currency WHERE id = ?", (id,))
-        return self.cursor.fetchone()
+        return self.reference_data().currencies.by_id.get(id)
 
     def get_category_by_name(self, name):
-        self.cursor.execute("SELECT * FROM cat WHERE name = ?", (name,))
-        return self.cursor.fetchone()
+        return self.reference_data().categories.by_name.get(name)
 
     def get_all_categories(self):
-        self.cursor.execute("SELECT id, name FROM cat")
-        return self.cursor.fetchall()
+        return [row[:2] for row in self.reference_data().categories]
 
     def get_all_currencies(self):
-        self.cursor.execute("SELECT id, name, exchange_rate FROM currency")
-        return self.cursor.fetchall()
+        return [row[:3] for row in self.reference_data().currencies]
 
     def get_all_accounts(self):
-        self.cursor.execute("""
-            SELECT a.id, a.name, c.name as category, cu.name as currency, a.nature, a.term
-            FROM accounts a
-            JOIN cat c ON a.cat_id = c.id
-            LEFT JOIN currency cu ON a.default_currency_id = cu.id
-        """)
-        return self.cursor.fetchall()
+        """(id, name, category, currency, nature, term) of every account with a category"""
+        reference = self.reference_data()
+        return [(id, name, reference.categories.name(cat_id), reference.currencies.name(currency_id), nature, term)
+                for id, name, cat_id, currency_id, nature, term in reference.accounts
+                if cat_id in reference.categories.by_id]
 
     def get_all_credit_cards(self):
-        self.cursor.execute("""
-            SELECT cc.id, a.name, cc.credit_limit, cc.close_day, cc.due_day, cu.name as currency
-            FROM ccards cc
-            JOIN accounts a ON cc.account_id = a.id
-            LEFT JOIN currency cu ON a.default_currency_id = cu.id
-        """)
-        return self.cursor.fetchall()
+        """(id, account name, credit_limit, close_day, due_day, currency) of every credit card"""
+        reference = self.reference_data()
+        cards = []
+        for id, account_id, credit_limit, close_day, due_day in reference.credit_cards:
+            account = reference.accounts.by_id.get(account_id)
+            if account:
+                cards.append((id, account[1], credit_limit, close_day, due_day, reference.currencies.name(account[3])))
+        return cards
 
     def get_credit_card_by_id(self, id):
-        self.cursor.execute("""
-            SELECT cc.id, cc.account_id, cc.credit_limit, cc.close_day, cc.due_day
-            FROM ccards cc
-            WHERE cc.id = ?
-        """, (id,))
-        result = self.cursor.fetchone()
+        result = self.reference_data().credit_cards.by_id.get(id)
         if result:
             return {
                 'id': result[0],
@@ -410,24 +415,19 @@ class Database:
         return None
 
     def get_account_details(self, account_id):
-        self.cursor.execute("""
-            SELECT a.id, a.name, a.cat_id, a.default_currency_id, c.name, cu.name, a.nature, a.term
-            FROM accounts a
-            JOIN cat c ON a.cat_id = c.id
-            LEFT JOIN currency cu ON a.default_currency_id = cu.id
-            WHERE a.id = ?
-        """, (account_id,))
-        result = self.cursor.fetchone()
-        if result:
+        reference = self.reference_data()
+        result = reference.accounts.by_id.get(account_id)
+        # Inner join on the category, as before
+        if result and result[2] in reference.categories.by_id:
             return {
                 'id': result[0],
                 'name': result[1],
                 'category_id': result[2],
                 'currency_id': result[3],
-                'category_name': result[4],
-                'currency_name': result[5],
-                'nature': result[6],
-                'term': result[7]
+                'category_name': reference.categories.name(result[2]),
+                'currency_name': reference.currencies.name(result[3]),
+                'nature': result[4],
+                'term': result[5]
             }
         return None
 
@@ -437,6 +437,10 @@ class Database:
             WHERE account_id = ?
         """, (account_id,))
         count = self.cursor.fetchone()[0]
+        if not count:
+            # Archived years keep per-account totals in the main database
+            self.cursor.execute("SELECT COUNT(*) FROM archive_account_totals WHERE account_id = ?", (account_id,))
+            count = self.cursor.fetchone()[0]
         return count > 0
 
     def get_credit_card_statement(self, account_id, month, year):
@@ -444,10 +448,11 @@ class Database:
         start_date = f"{year}-{month:02d}-01"
         end_date = f"{year}-{month:02d}-31" if month != 2 else f"{year}-{month:02d}-28"
 
-        self.cursor.execute("""
+        lines, transactions = archive.tables(self.conn, start_date, f"{year + month // 12}-{month % 12 + 1:02d}-01")
+        self.cursor.execute(f"""
             SELECT tl.date, t.description, tl.debit - tl.credit as amount
-            FROM transaction_lines tl
-            JOIN transactions t ON tl.transaction_id = t.id
+            FROM {lines} tl
+            JOIN {transactions} t ON tl.transaction_id = t.id
             WHERE tl.account_id = ? AND tl.date BETWEEN ? AND ?
             ORDER BY tl.date
         """, (account_id, start_date, end_date))
@@ -491,6 +496,16 @@ class Database:
         )
         self.conn.commit()
 
+    def reclassify_transaction_lines(self, filters, classification_id, dry_run=False):
+        """Set the classification of every line matching `filters` (see bulk.py) in one statement"""
+        return bulk.reclassify(self.conn, filters, classification_id, dry_run)
+
+    def delete_transactions_matching(self, filters, dry_run=False):
+        """Delete every transaction with a line matching `filters` (see bulk.py)"""
+        result = bulk.delete_transactions(self.conn, filters, dry_run)
+        result.pop("deltas", None)
+        return result
+
     def unlink_account_classification(self, account_id, classification_id):
         self.cursor.execute(
             "DELETE FROM account_classifications WHERE account_id = ? AND classification_id = ?",
@@ -578,11 +593,17 @@ class Database:
 
     def get_transaction_count(self, filter_params=None):
         """Get the total number of transactions matching the filter"""
+        # Only the archived years the date filters reach are read
+        date_to = (filter_params or {}).get('date_to')
+        lines, transactions = archive.tables(self.conn, (filter_params or {}).get('date_from'),
+                                             balances.next_day(balances.parse_date(str(date_to)[:10]))
+                                             if date_to else None)
+
         # Build the query dynamically based on filters
-        base_query = """
+        base_query = f"""
             SELECT COUNT(DISTINCT t.id)
-            FROM transactions t
-            JOIN transaction_lines tl ON t.id = tl.transaction_id
+            FROM {transactions} t
+            JOIN {lines} tl ON t.id = tl.transaction_id
         """
 
         where_clauses = []
@@ -624,10 +645,10 @@ class Database:
             # Get all transaction IDs that match the other filters
             if not where_clauses:
                 self.cursor.execute(
-                    "SELECT DISTINCT t.id FROM transactions t JOIN transaction_lines tl ON t.id = tl.transaction_id")
+                    f"SELECT DISTINCT t.id FROM {transactions} t JOIN {lines} tl ON t.id = tl.transaction_id")
             else:
                 self.cursor.execute(
-                    "SELECT DISTINCT t.id FROM transactions t JOIN transaction_lines tl ON t.id = tl.transaction_id WHERE " +
+                    f"SELECT DISTINCT t.id FROM {transactions} t JOIN {lines} tl ON t.id = tl.transaction_id WHERE " +
                     " AND ".join(where_clauses),
                     params
                 )
@@ -637,7 +658,7 @@ class Database:
             # For each transaction, calculate the total and apply amount filters
             for transaction_id in transaction_ids:
                 self.cursor.execute(
-                    "SELECT SUM(IFNULL(tl.debit, 0)) FROM transaction_lines tl WHERE tl.transaction_id = ?",
+                    f"SELECT SUM(IFNULL(tl.debit, 0)) FROM {lines} tl WHERE tl.transaction_id = ?",
                     (transaction_id,)
                 )
                 total_amount = self.cursor.fetchone()[0] or 0
@@ -659,9 +680,10 @@ class Database:
 
     def get_transaction_by_id(self, id):
         """Get a transaction by ID"""
-        self.cursor.execute("""
+        transactions = archive.transaction_tables(self.conn, id)[1]
+        self.cursor.execute(f"""
             SELECT t.id, t.description, t.currency_id, c.name as currency_name
-            FROM transactions t
+            FROM {transactions} t
             JOIN currency c ON t.currency_id = c.id
             WHERE t.id = ?
         """, (id,))
@@ -677,11 +699,12 @@ class Database:
 
     def get_transaction_lines_by_type(self, transaction_id, is_debit=True):
         """Get transaction lines of a specific type (debit or credit)"""
-        query = """
+        lines = archive.transaction_tables(self.conn, transaction_id)[0]
+        query = f"""
             SELECT tl.id, tl.account_id, a.name as account_name, 
                    tl.debit, tl.credit, tl.date, tl.classification_id, 
                    c.name as classification_name
-            FROM transaction_lines tl
+            FROM {lines} tl
             JOIN accounts a ON tl.account_id = a.id
             LEFT JOIN classifications c ON tl.classification_id = c.id
             WHERE tl.transaction_id = ? AND 
@@ -734,7 +757,7 @@ class Database:
         query = """
             SELECT otl.id, otl.orphan_transaction_id, otl.description, 
                    otl.account_id, a.name as account_name, 
-                   otl.debit, otl.credit, otl.status, otl.transaction_id, otl.notes
+                   otl.debit, otl.credit, otl.status, otl.transaction_id, otl.notes, otl.classification_id
             FROM orphan_transaction_lines otl
             LEFT JOIN accounts a ON otl.account_id = a.id
             WHERE 1=1
@@ -764,7 +787,8 @@ class Database:
                 'credit': row[6],
                 'status': row[7],
                 'transaction_id': row[8],
-                'notes': row[9] if len(row) > 9 else None
+                'notes': row[9] if len(row) > 9 else None,
+                'classification_id': row[10]
             })
 
         return results
@@ -773,17 +797,49 @@ class Database:
         """
         Insert a new orphan transaction with its lines
 
+        Lines that were already imported are skipped (see import_orphan_transaction).
+
+        Args:
+            reference: Reference for this batch import (e.g., filename)
+            lines_data: List of dicts with line data (description, account_id, debit, credit and
+                optionally classification_id; lines without one are classified by the rules). A date,
+                when the statement has one, is stored with the line and goes into its fingerprint
+
+        Returns:
+            Orphan transaction ID, or None when every line was a duplicate
+        """
+        return self.import_orphan_transaction(reference, lines_data)['orphan_transaction_id']
+
+    def import_orphan_transaction(self, reference, lines_data, skip_duplicates=True):
+        """
+        Insert a new orphan transaction with the lines of a statement that were not imported before
+
+        Each line is fingerprinted (see fingerprints.py) and the whole batch is
+        checked against the stored fingerprints in one lookup.
+
         Args:
             reference: Reference for this batch import (e.g., filename)
-            lines_data: List of dicts with line data (description, account_id, debit, credit)
+            lines_data: As for insert_orphan_transaction
+            skip_duplicates: Leave duplicate lines out (default), or store them
+                as ignored lines pointing at the line they repeat
 
         Returns:
-            Orphan transaction ID
+            Dict with orphan_transaction_id (None when nothing was stored), the
+            number of lines stored and the duplicates as {"index": position in
+            lines_data, "line_id": orphan line already holding it}
         """
         try:
             # Start a transaction
             self.begin_transaction()
 
+            line_fingerprints = fingerprints.fingerprint_lines(lines_data)
+            existing = fingerprints.duplicates(self.conn, line_fingerprints)
+            duplicates = [{"index": index, "line_id": existing[fingerprint]}
+                          for index, fingerprint in enumerate(line_fingerprints) if fingerprint in existing]
+            if skip_duplicates and len(duplicates) == len(lines_data) and lines_data:
+                self.commit_transaction()
+                return {"orphan_transaction_id": None, "inserted": 0, "duplicates": duplicates}
+
             # Insert the orphan transaction
             import_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             self.cursor.execute(
@@ -791,9 +847,16 @@ class Database:
                 (reference, import_date)
             )
             orphan_transaction_id = self.cursor.lastrowid
+            ruleset = rules.load(self.conn)
 
-            # Insert each line
-            for line in lines_data:
+            # Add a notes column to orphan_transaction_lines if it doesn't exist
+            try:
+                self.cursor.execute("SELECT notes FROM orphan_transaction_lines LIMIT 1")
+            except sqlite3.OperationalError:
+                self.cursor.execute("ALTER TABLE orphan_transaction_lines ADD COLUMN notes TEXT")
+
+            rows = []
+            for line, fingerprint in zip(lines_data, line_fingerprints):
                 # Set status based on validity - use 'ignored' for invalid lines
                 status = 'new' if line.get('valid', True) else 'ignored'
 
@@ -801,35 +864,35 @@ class Database:
                 account_id = line.get('account_id')
                 debit = line.get('debit')
                 credit = line.get('credit')
+                classification_id = line.get('classification_id')
+                if classification_id is None:
+                    classification_id = ruleset.classify(description, account_id, rules.line_amount(debit, credit))
 
                 # Store original account name if it couldn't be resolved
                 notes = None
                 if not account_id and line.get('account_name'):
-                    notes = f"Original account name: {line.get('account_name')}"
+                    notes = f"{fingerprints.ACCOUNT_NAME_NOTE}{line.get('account_name')}"
 
-                # Add a notes column to orphan_transaction_lines if it doesn't exist
-                try:
-                    self.cursor.execute("SELECT notes FROM orphan_transaction_lines LIMIT 1")
-                except sqlite3.OperationalError:
-                    self.cursor.execute("ALTER TABLE orphan_transaction_lines ADD COLUMN notes TEXT")
+                if fingerprint in existing:
+                    if skip_duplicates:
+                        continue
+                    status = 'ignored'
+                    notes = f"Duplicate of imported line {existing[fingerprint]}"
+                    fingerprint = None
 
-                self.cursor.execute("""
-                    INSERT INTO orphan_transaction_lines 
-                    (orphan_transaction_id, description, account_id, debit, credit, status, notes)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    orphan_transaction_id,
-                    description,
-                    account_id,
-                    debit,
-                    credit,
-                    status,
-                    notes
-                ))
+                rows.append((orphan_transaction_id, description, account_id, debit, credit, status, notes,
+                             classification_id, line.get('date'), fingerprint))
+
+            self.cursor.executemany("""
+                INSERT INTO orphan_transaction_lines 
+                (orphan_transaction_id, description, account_id, debit, credit, status, notes, classification_id,
+                 date, fingerprint)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
 
             # Commit transaction
             self.commit_transaction()
-            return orphan_transaction_id
+            return {"orphan_transaction_id": orphan_transaction_id, "inserted": len(rows), "duplicates": duplicates}
 
         except Exception as e:
             # Rollback on error
@@ -893,7 +956,7 @@ class Database:
             orphan_lines = []
             for line_id in orphan_line_ids:
                 self.cursor.execute("""
-                    SELECT description, account_id, debit, credit
+                    SELECT description, account_id, debit, credit, classification_id
                     FROM orphan_transaction_lines
                     WHERE id = ? AND status = 'new'
                 """, (line_id,))
@@ -907,7 +970,8 @@ class Database:
                     'description': line[0],
                     'account_id': line[1],
                     'debit': line[2] or 0,
-                    'credit': line[3] or 0
+                    'credit': line[3] or 0,
+                    'classification_id': line[4]
                 })
 
             # Calculate the imbalance
@@ -925,14 +989,14 @@ class Database:
                 self.cursor.execute("""
                     INSERT INTO transaction_lines
                     (transaction_id, account_id, debit, credit, date, classification_id)
-                    VALUES (?, ?, ?, ?, ?, NULL)
+                    VALUES (?, ?, ?, ?, ?, ?)
                 """, (
                     transaction_id,
                     line['account_id'],
                     line['debit'] or None,
                     line['credit'] or None,
                     balancing_date,  # Use the balancing date for consistency
-                    None
+                    line['classification_id']
                 ))
 
                 # Mark the orphan line as consumed
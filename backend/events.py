@@ -0,0 +1,168 @@
+"""
+Server-sent events of ledger changes.
+
+Write endpoints publish compact change events: which transactions were
+created, updated or deleted and the resulting debit - credit delta per
+account. table_versions reports every table bump here as well, so clients
+also learn when reference data changed and what its new version is. Each
+ledger has its own broker (ledgers.py), so clients only hear of theirs.
+
+Events are not sent one by one. The first event after a quiet spell
+schedules a flush COALESCE_SECONDS later, and everything published until
+then goes out as one `changes` message: account deltas are summed, table
+versions keep their latest value and a burst of more than MAX_TRANSACTIONS
+transactions is sent as `"truncated": true`, telling clients to refetch.
+
+Subscribers share a single future that the flush resolves, plus a short
+history of recent messages, so an idle subscriber costs one suspended
+coroutine and nothing per message. A client that reconnects with
+Last-Event-ID gets the messages it missed, or a `reset` event when they are
+no longer in the history.
+"""
+import asyncio
+import collections
+import threading
+
+import orjson
+
+COALESCE_SECONDS = 0.05
+KEEPALIVE_SECONDS = 15
+HISTORY_SIZE = 256
+MAX_TRANSACTIONS = 100
+
+
+class ChangeBroker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.subscribers = 0
+        self.pending = None
+        self.sequence = 0
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+        self.changed = None
+
+    def bind(self, loop):
+        """Use `loop` for flushing and waking subscribers (the server's event loop)"""
+        with self.lock:
+            if self.loop is not loop:
+                self.loop = loop
+                self.changed = loop.create_future()
+
+    def publish_transaction(self, transaction_id, action, deltas):
+        """
+        Record a transaction change
+
+        Args:
+            action: "created", "updated" or "deleted"
+            deltas: Dict of account id -> change in debit - credit
+        """
+        self.publish(transactions=[{"id": transaction_id, "action": action}], accounts=deltas)
+
+    def publish_tables(self, versions):
+        """Record new table versions (dict of table -> version)"""
+        self.publish(tables=versions)
+
+    def publish(self, transactions=(), accounts=None, tables=None):
+        """Merge a change into the pending message; safe to call from any thread"""
+        with self.lock:
+            if self.loop is None or not self.subscribers:
+                return
+            schedule = self.pending is None
+            if schedule:
+                self.pending = {"transactions": [], "accounts": {}, "tables": {}}
+            pending = self.pending
+            pending["transactions"].extend(transactions)
+            for account_id, delta in (accounts or {}).items():
+                pending["accounts"][account_id] = pending["accounts"].get(account_id, 0.0) + delta
+            pending["tables"].update(tables or {})
+            loop = self.loop
+        if schedule:
+            loop.call_soon_threadsafe(loop.call_later, COALESCE_SECONDS, self.flush)
+
+    def flush(self):
+        """Send the pending message to every subscriber (runs on the event loop)"""
+        with self.lock:
+            pending, self.pending = self.pending, None
+            if pending is None:
+                return
+            self.sequence += 1
+            transactions = pending["transactions"]
+            message = {
+                "transactions": transactions[:MAX_TRANSACTIONS],
+                "truncated": len(transactions) > MAX_TRANSACTIONS,
+                "accounts": {str(account_id): round(delta, 2)
+                             for account_id, delta in pending["accounts"].items() if round(delta, 2)},
+                "tables": pending["tables"],
+            }
+            self.history.append((self.sequence, format_event("changes", message, self.sequence)))
+            changed, self.changed = self.changed, self.loop.create_future()
+        changed.set_result(None)
+
+    def missed(self, last_seen):
+        """
+        Messages after sequence `last_seen`
+
+        Returns:
+            (list of formatted events, or None when some of them have already
+            dropped out of the history; the sequence they bring the client to;
+            the future resolved by the next flush)
+        """
+        with self.lock:
+            if last_seen > self.sequence:
+                # An id from before a restart
+                return None, self.sequence, self.changed
+            if last_seen == self.sequence:
+                return [], self.sequence, self.changed
+            if not self.history or self.history[0][0] > last_seen + 1:
+                return None, self.sequence, self.changed
+            return [event for sequence, event in self.history if sequence > last_seen], self.sequence, self.changed
+
+    async def stream(self, last_event_id=None):
+        """Async generator of SSE frames for one subscriber"""
+        self.bind(asyncio.get_running_loop())
+        with self.lock:
+            self.subscribers += 1
+            last_seen = self.sequence
+        try:
+            yield "retry: 3000\n\n"
+            if last_event_id is not None:
+                last_seen = last_event_id
+            while True:
+                missed, sequence, changed = self.missed(last_seen)
+                if missed is None:
+                    yield format_event("reset", {"sequence": sequence}, sequence)
+                elif missed:
+                    yield "".join(missed)
+                last_seen = sequence
+                try:
+                    await asyncio.wait_for(asyncio.shield(changed), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            with self.lock:
+                self.subscribers -= 1
+
+
+def format_event(name, payload, sequence):
+    return f"id: {sequence}\nevent: {name}\ndata: {orjson.dumps(payload).decode()}\n\n"
+
+
+def line_deltas(lines):
+    """Debit - credit per account of (account_id, debit, credit) rows or line dicts"""
+    deltas = {}
+    for line in lines:
+        if isinstance(line, dict):
+            account_id, debit, credit = line.get('account_id'), line.get('debit'), line.get('credit')
+        else:
+            account_id, debit, credit = line
+        deltas[account_id] = deltas.get(account_id, 0.0) + (debit or 0) - (credit or 0)
+    return deltas
+
+
+def difference(new, old):
+    """Per-account `new` minus `old` deltas"""
+    deltas = dict(new)
+    for account_id, delta in old.items():
+        deltas[account_id] = deltas.get(account_id, 0.0) - delta
+    return deltas
+
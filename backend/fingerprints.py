@@ -0,0 +1,121 @@
+"""
+Fingerprints of imported statement lines.
+
+Every line stored by Database.import_orphan_transaction gets a fingerprint:
+a hash of its account, date, signed amount in minor units and normalised
+description, plus an ordinal that tells apart identical lines within one
+statement (the second identical coffee of the day is ordinal 2). Re-importing
+a statement, or one that overlaps it, yields the same fingerprints for the
+lines already imported. A unique index on orphan_transaction_lines.fingerprint
+keeps them from being stored twice.
+
+A batch is checked with one lookup of all its fingerprints (duplicates()),
+not line by line. The fingerprint describes the line as imported, so editing
+an orphan line later does not change it. The statement date of a line is
+kept in orphan_transaction_lines.date along with the other inputs.
+
+Lines imported before fingerprints existed are fingerprinted by backfill()
+from the same inputs. Those lines were stored without a date; a line already
+consumed into a transaction takes the date of that transaction's line in its
+account, which is the date a re-import of its statement carries. A line never
+consumed has no date to go by and keeps an undated fingerprint.
+"""
+import hashlib
+import itertools
+import json
+import re
+
+INDEX = """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_orphan_transaction_lines_fingerprint
+    ON orphan_transaction_lines (fingerprint)
+"""
+# Notes prefix insert_orphan_transaction stores for an account it could not resolve
+ACCOUNT_NAME_NOTE = "Original account name: "
+
+
+def create_schema(cursor):
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(orphan_transaction_lines)").fetchall()]
+    if not columns:
+        return
+    if "date" not in columns:
+        cursor.execute("ALTER TABLE orphan_transaction_lines ADD COLUMN date TEXT")
+    if "fingerprint" not in columns:
+        cursor.execute("ALTER TABLE orphan_transaction_lines ADD COLUMN fingerprint TEXT")
+        backfill(cursor, "notes" in columns)
+    cursor.execute(INDEX)
+
+
+def normalize(description):
+    """Lowercase words and numbers of a description, so spacing and punctuation do not matter"""
+    return " ".join(re.findall(r"\w+", (description or "").lower()))
+
+
+def line_key(line):
+    """What identifies an imported line dict: account (id, else its name), date, signed amount, description"""
+    account = line.get('account_id')
+    if account is None:
+        account = f"name:{line.get('account_name') or ''}"
+    amount = round(((line.get('debit') or 0) - (line.get('credit') or 0)) * 100)
+    return f"{account}|{line.get('date') or ''}|{amount}|{normalize(line.get('description'))}"
+
+
+class Statement:
+    """Fingerprints the lines of one statement handed over in order, in one go or in parts"""
+
+    def __init__(self):
+        self.ordinals = {}
+
+    def fingerprints(self, lines):
+        fingerprints = []
+        for line in lines:
+            key = line_key(line)
+            self.ordinals[key] = self.ordinals.get(key, 0) + 1
+            fingerprints.append(hashlib.blake2b(f"{key}|{self.ordinals[key]}".encode(), digest_size=16).hexdigest())
+        return fingerprints
+
+
+def fingerprint_lines(lines):
+    """Fingerprint of every line dict of one statement, in order"""
+    return Statement().fingerprints(lines)
+
+
+def duplicates(conn, fingerprints):
+    """Dict of the `fingerprints` already stored -> id of the orphan line holding each"""
+    return dict(conn.execute("""
+        SELECT fingerprint, id FROM orphan_transaction_lines
+        WHERE fingerprint IN (SELECT value FROM json_each(?))
+    """, (json.dumps(fingerprints),)).fetchall())
+
+
+def backfill(cursor, has_notes):
+    """
+    Fingerprint the lines imported before fingerprints existed, statement by
+    statement and from the inputs fingerprint_lines() gets at import time;
+    lines that duplicate an earlier one keep none
+    """
+    notes = "otl.notes" if has_notes else "NULL"
+    # An undated line consumed into a transaction is dated like that transaction's line in its account
+    rows = cursor.execute(f"""
+        SELECT otl.id, otl.orphan_transaction_id, otl.description, otl.account_id, otl.debit, otl.credit, {notes},
+               COALESCE(otl.date, (
+                   SELECT MIN(tl.date) FROM transaction_lines tl
+                   WHERE tl.transaction_id = otl.transaction_id AND tl.account_id = otl.account_id
+               ))
+        FROM orphan_transaction_lines otl
+        ORDER BY otl.orphan_transaction_id, otl.id
+    """).fetchall()
+    seen = set()
+    updates = []
+    for _, statement in itertools.groupby(rows, key=lambda row: row[1]):
+        statement = list(statement)
+        lines = [{"description": description, "account_id": account_id, "debit": debit, "credit": credit,
+                  "date": line_date,
+                  "account_name": note[len(ACCOUNT_NAME_NOTE):] if note and note.startswith(ACCOUNT_NAME_NOTE)
+                  else None}
+                 for _, _, description, account_id, debit, credit, note, line_date in statement]
+        for row, line, fingerprint in zip(statement, lines, fingerprint_lines(lines)):
+            if fingerprint in seen:
+                fingerprint = None
+            seen.add(fingerprint)
+            updates.append((fingerprint, line["date"], row[0]))
+    cursor.executemany("UPDATE orphan_transaction_lines SET fingerprint = ?, date = ? WHERE id = ?", updates)
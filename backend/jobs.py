@@ -0,0 +1,435 @@
+"""
+Background jobs for long-running reports, exports and rebuilds.
+
+Jobs live in a `jobs` table in their own SQLite file (FINANCE_JOBS_DB,
+default <database>-jobs.db next to the ledger), so queue bookkeeping and
+large results never contend with ledger writes or end up in its backups.
+Results too big to hold in memory (exports) are written by their handler to
+a file in <jobs database>-results (JobContext.result_path) and only the path
+is stored; the file goes when its job is deleted.
+
+A fixed number of worker threads (FINANCE_JOB_WORKERS, default 2) run the
+queued jobs, so however many are submitted, at most that many heavy queries
+run at once. Each job kind is registered with the tables its result depends
+on; the result is cached under a key built from the kind, its parameters and
+the version tag of those tables (see versions.py). Submitting a job whose
+result is already cached, or which is already queued or running, returns the
+existing job instead of starting another.
+
+Cancelling a queued job takes effect at once; a running job is flagged in
+its row, so whichever process runs it sees the request, and handlers that
+loop check for it between batches (JobContext.check).
+Jobs left queued or running by a previous process are marked failed when the
+queue starts. Each job is run by the process that accepted it, so with
+several server processes (workers.py) only the jobs of processes that are
+gone are failed.
+
+With a LedgerPool (ledgers.py), every job belongs to the ledger current when
+it was submitted: it runs with that ledger current, its cache key covers the
+ledger, and a ledger sees and cancels only its own jobs.
+"""
+import contextlib
+import datetime
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+import orjson
+
+import metrics
+import workers
+
+WORKERS = int(os.environ.get("FINANCE_JOB_WORKERS", "2"))
+# Finished jobs kept, newest first; older ones are deleted with their results
+KEEP_FINISHED = 200
+# Seconds between JobContext.check() looks at the job's row for a cancel request
+CANCEL_POLL_INTERVAL = 0.5
+# Process that accepted a job: pid plus a token telling apart a reused pid
+OWNER = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        ledger TEXT NOT NULL DEFAULT '',
+        owner TEXT NOT NULL DEFAULT '',
+        kind TEXT NOT NULL,
+        params TEXT NOT NULL,
+        cache_key TEXT,
+        status TEXT NOT NULL,
+        created_at TIMESTAMP NOT NULL,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP,
+        error TEXT,
+        media_type TEXT,
+        filename TEXT,
+        result BLOB,
+        result_path TEXT,
+        cancel_requested INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_jobs_cache_key ON jobs (cache_key, status)",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON jobs (finished_at)",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_ledger ON jobs (ledger, created_at)",
+]
+# Columns added since the first version of the table
+ADDED_COLUMNS = {
+    "ledger": "TEXT NOT NULL DEFAULT ''",
+    "owner": "TEXT NOT NULL DEFAULT ''",
+    "result_path": "TEXT",
+    "cancel_requested": "INTEGER NOT NULL DEFAULT 0",
+}
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+JOB_FIELDS = ("id", "kind", "params", "status", "created_at", "started_at", "finished_at", "error", "media_type",
+              "filename")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobResult:
+    """A finished job's output: raw bytes, or a file (path) it wrote, plus how to serve them"""
+
+    def __init__(self, content, media_type="application/json", filename=None, path=None):
+        self.content = content
+        self.media_type = media_type
+        self.filename = filename
+        self.path = path
+
+
+class JobContext:
+    """Handed to a job handler; check() raises JobCancelled once the job is cancelled"""
+
+    def __init__(self, queue, job_id, cancelled):
+        self.queue = queue
+        self.job_id = job_id
+        self.cancelled = cancelled
+        self.next_poll = time.monotonic() + CANCEL_POLL_INTERVAL
+
+    def check(self):
+        # Cancel requests made through another process only reach the job's row
+        if not self.cancelled.is_set() and time.monotonic() >= self.next_poll:
+            self.next_poll = time.monotonic() + CANCEL_POLL_INTERVAL
+            if self.queue.cancel_requested(self.job_id):
+                self.cancelled.set()
+        if self.cancelled.is_set():
+            raise JobCancelled
+
+    def result_path(self, suffix=""):
+        """File for a result the handler writes itself, returned as JobResult(None, ..., path=...)"""
+        os.makedirs(self.queue.results_dir, exist_ok=True)
+        return os.path.join(self.queue.results_dir, self.job_id + suffix)
+
+
+class JobKind:
+    def __init__(self, name, handler, tables, cacheable, resolve):
+        self.name = name
+        self.handler = handler
+        self.tables = tables
+        self.cacheable = cacheable
+        self.resolve = resolve
+
+
+def now_iso():
+    return datetime.datetime.now().isoformat(timespec="milliseconds")
+
+
+def owner_alive(owner):
+    """Whether the process that accepted a job with this OWNER still runs"""
+    if owner == OWNER:
+        return True
+    pid = owner.partition(":")[0]
+    if not workers.SHARED or not pid.isdigit() or int(pid) == os.getpid():
+        # Alone, or our own pid reused after a restart: the owner is gone
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    def __init__(self, path, versions, workers=WORKERS, ledgers=None):
+        self.path = path
+        self.results_dir = os.path.splitext(path)[0] + "-results"
+        self.versions = versions
+        self.ledgers = ledgers
+        self.workers = workers
+        self.kinds = {}
+        self.pending = queue.Queue()
+        self.cancel_events = {}
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def register(self, name, tables=(), cacheable=True, resolve=None):
+        """
+        Decorator registering a job kind
+
+        The handler is called as handler(context, **params) and returns a
+        JSON-serializable payload or a JobResult. Results of cacheable kinds
+        are reused until one of `tables` changes. A result depending on more
+        than the tables (e.g. today's date) needs `resolve`: called as
+        resolve(params) on submit, it returns the params with that input
+        filled in, so the cache key and the handler both see it.
+        """
+        def decorator(handler):
+            self.kinds[name] = JobKind(name, handler, tuple(tables), cacheable, resolve)
+            return handler
+        return decorator
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def start(self):
+        """Create the table, fail jobs orphaned by a previous process and start the workers (once)"""
+        with self.lock:
+            if self.threads:
+                return
+            conn = self.connect()
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)").fetchall()]
+            for column, definition in ADDED_COLUMNS.items():
+                if columns and column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+            for statement in SCHEMA:
+                conn.execute(statement)
+            owners = [row[0] for row in conn.execute("SELECT DISTINCT owner FROM jobs WHERE status IN (?, ?)",
+                                                     (QUEUED, RUNNING)).fetchall()]
+            conn.execute("""
+                UPDATE jobs SET status = ?, error = ?, finished_at = ?
+                WHERE status IN (?, ?) AND owner IN (SELECT value FROM json_each(?))
+            """, (FAILED, "Interrupted by a restart", now_iso(), QUEUED, RUNNING,
+                  orjson.dumps([owner for owner in owners if not owner_alive(owner)]).decode()))
+            conn.commit()
+            self.remove_results(conn)
+            conn.close()
+            for number in range(self.workers):
+                thread = threading.Thread(target=self.work, name=f"job-worker-{number}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.pending.put(None)
+        for thread in threads:
+            thread.join()
+
+    def ledger(self):
+        """Name of the current ledger ('' without a LedgerPool)"""
+        return self.ledgers.current().name if self.ledgers is not None else ""
+
+    def using(self, ledger):
+        """Context manager making `ledger` current while a job of it runs"""
+        return self.ledgers.using(ledger) if self.ledgers is not None else contextlib.nullcontext()
+
+    def cache_key(self, kind, params):
+        encoded = orjson.dumps(params, option=orjson.OPT_SORT_KEYS)
+        version = self.versions.tag(kind.tables)
+        return hashlib.sha1(self.ledger().encode() + b"|" + kind.name.encode() + b"|" + encoded + b"|" +
+                            version.encode()).hexdigest()
+
+    def submit(self, name, params):
+        """
+        Queue a job, or return the matching cached or in-flight one
+
+        Returns:
+            (job dict, True if an existing job was returned)
+
+        Raises:
+            KeyError: unknown job kind
+        """
+        kind = self.kinds[name]
+        if kind.resolve is not None:
+            params = kind.resolve(dict(params))
+        self.start()
+        cache_key = self.cache_key(kind, params) if kind.cacheable else None
+        conn = self.connect()
+        try:
+            with conn:
+                if cache_key:
+                    existing = conn.execute("""
+                        SELECT id FROM jobs
+                        WHERE cache_key = ? AND status IN (?, ?, ?)
+                        ORDER BY created_at DESC
+                        LIMIT 1
+                    """, (cache_key, QUEUED, RUNNING, DONE)).fetchone()
+                    if existing:
+                        return self.get(existing["id"], conn), True
+                job_id = uuid.uuid4().hex
+                conn.execute("""
+                    INSERT INTO jobs (id, ledger, owner, kind, params, cache_key, status, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, (job_id, self.ledger(), OWNER, name, orjson.dumps(params).decode(), cache_key, QUEUED,
+                      now_iso()))
+            self.cancel_events[job_id] = threading.Event()
+            self.pending.put(job_id)
+            return self.get(job_id, conn), False
+        finally:
+            conn.close()
+
+    def get(self, job_id, conn=None):
+        """Job of the current ledger as a dict (without its result), or None"""
+        own = conn is None
+        conn = conn or self.connect()
+        try:
+            row = conn.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE id = ? AND ledger = ?",
+                               (job_id, self.ledger())).fetchone()
+        finally:
+            if own:
+                conn.close()
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = orjson.loads(job["params"])
+        return job
+
+    def wait(self, job_id, timeout, interval=0.05):
+        """The job once it has finished, or as it is when `timeout` seconds have passed (None if unknown)"""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job["status"] in FINISHED or time.monotonic() >= deadline:
+                return job
+            time.sleep(interval)
+
+    def recent(self, status=None, limit=50):
+        conn = self.connect()
+        try:
+            rows = conn.execute("""
+                SELECT id FROM jobs
+                WHERE ledger = ? AND (? IS NULL OR status = ?)
+                ORDER BY created_at DESC
+                LIMIT ?
+            """, (self.ledger(), status, status, limit)).fetchall()
+            return [self.get(row["id"], conn) for row in rows]
+        finally:
+            conn.close()
+
+    def result(self, job_id):
+        """(status, JobResult or None) of a job, or None when it does not exist"""
+        conn = self.connect()
+        try:
+            row = conn.execute("""
+                SELECT status, result, media_type, filename, result_path FROM jobs WHERE id = ? AND ledger = ?
+            """, (job_id, self.ledger())).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        if row["status"] != DONE:
+            return row["status"], None
+        return DONE, JobResult(row["result"], row["media_type"], row["filename"], row["result_path"])
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued or running job
+
+        A running job is flagged, and stops at its next JobContext.check()
+        in whichever process runs it.
+
+        Returns:
+            The job's status afterwards, or None when it does not exist
+        """
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND ledger = ? AND status = ?",
+                             (CANCELLED, now_iso(), job_id, self.ledger(), QUEUED))
+                conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND ledger = ? AND status = ?",
+                             (job_id, self.ledger(), RUNNING))
+            row = conn.execute("SELECT status FROM jobs WHERE id = ? AND ledger = ?",
+                               (job_id, self.ledger())).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        event = self.cancel_events.get(job_id)
+        if event is not None and row["status"] in (QUEUED, RUNNING, CANCELLED):
+            event.set()
+        return row["status"]
+
+    def cancel_requested(self, job_id):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return bool(row and row["cancel_requested"])
+
+    def remove_results(self, conn):
+        """Delete result files of jobs that are gone or did not finish with them (partial writes included)"""
+        try:
+            names = os.listdir(self.results_dir)
+        except FileNotFoundError:
+            return
+        kept = {row[0] for row in conn.execute("""
+            SELECT id FROM jobs WHERE status IN (?, ?) OR (status = ? AND result_path IS NOT NULL)
+        """, (QUEUED, RUNNING, DONE)).fetchall()}
+        for name in names:
+            if name.partition(".")[0] not in kept:
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.results_dir, name))
+
+    def work(self):
+        while True:
+            job_id = self.pending.get()
+            if job_id is None:
+                return
+            try:
+                self.run(job_id)
+            finally:
+                self.cancel_events.pop(job_id, None)
+
+    def run(self, job_id):
+        conn = self.connect()
+        try:
+            with conn:
+                claimed = conn.execute("UPDATE jobs SET status = ?, started_at = ? WHERE id = ? AND status = ?",
+                                       (RUNNING, now_iso(), job_id, QUEUED)).rowcount
+            if not claimed:
+                # Cancelled while it was queued
+                return
+            job = conn.execute("SELECT kind, params, ledger FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            kind = self.kinds[job["kind"]]
+            cancelled = self.cancel_events.get(job_id) or threading.Event()
+            context = JobContext(self, job_id, cancelled)
+            status, error, output = DONE, None, None
+            try:
+                with self.using(job["ledger"]), metrics.track(f"job:{kind.name}"):
+                    output = kind.handler(context, **orjson.loads(job["params"]))
+                context.check()
+                if not isinstance(output, JobResult):
+                    output = JobResult(orjson.dumps(output))
+            except JobCancelled:
+                status, output = CANCELLED, None
+            except Exception as e:
+                status, error, output = FAILED, f"{type(e).__name__}: {e}", None
+            with conn:
+                conn.execute("""
+                    UPDATE jobs SET status = ?, error = ?, finished_at = ?, result = ?, media_type = ?, filename = ?,
+                        result_path = ?
+                    WHERE id = ?
+                """, (status, error, now_iso(), output and output.content, output and output.media_type,
+                      output and output.filename, output and output.path, job_id))
+                conn.execute("""
+                    DELETE FROM jobs
+                    WHERE status IN (?, ?, ?) AND id NOT IN (
+                        SELECT id FROM jobs WHERE status IN (?, ?, ?) ORDER BY finished_at DESC LIMIT ?
+                    )
+                """, FINISHED + FINISHED + (KEEP_FINISHED,))
+            self.remove_results(conn)
+        finally:
+            conn.close()
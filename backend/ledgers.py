@@ -0,0 +1,346 @@
+"""
+Multi-ledger hosting: one SQLite file per household or entity, one process.
+
+A request picks its ledger with a /ledgers/{name} path prefix
+(/ledgers/smith/api/accounts is /api/accounts of ledger "smith") or an
+X-Ledger header; the prefix wins when both are given. LedgerMiddleware makes
+that ledger current for the rest of the request, worker thread included.
+Requests naming no ledger use the default one (FINANCE_DB), so a
+single-ledger deployment works as before.
+
+Named ledgers are the files <name>.db in FINANCE_LEDGER_DIR. A ledger is
+provisioned by putting its file there: naming one that does not exist is a
+404, never a new empty database. Each ledger gets the API's schema additions
+the first time this process opens it.
+
+Everything tied to one database file hangs off its Ledger: table version
+counters, the ETag cache, reference data, the analytics columns, the change
+broker and a stack of idle connections. LedgerPool keeps the
+FINANCE_MAX_LEDGERS most recently used ledgers and at most
+FINANCE_MAX_CONNECTIONS idle connections across all of them, closing the
+least recently used beyond either bound, so memory and file handles stay
+bounded however many ledgers are served. A ledger with requests or jobs in
+flight, connections checked out or event subscribers is never dropped, so
+nothing in flight loses its caches; it is dropped once it is idle and still
+beyond the bound.
+
+In multi-worker mode (workers.py) each ledger's version counters live in
+the ledger itself and its write requests share a file lock. Otherwise they
+live in memory and pick up the ledger's shared counters when another
+process (cli.py) bumps them.
+
+A connection handed out by connect() goes back to its ledger's stack on
+close(): an open transaction is rolled back, as closing it would have, and
+attached archive partitions are detached. Most requests therefore skip
+opening the file and parsing the schema.
+"""
+import collections
+import contextlib
+import contextvars
+import os
+import re
+import sqlite3
+import threading
+import weakref
+
+from fastapi.responses import ORJSONResponse
+
+import analytics
+import events
+import metrics
+import refdata
+import workers
+from responses import ConditionalCache
+from versions import SharedTableVersions, WatchedTableVersions
+
+MAX_LEDGERS = int(os.environ.get("FINANCE_MAX_LEDGERS", "256"))
+MAX_CONNECTIONS = int(os.environ.get("FINANCE_MAX_CONNECTIONS", "64"))
+PREFIX = "/ledgers/"
+HEADER = b"x-ledger"
+NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9_-]{0,63}")
+# Name of the default ledger
+DEFAULT = ""
+
+# Ledger of the request (or job) being served; None is the default ledger
+current_ledger = contextvars.ContextVar("current_ledger", default=None)
+
+
+class UnknownLedger(Exception):
+    pass
+
+
+class PooledConnection(metrics.InstrumentedConnection):
+    """Connection whose close() hands it back to its ledger's pool"""
+
+    pool = None
+    ledger = None
+
+    def close(self):
+        if self.ledger is not None:
+            self.pool.release(self)
+        elif self.pool is None:
+            super().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Leaving a `with` block closes the connection, rolling back what was not committed"""
+        self.close()
+        return False
+
+    def discard(self):
+        """Really close the connection"""
+        metrics.InstrumentedConnection.close(self)
+
+
+class Ledger:
+    def __init__(self, name, path, analytics_dir, shared=False):
+        self.name = name
+        self.path = path
+        # Multi-worker mode (workers.py): counters kept in the ledger, writes funnelled;
+        # otherwise in memory, watching the ledger's for bumps by other processes (cli.py)
+        self.versions = SharedTableVersions(path) if shared else WatchedTableVersions(path)
+        self.write_lock = workers.FileLock(path + "-write.lock") if shared else None
+        # Every version bump is also announced on this ledger's /api/events
+        self.broker = events.ChangeBroker()
+        self.versions.listen(self.broker.publish_tables)
+        self.reference_cache = ConditionalCache(self.versions)
+        self.reference_data = refdata.ReferenceData()
+        self.analytics = analytics.ColumnCache(analytics_dir)
+        self.idle = []
+        self.leased = weakref.WeakSet()
+        # Requests and jobs it is current for
+        self.holds = 0
+        self.closed = False
+
+    def busy(self):
+        return self.holds > 0 or len(self.leased) > 0 or self.broker.subscribers > 0
+
+    def discard(self):
+        """Close what a dropped ledger still has open besides its connections"""
+        self.versions.close()
+        if self.write_lock is not None:
+            self.write_lock.close()
+
+
+def analytics_dir_for(path):
+    return os.path.splitext(path)[0] + "-analytics"
+
+
+class LedgerPool:
+    def __init__(self, default_path, directory=None, prepare=None, analytics_dir=None,
+                 max_ledgers=MAX_LEDGERS, max_connections=MAX_CONNECTIONS, shared=workers.SHARED):
+        """
+        Args:
+            default_path: Database of requests that name no ledger
+            directory: Where named ledgers live, or None to serve only the default one
+            prepare: Called as prepare(conn) on the first connection to each ledger
+            analytics_dir: Analytics cache of the default ledger (named ones keep
+                theirs next to their file)
+            shared: Multi-worker mode (workers.py)
+        """
+        self.directory = directory
+        self.shared = shared
+        self.prepare = prepare
+        self.max_ledgers = max(max_ledgers, 1)
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        self.prepare_lock = threading.Lock()
+        # Files that already got prepare(), kept when their ledger is dropped
+        self.prepared = set()
+        self.idle_count = 0
+        self.default = Ledger(DEFAULT, default_path, analytics_dir or analytics_dir_for(default_path), shared)
+        # Least recently used first
+        self.ledgers = collections.OrderedDict({DEFAULT: self.default})
+
+    def path(self, name):
+        """File of the ledger called `name`; raises ValueError for an invalid name"""
+        if not NAME.fullmatch(name):
+            raise ValueError("Ledger names are 1-64 letters, digits, '-' or '_', starting with a letter or digit")
+        if self.directory is None:
+            raise UnknownLedger(f"Ledger '{name}' not found")
+        return os.path.join(self.directory, f"{name}.db")
+
+    def get(self, name, hold=False):
+        """
+        The Ledger called `name`, opened if needed
+
+        Args:
+            hold: Keep it from being dropped until unhold(ledger)
+
+        Raises:
+            ValueError: invalid name
+            UnknownLedger: no such ledger file
+        """
+        with self.lock:
+            ledger = self.ledgers.get(name)
+            if ledger is not None:
+                self.ledgers.move_to_end(name)
+                ledger.holds += hold
+                return ledger
+        path = self.path(name)
+        if not os.path.isfile(path):
+            raise UnknownLedger(f"Ledger '{name}' not found")
+        with self.lock:
+            ledger = self.ledgers.get(name)
+            if ledger is None:
+                ledger = self.ledgers[name] = Ledger(name, path, analytics_dir_for(path), self.shared)
+            self.ledgers.move_to_end(name)
+            ledger.holds += hold
+            closing = self.trim()
+        for item in closing:
+            item.discard()
+        return ledger
+
+    def unhold(self, ledger):
+        with self.lock:
+            ledger.holds -= 1
+
+    def current(self):
+        return current_ledger.get() or self.default
+
+    @contextlib.contextmanager
+    def using(self, name):
+        """Make the ledger called `name` current inside the block"""
+        ledger = self.get(name, hold=True)
+        token = current_ledger.set(ledger)
+        try:
+            yield ledger
+        finally:
+            current_ledger.reset(token)
+            self.unhold(ledger)
+
+    def subscribed(self):
+        """Ledgers with /api/events subscribers"""
+        with self.lock:
+            return [ledger for ledger in self.ledgers.values() if ledger.broker.subscribers]
+
+    def connect(self, ledger=None):
+        """A connection to `ledger` (default: the current one); close() returns it to the pool"""
+        ledger = ledger or self.current()
+        conn = None
+        with self.lock:
+            if ledger.idle:
+                conn = ledger.idle.pop()
+                self.idle_count -= 1
+        if conn is None:
+            conn = sqlite3.connect(ledger.path, timeout=30 if self.shared else 5, factory=PooledConnection,
+                                   check_same_thread=False)
+            conn.pool = self
+            if ledger.path not in self.prepared:
+                try:
+                    with self.prepare_lock:
+                        if ledger.path not in self.prepared and self.prepare is not None:
+                            self.prepare(conn)
+                        self.prepared.add(ledger.path)
+                except Exception:
+                    conn.discard()
+                    raise
+        conn.ledger = ledger
+        ledger.leased.add(conn)
+        return conn
+
+    def release(self, conn):
+        ledger, conn.ledger = conn.ledger, None
+        ledger.leased.discard(conn)
+        try:
+            conn.finish_statement()
+            if conn.in_transaction:
+                conn.rollback()
+            for _, schema, _ in conn.execute("PRAGMA database_list").fetchall():
+                if schema not in ("main", "temp"):
+                    conn.execute(f"DETACH DATABASE {schema}")
+            conn.__dict__.pop("reference_snapshot", None)
+        except sqlite3.Error:
+            conn.discard()
+            return
+        with self.lock:
+            if ledger.closed:
+                closing = [conn]
+            else:
+                ledger.idle.append(conn)
+                self.idle_count += 1
+                closing = self.trim()
+        for item in closing:
+            item.discard()
+
+    def trim(self):
+        """
+        Drop idle connections and ledgers, least recently used first, until
+        both bounds hold again (lock held)
+
+        Returns:
+            The connections and ledgers to discard() once the lock is released
+        """
+        closing = []
+        for name, ledger in list(self.ledgers.items()):
+            if len(self.ledgers) <= self.max_ledgers and self.idle_count <= self.max_connections:
+                break
+            if self.idle_count > self.max_connections or len(self.ledgers) > self.max_ledgers:
+                closing.extend(ledger.idle)
+                self.idle_count -= len(ledger.idle)
+                ledger.idle = []
+            if len(self.ledgers) > self.max_ledgers and name != DEFAULT and not ledger.busy():
+                ledger.closed = True
+                del self.ledgers[name]
+                closing.append(ledger)
+        return closing
+
+    def stats(self):
+        with self.lock:
+            return {"ledgers": len(self.ledgers), "idle_connections": self.idle_count,
+                    "leased_connections": sum(len(ledger.leased) for ledger in self.ledgers.values())}
+
+
+class LedgerLocal:
+    """Stands for an attribute of the current ledger, e.g. LedgerLocal(pool, "versions")"""
+
+    def __init__(self, pool, attribute):
+        self._pool = pool
+        self._attribute = attribute
+
+    def __getattr__(self, name):
+        return getattr(getattr(self._pool.current(), self._attribute), name)
+
+
+class LedgerMiddleware:
+    """Pure ASGI middleware making the ledger a request names current"""
+
+    def __init__(self, app, pool):
+        self.app = app
+        self.pool = pool
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        name = DEFAULT
+        root_path = scope.get("root_path", "")
+        path = scope["path"][len(root_path):] if scope["path"].startswith(root_path) else scope["path"]
+        if path.startswith(PREFIX):
+            name = path[len(PREFIX):].split("/", 1)[0]
+            # Routing matches what follows the root path, so the prefix goes there
+            scope["root_path"] = root_path + PREFIX + name
+        else:
+            for key, value in scope["headers"]:
+                if key == HEADER:
+                    name = value.decode("latin-1").strip()
+                    break
+
+        try:
+            ledger = self.pool.get(name, hold=True)
+        except ValueError as e:
+            await ORJSONResponse({"detail": str(e)}, status_code=400)(scope, receive, send)
+            return
+        except UnknownLedger as e:
+            await ORJSONResponse({"detail": str(e)}, status_code=404)(scope, receive, send)
+            return
+
+        token = current_ledger.set(ledger)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_ledger.reset(token)
+            self.pool.unhold(ledger)
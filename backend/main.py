@@ -1,9 +1,136 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, ORJSONResponse, PlainTextResponse, Response, StreamingResponse
+import contextlib
+import datetime
+import os
 import sqlite3
+import threading
 from typing import List, Dict, Any
 
-app = FastAPI(title="Finance App API")
+import analytics
+import archive
+import backup
+import balances
+import budgets
+import bulk
+import events
+import fingerprints
+import jobs
+import ledgers
+import metrics
+import periods
+import recurring
+import refdata
+import rules
+import transfer
+import versions
+import workers
+from responses import GZIP_MINIMUM_SIZE, fast_json, is_columnar, rows_payload
+
+DB_PATH = os.environ.get("FINANCE_DB", "finance.db")
+JOBS_DB_PATH = os.environ.get("FINANCE_JOBS_DB") or os.path.splitext(DB_PATH)[0] + "-jobs.db"
+ANALYTICS_DIR = os.environ.get("FINANCE_ANALYTICS_DIR") or os.path.splitext(DB_PATH)[0] + "-analytics"
+# Directory of the named ledgers (<name>.db); unset serves only FINANCE_DB
+LEDGER_DIR = os.environ.get("FINANCE_LEDGER_DIR")
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    prepare_database()
+    job_queue.start()
+    # With several workers only one of them takes the scheduled backups
+    scheduler = backup.scheduler_from_environment(DB_PATH) if workers.leader(DB_PATH) else None
+    if scheduler:
+        scheduler.start()
+    # Bumps made by other processes (workers, cli.py) reach /api/events subscribers
+    version_sync = workers.SyncThread(ledger_pool)
+    version_sync.start()
+    yield
+    version_sync.stop()
+    if scheduler:
+        scheduler.stop()
+    job_queue.stop()
+
+def create_schema(conn):
+    """Create the tables, indexes and triggers the API adds to the app's schema"""
+    if workers.SHARED:
+        conn.execute("PRAGMA journal_mode = WAL")
+    balances.create_schema(conn.cursor())
+    periods.create_schema(conn.cursor())
+    archive.create_schema(conn.cursor())
+    rules.create_schema(conn.cursor())
+    refdata.create_schema(conn.cursor())
+    analytics.create_schema(conn.cursor())
+    recurring.create_schema(conn.cursor())
+    fingerprints.create_schema(conn.cursor())
+    versions.create_schema(conn.cursor())
+    transfer.create_schema(conn.cursor())
+    budgets.create_schema(conn.cursor())
+    # Shared tags from before this process started may predate unrecorded writes
+    # (a single process's own epoch is new anyway, and it watches the shared one)
+    if workers.SHARED:
+        versions.rotate_epoch(conn)
+    conn.commit()
+
+# Connections and caches of every ledger this process serves (see ledgers.py);
+# the names below stand for those of the current request's ledger
+ledger_pool = ledgers.LedgerPool(DB_PATH, LEDGER_DIR, prepare=create_schema, analytics_dir=ANALYTICS_DIR)
+
+# Version counters of the ledger's tables, bumped by write endpoints
+table_versions = ledgers.LedgerLocal(ledger_pool, "versions")
+# Reference data (accounts, currencies, ...) is served from here with ETags
+reference_cache = ledgers.LedgerLocal(ledger_pool, "reference_cache")
+# Change events of the ledger for /api/events; every version bump is announced too
+change_broker = ledgers.LedgerLocal(ledger_pool, "broker")
+# Accounts, categories, currencies, classifications and credit cards by id and name
+reference_data = ledgers.LedgerLocal(ledger_pool, "reference_data")
+# Memory-mapped columns of every transaction line for the /api/analytics reports
+analytics_cache = ledgers.LedgerLocal(ledger_pool, "analytics")
+# Long-running reports and exports of all ledgers; job kinds are registered at the end of this module
+job_queue = jobs.JobQueue(JOBS_DB_PATH, table_versions, ledgers=ledger_pool)
+
+def get_db_connection():
+    """
+    Pooled connection to the current request's ledger; close(), or leaving
+    a `with get_db_connection() as conn:` block, returns it to the pool
+    """
+    return ledger_pool.connect()
+
+def reusing_connection(conn=None):
+    """`with` target for helpers taking an optional connection: `conn` if given (left open), else a pooled one"""
+    return contextlib.nullcontext(conn) if conn is not None else get_db_connection()
+
+def write_lock():
+    """
+    The current ledger's write lock in multi-worker mode, for jobs that write
+    outside a write request (WriteFunnel holds it for those)
+    """
+    lock = ledger_pool.current().write_lock
+    return lock if lock is not None else contextlib.nullcontext()
+
+def refresh_checkpoints_later(conn):
+    """Queue the checkpoint refresh when a read finds the previous month end uncovered (reads never write)"""
+    if balances.checkpoints_stale(conn):
+        job_queue.submit("refresh-checkpoints", {"through": balances.last_month_end().isoformat()})
+
+def detect_recurring_later(conn):
+    """Queue recurring detection when a read finds it behind the ledger (reads never write); True if it was"""
+    if recurring.is_current(conn):
+        return False
+    job_queue.submit("detect-recurring", {})
+    return True
+
+def prepare_database():
+    """Add the API's schema to the default ledger now rather than on its first request"""
+    ledger_pool.connect(ledger_pool.default).close()
+
+app = FastAPI(title="Finance App API", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Innermost; the write lock a write request takes is that of the ledger LedgerMiddleware picked
+if workers.SHARED:
+    app.add_middleware(workers.WriteFunnel, pool=ledger_pool)
+app.add_middleware(ledgers.LedgerMiddleware, pool=ledger_pool)
 
 # Enable CORS for frontend
 app.add_middleware(
@@ -12,145 +139,174 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
-
-def get_db_connection():
-    """Create a new database connection for each request"""
-    return sqlite3.connect("finance.db")
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+# Outermost, so latency covers compression as well
+app.add_middleware(metrics.MetricsMiddleware)
 
 @app.get("/")
 def read_root():
     return {"message": "Finance App API is running!"}
 
+@app.get("/api/metrics")
+def get_metrics():
+    """Request latency and SQL metrics in Prometheus text format"""
+    return PlainTextResponse(metrics.render() + backup.status.render_metrics(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/api/events")
+async def get_events(request: Request, last_event_id: int = None):
+    """Server-sent stream of coalesced ledger changes (see events.py)"""
+    header = request.headers.get("last-event-id")
+    if header and header.isdigit():
+        last_event_id = int(header)
+    return StreamingResponse(change_broker.stream(last_event_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/api/backups")
+def get_backups():
+    """Backups on disk, newest first, with the running backup's progress and recent results"""
+    try:
+        return {**backup.status.snapshot(), "backups": backup.list_backups(ledger_pool.current().path)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/backups", status_code=202)
+def create_backup(backup_data: dict = None):
+    """Start an online (default) or compact backup in the background; poll GET /api/backups"""
+    kind = (backup_data or {}).get('kind', "online")
+    if kind not in backup.KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(backup.KINDS)}")
+    if backup.status.snapshot()["running"]:
+        raise HTTPException(status_code=409, detail="A backup is already running")
+
+    # The thread does not inherit the request's ledger
+    path = ledger_pool.current().path
+
+    def run():
+        try:
+            backup.run_backup(path, kind)
+        except Exception as e:
+            # Recorded in backup.status
+            print(f"Backup failed: {type(e).__name__}: {e}")
+
+    threading.Thread(target=run, name="backup", daemon=True).start()
+    return {"message": f"{kind.capitalize()} backup started"}
+
+TRANSACTION_SUMMARY_FIELDS = ("id", "description", "currency_name", "date", "amount", "accounts",
+                              "total_debit", "total_credit", "line_count")
+
+# Per-transaction summary row; defaults and float coercion are done in SQL so
+# rows can be serialized as-is (TOTAL() always returns a float). The tables
+# come from archive.page_tables(), which only adds archived years when the
+# page reaches back into them
+TRANSACTION_SUMMARY_SQL = """
+    SELECT
+        t.id,
+        t.description,
+        COALESCE(c.name, 'USD') as currency_name,
+        MIN(tl.date) as date,
+        CASE WHEN TOTAL(tl.debit) > 0 THEN TOTAL(tl.debit) ELSE TOTAL(tl.credit) END as amount,
+        COALESCE(GROUP_CONCAT(DISTINCT a.name), 'Unknown') as accounts,
+        TOTAL(tl.debit) as total_debit,
+        TOTAL(tl.credit) as total_credit,
+        COUNT(tl.id) as line_count
+    FROM {transactions} t
+    JOIN {lines} tl ON t.id = tl.transaction_id
+    LEFT JOIN currency c ON t.currency_id = c.id
+    LEFT JOIN accounts a ON tl.account_id = a.id
+    GROUP BY t.id, t.description, c.name
+    ORDER BY date DESC
+    LIMIT ? OFFSET ?
+"""
+
 @app.get("/api/transactions")
-def get_transactions(skip: int = 0, limit: int = 100):
-    """Get transactions with pagination support"""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # First get total count
-        cursor.execute("""
-            SELECT COUNT(DISTINCT t.id)
-            FROM transactions t
-            JOIN transaction_lines tl ON t.id = tl.transaction_id
-        """)
-        total_count = cursor.fetchone()[0]
-        
-        # Then get paginated data
-        cursor.execute("""
-            SELECT 
-                t.id, 
-                t.description, 
-                c.name as currency_name,
-                MIN(tl.date) as date,
-                SUM(COALESCE(tl.debit, 0)) as total_debit,
-                SUM(COALESCE(tl.credit, 0)) as total_credit,
-                COUNT(tl.id) as line_count,
-                GROUP_CONCAT(DISTINCT a.name) as accounts
-            FROM transactions t
-            JOIN transaction_lines tl ON t.id = tl.transaction_id
-            LEFT JOIN currency c ON t.currency_id = c.id
-            LEFT JOIN accounts a ON tl.account_id = a.id
-            GROUP BY t.id, t.description, c.name
-            ORDER BY date DESC
-            LIMIT ? OFFSET ?
-        """, (limit, skip))
-        
-        transactions = []
-        for row in cursor.fetchall():
-            total_debit = float(row[4]) if row[4] else 0.0
-            total_credit = float(row[5]) if row[5] else 0.0
-            line_count = row[6]
-            
-            display_amount = total_debit if total_debit > 0 else total_credit
-            
-            transactions.append({
-                "id": row[0],
-                "description": row[1],
-                "currency_name": row[2] or "USD",
-                "date": row[3],
-                "amount": display_amount,
-                "accounts": row[7] or "Unknown",
-                "total_debit": total_debit,
-                "total_credit": total_credit,
-                "line_count": line_count
-            })
-        
-        conn.close()
-        return {
+def get_transactions(skip: int = 0, limit: int = 100, response_format: str = Query("rows", alias="format")):
+    """Get transactions with pagination support (?format=columnar for parallel arrays)"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+        
+            # First get total count
+            cursor.execute("""
+                SELECT COUNT(DISTINCT t.id)
+                FROM transactions t
+                JOIN transaction_lines tl ON t.id = tl.transaction_id
+            """)
+            total_count = cursor.fetchone()[0] + archive.archived_transaction_count(conn)
+        
+            # Then get paginated data
+            lines, transactions = archive.page_tables(conn, skip + limit)
+            cursor.execute(TRANSACTION_SUMMARY_SQL.format(transactions=transactions, lines=lines), (limit, skip))
+            transactions = rows_payload(cursor.fetchall(), TRANSACTION_SUMMARY_FIELDS,
+                                        columnar=is_columnar(response_format))
+        
+        return fast_json({
             "transactions": transactions, 
             "total": total_count,
             "skip": skip,
             "limit": limit
-        }
+        })
     except Exception as e:
         return {"error": str(e)}
 
+TRANSACTION_LINE_FIELDS = ("id", "transaction_id", "account_name", "debit", "credit", "date",
+                           "classification_name")
+
 @app.get("/api/transactions/{transaction_id}/lines")
-def get_transaction_lines(transaction_id: int):
+def get_transaction_lines(transaction_id: int, response_format: str = Query("rows", alias="format")):
     """Get all lines for a specific transaction"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT 
-                tl.id,
-                tl.transaction_id,
-                a.name as account_name,
-                tl.debit,
-                tl.credit,
-                tl.date,
-                c.name as classification_name
-            FROM transaction_lines tl
-            JOIN accounts a ON tl.account_id = a.id
-            LEFT JOIN classifications c ON tl.classification_id = c.id
-            WHERE tl.transaction_id = ?
-            ORDER BY tl.id
-        """, (transaction_id,))
-        
-        lines = []
-        for row in cursor.fetchall():
-            lines.append({
-                "id": row[0],
-                "transaction_id": row[1],
-                "account_name": row[2],
-                "debit": float(row[3]) if row[3] else None,
-                "credit": float(row[4]) if row[4] else None,
-                "date": row[5],
-                "classification_name": row[6]
-            })
-        
-        conn.close()
-        return {"lines": lines, "total": len(lines)}
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            lines_table = archive.transaction_tables(conn, transaction_id)[0]
+            cursor.execute(f"""
+                SELECT 
+                    tl.id,
+                    tl.transaction_id,
+                    a.name as account_name,
+                    NULLIF(tl.debit, 0) as debit,
+                    NULLIF(tl.credit, 0) as credit,
+                    tl.date,
+                    c.name as classification_name
+                FROM {lines_table} tl
+                JOIN accounts a ON tl.account_id = a.id
+                LEFT JOIN classifications c ON tl.classification_id = c.id
+                WHERE tl.transaction_id = ?
+                ORDER BY tl.id
+            """, (transaction_id,))
+        
+            rows = cursor.fetchall()
+            lines = rows_payload(rows, TRANSACTION_LINE_FIELDS, columnar=is_columnar(response_format))
+        
+        return fast_json({"lines": lines, "total": len(rows)})
     except Exception as e:
         return {"error": str(e)}
 
+ACCOUNT_FIELDS = ("id", "name", "category", "currency", "nature", "term")
+
 @app.get("/api/accounts")
-def get_accounts():
+def get_accounts(request: Request, response_format: str = Query("rows", alias="format")):
     """Get all accounts"""
+    columnar = is_columnar(response_format)
+    return reference_cache.respond(request, ("accounts", columnar), ("accounts", "cat", "currency"),
+                                   lambda: load_accounts(columnar))
+
+def load_accounts(columnar=False, conn=None):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT a.id, a.name, c.name as category, cu.name as currency, a.nature, a.term
-            FROM accounts a
-            JOIN cat c ON a.cat_id = c.id
-            LEFT JOIN currency cu ON a.default_currency_id = cu.id
-        """)
-        
-        result = []
-        for row in cursor.fetchall():
-            result.append({
-                "id": row[0],
-                "name": row[1],
-                "category": row[2],
-                "currency": row[3],
-                "nature": row[4] if row[4] else "both",
-                "term": row[5] if row[5] else "undefined"
-            })
+        with reusing_connection(conn) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT a.id, a.name, c.name as category, cu.name as currency,
+                       COALESCE(NULLIF(a.nature, ''), 'both') as nature,
+                       COALESCE(NULLIF(a.term, ''), 'undefined') as term
+                FROM accounts a
+                JOIN cat c ON a.cat_id = c.id
+                LEFT JOIN currency cu ON a.default_currency_id = cu.id
+            """)
+        
+            result = rows_payload(cursor.fetchall(), ACCOUNT_FIELDS, columnar=columnar)
         
-        conn.close()
         return {"accounts": result}
     except Exception as e:
         return {"error": str(e)}
@@ -159,59 +315,220 @@ def get_accounts():
 def create_transaction(transaction_data: dict):
     """Create a new transaction with its lines"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Insert transaction
-        cursor.execute("""
-            INSERT INTO transactions (description, currency_id)
-            VALUES (?, ?)
-        """, (transaction_data['description'], transaction_data['currency_id']))
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        transaction_id = cursor.lastrowid
+            closed_through = periods.closed_dates(conn, [line.get('date') for line in transaction_data['lines']])
+            if closed_through:
+                raise HTTPException(status_code=409, detail=f"Books are closed through {closed_through}")
         
-        # Insert transaction lines
-        for line in transaction_data['lines']:
+            # Insert transaction
             cursor.execute("""
-                INSERT INTO transaction_lines (transaction_id, account_id, debit, credit, date, classification_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (transaction_id, line['account_id'], line.get('debit'), line.get('credit'), 
-                  line['date'], line.get('classification_id')))
-        
-        conn.commit()
-        conn.close()
+                INSERT INTO transactions (description, currency_id)
+                VALUES (?, ?)
+            """, (transaction_data['description'], transaction_data['currency_id']))
+        
+            transaction_id = cursor.lastrowid
+        
+            # Insert transaction lines
+            for line in transaction_data['lines']:
+                cursor.execute("""
+                    INSERT INTO transaction_lines (transaction_id, account_id, debit, credit, date, classification_id)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (transaction_id, line['account_id'], line.get('debit'), line.get('credit'), 
+                      line['date'], line.get('classification_id')))
+        
+            conn.commit()
+            table_versions.bump("transactions", "transaction_lines")
+            change_broker.publish_transaction(transaction_id, "created", events.line_deltas(transaction_data['lines']))
         return {"message": "Transaction created successfully", "id": transaction_id}
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
+# Stored columns of a transaction line, in the order diff_transaction_lines compares them
+LINE_COLUMNS = ("account_id", "debit", "credit", "date", "classification_id")
+
+def diff_transaction_lines(stored, submitted, replace):
+    """
+    Work out the statements that turn the stored lines into the submitted ones
+
+    Args:
+        stored: Dict of line id -> tuple of LINE_COLUMNS values, in id order
+        submitted: Line dicts; those with an "id" refer to stored lines
+        replace: True for PUT semantics. Lines without an id then take over a
+            stored line with the same values, or else the next unclaimed one,
+            so a full resubmission keeps its line ids. For PATCH they are new
+            lines and missing keys of identified lines keep their stored value.
+
+    Returns:
+        (updates as [(id, values)], inserts as [values], deleted ids, unchanged ids)
+
+    Raises:
+        ValueError: a line id that does not belong to the transaction or is repeated
+    """
+    claimed = {}
+    unidentified = []
+    for line in submitted:
+        line_id = line.get('id')
+        if line_id is None:
+            unidentified.append(line)
+            continue
+        if line_id not in stored:
+            raise ValueError(f"Line {line_id} does not belong to this transaction")
+        if line_id in claimed:
+            raise ValueError(f"Line {line_id} is listed more than once")
+        if replace:
+            claimed[line_id] = tuple(line.get(column) for column in LINE_COLUMNS)
+        else:
+            claimed[line_id] = tuple(line.get(column, value) for column, value in zip(LINE_COLUMNS, stored[line_id]))
+    
+    new_values = [tuple(line.get(column) for column in LINE_COLUMNS) for line in unidentified]
+    inserts = []
+    if replace:
+        free = [line_id for line_id in stored if line_id not in claimed]
+        # Identical lines first, then lines of the same account, so reordering,
+        # dropping or editing one line does not rewrite the others
+        remaining = new_values
+        for same in (lambda old, new: old == new, lambda old, new: old[0] == new[0]):
+            unmatched = []
+            for values in remaining:
+                match = next((line_id for line_id in free if same(stored[line_id], values)), None)
+                if match is None:
+                    unmatched.append(values)
+                else:
+                    free.remove(match)
+                    claimed[match] = values
+            remaining = unmatched
+        for values in remaining:
+            if free:
+                claimed[free.pop(0)] = values
+            else:
+                inserts.append(values)
+    else:
+        inserts = new_values
+    
+    updates = [(line_id, values) for line_id, values in sorted(claimed.items()) if stored[line_id] != values]
+    unchanged = [line_id for line_id, values in sorted(claimed.items()) if stored[line_id] == values]
+    deleted = [line_id for line_id in stored if line_id not in claimed]
+    return updates, inserts, deleted, unchanged
+
 @app.put("/api/transactions/{transaction_id}")
 def update_transaction(transaction_id: int, transaction_data: dict):
-    """Update an existing transaction"""
+    """Update an existing transaction, replacing its lines"""
+    return apply_transaction_update(transaction_id, transaction_data, replace=True)
+
+@app.patch("/api/transactions/{transaction_id}")
+def patch_transaction(transaction_id: int, transaction_data: dict):
+    """
+    Update only what is submitted
+
+    description and currency_id are optional. When lines are given, lines
+    with an id update that line (missing keys keep their value), lines
+    without one are added and stored lines left out are deleted.
+    """
+    return apply_transaction_update(transaction_id, transaction_data, replace=False)
+
+def apply_transaction_update(transaction_id, transaction_data, replace):
+    """
+    Diff the submitted transaction against the stored one and write only the difference
+
+    Line ids of kept lines never change. The response lists the inserted,
+    updated, deleted and unchanged line ids.
+    """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Update transaction
-        cursor.execute("""
-            UPDATE transactions 
-            SET description = ?, currency_id = ?
-            WHERE id = ?
-        """, (transaction_data['description'], transaction_data['currency_id'], transaction_id))
+            archived_year = archive.archived_year(conn, transaction_id)
+            if archived_year:
+                raise HTTPException(status_code=409, detail=f"Transaction is archived with {archived_year}")
         
-        # Delete existing lines
-        cursor.execute("DELETE FROM transaction_lines WHERE transaction_id = ?", (transaction_id,))
+            cursor.execute("SELECT description, currency_id FROM transactions WHERE id = ?", (transaction_id,))
+            header = cursor.fetchone()
+            if header is None:
+                raise HTTPException(status_code=404, detail="Transaction not found")
         
-        # Insert new lines
-        for line in transaction_data['lines']:
-            cursor.execute("""
-                INSERT INTO transaction_lines (transaction_id, account_id, debit, credit, date, classification_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (transaction_id, line['account_id'], line.get('debit'), line.get('credit'), 
-                  line['date'], line.get('classification_id')))
-        
-        conn.commit()
-        conn.close()
-        return {"message": "Transaction updated successfully"}
+            if replace:
+                new_header = (transaction_data['description'], transaction_data['currency_id'])
+            else:
+                new_header = (transaction_data.get('description', header[0]), transaction_data.get('currency_id', header[1]))
+            header_changed = tuple(header) != new_header
+        
+            cursor.execute(f"""
+                SELECT id, {', '.join(LINE_COLUMNS)} FROM transaction_lines
+                WHERE transaction_id = ?
+                ORDER BY id
+            """, (transaction_id,))
+            stored = {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+            if replace or 'lines' in transaction_data:
+                try:
+                    updates, inserts, deleted, unchanged = diff_transaction_lines(
+                        stored, transaction_data['lines'], replace)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+            else:
+                updates, inserts, deleted, unchanged = [], [], [], list(stored)
+        
+            lines_changed = bool(updates or inserts or deleted)
+            if header_changed or lines_changed:
+                date_index = LINE_COLUMNS.index('date')
+                dates = [values[date_index] for values in stored.values()]
+                dates += [values[date_index] for _, values in updates] + [values[date_index] for values in inserts]
+                closed_through = periods.closed_dates(conn, dates)
+                if closed_through:
+                    raise HTTPException(status_code=409, detail=f"Books are closed through {closed_through}")
+        
+            if header_changed:
+                cursor.execute("""
+                    UPDATE transactions 
+                    SET description = ?, currency_id = ?
+                    WHERE id = ?
+                """, new_header + (transaction_id,))
+        
+            if deleted:
+                cursor.execute(f"DELETE FROM transaction_lines WHERE id IN ({', '.join('?' * len(deleted))})", deleted)
+        
+            cursor.executemany(f"""
+                UPDATE transaction_lines
+                SET {', '.join(f'{column} = ?' for column in LINE_COLUMNS)}
+                WHERE id = ?
+            """, [values + (line_id,) for line_id, values in updates])
+        
+            inserted = []
+            for values in inserts:
+                cursor.execute(f"""
+                    INSERT INTO transaction_lines (transaction_id, {', '.join(LINE_COLUMNS)})
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (transaction_id,) + values)
+                inserted.append(cursor.lastrowid)
+        
+            conn.commit()
+        
+            bumped = (("transactions",) if header_changed else ()) + (("transaction_lines",) if lines_changed else ())
+            if bumped:
+                table_versions.bump(*bumped)
+            if lines_changed:
+                old_rows = [stored[line_id] for line_id, _ in updates] + [stored[line_id] for line_id in deleted]
+                new_rows = [values for _, values in updates] + inserts
+                change_broker.publish_transaction(transaction_id, "updated", events.difference(
+                    events.line_deltas(values[:3] for values in new_rows),
+                    events.line_deltas(values[:3] for values in old_rows)))
+            elif header_changed:
+                change_broker.publish_transaction(transaction_id, "updated", {})
+        return {
+            "message": "Transaction updated successfully",
+            "transaction_changed": header_changed,
+            "lines": {
+                "inserted": inserted,
+                "updated": [line_id for line_id, _ in updates],
+                "deleted": deleted,
+                "unchanged": unchanged,
+            },
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
@@ -219,127 +536,200 @@ def update_transaction(transaction_id: int, transaction_data: dict):
 def delete_transaction(transaction_id: int):
     """Delete a transaction and its lines"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Check if transaction exists
-        cursor.execute("SELECT id FROM transactions WHERE id = ?", (transaction_id,))
-        if not cursor.fetchone():
-            raise HTTPException(status_code=404, detail="Transaction not found")
-        
-        # Delete transaction lines first (foreign key constraint)
-        cursor.execute("DELETE FROM transaction_lines WHERE transaction_id = ?", (transaction_id,))
-        
-        # Delete transaction
-        cursor.execute("DELETE FROM transactions WHERE id = ?", (transaction_id,))
-        
-        conn.commit()
-        conn.close()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+        
+            # Check if transaction exists
+            cursor.execute("SELECT id FROM transactions WHERE id = ?", (transaction_id,))
+            if not cursor.fetchone():
+                archived_year = archive.archived_year(conn, transaction_id)
+                if archived_year:
+                    raise HTTPException(status_code=409, detail=f"Transaction is archived with {archived_year}")
+                raise HTTPException(status_code=404, detail="Transaction not found")
+        
+            cursor.execute("SELECT date, account_id, debit, credit FROM transaction_lines WHERE transaction_id = ?",
+                           (transaction_id,))
+            old_lines = cursor.fetchall()
+            closed_through = periods.closed_dates(conn, [row[0] for row in old_lines])
+            if closed_through:
+                raise HTTPException(status_code=409, detail=f"Books are closed through {closed_through}")
+        
+            # Delete transaction lines first (foreign key constraint)
+            cursor.execute("DELETE FROM transaction_lines WHERE transaction_id = ?", (transaction_id,))
+        
+            # Delete transaction
+            cursor.execute("DELETE FROM transactions WHERE id = ?", (transaction_id,))
+        
+            conn.commit()
+            table_versions.bump("transactions", "transaction_lines")
+            change_broker.publish_transaction(transaction_id, "deleted", events.difference(
+                {}, events.line_deltas(row[1:] for row in old_lines)))
         return {"message": "Transaction deleted successfully"}
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/transaction-lines/reclassify")
+def bulk_reclassify(request_data: dict):
+    """
+    Set the classification of every line matching a filter in one statement
+
+    Body: {"filter": {...}, "classification_id": id or null, "dry_run": bool};
+    see bulk.py for the filter keys. A dry run only counts the lines.
+    """
+    classification_id = request_data.get('classification_id')
+    try:
+        with get_db_connection() as conn:
+            if classification_id is not None and \
+                    classification_id not in reference_data.snapshot(conn).classifications.by_id:
+                raise HTTPException(status_code=400, detail="Classification not found")
+            result = bulk.reclassify(conn, request_data.get('filter'), classification_id,
+                                     dry_run=bool(request_data.get('dry_run')))
+        if result["lines"] and not result["dry_run"]:
+            table_versions.bump("transaction_lines")
+        return result
+    except HTTPException:
+        raise
+    except bulk.ClosedPeriodError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/transactions/bulk-delete")
+def bulk_delete_transactions(request_data: dict):
+    """
+    Delete every transaction with a line matching a filter, set-based
+
+    Body: {"filter": {...}, "dry_run": bool}; see bulk.py for the filter keys.
+    A dry run only counts the transactions and lines.
+    """
+    try:
+        with get_db_connection() as conn:
+            result = bulk.delete_transactions(conn, request_data.get('filter'), dry_run=bool(request_data.get('dry_run')))
+        if result["dry_run"]:
+            return result
+        deleted, deltas = result.pop("deleted"), result.pop("deltas")
+        if deleted:
+            table_versions.bump("transactions", "transaction_lines")
+            change_broker.publish(
+                transactions=[{"id": transaction_id, "action": "deleted"} for transaction_id in deleted],
+                accounts={account_id: -delta for account_id, delta in deltas.items()})
+        return result
+    except bulk.ClosedPeriodError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/currencies")
-def get_currencies():
+def get_currencies(request: Request):
     """Get all currencies"""
+    return reference_cache.respond(request, "currencies", ("currency",), load_currencies)
+
+def load_currencies(conn=None):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, exchange_rate FROM currency")
-        
-        currencies = []
-        for row in cursor.fetchall():
-            currencies.append({
-                "id": row[0],
-                "name": row[1],
-                "exchange_rate": float(row[2]) if row[2] else 1.0
-            })
+        with reusing_connection(conn) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name, exchange_rate FROM currency")
+        
+            currencies = []
+            for row in cursor.fetchall():
+                currencies.append({
+                    "id": row[0],
+                    "name": row[1],
+                    "exchange_rate": float(row[2]) if row[2] else 1.0
+                })
         
-        conn.close()
         return {"currencies": currencies}
     except Exception as e:
         return {"error": str(e)}
 
 @app.get("/api/classifications")
-def get_classifications():
+def get_classifications(request: Request):
     """Get all classifications"""
+    return reference_cache.respond(request, "classifications", ("classifications",), load_classifications)
+
+def load_classifications(conn=None):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name FROM classifications")
-        
-        classifications = []
-        for row in cursor.fetchall():
-            classifications.append({
-                "id": row[0],
-                "name": row[1]
-            })
+        with reusing_connection(conn) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name FROM classifications")
+        
+            classifications = []
+            for row in cursor.fetchall():
+                classifications.append({
+                    "id": row[0],
+                    "name": row[1]
+                })
         
-        conn.close()
         return {"classifications": classifications}
     except Exception as e:
         return {"error": str(e)}
     
+ACCOUNT_DETAIL_FIELDS = ("id", "name", "category_name", "currency_name", "nature", "term",
+                         "is_credit_card", "classifications", "credit_limit", "close_day", "due_day")
+CREDIT_CARD_FIELDS = ("credit_limit", "close_day", "due_day")
+ACCOUNT_DETAIL_TABLES = ("accounts", "cat", "currency", "ccards", "account_classifications", "classifications")
+
 # Enhanced Accounts endpoint with full details
 @app.get("/api/accounts/detailed")
-def get_accounts_detailed():
+def get_accounts_detailed(request: Request, response_format: str = Query("rows", alias="format")):
     """Get all accounts with full details including credit card info and classifications"""
+    columnar = is_columnar(response_format)
+    return reference_cache.respond(request, ("accounts-detailed", columnar), ACCOUNT_DETAIL_TABLES,
+                                   lambda: load_accounts_detailed(columnar))
+
+def load_accounts_detailed(columnar=False, conn=None):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get all accounts with category and currency names
-        cursor.execute("""
-            SELECT 
-                a.id, a.name, c.name as category_name, cu.name as currency_name, 
-                a.nature, a.term
-            FROM accounts a
-            JOIN cat c ON a.cat_id = c.id
-            LEFT JOIN currency cu ON a.default_currency_id = cu.id
-            ORDER BY a.name
-        """)
-        
-        accounts = []
-        for row in cursor.fetchall():
-            account_id = row[0]
-            
-            # Check if it's a credit card
-            cursor.execute("SELECT credit_limit, close_day, due_day FROM ccards WHERE account_id = ?", (account_id,))
-            credit_card_data = cursor.fetchone()
-            
-            # Get classifications for this account
+        with reusing_connection(conn) as conn:
+            cursor = conn.cursor()
+        
+            # Get classifications for all accounts in one pass
             cursor.execute("""
-                SELECT c.name 
+                SELECT ac.account_id, c.name 
                 FROM classifications c
                 JOIN account_classifications ac ON c.id = ac.classification_id
-                WHERE ac.account_id = ?
-            """, (account_id,))
-            classifications = [cls[0] for cls in cursor.fetchall()]
-            
-            account = {
-                "id": row[0],
-                "name": row[1],
-                "category_name": row[2],
-                "currency_name": row[3] or "USD",
-                "nature": row[4] or "both",
-                "term": row[5] or "undefined",
-                "is_credit_card": credit_card_data is not None,
-                "classifications": classifications
-            }
-            
-            # Add credit card details if applicable
-            if credit_card_data:
-                account.update({
-                    "credit_limit": float(credit_card_data[0]),
-                    "close_day": credit_card_data[1],
-                    "due_day": credit_card_data[2]
-                })
-            
-            accounts.append(account)
+                ORDER BY ac.id
+            """)
+            classifications_by_account = {}
+            for account_id, classification_name in cursor.fetchall():
+                classifications_by_account.setdefault(account_id, []).append(classification_name)
+        
+            # Get all accounts with category, currency names and credit card details
+            cursor.execute("""
+                SELECT 
+                    a.id, a.name, c.name as category_name,
+                    COALESCE(cu.name, 'USD') as currency_name, 
+                    COALESCE(NULLIF(a.nature, ''), 'both') as nature,
+                    COALESCE(NULLIF(a.term, ''), 'undefined') as term,
+                    cc.id IS NOT NULL as is_credit_card,
+                    cc.credit_limit, cc.close_day, cc.due_day
+                FROM accounts a
+                JOIN cat c ON a.cat_id = c.id
+                LEFT JOIN currency cu ON a.default_currency_id = cu.id
+                LEFT JOIN ccards cc ON cc.id = (SELECT MIN(id) FROM ccards WHERE account_id = a.id)
+                ORDER BY a.name
+            """)
+        
+            rows = [
+                row[:6] + (bool(row[6]), classifications_by_account.get(row[0], [])) + row[7:]
+                for row in cursor.fetchall()
+            ]
+        
+            if columnar:
+                accounts = rows_payload(rows, ACCOUNT_DETAIL_FIELDS, columnar=True)
+            else:
+                accounts = rows_payload(rows, ACCOUNT_DETAIL_FIELDS)
+                # Credit card details are only present on credit card accounts
+                for account in accounts:
+                    if not account["is_credit_card"]:
+                        for field in CREDIT_CARD_FIELDS:
+                            del account[field]
         
-        conn.close()
         return {"accounts": accounts}
     except Exception as e:
         return {"error": str(e)}
@@ -348,67 +738,59 @@ def get_accounts_detailed():
 def create_account(account_data: dict):
     """Create a new account"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Insert account
-        cursor.execute("""
-            INSERT INTO accounts (name, cat_id, default_currency_id, nature, term)
-            VALUES (?, ?, ?, ?, ?)
-        """, (
-            account_data['name'],
-            account_data['category_id'],
-            account_data['currency_id'],
-            account_data['nature'],
-            account_data['term']
-        ))
-        
-        account_id = cursor.lastrowid
-        
-        # If it's a credit card, add credit card details
-        if account_data.get('is_credit_card', False):
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+        
+            # Insert account
             cursor.execute("""
-                INSERT INTO ccards (account_id, credit_limit, close_day, due_day)
-                VALUES (?, ?, ?, ?)
+                INSERT INTO accounts (name, cat_id, default_currency_id, nature, term)
+                VALUES (?, ?, ?, ?, ?)
             """, (
-                account_id,
-                account_data['credit_limit'],
-                account_data['close_day'],
-                account_data['due_day']
+                account_data['name'],
+                account_data['category_id'],
+                account_data['currency_id'],
+                account_data['nature'],
+                account_data['term']
             ))
         
-        conn.commit()
-        
-        # Get the created account with full details
-        cursor.execute("""
-            SELECT a.id, a.name, c.name as category_name, cu.name as currency_name, 
-                   a.nature, a.term
-            FROM accounts a
-            JOIN cat c ON a.cat_id = c.id
-            LEFT JOIN currency cu ON a.default_currency_id = cu.id
-            WHERE a.id = ?
-        """, (account_id,))
-        
-        row = cursor.fetchone()
-        account = {
-            "id": row[0],
-            "name": row[1],
-            "category_name": row[2],
-            "currency_name": row[3] or "USD",
-            "nature": row[4] or "both",
-            "term": row[5] or "undefined",
-            "is_credit_card": account_data.get('is_credit_card', False),
-            "classifications": []
-        }
+            account_id = cursor.lastrowid
+        
+            # If it's a credit card, add credit card details
+            if account_data.get('is_credit_card', False):
+                cursor.execute("""
+                    INSERT INTO ccards (account_id, credit_limit, close_day, due_day)
+                    VALUES (?, ?, ?, ?)
+                """, (
+                    account_id,
+                    account_data['credit_limit'],
+                    account_data['close_day'],
+                    account_data['due_day']
+                ))
+        
+            conn.commit()
+            table_versions.bump("accounts", "ccards")
+        
+            # Get the created account with full details
+            reference = reference_data.snapshot(conn)
+            row = reference.accounts.by_id[account_id]
+            account = {
+                "id": row[0],
+                "name": row[1],
+                "category_name": reference.categories.name(row[2]),
+                "currency_name": reference.currencies.name(row[3]) or "USD",
+                "nature": row[4] or "both",
+                "term": row[5] or "undefined",
+                "is_credit_card": account_data.get('is_credit_card', False),
+                "classifications": []
+            }
         
-        if account_data.get('is_credit_card', False):
-            account.update({
-                "credit_limit": float(account_data['credit_limit']),
-                "close_day": account_data['close_day'],
-                "due_day": account_data['due_day']
-            })
+            if account_data.get('is_credit_card', False):
+                account.update({
+                    "credit_limit": float(account_data['credit_limit']),
+                    "close_day": account_data['close_day'],
+                    "due_day": account_data['due_day']
+                })
         
-        conn.close()
         return {"account": account}
     except Exception as e:
         return {"error": str(e)}
@@ -417,89 +799,78 @@ def create_account(account_data: dict):
 def update_account(account_id: int, account_data: dict):
     """Update an existing account"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Update account basic info
-        cursor.execute("""
-            UPDATE accounts 
-            SET name = ?, cat_id = ?, default_currency_id = ?, nature = ?, term = ?
-            WHERE id = ?
-        """, (
-            account_data['name'],
-            account_data['category_id'],
-            account_data['currency_id'],
-            account_data['nature'],
-            account_data['term'],
-            account_id
-        ))
-        
-        # Handle credit card status
-        cursor.execute("SELECT COUNT(*) FROM ccards WHERE account_id = ?", (account_id,))
-        is_currently_credit_card = cursor.fetchone()[0] > 0
-        
-        if account_data.get('is_credit_card', False) and not is_currently_credit_card:
-            # Add credit card details
-            cursor.execute("""
-                INSERT INTO ccards (account_id, credit_limit, close_day, due_day)
-                VALUES (?, ?, ?, ?)
-            """, (
-                account_id,
-                account_data['credit_limit'],
-                account_data['close_day'],
-                account_data['due_day']
-            ))
-        elif account_data.get('is_credit_card', False) and is_currently_credit_card:
-            # Update existing credit card details
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            is_currently_credit_card = account_id in reference_data.snapshot(conn).credit_cards_by_account
+        
+            # Update account basic info
             cursor.execute("""
-                UPDATE ccards 
-                SET credit_limit = ?, close_day = ?, due_day = ?
-                WHERE account_id = ?
+                UPDATE accounts 
+                SET name = ?, cat_id = ?, default_currency_id = ?, nature = ?, term = ?
+                WHERE id = ?
             """, (
-                account_data['credit_limit'],
-                account_data['close_day'],
-                account_data['due_day'],
+                account_data['name'],
+                account_data['category_id'],
+                account_data['currency_id'],
+                account_data['nature'],
+                account_data['term'],
                 account_id
             ))
-        elif not account_data.get('is_credit_card', False) and is_currently_credit_card:
-            # Remove credit card details
-            cursor.execute("DELETE FROM ccards WHERE account_id = ?", (account_id,))
         
-        conn.commit()
-        
-        # Return updated account
-        cursor.execute("""
-            SELECT a.id, a.name, c.name as category_name, cu.name as currency_name, 
-                   a.nature, a.term
-            FROM accounts a
-            JOIN cat c ON a.cat_id = c.id
-            LEFT JOIN currency cu ON a.default_currency_id = cu.id
-            WHERE a.id = ?
-        """, (account_id,))
-        
-        row = cursor.fetchone()
-        account = {
-            "id": row[0],
-            "name": row[1],
-            "category_name": row[2],
-            "currency_name": row[3] or "USD",
-            "nature": row[4] or "both",
-            "term": row[5] or "undefined",
-            "is_credit_card": account_data.get('is_credit_card', False),
-            "classifications": []
-        }
+            # Handle credit card status
+            if account_data.get('is_credit_card', False) and not is_currently_credit_card:
+                # Add credit card details
+                cursor.execute("""
+                    INSERT INTO ccards (account_id, credit_limit, close_day, due_day)
+                    VALUES (?, ?, ?, ?)
+                """, (
+                    account_id,
+                    account_data['credit_limit'],
+                    account_data['close_day'],
+                    account_data['due_day']
+                ))
+            elif account_data.get('is_credit_card', False) and is_currently_credit_card:
+                # Update existing credit card details
+                cursor.execute("""
+                    UPDATE ccards 
+                    SET credit_limit = ?, close_day = ?, due_day = ?
+                    WHERE account_id = ?
+                """, (
+                    account_data['credit_limit'],
+                    account_data['close_day'],
+                    account_data['due_day'],
+                    account_id
+                ))
+            elif not account_data.get('is_credit_card', False) and is_currently_credit_card:
+                # Remove credit card details
+                cursor.execute("DELETE FROM ccards WHERE account_id = ?", (account_id,))
+        
+            conn.commit()
+            table_versions.bump("accounts", "ccards")
+        
+            # Return updated account
+            reference = reference_data.snapshot(conn)
+            row = reference.accounts.by_id[account_id]
+            account = {
+                "id": row[0],
+                "name": row[1],
+                "category_name": reference.categories.name(row[2]),
+                "currency_name": reference.currencies.name(row[3]) or "USD",
+                "nature": row[4] or "both",
+                "term": row[5] or "undefined",
+                "is_credit_card": account_data.get('is_credit_card', False),
+                "classifications": []
+            }
         
-        if account_data.get('is_credit_card', False):
-            cursor.execute("SELECT credit_limit, close_day, due_day FROM ccards WHERE account_id = ?", (account_id,))
-            cc_data = cursor.fetchone()
-            if cc_data:
-                account.update({
-                    "credit_limit": float(cc_data[0]),
-                    "close_day": cc_data[1],
-                    "due_day": cc_data[2]
-                })
+            if account_data.get('is_credit_card', False):
+                cc_data = reference.credit_cards_by_account.get(account_id)
+                if cc_data:
+                    account.update({
+                        "credit_limit": float(cc_data[2]),
+                        "close_day": cc_data[3],
+                        "due_day": cc_data[4]
+                    })
         
-        conn.close()
         return {"account": account}
     except Exception as e:
         return {"error": str(e)}
@@ -508,27 +879,30 @@ def update_account(account_id: int, account_data: dict):
 def delete_account(account_id: int):
     """Delete an account"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Check if account has transactions
-        cursor.execute("SELECT COUNT(*) FROM transaction_lines WHERE account_id = ?", (account_id,))
-        has_transactions = cursor.fetchone()[0] > 0
+            # Check if account has transactions
+            cursor.execute("SELECT COUNT(*) FROM transaction_lines WHERE account_id = ?", (account_id,))
+            has_transactions = cursor.fetchone()[0] > 0
+            if not has_transactions:
+                cursor.execute("SELECT 1 FROM archive_account_totals WHERE account_id = ? LIMIT 1", (account_id,))
+                has_transactions = cursor.fetchone() is not None
         
-        if has_transactions:
-            raise HTTPException(status_code=400, detail="Cannot delete account with existing transactions")
+            if has_transactions:
+                raise HTTPException(status_code=400, detail="Cannot delete account with existing transactions")
         
-        # Delete credit card record if exists
-        cursor.execute("DELETE FROM ccards WHERE account_id = ?", (account_id,))
+            # Delete credit card record if exists
+            cursor.execute("DELETE FROM ccards WHERE account_id = ?", (account_id,))
         
-        # Delete account classifications
-        cursor.execute("DELETE FROM account_classifications WHERE account_id = ?", (account_id,))
+            # Delete account classifications
+            cursor.execute("DELETE FROM account_classifications WHERE account_id = ?", (account_id,))
         
-        # Delete account
-        cursor.execute("DELETE FROM accounts WHERE id = ?", (account_id,))
+            # Delete account
+            cursor.execute("DELETE FROM accounts WHERE id = ?", (account_id,))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            table_versions.bump("accounts", "ccards", "account_classifications")
         return {"message": "Account deleted successfully"}
     except HTTPException:
         raise
@@ -538,21 +912,23 @@ def delete_account(account_id: int):
 
 # Category CRUD endpoints
 @app.get("/api/categories")
-def get_categories():
+def get_categories(request: Request):
     """Get all categories"""
+    return reference_cache.respond(request, "categories", ("cat",), load_categories)
+
+def load_categories(conn=None):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name FROM cat ORDER BY name")
-        
-        categories = []
-        for row in cursor.fetchall():
-            categories.append({
-                "id": row[0],
-                "name": row[1]
-            })
+        with reusing_connection(conn) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name FROM cat ORDER BY name")
+        
+            categories = []
+            for row in cursor.fetchall():
+                categories.append({
+                    "id": row[0],
+                    "name": row[1]
+                })
         
-        conn.close()
         return {"categories": categories}
     except Exception as e:
         return {"error": str(e)}
@@ -561,14 +937,14 @@ def get_categories():
 def create_category(category_data: dict):
     """Create a new category"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute("INSERT INTO cat (name) VALUES (?)", (category_data['name'],))
-        category_id = cursor.lastrowid
+            cursor.execute("INSERT INTO cat (name) VALUES (?)", (category_data['name'],))
+            category_id = cursor.lastrowid
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            table_versions.bump("cat")
         return {"category": {"id": category_id, "name": category_data['name']}}
     except Exception as e:
         return {"error": str(e)}
@@ -577,18 +953,17 @@ def create_category(category_data: dict):
 def update_category(category_id: int, category_data: dict):
     """Update an existing category"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Check if category exists
-        cursor.execute("SELECT id FROM cat WHERE id = ?", (category_id,))
-        if not cursor.fetchone():
-            return {"error": "Category not found"}
+            # Check if category exists
+            if category_id not in reference_data.snapshot(conn).categories.by_id:
+                return {"error": "Category not found"}
         
-        cursor.execute("UPDATE cat SET name = ? WHERE id = ?", (category_data['name'], category_id))
+            cursor.execute("UPDATE cat SET name = ? WHERE id = ?", (category_data['name'], category_id))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            table_versions.bump("cat")
         return {"category": {"id": category_id, "name": category_data['name']}}
     except Exception as e:
         return {"error": str(e)}
@@ -597,25 +972,24 @@ def update_category(category_id: int, category_data: dict):
 def delete_category(category_id: int):
     """Delete a category"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Check if category exists
-        cursor.execute("SELECT id FROM cat WHERE id = ?", (category_id,))
-        if not cursor.fetchone():
-            raise HTTPException(status_code=404, detail="Category not found")
+            # Check if category exists
+            if category_id not in reference_data.snapshot(conn).categories.by_id:
+                raise HTTPException(status_code=404, detail="Category not found")
         
-        # Check if category is used by any accounts
-        cursor.execute("SELECT COUNT(*) FROM accounts WHERE cat_id = ?", (category_id,))
-        accounts_count = cursor.fetchone()[0]
+            # Check if category is used by any accounts
+            cursor.execute("SELECT COUNT(*) FROM accounts WHERE cat_id = ?", (category_id,))
+            accounts_count = cursor.fetchone()[0]
         
-        if accounts_count > 0:
-            raise HTTPException(status_code=400, detail=f"Cannot delete category. It is used by {accounts_count} account(s)")
+            if accounts_count > 0:
+                raise HTTPException(status_code=400, detail=f"Cannot delete category. It is used by {accounts_count} account(s)")
         
-        cursor.execute("DELETE FROM cat WHERE id = ?", (category_id,))
+            cursor.execute("DELETE FROM cat WHERE id = ?", (category_id,))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            table_versions.bump("cat")
         return {"message": "Category deleted successfully"}
     except HTTPException:
         raise  # Re-raise HTTPException
@@ -624,22 +998,24 @@ def delete_category(category_id: int):
 
 # Enhanced Currencies endpoint
 @app.get("/api/currencies/detailed")
-def get_currencies_detailed():
+def get_currencies_detailed(request: Request):
     """Get all currencies with full details"""
+    return reference_cache.respond(request, "currencies-detailed", ("currency",), load_currencies_detailed)
+
+def load_currencies_detailed():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, exchange_rate FROM currency ORDER BY name")
-        
-        currencies = []
-        for row in cursor.fetchall():
-            currencies.append({
-                "id": row[0],
-                "name": row[1],
-                "exchange_rate": float(row[2]) if row[2] else 1.0
-            })
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name, exchange_rate FROM currency ORDER BY name")
+        
+            currencies = []
+            for row in cursor.fetchall():
+                currencies.append({
+                    "id": row[0],
+                    "name": row[1],
+                    "exchange_rate": float(row[2]) if row[2] else 1.0
+                })
         
-        conn.close()
         return {"currencies": currencies}
     except Exception as e:
         return {"error": str(e)}
@@ -648,15 +1024,15 @@ def get_currencies_detailed():
 def create_currency(currency_data: dict):
     """Create a new currency"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute("INSERT INTO currency (name, exchange_rate) VALUES (?, ?)", 
-                      (currency_data['name'], currency_data['exchange_rate']))
-        currency_id = cursor.lastrowid
+            cursor.execute("INSERT INTO currency (name, exchange_rate) VALUES (?, ?)", 
+                          (currency_data['name'], currency_data['exchange_rate']))
+            currency_id = cursor.lastrowid
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            table_versions.bump("currency")
         return {"currency": {
             "id": currency_id, 
             "name": currency_data['name'],
@@ -669,19 +1045,18 @@ def create_currency(currency_data: dict):
 def update_currency(currency_id: int, currency_data: dict):
     """Update an existing currency"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Check if currency exists
-        cursor.execute("SELECT id FROM currency WHERE id = ?", (currency_id,))
-        if not cursor.fetchone():
-            return {"error": "Currency not found"}
+            # Check if currency exists
+            if currency_id not in reference_data.snapshot(conn).currencies.by_id:
+                return {"error": "Currency not found"}
         
-        cursor.execute("UPDATE currency SET name = ?, exchange_rate = ? WHERE id = ?", 
-                      (currency_data['name'], currency_data['exchange_rate'], currency_id))
+            cursor.execute("UPDATE currency SET name = ?, exchange_rate = ? WHERE id = ?", 
+                          (currency_data['name'], currency_data['exchange_rate'], currency_id))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            table_versions.bump("currency")
         return {"currency": {
             "id": currency_id, 
             "name": currency_data['name'],
@@ -694,28 +1069,28 @@ def update_currency(currency_id: int, currency_data: dict):
 def delete_currency(currency_id: int):
     """Delete a currency"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Check if currency exists
-        cursor.execute("SELECT id FROM currency WHERE id = ?", (currency_id,))
-        if not cursor.fetchone():
-            raise HTTPException(status_code=404, detail="Currency not found")
+            # Check if currency exists
+            if currency_id not in reference_data.snapshot(conn).currencies.by_id:
+                raise HTTPException(status_code=404, detail="Currency not found")
         
-        # Check if currency is used by any accounts or transactions
-        cursor.execute("SELECT COUNT(*) FROM accounts WHERE default_currency_id = ?", (currency_id,))
-        accounts_count = cursor.fetchone()[0]
+            # Check if currency is used by any accounts or transactions
+            cursor.execute("SELECT COUNT(*) FROM accounts WHERE default_currency_id = ?", (currency_id,))
+            accounts_count = cursor.fetchone()[0]
         
-        cursor.execute("SELECT COUNT(*) FROM transactions WHERE currency_id = ?", (currency_id,))
-        transactions_count = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*) FROM transactions WHERE currency_id = ?", (currency_id,))
+            transactions_count = cursor.fetchone()[0] + archive.count_archived(conn, "transactions", "currency_id = ?",
+                                                                               (currency_id,))
         
-        if accounts_count > 0 or transactions_count > 0:
-            raise HTTPException(status_code=400, detail=f"Cannot delete currency. It is used by {accounts_count} account(s) and {transactions_count} transaction(s)")
+            if accounts_count > 0 or transactions_count > 0:
+                raise HTTPException(status_code=400, detail=f"Cannot delete currency. It is used by {accounts_count} account(s) and {transactions_count} transaction(s)")
         
-        cursor.execute("DELETE FROM currency WHERE id = ?", (currency_id,))
+            cursor.execute("DELETE FROM currency WHERE id = ?", (currency_id,))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            table_versions.bump("currency")
         return {"message": "Currency deleted successfully"}
     except HTTPException:
         raise  # Re-raise HTTPException to let FastAPI handle it properly
@@ -724,21 +1099,23 @@ def delete_currency(currency_id: int):
     
 # Enhanced Classifications endpoint
 @app.get("/api/classifications/detailed")
-def get_classifications_detailed():
+def get_classifications_detailed(request: Request):
     """Get all classifications with full details"""
+    return reference_cache.respond(request, "classifications-detailed", ("classifications",), load_classifications_detailed)
+
+def load_classifications_detailed():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name FROM classifications ORDER BY name")
-        
-        classifications = []
-        for row in cursor.fetchall():
-            classifications.append({
-                "id": row[0],
-                "name": row[1]
-            })
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name FROM classifications ORDER BY name")
+        
+            classifications = []
+            for row in cursor.fetchall():
+                classifications.append({
+                    "id": row[0],
+                    "name": row[1]
+                })
         
-        conn.close()
         return {"classifications": classifications}
     except Exception as e:
         return {"error": str(e)}
@@ -747,14 +1124,14 @@ def get_classifications_detailed():
 def create_classification(classification_data: dict):
     """Create a new classification"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute("INSERT INTO classifications (name) VALUES (?)", (classification_data['name'],))
-        classification_id = cursor.lastrowid
+            cursor.execute("INSERT INTO classifications (name) VALUES (?)", (classification_data['name'],))
+            classification_id = cursor.lastrowid
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            table_versions.bump("classifications")
         return {"classification": {"id": classification_id, "name": classification_data['name']}}
     except Exception as e:
         return {"error": str(e)}
@@ -763,19 +1140,18 @@ def create_classification(classification_data: dict):
 def update_classification(classification_id: int, classification_data: dict):
     """Update an existing classification"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Check if classification exists
-        cursor.execute("SELECT id FROM classifications WHERE id = ?", (classification_id,))
-        if not cursor.fetchone():
-            return {"error": "Classification not found"}
+            # Check if classification exists
+            if classification_id not in reference_data.snapshot(conn).classifications.by_id:
+                return {"error": "Classification not found"}
         
-        cursor.execute("UPDATE classifications SET name = ? WHERE id = ?", 
-                      (classification_data['name'], classification_id))
+            cursor.execute("UPDATE classifications SET name = ? WHERE id = ?", 
+                          (classification_data['name'], classification_id))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            table_versions.bump("classifications")
         return {"classification": {"id": classification_id, "name": classification_data['name']}}
     except Exception as e:
         return {"error": str(e)}
@@ -784,63 +1160,200 @@ def update_classification(classification_id: int, classification_data: dict):
 def delete_classification(classification_id: int):
     """Delete a classification"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+        
+            # Check if classification exists
+            if classification_id not in reference_data.snapshot(conn).classifications.by_id:
+                raise HTTPException(status_code=404, detail="Classification not found")
         
-        # Check if classification exists
-        cursor.execute("SELECT id FROM classifications WHERE id = ?", (classification_id,))
-        if not cursor.fetchone():
-            raise HTTPException(status_code=404, detail="Classification not found")
+            # Check if classification is used by any transaction lines or account classifications
+            cursor.execute("SELECT COUNT(*) FROM transaction_lines WHERE classification_id = ?", (classification_id,))
+            transaction_lines_count = cursor.fetchone()[0] + archive.count_archived(
+                conn, "transaction_lines", "classification_id = ?", (classification_id,))
         
-        # Check if classification is used by any transaction lines or account classifications
-        cursor.execute("SELECT COUNT(*) FROM transaction_lines WHERE classification_id = ?", (classification_id,))
-        transaction_lines_count = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*) FROM account_classifications WHERE classification_id = ?", (classification_id,))
+            account_links_count = cursor.fetchone()[0]
         
-        cursor.execute("SELECT COUNT(*) FROM account_classifications WHERE classification_id = ?", (classification_id,))
-        account_links_count = cursor.fetchone()[0]
+            if transaction_lines_count > 0 or account_links_count > 0:
+                raise HTTPException(status_code=400, detail=f"Cannot delete classification. It is used by {transaction_lines_count} transaction line(s) and linked to {account_links_count} account(s)")
         
-        if transaction_lines_count > 0 or account_links_count > 0:
-            raise HTTPException(status_code=400, detail=f"Cannot delete classification. It is used by {transaction_lines_count} transaction line(s) and linked to {account_links_count} account(s)")
+            cursor.execute("SELECT COUNT(*) FROM classification_rules WHERE classification_id = ?", (classification_id,))
+            rules_count = cursor.fetchone()[0]
+            if rules_count > 0:
+                raise HTTPException(status_code=400, detail=f"Cannot delete classification. It is assigned by {rules_count} rule(s)")
         
-        cursor.execute("DELETE FROM classifications WHERE id = ?", (classification_id,))
+            cursor.execute("DELETE FROM classifications WHERE id = ?", (classification_id,))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            table_versions.bump("classifications")
         return {"message": "Classification deleted successfully"}
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Classification rule endpoints
+@app.get("/api/classification-rules")
+def get_classification_rules(request: Request):
+    """Get all classification rules in evaluation order"""
+    return reference_cache.respond(request, "classification-rules", ("classification_rules", "classifications"),
+                                   load_classification_rules)
+
+def load_classification_rules():
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT {', '.join('r.' + field for field in rules.RULE_FIELDS)}, c.name as classification_name
+                FROM classification_rules r
+                LEFT JOIN classifications c ON r.classification_id = c.id
+                ORDER BY r.priority DESC, r.id
+            """)
+        
+            result = rows_payload(cursor.fetchall(), rules.RULE_FIELDS + ("classification_name",))
+            for rule in result:
+                rule["enabled"] = bool(rule["enabled"])
+        
+        return {"rules": result}
+    except Exception as e:
+        return {"error": str(e)}
+
+def rule_values(rule_data):
+    """Column values of a submitted rule, after validation (raises HTTPException 400)"""
+    try:
+        rules.validate(rule_data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return (rule_data.get('name'), int(rule_data.get('priority') or 0), rule_data.get('keyword') or None,
+            rule_data.get('pattern') or None, rule_data.get('account_id'), rule_data.get('min_amount'),
+            rule_data.get('max_amount'), rule_data['classification_id'], 1 if rule_data.get('enabled', True) else 0)
+
+def rule_payload(rule_id, values):
+    rule = dict(zip(rules.RULE_FIELDS, (rule_id,) + values))
+    rule["enabled"] = bool(rule["enabled"])
+    return rule
+
+@app.post("/api/classification-rules")
+def create_classification_rule(rule_data: dict):
+    """Create a classification rule"""
+    values = rule_values(rule_data)
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+        
+            cursor.execute(f"""
+                INSERT INTO classification_rules ({', '.join(rules.RULE_FIELDS[1:])})
+                VALUES ({', '.join('?' * len(values))})
+            """, values)
+            rule_id = cursor.lastrowid
+        
+            conn.commit()
+            table_versions.bump("classification_rules")
+        return {"rule": rule_payload(rule_id, values)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.put("/api/classification-rules/{rule_id}")
+def update_classification_rule(rule_id: int, rule_data: dict):
+    """Replace a classification rule"""
+    values = rule_values(rule_data)
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+        
+            cursor.execute(f"""
+                UPDATE classification_rules SET {', '.join(field + ' = ?' for field in rules.RULE_FIELDS[1:])}
+                WHERE id = ?
+            """, values + (rule_id,))
+            if not cursor.rowcount:
+                raise HTTPException(status_code=404, detail="Rule not found")
+        
+            conn.commit()
+            table_versions.bump("classification_rules")
+        return {"rule": rule_payload(rule_id, values)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.delete("/api/classification-rules/{rule_id}")
+def delete_classification_rule(rule_id: int):
+    """Delete a classification rule"""
+    try:
+        with get_db_connection() as conn:
+            deleted = conn.execute("DELETE FROM classification_rules WHERE id = ?", (rule_id,)).rowcount
+            conn.commit()
+        if not deleted:
+            raise HTTPException(status_code=404, detail="Rule not found")
+        table_versions.bump("classification_rules")
+        return {"message": "Rule deleted successfully"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/classification-rules/test")
+def test_classification_rules(line_data: dict):
+    """Which rule would classify a line (description, account_id, amount)"""
+    try:
+        with get_db_connection() as conn:
+            ruleset = rules.load(conn)
+        rule = ruleset.match(line_data.get('description'), line_data.get('account_id'), line_data.get('amount'))
+        return {"rule": rule._asdict() if rule else None,
+                "classification_id": rule.classification_id if rule else None}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/classification-rules/apply")
+def apply_classification_rules(request_data: dict):
+    """
+    Classify existing lines with the rules
+
+    Body: {"filter": {...} (optional, see bulk.py), "overwrite": bool,
+    "dry_run": bool}. Without overwrite only unclassified lines change;
+    lines in closed periods never do. For the whole ledger, submit an
+    apply-classification-rules job instead.
+    """
+    try:
+        with get_db_connection() as conn:
+            result = rules.apply(conn, request_data.get('filter'), overwrite=bool(request_data.get('overwrite')),
+                                 dry_run=bool(request_data.get('dry_run')))
+        if result["classified"] and not result["dry_run"]:
+            table_versions.bump("transaction_lines")
+        return result
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Account-Classification linking endpoints
 @app.get("/api/accounts/{account_id}/classifications")
 def get_account_classifications(account_id: int):
     """Get classifications linked to a specific account"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Check if account exists
-        cursor.execute("SELECT id FROM accounts WHERE id = ?", (account_id,))
-        if not cursor.fetchone():
-            return {"error": "Account not found"}
-        
-        cursor.execute("""
-            SELECT c.id, c.name
-            FROM classifications c
-            JOIN account_classifications ac ON c.id = ac.classification_id
-            WHERE ac.account_id = ?
-            ORDER BY c.name
-        """, (account_id,))
-        
-        classifications = []
-        for row in cursor.fetchall():
-            classifications.append({
-                "id": row[0],
-                "name": row[1]
-            })
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+        
+            # Check if account exists
+            if account_id not in reference_data.snapshot(conn).accounts.by_id:
+                return {"error": "Account not found"}
+        
+            cursor.execute("""
+                SELECT c.id, c.name
+                FROM classifications c
+                JOIN account_classifications ac ON c.id = ac.classification_id
+                WHERE ac.account_id = ?
+                ORDER BY c.name
+            """, (account_id,))
+        
+            classifications = []
+            for row in cursor.fetchall():
+                classifications.append({
+                    "id": row[0],
+                    "name": row[1]
+                })
         
-        conn.close()
         return {"classifications": classifications}
     except Exception as e:
         return {"error": str(e)}
@@ -849,30 +1362,28 @@ def get_account_classifications(account_id: int):
 def link_account_classification(account_id: int, classification_id: int):
     """Link a classification to an account"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Check if account exists
-        cursor.execute("SELECT id FROM accounts WHERE id = ?", (account_id,))
-        if not cursor.fetchone():
-            return {"error": "Account not found"}
+            # Check if account exists
+            if account_id not in reference_data.snapshot(conn).accounts.by_id:
+                return {"error": "Account not found"}
         
-        # Check if classification exists
-        cursor.execute("SELECT id FROM classifications WHERE id = ?", (classification_id,))
-        if not cursor.fetchone():
-            return {"error": "Classification not found"}
+            # Check if classification exists
+            if classification_id not in reference_data.snapshot(conn).classifications.by_id:
+                return {"error": "Classification not found"}
         
-        # Check if link already exists
-        cursor.execute("SELECT id FROM account_classifications WHERE account_id = ? AND classification_id = ?", 
-                      (account_id, classification_id))
-        if cursor.fetchone():
-            return {"error": "Classification is already linked to this account"}
+            # Check if link already exists
+            cursor.execute("SELECT id FROM account_classifications WHERE account_id = ? AND classification_id = ?", 
+                          (account_id, classification_id))
+            if cursor.fetchone():
+                return {"error": "Classification is already linked to this account"}
         
-        cursor.execute("INSERT INTO account_classifications (account_id, classification_id) VALUES (?, ?)", 
-                      (account_id, classification_id))
+            cursor.execute("INSERT INTO account_classifications (account_id, classification_id) VALUES (?, ?)", 
+                          (account_id, classification_id))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            table_versions.bump("account_classifications")
         return {"message": "Classification linked successfully"}
     except Exception as e:
         return {"error": str(e)}
@@ -881,212 +1392,416 @@ def link_account_classification(account_id: int, classification_id: int):
 def unlink_account_classification(account_id: int, classification_id: int):
     """Unlink a classification from an account"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Check if account exists
-        cursor.execute("SELECT id FROM accounts WHERE id = ?", (account_id,))
-        if not cursor.fetchone():
-            return {"error": "Account not found"}
+            # Check if account exists
+            if account_id not in reference_data.snapshot(conn).accounts.by_id:
+                return {"error": "Account not found"}
         
-        # Check if link exists
-        cursor.execute("SELECT id FROM account_classifications WHERE account_id = ? AND classification_id = ?", 
-                      (account_id, classification_id))
-        if not cursor.fetchone():
-            return {"error": "Classification is not linked to this account"}
+            # Check if link exists
+            cursor.execute("SELECT id FROM account_classifications WHERE account_id = ? AND classification_id = ?", 
+                          (account_id, classification_id))
+            if not cursor.fetchone():
+                return {"error": "Classification is not linked to this account"}
         
-        cursor.execute("DELETE FROM account_classifications WHERE account_id = ? AND classification_id = ?", 
-                      (account_id, classification_id))
+            cursor.execute("DELETE FROM account_classifications WHERE account_id = ? AND classification_id = ?", 
+                          (account_id, classification_id))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            table_versions.bump("account_classifications")
         return {"message": "Classification unlinked successfully"}
     except Exception as e:
         return {"error": str(e)}
     
 
+def load_account_classifications(conn=None):
+    """Linked classifications of every account, keyed by account id"""
+    try:
+        with reusing_connection(conn) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT ac.account_id, c.id, c.name
+                FROM classifications c
+                JOIN account_classifications ac ON c.id = ac.classification_id
+                ORDER BY ac.account_id, c.name
+            """)
+        
+            links = {}
+            for account_id, classification_id, name in cursor.fetchall():
+                links.setdefault(str(account_id), []).append({"id": classification_id, "name": name})
+        
+        return {"account_classifications": links}
+    except Exception as e:
+        return {"error": str(e)}
+
+# Section name -> (tables it is read from, loader(conn, columnar) returning the matching route's payload)
+BOOTSTRAP_SECTIONS = {
+    "accounts": (("accounts", "cat", "currency"), lambda conn, columnar: load_accounts(columnar, conn)),
+    "accounts_detailed": (ACCOUNT_DETAIL_TABLES, lambda conn, columnar: load_accounts_detailed(columnar, conn)),
+    "currencies": (("currency",), lambda conn, columnar: load_currencies(conn)),
+    "classifications": (("classifications",), lambda conn, columnar: load_classifications(conn)),
+    "categories": (("cat",), lambda conn, columnar: load_categories(conn)),
+    "account_classifications": (("account_classifications", "classifications"),
+                                lambda conn, columnar: load_account_classifications(conn)),
+}
+BOOTSTRAP_TABLES = tuple(dict.fromkeys(table for tables, _ in BOOTSTRAP_SECTIONS.values() for table in tables))
+
+@app.get("/api/bootstrap")
+def get_bootstrap(request: Request, versions: str = None, response_format: str = Query("rows", alias="format")):
+    """
+    All reference data in one round trip, read in a single transaction
+
+    Every section comes with its version; ?versions=section:version,... skips
+    the sections the client already has. Without it the whole payload is
+    served with an ETag, like the individual reference routes.
+    """
+    columnar = is_columnar(response_format)
+    if not versions:
+        return reference_cache.respond(request, ("bootstrap", columnar), BOOTSTRAP_TABLES,
+                                       lambda: load_bootstrap(columnar))
+    known = dict(item.split(":", 1) for item in versions.split(",") if ":" in item)
+    return fast_json(load_bootstrap(columnar, known))
+
+def load_bootstrap(columnar=False, known=None):
+    known = known or {}
+    # Taken before the read, so no section is ever older than its version
+    current = {name: table_versions.tag(tables) for name, (tables, _) in BOOTSTRAP_SECTIONS.items()}
+    try:
+        with get_db_connection() as conn:
+            # One read transaction, so the sections are consistent with each other
+            conn.execute("BEGIN")
+            sections = {}
+            for name, (_, loader) in BOOTSTRAP_SECTIONS.items():
+                if known.get(name) == current[name]:
+                    continue
+                payload = loader(conn, columnar)
+                if "error" in payload:
+                    return payload
+                sections[name] = next(iter(payload.values()))
+            conn.rollback()
+        return {
+            "versions": current,
+            "sections": sections,
+            "unchanged": [name for name in current if name not in sections],
+        }
+    except Exception as e:
+        return {"error": str(e)}
+
+ACCOUNT_BALANCE_FIELDS = ("id", "name", "category", "balance", "currency", "nature", "term",
+                          "is_credit_card", "credit_limit", "due_day", "close_day")
+
+@app.get("/api/accounts/{account_id}/balance")
+def get_account_balance(account_id: int, as_of: str = None):
+    """Balance of an account at the end of as_of (YYYY-MM-DD, default today)"""
+    try:
+        day = balances.parse_date(as_of) if as_of else datetime.date.today()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="as_of must be a YYYY-MM-DD date")
+    try:
+        with get_db_connection() as conn:
+            account = reference_data.snapshot(conn).accounts.by_id.get(account_id)
+            if not account:
+                raise HTTPException(status_code=404, detail="Account not found")
+
+            balance = balances.account_balance(conn, account_id, day)
+            refresh_checkpoints_later(conn)
+        balance["account_name"] = account[1]
+        return balance
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/accounts/{account_id}/register")
+def get_account_register(account_id: int, limit: int = Query(100, ge=1, le=1000), cursor: str = None,
+                         start: str = None, response_format: str = Query("rows", alias="format")):
+    """An account's lines in date order with a running balance, paged by cursor"""
+    try:
+        start_day = balances.parse_date(start) if start else None
+        if cursor:
+            balances.decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid start date or cursor")
+    try:
+        with get_db_connection() as conn:
+            account = reference_data.snapshot(conn).accounts.by_id.get(account_id)
+            if not account:
+                raise HTTPException(status_code=404, detail="Account not found")
+
+            rows, opening, next_cursor = balances.register(conn, account_id, limit, after=cursor, start=start_day)
+        return fast_json({
+            "account_id": account_id,
+            "account_name": account[1],
+            "opening_balance": opening,
+            "lines": rows_payload(rows, balances.REGISTER_FIELDS, columnar=is_columnar(response_format)),
+            "next_cursor": next_cursor,
+        })
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/reports/trial-balance")
+def get_trial_balance(as_of: str = None, response_format: str = Query("rows", alias="format")):
+    """Debit and credit totals of every account at the end of as_of (YYYY-MM-DD, default today)"""
+    try:
+        day = balances.parse_date(as_of) if as_of else datetime.date.today()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="as_of must be a YYYY-MM-DD date")
+    try:
+        with get_db_connection() as conn:
+            # Closed periods are answered from their frozen snapshots
+            snapshot = periods.trial_balance(conn, day)
+            rows, checkpoint = snapshot or balances.trial_balance(conn, day)
+            if not snapshot:
+                refresh_checkpoints_later(conn)
+        return fast_json({
+            "as_of": day.isoformat(),
+            "source": "period_snapshot" if snapshot else "checkpoints",
+            "checkpoint": checkpoint,
+            "accounts": rows_payload(rows, balances.TRIAL_BALANCE_FIELDS, columnar=is_columnar(response_format)),
+            "total_debit": round(sum(row[4] for row in rows), 2),
+            "total_credit": round(sum(row[5] for row in rows), 2),
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/reports/classifications")
+def get_classification_report(date_from: str = Query(None, alias="from"), date_to: str = Query(None, alias="to"),
+                              granularity: str = "month", classification_id: int = None,
+                              response_format: str = Query("rows", alias="format")):
+    """
+    Spend (debit) and income (credit) per month, quarter or year and
+    classification between from and to (YYYY-MM-DD, inclusive); with a
+    classification_id (0 for unclassified), that classification's per
+    account instead. Served from the maintained month totals (budgets.py).
+    """
+    if granularity not in budgets.GRANULARITIES:
+        raise HTTPException(status_code=400,
+                            detail=f"granularity must be one of {', '.join(budgets.GRANULARITIES)}")
+    try:
+        first = balances.parse_date(date_from) if date_from else None
+        last = balances.parse_date(date_to) if date_to else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="from and to must be YYYY-MM-DD dates")
+    if first and last and first > last:
+        raise HTTPException(status_code=400, detail="from must not be after to")
+    try:
+        with get_db_connection() as conn:
+            rows = budgets.classification_report(conn, reference_data.snapshot(conn), first, last, granularity,
+                                                 classification_id)
+        fields = budgets.REPORT_FIELDS if classification_id is None else budgets.DRILL_DOWN_FIELDS
+        return fast_json({
+            "from": date_from,
+            "to": date_to,
+            "granularity": granularity,
+            "classification_id": classification_id,
+            "periods": rows_payload(rows, fields, columnar=is_columnar(response_format)),
+            "total_spend": round(sum(row[3] for row in rows), 2),
+            "total_income": round(sum(row[4] for row in rows), 2),
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Closing or reopening changes these; bumping them also tells /api/events subscribers
+PERIOD_TABLES = ("closed_periods", "period_account_snapshots", "period_classification_snapshots")
+
+@app.get("/api/periods")
+def get_periods():
+    """Closed-through date and the closed periods"""
+    try:
+        with get_db_connection() as conn:
+            closed = periods.list_periods(conn)
+        return {
+            "closed_through": closed[-1][0] if closed else None,
+            "periods": [{"period_end": period_end, "closed_at": closed_at} for period_end, closed_at in closed],
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/periods/close")
+def close_periods(close_data: dict):
+    """Close the books through a month end (through: YYYY-MM-DD)"""
+    try:
+        through = balances.parse_date(close_data.get('through') or "")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="through must be a YYYY-MM-DD date")
+    try:
+        with get_db_connection() as conn:
+            closed = periods.close_periods(conn, through)
+        table_versions.bump(*PERIOD_TABLES)
+        return {"message": f"Closed {len(closed)} period(s)", "closed_through": through.isoformat(),
+                "periods": closed}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.delete("/api/periods/{period_end}")
+def reopen_periods(period_end: str):
+    """Reopen a closed period and every period after it"""
+    try:
+        with get_db_connection() as conn:
+            archived = archive.archived_year_end(conn)
+            if archived is not None and period_end <= archived:
+                raise HTTPException(status_code=409, detail=f"Periods through {archived} are archived")
+            reopened = periods.reopen_periods(conn, period_end)
+        if not reopened:
+            raise HTTPException(status_code=404, detail="Period is not closed")
+        table_versions.bump(*PERIOD_TABLES)
+        return {"message": f"Reopened {len(reopened)} period(s)", "periods": reopened}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/dashboard")
-def get_dashboard_data():
-    """Get comprehensive dashboard data"""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get account balances
-        cursor.execute("""
-            SELECT 
-                a.id, a.name, c.name as category, 
-                COALESCE(SUM(tl.debit), 0) - COALESCE(SUM(tl.credit), 0) as balance,
-                cu.name as currency, a.nature, a.term,
-                CASE WHEN cc.account_id IS NOT NULL THEN 1 ELSE 0 END as is_credit_card,
-                cc.credit_limit, cc.due_day, cc.close_day
-            FROM accounts a
-            JOIN cat c ON a.cat_id = c.id
-            LEFT JOIN currency cu ON a.default_currency_id = cu.id
-            LEFT JOIN transaction_lines tl ON a.id = tl.account_id
-            LEFT JOIN ccards cc ON a.id = cc.account_id
-            GROUP BY a.id, a.name, c.name, cu.name, a.nature, a.term, cc.credit_limit, cc.due_day, cc.close_day
-            ORDER BY c.name, a.name
-        """)
-        
-        account_balances = []
-        total_assets = 0
-        total_liabilities = 0
-        total_equity = 0
-        
-        for row in cursor.fetchall():
-            balance = float(row[3]) if row[3] else 0.0
-            account_balance = {
-                "id": row[0],
-                "name": row[1],
-                "category": row[2],
-                "balance": balance,
-                "currency": row[4] or "USD",
-                "nature": row[5] or "both",
-                "term": row[6] or "undefined",
-                "is_credit_card": bool(row[7]),
-                "credit_limit": float(row[8]) if row[8] else None,
-                "due_day": row[9],
-                "close_day": row[10]
-            }
-            account_balances.append(account_balance)
-            
-            # Calculate totals based on account nature and balance
-            category = row[2].lower()
-            if 'asset' in category or 'cash' in category or 'bank' in category:
-                total_assets += balance
-            elif 'liability' in category or 'payable' in category or 'loan' in category:
-                total_liabilities += abs(balance)  # Liabilities are typically negative
-            elif 'equity' in category or 'capital' in category:
-                total_equity += balance
-        
-        # Get transaction counts
-        cursor.execute("SELECT COUNT(*) FROM transactions")
-        transaction_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM accounts")
-        account_count = cursor.fetchone()[0]
-        
-        # Get income/expense totals (simplified - you may want to refine this)
-        cursor.execute("""
-            SELECT 
-                COALESCE(SUM(CASE WHEN c.name LIKE '%income%' OR c.name LIKE '%revenue%' THEN tl.credit END), 0) as total_income,
-                COALESCE(SUM(CASE WHEN c.name LIKE '%expense%' OR c.name LIKE '%cost%' THEN tl.debit END), 0) as total_expenses
-            FROM transaction_lines tl
-            JOIN accounts a ON tl.account_id = a.id
-            JOIN cat c ON a.cat_id = c.id
-        """)
-        
-        income_expense = cursor.fetchone()
-        total_income = float(income_expense[0]) if income_expense[0] else 0.0
-        total_expenses = float(income_expense[1]) if income_expense[1] else 0.0
-        
-        # Get recent transactions (last 5)
-        cursor.execute("""
-            SELECT 
-                t.id, t.description, cu.name as currency_name,
-                MIN(tl.date) as date,
-                SUM(COALESCE(tl.debit, 0)) as total_debit,
-                SUM(COALESCE(tl.credit, 0)) as total_credit,
-                COUNT(tl.id) as line_count,
-                GROUP_CONCAT(DISTINCT a.name) as accounts
-            FROM transactions t
-            JOIN transaction_lines tl ON t.id = tl.transaction_id
-            LEFT JOIN currency cu ON t.currency_id = cu.id
-            LEFT JOIN accounts a ON tl.account_id = a.id
-            GROUP BY t.id, t.description, cu.name
-            ORDER BY date DESC
-            LIMIT 5
-        """)
-        
-        recent_transactions = []
-        for row in cursor.fetchall():
-            total_debit = float(row[4]) if row[4] else 0.0
-            total_credit = float(row[5]) if row[5] else 0.0
-            display_amount = total_debit if total_debit > 0 else total_credit
+def get_dashboard(response_format: str = Query("rows", alias="format")):
+    """Get comprehensive dashboard data (?format=columnar for parallel arrays)"""
+    return fast_json(get_dashboard_data(columnar=is_columnar(response_format)))
+
+def get_dashboard_data(columnar=False):
+    """Build the dashboard payload"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            # Archived years only contribute their per-account totals
+            account_lines = archive.account_lines(conn)
+        
+            # Get account balances
+            cursor.execute(f"""
+                SELECT 
+                    a.id, a.name, c.name as category, 
+                    TOTAL(tl.debit) - TOTAL(tl.credit) as balance,
+                    COALESCE(cu.name, 'USD') as currency,
+                    COALESCE(NULLIF(a.nature, ''), 'both') as nature,
+                    COALESCE(NULLIF(a.term, ''), 'undefined') as term,
+                    CASE WHEN cc.account_id IS NOT NULL THEN 1 ELSE 0 END as is_credit_card,
+                    NULLIF(cc.credit_limit, 0) as credit_limit, cc.due_day, cc.close_day
+                FROM accounts a
+                JOIN cat c ON a.cat_id = c.id
+                LEFT JOIN currency cu ON a.default_currency_id = cu.id
+                LEFT JOIN {account_lines} tl ON a.id = tl.account_id
+                LEFT JOIN ccards cc ON a.id = cc.account_id
+                GROUP BY a.id, a.name, c.name, cu.name, a.nature, a.term, cc.credit_limit, cc.due_day, cc.close_day
+                ORDER BY c.name, a.name
+            """)
+        
+            balance_rows = []
+            total_assets = 0
+            total_liabilities = 0
+            total_equity = 0
+        
+            for row in cursor.fetchall():
+                balance = row[3]
+                balance_rows.append(row[:7] + (bool(row[7]),) + row[8:])
             
-            recent_transactions.append({
-                "id": row[0],
-                "description": row[1],
-                "currency_name": row[2] or "USD",
-                "date": row[3],
-                "amount": display_amount,
-                "accounts": row[7] or "Unknown",
-                "total_debit": total_debit,
-                "total_credit": total_credit,
-                "line_count": row[6]
-            })
-        
-        # Get credit card dues
-        cursor.execute("""
-            SELECT 
-                cc.id, a.name as account_name,
-                COALESCE(SUM(tl.credit), 0) - COALESCE(SUM(tl.debit), 0) as current_balance,
-                cc.credit_limit, cc.due_day, cc.close_day
-            FROM ccards cc
-            JOIN accounts a ON cc.account_id = a.id
-            LEFT JOIN transaction_lines tl ON a.id = tl.account_id
-            GROUP BY cc.id, a.name, cc.credit_limit, cc.due_day, cc.close_day
-        """)
-        
-        credit_card_dues = []
-        for row in cursor.fetchall():
-            current_balance = float(row[2]) if row[2] else 0.0
-            credit_limit = float(row[3]) if row[3] else 0.0
-            due_day = row[4]
+                # Calculate totals based on account nature and balance
+                category = row[2].lower()
+                if 'asset' in category or 'cash' in category or 'bank' in category:
+                    total_assets += balance
+                elif 'liability' in category or 'payable' in category or 'loan' in category:
+                    total_liabilities += abs(balance)  # Liabilities are typically negative
+                elif 'equity' in category or 'capital' in category:
+                    total_equity += balance
+        
+            # Get transaction counts
+            cursor.execute("SELECT COUNT(*) FROM transactions")
+            transaction_count = cursor.fetchone()[0] + archive.archived_transaction_count(conn)
+        
+            account_count = len(reference_data.snapshot(conn).accounts.rows)
+        
+            # Get income/expense totals (simplified - you may want to refine this)
+            cursor.execute(f"""
+                SELECT 
+                    COALESCE(SUM(CASE WHEN c.name LIKE '%income%' OR c.name LIKE '%revenue%' THEN tl.credit END), 0) as total_income,
+                    COALESCE(SUM(CASE WHEN c.name LIKE '%expense%' OR c.name LIKE '%cost%' THEN tl.debit END), 0) as total_expenses
+                FROM {account_lines} tl
+                JOIN accounts a ON tl.account_id = a.id
+                JOIN cat c ON a.cat_id = c.id
+            """)
+        
+            income_expense = cursor.fetchone()
+            total_income = float(income_expense[0]) if income_expense[0] else 0.0
+            total_expenses = float(income_expense[1]) if income_expense[1] else 0.0
+        
+            account_balances = rows_payload(balance_rows, ACCOUNT_BALANCE_FIELDS, columnar=columnar)
+        
+            # Get recent transactions (last 5)
+            lines, transactions = archive.page_tables(conn, 5)
+            cursor.execute(TRANSACTION_SUMMARY_SQL.format(transactions=transactions, lines=lines), (5, 0))
+            recent_transactions = rows_payload(cursor.fetchall(), TRANSACTION_SUMMARY_FIELDS, columnar=columnar)
+        
+            # Get credit card dues
+            cursor.execute(f"""
+                SELECT 
+                    cc.id, a.name as account_name,
+                    COALESCE(SUM(tl.credit), 0) - COALESCE(SUM(tl.debit), 0) as current_balance,
+                    cc.credit_limit, cc.due_day, cc.close_day
+                FROM ccards cc
+                JOIN accounts a ON cc.account_id = a.id
+                LEFT JOIN {account_lines} tl ON a.id = tl.account_id
+                GROUP BY cc.id, a.name, cc.credit_limit, cc.due_day, cc.close_day
+            """)
+        
+            credit_card_dues = []
+            for row in cursor.fetchall():
+                current_balance = float(row[2]) if row[2] else 0.0
+                credit_limit = float(row[3]) if row[3] else 0.0
+                due_day = row[4]
             
-            # Calculate next due date
-            from datetime import datetime, timedelta
-            today = datetime.now()
-            if due_day:
-                try:
-                    # Find next due date
-                    next_due = datetime(today.year, today.month, due_day)
-                    if next_due <= today:
-                        # Move to next month
-                        if today.month == 12:
-                            next_due = datetime(today.year + 1, 1, due_day)
-                        else:
-                            next_due = datetime(today.year, today.month + 1, due_day)
+                # Calculate next due date
+                from datetime import datetime, timedelta
+                today = datetime.now()
+                if due_day:
+                    try:
+                        # Find next due date
+                        next_due = datetime(today.year, today.month, due_day)
+                        if next_due <= today:
+                            # Move to next month
+                            if today.month == 12:
+                                next_due = datetime(today.year + 1, 1, due_day)
+                            else:
+                                next_due = datetime(today.year, today.month + 1, due_day)
                     
-                    days_until_due = (next_due - today).days
-                    due_date = next_due.strftime('%Y-%m-%d')
-                except:
+                        days_until_due = (next_due - today).days
+                        due_date = next_due.strftime('%Y-%m-%d')
+                    except:
+                        days_until_due = 0
+                        due_date = today.strftime('%Y-%m-%d')
+                else:
                     days_until_due = 0
                     due_date = today.strftime('%Y-%m-%d')
-            else:
-                days_until_due = 0
-                due_date = today.strftime('%Y-%m-%d')
             
-            utilization = (current_balance / credit_limit * 100) if credit_limit > 0 else 0
+                utilization = (current_balance / credit_limit * 100) if credit_limit > 0 else 0
             
-            credit_card_dues.append({
-                "id": row[0],
-                "account_name": row[1],
-                "current_balance": current_balance,
-                "credit_limit": credit_limit,
-                "due_date": due_date,
-                "days_until_due": days_until_due,
-                "utilization_percentage": round(utilization, 2)
-            })
-        
-        # Create summary
-        net_worth = total_assets - total_liabilities
-        net_income = total_income - total_expenses
-        
-        summary = {
-            "totalAssets": total_assets,
-            "totalLiabilities": total_liabilities,
-            "totalEquity": total_equity,
-            "netWorth": net_worth,
-            "totalIncome": total_income,
-            "totalExpenses": total_expenses,
-            "netIncome": net_income,
-            "transactionCount": transaction_count,
-            "accountCount": account_count
-        }
+                credit_card_dues.append({
+                    "id": row[0],
+                    "account_name": row[1],
+                    "current_balance": current_balance,
+                    "credit_limit": credit_limit,
+                    "due_date": due_date,
+                    "days_until_due": days_until_due,
+                    "utilization_percentage": round(utilization, 2)
+                })
+        
+            # Create summary
+            net_worth = total_assets - total_liabilities
+            net_income = total_income - total_expenses
+        
+            summary = {
+                "totalAssets": total_assets,
+                "totalLiabilities": total_liabilities,
+                "totalEquity": total_equity,
+                "netWorth": net_worth,
+                "totalIncome": total_income,
+                "totalExpenses": total_expenses,
+                "netIncome": net_income,
+                "transactionCount": transaction_count,
+                "accountCount": account_count
+            }
         
-        conn.close()
         
         return {
             "summary": summary,
@@ -1119,42 +1834,66 @@ def get_credit_card_dues():
 @app.get("/api/dashboard/monthly-trends")
 def get_monthly_trends(months: int = 12):
 	"""Get monthly financial trends for the last N months"""
+	return monthly_trends(months)
+
+def monthly_trends(months, today=None):
+	"""Monthly trends for the N months before today (YYYY-MM-DD, default the current date)"""
 	try:
-		conn = get_db_connection()
-		cursor = conn.cursor()
+		with get_db_connection() as conn:
+			cursor = conn.cursor()
 		
-		# Get monthly income/expense data
-		cursor.execute("""
-			SELECT 
-				strftime('%Y-%m', tl.date) as month,
-				COALESCE(SUM(CASE WHEN c.name LIKE '%income%' OR c.name LIKE '%revenue%' THEN tl.credit END), 0) as income,
-				COALESCE(SUM(CASE WHEN c.name LIKE '%expense%' OR c.name LIKE '%cost%' THEN tl.debit END), 0) as expenses,
-				COALESCE(SUM(CASE WHEN c.name LIKE '%asset%' OR c.name LIKE '%cash%' OR c.name LIKE '%bank%' THEN tl.debit - tl.credit END), 0) as net_assets
-			FROM transaction_lines tl
-			JOIN accounts a ON tl.account_id = a.id
-			JOIN cat c ON a.cat_id = c.id
-			WHERE tl.date >= date('now', '-{} months')
-			GROUP BY strftime('%Y-%m', tl.date)
-			ORDER BY month
-		""".format(months))
+			cursor.execute("SELECT date(?, '-{} months')".format(months), (today or 'now',))
+			start = cursor.fetchone()[0]
+			# Closed months are read from the period snapshots, the rest from the lines
+			closed = periods.snapshot_window(conn, start) or ("", "")
+			lines_table = archive.lines_table(conn, start, closed[0] or None)
 		
-		monthly_data = []
-		for row in cursor.fetchall():
-			month = row[0]
-			income = float(row[1]) if row[1] else 0.0
-			expenses = float(row[2]) if row[2] else 0.0
-			net_assets = float(row[3]) if row[3] else 0.0
-			net_income = income - expenses
+			# Get monthly income/expense data
+			cursor.execute(f"""
+				SELECT month, TOTAL(income), TOTAL(expenses), TOTAL(net_assets)
+				FROM (
+					SELECT 
+						strftime('%Y-%m', tl.date) as month,
+						SUM(CASE WHEN c.name LIKE '%income%' OR c.name LIKE '%revenue%' THEN tl.credit END) as income,
+						SUM(CASE WHEN c.name LIKE '%expense%' OR c.name LIKE '%cost%' THEN tl.debit END) as expenses,
+						SUM(CASE WHEN c.name LIKE '%asset%' OR c.name LIKE '%cash%' OR c.name LIKE '%bank%' THEN tl.debit - tl.credit END) as net_assets
+					FROM {lines_table} tl
+					JOIN accounts a ON tl.account_id = a.id
+					JOIN cat c ON a.cat_id = c.id
+					WHERE tl.date >= ? AND NOT (tl.date >= ? AND tl.date < ?)
+					GROUP BY strftime('%Y-%m', tl.date)
+					UNION ALL
+					SELECT 
+						substr(s.period_end, 1, 7) as month,
+						SUM(CASE WHEN c.name LIKE '%income%' OR c.name LIKE '%revenue%' THEN s.credit END) as income,
+						SUM(CASE WHEN c.name LIKE '%expense%' OR c.name LIKE '%cost%' THEN s.debit END) as expenses,
+						SUM(CASE WHEN c.name LIKE '%asset%' OR c.name LIKE '%cash%' OR c.name LIKE '%bank%' THEN s.net END) as net_assets
+					FROM period_account_snapshots s
+					JOIN accounts a ON s.account_id = a.id
+					JOIN cat c ON a.cat_id = c.id
+					WHERE s.period_end >= ? AND s.period_end < ? AND s.lines > 0
+					GROUP BY s.period_end
+				)
+				GROUP BY month
+				ORDER BY month
+			""", (start,) + closed + closed)
+		
+			monthly_data = []
+			for row in cursor.fetchall():
+				month = row[0]
+				income = float(row[1]) if row[1] else 0.0
+				expenses = float(row[2]) if row[2] else 0.0
+				net_assets = float(row[3]) if row[3] else 0.0
+				net_income = income - expenses
 			
-			monthly_data.append({
-				"month": month,
-				"income": income,
-				"expenses": expenses,
-				"net_income": net_income,
-				"net_assets": net_assets
-			})
+				monthly_data.append({
+					"month": month,
+					"income": income,
+					"expenses": expenses,
+					"net_income": net_income,
+					"net_assets": net_assets
+				})
 		
-		conn.close()
 		return {"monthly_trends": monthly_data}
 		
 	except Exception as e:
@@ -1163,42 +1902,66 @@ def get_monthly_trends(months: int = 12):
 @app.get("/api/dashboard/yearly-trends")
 def get_yearly_trends(years: int = 5):
 	"""Get yearly financial trends for the last N years"""
+	return yearly_trends(years)
+
+def yearly_trends(years, today=None):
+	"""Yearly trends for the N years before today (YYYY-MM-DD, default the current date)"""
 	try:
-		conn = get_db_connection()
-		cursor = conn.cursor()
+		with get_db_connection() as conn:
+			cursor = conn.cursor()
+		
+			cursor.execute("SELECT date(?, '-{} years')".format(years), (today or 'now',))
+			start = cursor.fetchone()[0]
+			# Closed months are read from the period snapshots, the rest from the lines
+			closed = periods.snapshot_window(conn, start) or ("", "")
+			lines_table = archive.lines_table(conn, start, closed[0] or None)
 		
-		# Get yearly income/expense data
-		cursor.execute("""
-			SELECT 
-				strftime('%Y', tl.date) as year,
-				COALESCE(SUM(CASE WHEN c.name LIKE '%income%' OR c.name LIKE '%revenue%' THEN tl.credit END), 0) as income,
-				COALESCE(SUM(CASE WHEN c.name LIKE '%expense%' OR c.name LIKE '%cost%' THEN tl.debit END), 0) as expenses,
-				COALESCE(SUM(CASE WHEN c.name LIKE '%asset%' OR c.name LIKE '%cash%' OR c.name LIKE '%bank%' THEN tl.debit - tl.credit END), 0) as net_assets
-			FROM transaction_lines tl
-			JOIN accounts a ON tl.account_id = a.id
-			JOIN cat c ON a.cat_id = c.id
-			WHERE tl.date >= date('now', '-{} years')
-			GROUP BY strftime('%Y', tl.date)
-			ORDER BY year
-		""".format(years))
+			# Get yearly income/expense data
+			cursor.execute(f"""
+				SELECT year, TOTAL(income), TOTAL(expenses), TOTAL(net_assets)
+				FROM (
+					SELECT 
+						strftime('%Y', tl.date) as year,
+						SUM(CASE WHEN c.name LIKE '%income%' OR c.name LIKE '%revenue%' THEN tl.credit END) as income,
+						SUM(CASE WHEN c.name LIKE '%expense%' OR c.name LIKE '%cost%' THEN tl.debit END) as expenses,
+						SUM(CASE WHEN c.name LIKE '%asset%' OR c.name LIKE '%cash%' OR c.name LIKE '%bank%' THEN tl.debit - tl.credit END) as net_assets
+					FROM {lines_table} tl
+					JOIN accounts a ON tl.account_id = a.id
+					JOIN cat c ON a.cat_id = c.id
+					WHERE tl.date >= ? AND NOT (tl.date >= ? AND tl.date < ?)
+					GROUP BY strftime('%Y', tl.date)
+					UNION ALL
+					SELECT 
+						substr(s.period_end, 1, 4) as year,
+						SUM(CASE WHEN c.name LIKE '%income%' OR c.name LIKE '%revenue%' THEN s.credit END) as income,
+						SUM(CASE WHEN c.name LIKE '%expense%' OR c.name LIKE '%cost%' THEN s.debit END) as expenses,
+						SUM(CASE WHEN c.name LIKE '%asset%' OR c.name LIKE '%cash%' OR c.name LIKE '%bank%' THEN s.net END) as net_assets
+					FROM period_account_snapshots s
+					JOIN accounts a ON s.account_id = a.id
+					JOIN cat c ON a.cat_id = c.id
+					WHERE s.period_end >= ? AND s.period_end < ? AND s.lines > 0
+					GROUP BY substr(s.period_end, 1, 4)
+				)
+				GROUP BY year
+				ORDER BY year
+			""", (start,) + closed + closed)
 		
-		yearly_data = []
-		for row in cursor.fetchall():
-			year = row[0]
-			income = float(row[1]) if row[1] else 0.0
-			expenses = float(row[2]) if row[2] else 0.0
-			net_assets = float(row[3]) if row[3] else 0.0
-			net_income = income - expenses
+			yearly_data = []
+			for row in cursor.fetchall():
+				year = row[0]
+				income = float(row[1]) if row[1] else 0.0
+				expenses = float(row[2]) if row[2] else 0.0
+				net_assets = float(row[3]) if row[3] else 0.0
+				net_income = income - expenses
 			
-			yearly_data.append({
-				"year": year,
-				"income": income,
-				"expenses": expenses,
-				"net_income": net_income,
-				"net_assets": net_assets
-			})
+				yearly_data.append({
+					"year": year,
+					"income": income,
+					"expenses": expenses,
+					"net_income": net_income,
+					"net_assets": net_assets
+				})
 		
-		conn.close()
 		return {"yearly_trends": yearly_data}
 		
 	except Exception as e:
@@ -1208,65 +1971,65 @@ def get_yearly_trends(years: int = 5):
 def get_monthly_liabilities():
 	"""Get liabilities for current month and next month"""
 	try:
-		conn = get_db_connection()
-		cursor = conn.cursor()
+		with get_db_connection() as conn:
+			cursor = conn.cursor()
 		
-		from datetime import datetime, timedelta
+			from datetime import datetime, timedelta
 		
-		# Get current date info
-		today = datetime.now()
-		current_year = today.year
-		current_month = today.month
+			# Get current date info
+			today = datetime.now()
+			current_year = today.year
+			current_month = today.month
 		
-		# Calculate next month
-		if current_month == 12:
-			next_month = 1
-			next_year = current_year + 1
-		else:
-			next_month = current_month + 1
-			next_year = current_year
+			# Calculate next month
+			if current_month == 12:
+				next_month = 1
+				next_year = current_year + 1
+			else:
+				next_month = current_month + 1
+				next_year = current_year
 		
-		# Current month liabilities (including credit card dues)
-		cursor.execute("""
-			SELECT 
-				COALESCE(SUM(tl.credit - tl.debit), 0) as current_month_liabilities
-			FROM transaction_lines tl
-			JOIN accounts a ON tl.account_id = a.id
-			JOIN cat c ON a.cat_id = c.id
-			WHERE (c.name LIKE '%liability%' OR c.name LIKE '%payable%' OR c.name LIKE '%loan%')
-			AND strftime('%Y-%m', tl.date) = ?
-		""", (f"{current_year:04d}-{current_month:02d}",))
+			# Current month liabilities (including credit card dues)
+			cursor.execute("""
+				SELECT 
+					COALESCE(SUM(tl.credit - tl.debit), 0) as current_month_liabilities
+				FROM transaction_lines tl
+				JOIN accounts a ON tl.account_id = a.id
+				JOIN cat c ON a.cat_id = c.id
+				WHERE (c.name LIKE '%liability%' OR c.name LIKE '%payable%' OR c.name LIKE '%loan%')
+				AND strftime('%Y-%m', tl.date) = ?
+			""", (f"{current_year:04d}-{current_month:02d}",))
 		
-		current_month_result = cursor.fetchone()
-		current_month_liabilities = float(current_month_result[0]) if current_month_result[0] else 0.0
+			current_month_result = cursor.fetchone()
+			current_month_liabilities = float(current_month_result[0]) if current_month_result[0] else 0.0
 		
-		# Add credit card dues for current month
-		cursor.execute("""
-			SELECT 
-				COALESCE(SUM(tl.credit - tl.debit), 0) as cc_dues
-			FROM ccards cc
-			JOIN accounts a ON cc.account_id = a.id
-			LEFT JOIN transaction_lines tl ON a.id = tl.account_id
-			WHERE strftime('%Y-%m', tl.date) = ? OR tl.date IS NULL
-		""", (f"{current_year:04d}-{current_month:02d}",))
+			# Add credit card dues for current month
+			cursor.execute("""
+				SELECT 
+					COALESCE(SUM(tl.credit - tl.debit), 0) as cc_dues
+				FROM ccards cc
+				JOIN accounts a ON cc.account_id = a.id
+				LEFT JOIN transaction_lines tl ON a.id = tl.account_id
+				WHERE strftime('%Y-%m', tl.date) = ? OR tl.date IS NULL
+			""", (f"{current_year:04d}-{current_month:02d}",))
 		
-		cc_current = cursor.fetchone()
-		current_month_cc = float(cc_current[0]) if cc_current[0] else 0.0
+			cc_current = cursor.fetchone()
+			current_month_cc = float(cc_current[0]) if cc_current[0] else 0.0
 		
-		# Next month projected liabilities (credit cards due dates)
-		cursor.execute("""
-			SELECT 
-				COALESCE(SUM(tl.credit - tl.debit), 0) as next_month_cc_dues
-			FROM ccards cc
-			JOIN accounts a ON cc.account_id = a.id
-			LEFT JOIN transaction_lines tl ON a.id = tl.account_id
-			WHERE cc.due_day BETWEEN 1 AND 31
-		""")
+			# Next month projected liabilities (credit cards due dates); all of
+			# history, archived years included
+			cursor.execute(f"""
+				SELECT 
+					COALESCE(SUM(tl.credit - tl.debit), 0) as next_month_cc_dues
+				FROM ccards cc
+				JOIN accounts a ON cc.account_id = a.id
+				LEFT JOIN {archive.lines_table(conn)} tl ON a.id = tl.account_id
+				WHERE cc.due_day BETWEEN 1 AND 31
+			""")
 		
-		next_month_result = cursor.fetchone()
-		next_month_liabilities = float(next_month_result[0]) if next_month_result[0] else 0.0
+			next_month_result = cursor.fetchone()
+			next_month_liabilities = float(next_month_result[0]) if next_month_result[0] else 0.0
 		
-		conn.close()
 		
 		return {
 			"current_month_liabilities": abs(current_month_liabilities + current_month_cc),
@@ -1276,4 +2039,423 @@ def get_monthly_liabilities():
 		}
 		
 	except Exception as e:
-		raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+		raise HTTPException(status_code=500, detail=str(e))
+
+# Columnar analytics (analytics.py); amounts are returned in major units
+ANALYTICS_FIELDS = analytics.LABELLED_FIELDS
+
+# How long the first analytics read waits for the columns to be built
+ANALYTICS_BUILD_WAIT = 300
+
+def analytics_selection(date_from, date_to, account_id, classification_id):
+    """
+    The last complete analytics Columns, the mask of the lines matching the
+    filters, the reference data, and whether the columns lag behind the ledger
+
+    Reads never write: a read finding the columns behind queues the
+    refresh-analytics job and answers from what is there. Only the very first
+    read of a ledger waits for the job to build them.
+    """
+    try:
+        account_ids = [int(value) for value in account_id.split(",")] if account_id else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="account_id must be a comma-separated list of ids")
+    with get_db_connection() as conn:
+        columns, current = analytics_cache.latest(conn)
+        if not current:
+            job, _ = job_queue.submit("refresh-analytics", {})
+            if columns is None:
+                job_queue.wait(job["id"], ANALYTICS_BUILD_WAIT)
+                columns, current = analytics_cache.latest(conn)
+        reference = reference_data.snapshot(conn)
+    if columns is None:
+        raise HTTPException(status_code=503, detail="The analytics columns are still being built; retry shortly")
+    try:
+        mask = columns.select(date_from, date_to, account_ids, classification_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="date_from and date_to must be YYYY-MM-DD dates")
+    return columns, mask, reference, not current
+
+@app.get("/api/analytics/totals")
+def get_analytics_totals(group_by: str = "month", date_from: str = None, date_to: str = None,
+                         account_id: str = None, classification_id: int = None,
+                         response_format: str = Query("rows", alias="format")):
+    """Debit, credit, net and line count per account, classification, transaction, day, month or year"""
+    if group_by not in analytics.GROUPINGS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {', '.join(analytics.GROUPINGS)}")
+    try:
+        columns, mask, reference, stale = analytics_selection(date_from, date_to, account_id, classification_id)
+        keys, debit, credit, lines = analytics.group_totals(columns, group_by, mask)
+        rows = analytics.labelled_rows(group_by, keys, debit, credit, lines, reference)
+        return fast_json({"group_by": group_by, "stale": stale,
+                          "totals": rows_payload(rows, ANALYTICS_FIELDS, columnar=is_columnar(response_format))})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/analytics/trend")
+def get_analytics_trend(granularity: str = "month", date_from: str = None, date_to: str = None,
+                        account_id: str = None, classification_id: int = None,
+                        response_format: str = Query("rows", alias="format")):
+    """Totals per day, month or year with empty periods filled in and the net accumulated since the first"""
+    if granularity not in ("day", "month", "year"):
+        raise HTTPException(status_code=400, detail="granularity must be day, month or year")
+    try:
+        columns, mask, reference, stale = analytics_selection(date_from, date_to, account_id, classification_id)
+        keys, debit, credit, lines, cumulative = analytics.trend(columns, granularity, mask)
+        rows = analytics.labelled_rows(granularity, keys, debit, credit, lines, reference)
+        rows = [row + (value,) for row, value in zip(rows, (cumulative / 100).round(2).tolist())]
+        return fast_json({"granularity": granularity, "stale": stale,
+                          "trend": rows_payload(rows, ANALYTICS_FIELDS + ("cumulative_net",),
+                                                columnar=is_columnar(response_format))})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/analytics/top")
+def get_analytics_top(by: str = "account", n: int = Query(10, ge=1, le=1000), measure: str = "debit",
+                      date_from: str = None, date_to: str = None, account_id: str = None,
+                      classification_id: int = None, response_format: str = Query("rows", alias="format")):
+    """The n accounts, classifications, transactions or periods with the largest debit, credit, net or line count"""
+    if by not in analytics.GROUPINGS:
+        raise HTTPException(status_code=400, detail=f"by must be one of {', '.join(analytics.GROUPINGS)}")
+    if measure not in analytics.MEASURES:
+        raise HTTPException(status_code=400, detail=f"measure must be one of {', '.join(analytics.MEASURES)}")
+    try:
+        columns, mask, reference, stale = analytics_selection(date_from, date_to, account_id, classification_id)
+        keys, debit, credit, lines = analytics.top(columns, by, n, measure, mask)
+        rows = analytics.labelled_rows(by, keys, debit, credit, lines, reference)
+        return fast_json({"by": by, "measure": measure, "stale": stale,
+                          "top": rows_payload(rows, ANALYTICS_FIELDS, columnar=is_columnar(response_format))})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/analytics/percentiles")
+def get_analytics_percentiles(q: str = "50,90,99", side: str = "any", date_from: str = None, date_to: str = None,
+                              account_id: str = None, classification_id: int = None):
+    """Percentiles of the line amounts: debits, credits or (side=any) every line's absolute amount"""
+    try:
+        quantiles = [float(value) for value in q.split(",")]
+    except ValueError:
+        quantiles = []
+    if not quantiles or not all(0 <= value <= 100 for value in quantiles):
+        raise HTTPException(status_code=400, detail="q must be a comma-separated list of numbers from 0 to 100")
+    if side not in analytics.SIDES:
+        raise HTTPException(status_code=400, detail=f"side must be one of {', '.join(analytics.SIDES)}")
+    try:
+        columns, mask, _, stale = analytics_selection(date_from, date_to, account_id, classification_id)
+        values, count = analytics.percentiles(columns, quantiles, mask, side)
+        return {
+            "side": side,
+            "stale": stale,
+            "lines": count,
+            "percentiles": {f"{quantile:g}": round(value / 100, 2) if values else None
+                            for quantile, value in zip(quantiles, values or [None] * len(quantiles))},
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Recurring transactions and the cash-flow forecast (recurring.py)
+@app.get("/api/recurring")
+def get_recurring(response_format: str = Query("rows", alias="format")):
+    """
+    Recurring series found in the ledger, most confident first; when
+    detection is behind the ledger, the stored series are served as stale
+    while the detect-recurring job catches up
+    """
+    try:
+        with get_db_connection() as conn:
+            stale = detect_recurring_later(conn)
+            rows = recurring.series(conn)
+        return fast_json({"stale": stale,
+                          "series": rows_payload(rows, recurring.SERIES_FIELDS, columnar=is_columnar(response_format))})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/recurring/detect")
+def detect_recurring(detect_data: dict = None):
+    """Catch up with the ledger changes now, or rebuild every series with {"full": true}"""
+    try:
+        with get_db_connection() as conn:
+            return recurring.detect(conn, full=bool((detect_data or {}).get('full')))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/forecast")
+def get_forecast(days: int = Query(90, ge=1, le=730), as_of: str = None,
+                 response_format: str = Query("rows", alias="format")):
+    """Cash position over the `days` days after as_of (default today): cash balances plus the recurring series"""
+    try:
+        day = balances.parse_date(as_of) if as_of else datetime.date.today()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="as_of must be a YYYY-MM-DD date")
+    try:
+        with get_db_connection() as conn:
+            stale = detect_recurring_later(conn)
+            cash = recurring.cash_account_ids(conn)
+            accounts = [row for row in balances.trial_balance(conn, day)[0] if row[0] in cash]
+            refresh_checkpoints_later(conn)
+            projected = recurring.forecast(conn, {row[0]: row[6] for row in accounts}, day, days)
+        opening = round(sum(row[6] for row in accounts), 2)
+        lowest = min(projected, key=lambda event: event[5], default=None)
+        if lowest is None or lowest[5] >= opening:
+            lowest = (day.isoformat(),) + (None,) * 4 + (opening,)
+        return fast_json({
+            "as_of": day.isoformat(),
+            "days": days,
+            "stale": stale,
+            "opening_balance": opening,
+            "closing_balance": projected[-1][5] if projected else opening,
+            "lowest_balance": lowest[5],
+            "lowest_date": lowest[0],
+            "inflow": round(sum((event[4] for event in projected if event[4] > 0), 0.0), 2),
+            "outflow": round(-sum((event[4] for event in projected if event[4] < 0), 0.0), 2),
+            "accounts": [{"account_id": row[0], "account_name": row[1], "balance": row[6]} for row in accounts],
+            "events": rows_payload(projected, recurring.FORECAST_FIELDS, columnar=is_columnar(response_format)),
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Budgets and their actuals (budgets.py)
+@app.get("/api/budgets")
+def get_budgets(period: str = None):
+    """Budgets of one month (period=YYYY-MM) or of all months"""
+    if period is not None:
+        try:
+            budgets.validate_period(period)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    try:
+        with get_db_connection() as conn:
+            rows = budgets.list_budgets(conn, period)
+        return {"budgets": rows_payload(rows, budgets.BUDGET_FIELDS)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def budget_values(conn, budget_data, budget_id=None):
+    """
+    Column values of a submitted budget (raises HTTPException: 400 when
+    invalid, 409 when its month already has a budget for the same target);
+    call inside the write transaction that stores them, so no other request
+    can take the target between the check and the write
+    """
+    try:
+        budgets.validate(budget_data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    values = (budget_data['period'], budget_data.get('classification_id'), budget_data.get('account_id'),
+              float(budget_data['amount']))
+    reference = reference_data.snapshot(conn)
+    if values[1] is not None and reference.classifications.name(values[1]) is None:
+        raise HTTPException(status_code=400, detail="Classification not found")
+    if values[2] is not None and reference.accounts.name(values[2]) is None:
+        raise HTTPException(status_code=400, detail="Account not found")
+    existing = conn.execute("""
+        SELECT id FROM budgets WHERE period = ? AND classification_id IS ? AND account_id IS ? AND id IS NOT ?
+    """, values[:3] + (budget_id,)).fetchone()
+    if existing:
+        raise HTTPException(status_code=409, detail=f"Budget {existing[0]} already covers this month and target")
+    return values
+
+@app.post("/api/budgets")
+def create_budget(budget_data: dict):
+    """Create a budget: {"period": "YYYY-MM", "classification_id", "account_id" (either or both), "amount"}"""
+    try:
+        with get_db_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            values = budget_values(conn, budget_data)
+            cursor = conn.execute("""
+                INSERT INTO budgets (period, classification_id, account_id, amount) VALUES (?, ?, ?, ?)
+            """, values)
+            conn.commit()
+        table_versions.bump("budgets")
+        return {"budget": dict(zip(budgets.BUDGET_FIELDS, (cursor.lastrowid,) + values))}
+    except HTTPException:
+        raise
+    except sqlite3.IntegrityError:
+        # Written past the check by a writer that does not make it (the unique index has the last word)
+        raise HTTPException(status_code=409, detail="A budget already covers this month and target")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.put("/api/budgets/{budget_id}")
+def update_budget(budget_id: int, budget_data: dict):
+    """Replace a budget"""
+    try:
+        with get_db_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            values = budget_values(conn, budget_data, budget_id)
+            updated = conn.execute("""
+                UPDATE budgets SET period = ?, classification_id = ?, account_id = ?, amount = ? WHERE id = ?
+            """, values + (budget_id,)).rowcount
+            conn.commit()
+        if not updated:
+            raise HTTPException(status_code=404, detail="Budget not found")
+        table_versions.bump("budgets")
+        return {"budget": dict(zip(budgets.BUDGET_FIELDS, (budget_id,) + values))}
+    except HTTPException:
+        raise
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=409, detail="A budget already covers this month and target")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.delete("/api/budgets/{budget_id}")
+def delete_budget(budget_id: int):
+    """Delete a budget"""
+    try:
+        with get_db_connection() as conn:
+            deleted = conn.execute("DELETE FROM budgets WHERE id = ?", (budget_id,)).rowcount
+            conn.commit()
+        if not deleted:
+            raise HTTPException(status_code=404, detail="Budget not found")
+        table_versions.bump("budgets")
+        return {"message": "Budget deleted successfully"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/budgets/{period}/status")
+def get_budget_status(period: str, response_format: str = Query("rows", alias="format")):
+    """Every budget of a month (YYYY-MM) against the month's actuals, read from the maintained month totals"""
+    try:
+        budgets.validate_period(period)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        with get_db_connection() as conn:
+            rows = budgets.status(conn, period, reference_data.snapshot(conn))
+        return fast_json({
+            "period": period,
+            "budgets": rows_payload(rows, budgets.STATUS_FIELDS, columnar=is_columnar(response_format)),
+            "over_budget": sum(row[8] > row[5] for row in rows),
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Background jobs
+@app.post("/api/jobs", status_code=202)
+def submit_job(job_data: dict):
+    """Queue a job ({"kind": ..., "params": {...}}); an identical cached or running job is returned instead"""
+    kind = job_data.get('kind')
+    params = job_data.get('params') or {}
+    if kind not in job_queue.kinds:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(sorted(job_queue.kinds))}")
+    if not isinstance(params, dict):
+        raise HTTPException(status_code=400, detail="params must be an object")
+    try:
+        job, existing = job_queue.submit(kind, params)
+        return {"job": job, "existing": existing}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/jobs")
+def get_jobs(status: str = None, limit: int = Query(50, ge=1, le=200)):
+    """Most recent jobs, optionally only those with the given status"""
+    try:
+        return {"jobs": job_queue.recent(status, limit)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/jobs/{job_id}")
+def get_job(job_id: str):
+    """Status of a job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/api/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    """Download a finished job's result"""
+    found = job_queue.result(job_id)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    status, result = found
+    if result is None:
+        raise HTTPException(status_code=409, detail=f"Job is {status}")
+    if result.path is not None:
+        return FileResponse(result.path, media_type=result.media_type, filename=result.filename)
+    headers = {"Content-Disposition": f'attachment; filename="{result.filename}"'} if result.filename else None
+    return Response(result.content, media_type=result.media_type, headers=headers)
+
+@app.delete("/api/jobs/{job_id}")
+def cancel_job(job_id: str):
+    """Cancel a queued or running job"""
+    status = job_queue.cancel(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if status in (jobs.DONE, jobs.FAILED):
+        raise HTTPException(status_code=409, detail=f"Job is already {status}")
+    return {"message": "Job cancelled" if status == jobs.CANCELLED else "Cancellation requested", "status": status}
+
+TREND_TABLES = ("transaction_lines", "accounts", "cat")
+
+def dated_today(params):
+    """Job params with today's date in, for kinds whose result moves with it (see JobQueue.register)"""
+    return {**params, "today": datetime.date.today().isoformat()}
+
+def dated_as_of(params):
+    return {**params, "as_of": params.get("as_of") or datetime.date.today().isoformat()}
+
+@job_queue.register("monthly-trends", tables=TREND_TABLES, resolve=dated_today)
+def monthly_trends_job(context, months=12, today=None):
+    return monthly_trends(int(months), today)
+
+@job_queue.register("yearly-trends", tables=TREND_TABLES, resolve=dated_today)
+def yearly_trends_job(context, years=5, today=None):
+    return yearly_trends(int(years), today)
+
+@job_queue.register("trial-balance", tables=("transaction_lines", "accounts", "cat", "currency", "closed_periods"),
+                    resolve=dated_as_of)
+def trial_balance_job(context, as_of=None):
+    return jobs.JobResult(get_trial_balance(as_of, "rows").body)
+
+# Cached until the lines change, so reads finding stale checkpoints queue one refresh per month end
+@job_queue.register("refresh-checkpoints", tables=("transaction_lines",))
+def refresh_checkpoints_job(context, through=None):
+    with get_db_connection() as conn:
+        with write_lock():
+            written = balances.refresh_checkpoints(conn, balances.parse_date(through) if through else None)
+    return {"checkpoints_written": written}
+
+@job_queue.register("apply-classification-rules", cacheable=False)
+def apply_classification_rules_job(context, filter=None, overwrite=False):
+    with get_db_connection() as conn:
+        with write_lock():
+            result = rules.apply(conn, filter, overwrite=overwrite, check=context.check)
+    if result["classified"]:
+        table_versions.bump("transaction_lines")
+    return result
+
+# Queued by analytics reads finding the columns behind; one per version of the lines
+@job_queue.register("refresh-analytics", tables=("transaction_lines",))
+def refresh_analytics_job(context):
+    """Build or update the analytics columns (the only place the server writes them)"""
+    with get_db_connection() as conn:
+        with write_lock():
+            columns = analytics_cache.refresh(conn)
+    return {"lines": len(columns), "live": int(columns.live.sum())}
+
+# Queued by reads finding detection behind the ledger; one per version of the tables it reads
+@job_queue.register("detect-recurring", tables=("transactions", "transaction_lines", "accounts", "cat"))
+def detect_recurring_job(context, full=False):
+    with get_db_connection() as conn:
+        with write_lock():
+            return recurring.detect(conn, full=bool(full))
+
+@job_queue.register("export-transactions",
+                    tables=("transactions", "transaction_lines", "accounts", "currency", "classifications"))
+def export_transactions_job(context, date_from=None, date_to=None):
+    """Every transaction line (archived years included) as CSV, optionally limited to a date range"""
+    path = context.result_path(".csv")
+    with get_db_connection() as conn, open(path, "w", newline="") as output:
+        transfer.write_csv(transfer.export_rows(conn, date_from, date_to), output, check=context.check)
+    return jobs.JobResult(None, "text/csv", "transactions.csv", path=path)
@@ -0,0 +1,338 @@
+"""
+Request and SQL metrics, exposed in Prometheus text format.
+
+MetricsMiddleware records a latency histogram and status counts per route
+template. Connections created with InstrumentedConnection report every
+execute(), executemany() and executescript() call, and every commit and
+rollback, as one statement, and VM work through sqlite3's progress hook;
+both are attributed to the request being served via a context variable, which
+Starlette carries into the threadpool that runs the sync endpoints.
+
+Statements are identified by the SQL their callers pass, with its
+placeholders, so an executemany() of any number of rows costs one lookup.
+(sqlite3's trace hook would see every row of it, with the values filled in.)
+
+A statement's time is measured from the moment it starts until the next
+statement on the same request starts or the connection is closed, so it
+includes fetching and turning its rows into Python objects.
+"""
+import bisect
+import contextlib
+import contextvars
+import functools
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 500, 1000)
+# The progress handler runs every this many SQLite VM instructions
+PROGRESS_INTERVAL = 10_000
+# Keeps the statement label set bounded if callers build SQL dynamically
+MAX_STATEMENTS = 500
+# Longer statements are cut in the info metric
+MAX_SQL_LABEL = 500
+
+BACKGROUND = "<background>"
+UNMATCHED = "<unmatched>"
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+
+
+class RequestStats:
+    """SQL activity of the request being served"""
+
+    __slots__ = ("scope", "label", "statements", "pending", "pending_start")
+
+    def __init__(self, scope=None, label=None):
+        self.scope = scope
+        self.label = label
+        self.statements = 0
+        self.pending = None
+        self.pending_start = 0.0
+
+    @property
+    def route(self):
+        if self.label is not None:
+            return self.label
+        # The router stores the matched route in the scope before the
+        # endpoint runs, so this is the route template by the first statement
+        route = self.scope.get("route")
+        return route.path if route is not None else UNMATCHED
+
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            # One slot per bucket, then +Inf, sum
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self, name, label_names):
+        lines = []
+        for labels, series in sorted(self.series.items()):
+            base = format_labels(label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{base},le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{base}}} {series[-1]}")
+            lines.append(f"{name}_count{{{base}}} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.request_latency = Histogram(LATENCY_BUCKETS)
+            self.request_statements = Histogram(STATEMENT_COUNT_BUCKETS)
+            self.statements = {}
+            self.statement_latency = Histogram(LATENCY_BUCKETS)
+            self.statement_sql = {}
+            self.vm_steps = {}
+
+    def record_request(self, route, method, status, duration, statements):
+        with self.lock:
+            key = (route, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.request_latency.observe((route, method), duration)
+            self.request_statements.observe((route, method), statements)
+
+    def record_statement(self, route, sql):
+        """Count a statement; returns its id for record_statement_time"""
+        statement_id, kind = statement_identity(sql)
+        with self.lock:
+            if statement_id not in self.statement_sql:
+                if len(self.statement_sql) >= MAX_STATEMENTS:
+                    statement_id = "other"
+                    self.statement_sql.setdefault(statement_id, "<statements beyond the label limit>")
+                else:
+                    self.statement_sql[statement_id] = normalize_sql(sql)
+            key = (route, kind)
+            self.statements[key] = self.statements.get(key, 0) + 1
+        return statement_id
+
+    def record_statement_time(self, route, statement_id, duration):
+        with self.lock:
+            self.statement_latency.observe((route, statement_id), duration)
+
+    def record_vm_steps(self, route, steps):
+        with self.lock:
+            self.vm_steps[route] = self.vm_steps.get(route, 0) + steps
+
+    def render(self):
+        with self.lock:
+            lines = [
+                "# HELP finance_http_requests_total Requests served, by route template and status.",
+                "# TYPE finance_http_requests_total counter",
+            ]
+            for labels, count in sorted(self.requests.items()):
+                lines.append(f"finance_http_requests_total{{{format_labels(('route', 'method', 'status'), labels)}}} "
+                             f"{count}")
+            lines += [
+                "# HELP finance_http_request_duration_seconds Request latency, by route template.",
+                "# TYPE finance_http_request_duration_seconds histogram",
+            ]
+            lines += self.request_latency.render("finance_http_request_duration_seconds", ("route", "method"))
+            lines += [
+                "# HELP finance_http_request_sql_statements SQL statements executed per request.",
+                "# TYPE finance_http_request_sql_statements histogram",
+            ]
+            lines += self.request_statements.render("finance_http_request_sql_statements", ("route", "method"))
+            lines += [
+                "# HELP finance_sql_statements_total SQL statements executed, by route and statement kind.",
+                "# TYPE finance_sql_statements_total counter",
+            ]
+            for labels, count in sorted(self.statements.items()):
+                lines.append(f"finance_sql_statements_total{{{format_labels(('route', 'kind'), labels)}}} {count}")
+            lines += [
+                "# HELP finance_sql_statement_duration_seconds Time attributed to each statement, by route.",
+                "# TYPE finance_sql_statement_duration_seconds histogram",
+            ]
+            lines += self.statement_latency.render("finance_sql_statement_duration_seconds", ("route", "statement"))
+            lines += [
+                "# HELP finance_sql_statement_info Normalized SQL text of each statement id.",
+                "# TYPE finance_sql_statement_info gauge",
+            ]
+            for statement_id, sql in sorted(self.statement_sql.items()):
+                lines.append(f"finance_sql_statement_info{{{format_labels(('statement', 'sql'), (statement_id, sql[:MAX_SQL_LABEL]))}}} 1")
+            lines += [
+                "# HELP finance_sql_vm_steps_total Approximate SQLite VM instructions executed, by route.",
+                "# TYPE finance_sql_vm_steps_total counter",
+            ]
+            for route, steps in sorted(self.vm_steps.items()):
+                lines.append(f"finance_sql_vm_steps_total{{{format_labels(('route',), (route,))}}} {steps}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def format_labels(names, values):
+    return ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_sql(sql):
+    """Replace literals with ? and collapse whitespace"""
+    return _WHITESPACE.sub(" ", _LITERALS.sub("?", sql)).strip()
+
+
+@functools.lru_cache(maxsize=4096)
+def statement_identity(sql):
+    normalized = normalize_sql(sql)
+    kind = normalized.split(" ", 1)[0].upper() if normalized else "OTHER"
+    if kind not in ("SELECT", "INSERT", "UPDATE", "DELETE", "BEGIN", "COMMIT", "ROLLBACK", "WITH"):
+        kind = "OTHER"
+    return hashlib.sha1(normalized.encode()).hexdigest()[:10], kind
+
+
+def finish_statement(stats, now):
+    if stats.pending is not None:
+        registry.record_statement_time(stats.route, stats.pending, now - stats.pending_start)
+        stats.pending = None
+
+
+def begin_statement(sql):
+    stats = current_request.get()
+    if stats is None:
+        registry.record_statement(BACKGROUND, sql)
+        return
+    now = time.perf_counter()
+    finish_statement(stats, now)
+    stats.statements += 1
+    stats.pending = registry.record_statement(stats.route, sql)
+    stats.pending_start = now
+
+
+def on_progress():
+    stats = current_request.get()
+    registry.record_vm_steps(stats.route if stats is not None else BACKGROUND, PROGRESS_INTERVAL)
+    return 0
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports each call, however many rows it binds, as one statement"""
+
+    def execute(self, sql, parameters=()):
+        begin_statement(sql)
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        begin_statement(sql)
+        return super().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        begin_statement(sql_script)
+        return super().executescript(sql_script)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection that reports its statements to the metrics registry"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_progress_handler(on_progress, PROGRESS_INTERVAL)
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute() and the like run the cursor's C methods, not the overrides
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        if self.in_transaction:
+            begin_statement("COMMIT")
+        super().commit()
+
+    def rollback(self):
+        if self.in_transaction:
+            begin_statement("ROLLBACK")
+        super().rollback()
+
+    def close(self):
+        self.finish_statement()
+        super().close()
+
+    def finish_statement(self):
+        """Record the duration of the request's last statement"""
+        stats = current_request.get()
+        if stats is not None:
+            finish_statement(stats, time.perf_counter())
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording latency, status and SQL counts per route"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = current_request.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            now = time.perf_counter()
+            finish_statement(stats, now)
+            registry.record_request(stats.route, scope["method"], status, now - start, stats.statements)
+            current_request.reset(token)
+
+
+@contextlib.contextmanager
+def track(label):
+    """Attribute SQL run outside a request (scripts, background work) to `label`"""
+    stats = RequestStats(label=label)
+    token = current_request.set(stats)
+    try:
+        yield stats
+    finally:
+        finish_statement(stats, time.perf_counter())
+        current_request.reset(token)
+
+
+def render():
+    return registry.render()
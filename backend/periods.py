@@ -0,0 +1,240 @@
+"""
+Monthly period close.
+
+Closing the books through a month end records every month up to it in
+closed_periods and freezes that month's totals into two snapshot tables:
+
+- period_account_snapshots: per account, the month's debit, credit and line
+  count plus the closing (cumulative) debit and credit. Every account with
+  history gets a row for every closed month, so a month's rows alone give
+  the full balance sheet at its end.
+- period_classification_snapshots: per classification, the month's debit,
+  credit and line count.
+
+Triggers reject any insert, update or delete of a transaction line dated in
+a closed period, so the snapshots can never drift from the lines they were
+built from. Reports over closed months read the snapshots instead of the
+lines. Reopening a period drops it and every later period.
+"""
+import datetime
+
+from balances import next_day, parse_date, trial_balance_rows
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS closed_periods (
+        period_end DATE PRIMARY KEY,
+        closed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS period_account_snapshots (
+        period_end DATE NOT NULL,
+        account_id INTEGER NOT NULL,
+        debit REAL NOT NULL,
+        credit REAL NOT NULL,
+        -- debit - credit summed over lines that carry both sides, the way
+        -- the dashboard trends compute net assets
+        net REAL NOT NULL,
+        lines INTEGER NOT NULL,
+        closing_debit REAL NOT NULL,
+        closing_credit REAL NOT NULL,
+        PRIMARY KEY (period_end, account_id)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS period_classification_snapshots (
+        period_end DATE NOT NULL,
+        classification_id INTEGER NOT NULL,
+        debit REAL NOT NULL,
+        credit REAL NOT NULL,
+        lines INTEGER NOT NULL,
+        PRIMARY KEY (period_end, classification_id)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS closed_period_line_insert
+    BEFORE INSERT ON transaction_lines
+    WHEN date(NEW.date) <= (SELECT MAX(period_end) FROM closed_periods)
+    BEGIN
+        SELECT RAISE(ABORT, 'Cannot add a transaction line dated in a closed period');
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS closed_period_line_update
+    BEFORE UPDATE OF transaction_id, account_id, debit, credit, date, classification_id ON transaction_lines
+    WHEN MIN(date(OLD.date), date(NEW.date)) <= (SELECT MAX(period_end) FROM closed_periods)
+    BEGIN
+        SELECT RAISE(ABORT, 'Cannot change a transaction line dated in a closed period');
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS closed_period_line_delete
+    BEFORE DELETE ON transaction_lines
+    WHEN date(OLD.date) <= (SELECT MAX(period_end) FROM closed_periods)
+    BEGIN
+        SELECT RAISE(ABORT, 'Cannot delete a transaction line dated in a closed period');
+    END
+    """,
+]
+
+
+def create_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+def month_end(day):
+    following = (day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return following - datetime.timedelta(days=1)
+
+
+def closed_through(conn):
+    """Last closed period end as an ISO date, or None"""
+    return conn.execute("SELECT MAX(period_end) FROM closed_periods").fetchone()[0]
+
+
+def closed_dates(conn, dates):
+    """The closed-through date if any of `dates` falls in a closed period, else None"""
+    through = closed_through(conn)
+    if through is not None and any(str(day)[:10] <= through for day in dates if day):
+        return through
+    return None
+
+
+def list_periods(conn):
+    return conn.execute("SELECT period_end, closed_at FROM closed_periods ORDER BY period_end").fetchall()
+
+
+def close_periods(conn, through, today=None):
+    """
+    Close every open month up to and including `through` and commit
+
+    Args:
+        through: datetime.date; must be a month end after the current
+            closed-through date and no later than the end of the current
+            month
+        today: datetime.date the current month is taken from (default: today)
+
+    Returns:
+        List of the period ends closed
+    """
+    if through != month_end(through):
+        raise ValueError("Periods close at a month end")
+    if through > month_end(today or datetime.date.today()):
+        raise ValueError("Cannot close a month after the current one")
+    cursor = conn.cursor()
+    previous = closed_through(conn)
+    if previous is not None and through.isoformat() <= previous:
+        raise ValueError(f"Books are already closed through {previous}")
+
+    if previous is not None:
+        first = parse_date(previous) + datetime.timedelta(days=1)
+    else:
+        cursor.execute("SELECT MIN(date) FROM transaction_lines")
+        earliest = cursor.fetchone()[0]
+        first = parse_date(earliest[:10]).replace(day=1) if earliest else through.replace(day=1)
+
+    closed = []
+    period_start = first
+    while period_start <= through:
+        period_end = month_end(period_start)
+        snapshot_period(cursor, previous, period_start, period_end)
+        cursor.execute("INSERT INTO closed_periods (period_end) VALUES (?)", (period_end.isoformat(),))
+        closed.append(period_end.isoformat())
+        previous = period_end.isoformat()
+        period_start = period_end + datetime.timedelta(days=1)
+    conn.commit()
+    return closed
+
+
+def snapshot_period(cursor, previous, period_start, period_end):
+    """Freeze one month's totals, carrying closing balances over from `previous`"""
+    bounds = {"previous": previous or "", "start": period_start.isoformat(), "end": next_day(period_end),
+              "period_end": period_end.isoformat()}
+    cursor.execute("""
+        INSERT INTO period_account_snapshots
+            (period_end, account_id, debit, credit, net, lines, closing_debit, closing_credit)
+        SELECT :period_end, account_id, TOTAL(debit), TOTAL(credit), TOTAL(net), TOTAL(lines),
+               TOTAL(closing_debit), TOTAL(closing_credit)
+        FROM (
+            SELECT account_id, 0 AS debit, 0 AS credit, 0 AS net, 0 AS lines, closing_debit, closing_credit
+            FROM period_account_snapshots
+            WHERE period_end = :previous
+            UNION ALL
+            SELECT account_id, TOTAL(debit), TOTAL(credit), TOTAL(debit - credit), COUNT(*),
+                   TOTAL(debit), TOTAL(credit)
+            FROM transaction_lines
+            WHERE date >= :start AND date < :end
+            GROUP BY account_id
+        )
+        GROUP BY account_id
+    """, bounds)
+    cursor.execute("""
+        INSERT INTO period_classification_snapshots (period_end, classification_id, debit, credit, lines)
+        SELECT :period_end, classification_id, TOTAL(debit), TOTAL(credit), COUNT(*)
+        FROM transaction_lines
+        WHERE date >= :start AND date < :end AND classification_id IS NOT NULL
+        GROUP BY classification_id
+    """, bounds)
+
+
+def reopen_periods(conn, period_end):
+    """
+    Reopen `period_end` and every later period, dropping their snapshots, and commit
+
+    Returns:
+        List of the period ends reopened
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT period_end FROM closed_periods WHERE period_end >= ? ORDER BY period_end",
+                   (period_end,))
+    reopened = [row[0] for row in cursor.fetchall()]
+    cursor.execute("DELETE FROM period_account_snapshots WHERE period_end >= ?", (period_end,))
+    cursor.execute("DELETE FROM period_classification_snapshots WHERE period_end >= ?", (period_end,))
+    cursor.execute("DELETE FROM closed_periods WHERE period_end >= ?", (period_end,))
+    conn.commit()
+    return reopened
+
+
+def snapshot_window(conn, start):
+    """
+    The closed months that lie entirely on or after `start`
+
+    Returns:
+        (first_day, end) ISO bounds such that lines dated in [first_day, end)
+        are covered by snapshots, or None when no closed month qualifies
+    """
+    through = closed_through(conn)
+    if through is None:
+        return None
+    day = parse_date(start[:10])
+    first_day = day if day.day == 1 else month_end(day) + datetime.timedelta(days=1)
+    end = next_day(parse_date(through))
+    if first_day.isoformat() >= end:
+        return None
+    return first_day.isoformat(), end
+
+
+def trial_balance(conn, as_of):
+    """
+    Trial balance from the closing snapshot of the last closed period on or
+    before `as_of`, when `as_of` falls inside the closed range
+
+    Returns:
+        (rows as TRIAL_BALANCE_FIELDS tuples, period end used), or None when
+        `as_of` is after the closed-through date or before the first period
+    """
+    through = closed_through(conn)
+    if through is None or as_of.isoformat() > through:
+        return None
+    period_end = conn.execute("SELECT MAX(period_end) FROM closed_periods WHERE period_end <= ?",
+                              (as_of.isoformat(),)).fetchone()[0]
+    if period_end is None:
+        return None
+    rows = trial_balance_rows(conn, """
+        SELECT account_id, closing_debit AS debit, closing_credit AS credit
+        FROM period_account_snapshots
+        WHERE period_end = :base_date
+    """, period_end, as_of)
+    return rows, period_end
@@ -0,0 +1,444 @@
+"""
+Recurring transactions and the cash-flow forecast built on them.
+
+Only transactions that move cash count: those with a line on a cash
+account, which are the accounts whose category is an asset, cash or bank
+one (the same test the dashboard's net assets use). Transfers between cash
+accounts leave the cash position alone and are skipped. For every other such
+transaction recurring_occurrences keeps one row: the series key, which is
+the normalised description plus the counterpart account (the non-cash
+account moving the most), the cash account involved, the date and the cash
+amount (debit - credit, so income is positive).
+
+A series with at least MIN_OCCURRENCES dates is recurring when most of its
+recent intervals fit one cadence (weekly to yearly) and its recent amounts
+are stable. The recurring series are stored in recurring_series together
+with the cadence, typical amount and next expected date. forecast() projects
+them onto the current balances of the cash accounts.
+
+detect() is incremental. New transactions are found by id watermark.
+Triggers log the ids of older transactions whose lines, description or
+existence changed, but only once detection has run (recurring_state). Only
+those transactions' occurrences are recomputed, and only the series they
+left or joined are analysed again. When the set of cash accounts changes,
+everything is rebuilt. Archived transactions keep their occurrences
+(archive.py sets the delete triggers aside).
+"""
+import calendar
+import datetime
+import itertools
+import json
+import re
+import statistics
+
+import archive
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS recurring_occurrences (
+        transaction_id INTEGER PRIMARY KEY,
+        description_key TEXT NOT NULL,
+        counterpart_id INTEGER NOT NULL,
+        account_id INTEGER NOT NULL,
+        description TEXT,
+        date DATE NOT NULL,
+        amount REAL NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_recurring_occurrences_series
+    ON recurring_occurrences (description_key, counterpart_id, date)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS recurring_series (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        description_key TEXT NOT NULL,
+        counterpart_id INTEGER NOT NULL,
+        account_id INTEGER NOT NULL,
+        description TEXT,
+        cadence TEXT NOT NULL,
+        interval_days REAL NOT NULL,
+        amount REAL NOT NULL,
+        amount_variation REAL NOT NULL,
+        occurrences INTEGER NOT NULL,
+        first_date DATE NOT NULL,
+        last_date DATE NOT NULL,
+        next_date DATE NOT NULL,
+        confidence REAL NOT NULL,
+        UNIQUE (description_key, counterpart_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS recurring_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        watermark INTEGER NOT NULL,
+        cash_accounts TEXT NOT NULL,
+        detected_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS recurring_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        transaction_id INTEGER NOT NULL
+    )
+    """,
+    # Lines added to a transaction above the watermark are picked up as new
+    """
+    CREATE TRIGGER IF NOT EXISTS recurring_line_insert
+    AFTER INSERT ON transaction_lines
+    WHEN NEW.transaction_id <= (SELECT watermark FROM recurring_state WHERE id = 1)
+    BEGIN
+        INSERT INTO recurring_changes (transaction_id) VALUES (NEW.transaction_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS recurring_line_update
+    AFTER UPDATE OF transaction_id, account_id, debit, credit, date ON transaction_lines
+    WHEN EXISTS (SELECT 1 FROM recurring_state)
+    BEGIN
+        INSERT INTO recurring_changes (transaction_id) VALUES (OLD.transaction_id);
+        INSERT INTO recurring_changes (transaction_id) VALUES (NEW.transaction_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS recurring_line_delete
+    AFTER DELETE ON transaction_lines
+    WHEN EXISTS (SELECT 1 FROM recurring_state)
+    BEGIN
+        INSERT INTO recurring_changes (transaction_id) VALUES (OLD.transaction_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS recurring_transaction_update
+    AFTER UPDATE OF description ON transactions
+    WHEN EXISTS (SELECT 1 FROM recurring_state)
+    BEGIN
+        INSERT INTO recurring_changes (transaction_id) VALUES (NEW.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS recurring_transaction_delete
+    AFTER DELETE ON transactions
+    WHEN EXISTS (SELECT 1 FROM recurring_state)
+    BEGIN
+        INSERT INTO recurring_changes (transaction_id) VALUES (OLD.id);
+    END
+    """,
+]
+
+CASH_ACCOUNTS = """
+    SELECT a.id FROM accounts a JOIN cat c ON a.cat_id = c.id
+    WHERE c.name LIKE '%asset%' OR c.name LIKE '%cash%' OR c.name LIKE '%bank%'
+"""
+
+SERIES_FIELDS = ("id", "description", "counterpart_id", "account_id", "cadence", "interval_days", "amount",
+                 "amount_variation", "occurrences", "first_date", "last_date", "next_date", "confidence")
+FORECAST_FIELDS = ("date", "series_id", "description", "account_id", "amount", "balance")
+
+# name -> (typical interval in days, tolerance in days, calendar months per step or None)
+CADENCES = {
+    "weekly": (7, 1, None),
+    "biweekly": (14, 2, None),
+    "monthly": (30.44, 3, 1),
+    "quarterly": (91.31, 7, 3),
+    "yearly": (365.25, 10, 12),
+}
+MIN_OCCURRENCES = 3
+# Only the most recent intervals and amounts describe a series
+RECENT = 12
+# Share of the recent intervals that must fit the cadence
+MIN_REGULARITY = 0.75
+# Largest median deviation of the recent amounts, relative to their median
+MAX_AMOUNT_VARIATION = 0.25
+# A series whose next date is this many intervals overdue has stopped
+STALE_INTERVALS = 2
+# Dropped from descriptions, so "Salary Jan" and "Salary February" are one series
+MONTH_WORDS = {name.lower() for name in calendar.month_name[1:] + calendar.month_abbr[1:]} | {"sept"}
+# Transactions read per statement while computing occurrences
+BATCH_SIZE = 5000
+
+
+def create_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+def normalize(description):
+    """Series key of a description: its lowercase words, without digits, punctuation or month names"""
+    return " ".join(word for word in re.findall(r"[^\W\d_]+", (description or "").lower())
+                    if word not in MONTH_WORDS)
+
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    year = day.year + month // 12
+    month = month % 12 + 1
+    return datetime.date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def step(day, cadence):
+    """The date one `cadence` after `day`"""
+    days, _, months = CADENCES[cadence]
+    return add_months(day, months) if months else day + datetime.timedelta(days=days)
+
+
+def occurrences_from_lines(rows, cash_accounts):
+    """
+    One occurrence per transaction from (transaction_id, description, account_id, debit - credit, date)
+    rows ordered by transaction
+
+    Yields:
+        (transaction_id, description_key, counterpart_id, account_id, description, date, amount)
+    """
+    for transaction_id, lines in itertools.groupby(rows, key=lambda row: row[0]):
+        lines = list(lines)
+        cash = [line for line in lines if line[2] in cash_accounts]
+        other = [line for line in lines if line[2] not in cash_accounts and line[2] is not None]
+        amount = round(sum(line[3] for line in cash), 2)
+        if not cash or not other or not amount:
+            continue
+        account_id = max(cash, key=lambda line: abs(line[3]))[2]
+        counterpart_id = max(other, key=lambda line: abs(line[3]))[2]
+        description = lines[0][1]
+        yield (transaction_id, normalize(description), counterpart_id, account_id, description,
+               max(line[4] for line in cash), amount)
+
+
+def store_occurrences(conn, lines, transactions, cash_accounts, where="", params=()):
+    """Compute and insert the occurrences of the transactions matching `where`; return their series keys"""
+    cursor = conn.execute(f"""
+        SELECT t.id, t.description, tl.account_id, COALESCE(tl.debit, 0) - COALESCE(tl.credit, 0), date(tl.date)
+        FROM {transactions} t
+        JOIN {lines} tl ON tl.transaction_id = t.id
+        {where}
+        ORDER BY t.id
+    """, params)
+    keys = set()
+    carried = []
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if rows:
+            # The last transaction may go on in the next batch: keep its lines for then
+            last = rows[-1][0]
+            complete = carried + [row for row in rows if row[0] != last]
+            carried = [row for row in rows if row[0] == last]
+        else:
+            complete, carried = carried, []
+        batch = list(occurrences_from_lines(complete, cash_accounts))
+        conn.executemany("INSERT OR REPLACE INTO recurring_occurrences VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+        keys.update((row[1], row[2]) for row in batch)
+        if not rows:
+            return keys
+
+
+def analyze(rows):
+    """
+    Recurring series of one key's occurrences, or None
+
+    Args:
+        rows: (date, amount, description, account_id) ordered by date
+
+    Returns:
+        Dict of the recurring_series columns (without id and key)
+    """
+    # Several payments on the same day are one occurrence
+    by_date = {}
+    for date, amount, description, account_id in rows:
+        total = by_date.get(date, (0.0, None, None))[0]
+        by_date[date] = (total + amount, description, account_id)
+    if len(by_date) < MIN_OCCURRENCES:
+        return None
+    dates = [datetime.date.fromisoformat(date) for date in by_date]
+    intervals = [(later - earlier).days for earlier, later in zip(dates, dates[1:])][-RECENT:]
+    median_interval = statistics.median(intervals)
+    cadence = min(CADENCES, key=lambda name: abs(CADENCES[name][0] - median_interval))
+    days, tolerance, _ = CADENCES[cadence]
+    regularity = sum(abs(interval - days) <= tolerance for interval in intervals) / len(intervals)
+    if regularity < MIN_REGULARITY:
+        return None
+
+    amounts = [value[0] for value in by_date.values()][-RECENT:]
+    amount = statistics.median(amounts)
+    if not amount or (amount > 0) != (amounts[-1] > 0):
+        return None
+    variation = statistics.median(abs(value - amount) for value in amounts) / abs(amount)
+    if variation > MAX_AMOUNT_VARIATION:
+        return None
+
+    _, description, account_id = list(by_date.values())[-1]
+    return {
+        "account_id": account_id,
+        "description": description,
+        "cadence": cadence,
+        "interval_days": round(statistics.fmean(intervals), 2),
+        "amount": round(amount, 2),
+        "amount_variation": round(variation, 4),
+        "occurrences": len(by_date),
+        "first_date": dates[0].isoformat(),
+        "last_date": dates[-1].isoformat(),
+        "next_date": step(dates[-1], cadence).isoformat(),
+        "confidence": round(regularity * (1 - variation) * min(1.0, len(by_date) / RECENT), 4),
+    }
+
+
+def series_in(parameter):
+    """Condition on the series keys listed in a JSON array of [description_key, counterpart_id] pairs"""
+    return f"""(description_key, counterpart_id) IN (
+        SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each({parameter})
+    )"""
+
+
+def store_series(conn, keys=None):
+    """
+    Analyse the occurrences of `keys` (every key when None) and store or drop
+    their series; a series that is still recurring keeps its id
+    """
+    if keys is None:
+        cursor = conn.execute("""
+            SELECT description_key, counterpart_id, date, amount, description, account_id
+            FROM recurring_occurrences
+            ORDER BY description_key, counterpart_id, date
+        """)
+    elif not keys:
+        return
+    else:
+        cursor = conn.execute(f"""
+            SELECT description_key, counterpart_id, date, amount, description, account_id
+            FROM recurring_occurrences
+            WHERE {series_in("?1")}
+            ORDER BY description_key, counterpart_id, date
+        """, (json.dumps(sorted(keys)),))
+    found = []
+    for (description_key, counterpart_id), rows in itertools.groupby(cursor, key=lambda row: row[:2]):
+        series = analyze([row[2:] for row in rows])
+        if series:
+            found.append({"description_key": description_key, "counterpart_id": counterpart_id, **series})
+
+    found_keys = json.dumps([[series["description_key"], series["counterpart_id"]] for series in found])
+    if keys is None:
+        conn.execute(f"DELETE FROM recurring_series WHERE NOT {series_in('?1')}", (found_keys,))
+    else:
+        conn.execute(f"DELETE FROM recurring_series WHERE {series_in('?1')} AND NOT {series_in('?2')}",
+                     (json.dumps(sorted(keys)), found_keys))
+    if found:
+        columns = list(found[0])
+        conn.executemany(f"""
+            INSERT INTO recurring_series ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+            ON CONFLICT (description_key, counterpart_id) DO UPDATE SET
+            {', '.join(f"{column} = excluded.{column}" for column in columns[2:])}
+        """, [tuple(series[column] for column in columns) for series in found])
+
+
+def cash_account_ids(conn):
+    return {row[0] for row in conn.execute(CASH_ACCOUNTS)}
+
+
+def cash_accounts_key(conn):
+    return json.dumps(sorted(cash_account_ids(conn)))
+
+
+def is_current(conn):
+    """True when nothing changed since the last detect(), checked without taking the write lock"""
+    state = conn.execute("SELECT watermark, cash_accounts FROM recurring_state WHERE id = 1").fetchone()
+    return state is not None \
+        and conn.execute("SELECT 1 FROM recurring_changes LIMIT 1").fetchone() is None \
+        and conn.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0] <= state[0] \
+        and cash_accounts_key(conn) == state[1]
+
+
+def detect(conn, full=False):
+    """
+    Bring the occurrences and recurring series up to date and commit
+
+    Returns:
+        {"transactions": transactions reprocessed, "series": series analysed
+        (None for all of them), "rebuilt": whether everything was redone}
+    """
+    if not full and is_current(conn):
+        return {"transactions": 0, "series": 0, "rebuilt": False}
+    # Partitions cannot be attached once the transaction has begun
+    lines, transactions = archive.tables(conn)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        state = conn.execute("SELECT watermark, cash_accounts FROM recurring_state WHERE id = 1").fetchone()
+        cash_key = cash_accounts_key(conn)
+        cash_accounts = set(json.loads(cash_key))
+        watermark = conn.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0]
+        rebuilt = full or state is None or state[1] != cash_key
+        if rebuilt:
+            conn.execute("DELETE FROM recurring_occurrences")
+            store_occurrences(conn, lines, transactions, cash_accounts, f"""
+                WHERE t.id IN (SELECT transaction_id FROM {lines} WHERE account_id IN ({CASH_ACCOUNTS}))
+            """)
+            store_series(conn)
+            changed, keys = None, None
+        else:
+            changed = [row[0] for row in conn.execute("""
+                SELECT DISTINCT transaction_id FROM recurring_changes
+                UNION
+                SELECT id FROM transactions WHERE id > ?
+            """, (state[0],))]
+            selected = "IN (SELECT value FROM json_each(?))"
+            ids = (json.dumps(changed),)
+            keys = set(conn.execute(f"""
+                SELECT description_key, counterpart_id FROM recurring_occurrences WHERE transaction_id {selected}
+            """, ids).fetchall())
+            conn.execute(f"DELETE FROM recurring_occurrences WHERE transaction_id {selected}", ids)
+            if changed:
+                keys |= store_occurrences(conn, "transaction_lines", "transactions", cash_accounts,
+                                          f"WHERE t.id {selected}", ids)
+            store_series(conn, keys)
+        conn.execute("DELETE FROM recurring_changes")
+        conn.execute("""
+            INSERT OR REPLACE INTO recurring_state (id, watermark, cash_accounts, detected_at)
+            VALUES (1, ?, ?, CURRENT_TIMESTAMP)
+        """, (watermark, cash_key))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return {"transactions": None if changed is None else len(changed),
+            "series": None if keys is None else len(keys), "rebuilt": rebuilt}
+
+
+def series(conn):
+    """Stored recurring series as SERIES_FIELDS rows, most confident first"""
+    return conn.execute(f"""
+        SELECT {', '.join(SERIES_FIELDS)} FROM recurring_series ORDER BY confidence DESC, id
+    """).fetchall()
+
+
+def forecast(conn, balances_by_account, start, days):
+    """
+    Expected cash movements in the `days` days after `start`
+
+    Series that have stopped (their next date is more than STALE_INTERVALS
+    intervals before `start`) are left out; dates already past are skipped.
+
+    Args:
+        balances_by_account: Current balance of every cash account
+
+    Returns:
+        (FORECAST_FIELDS rows in date order, the balance after each one
+        starting from the sum of `balances_by_account`)
+    """
+    end = start + datetime.timedelta(days=days)
+    events = []
+    for series_id, description, account_id, cadence, interval_days, amount, next_date in conn.execute("""
+        SELECT id, description, account_id, cadence, interval_days, amount, next_date FROM recurring_series
+    """):
+        day = datetime.date.fromisoformat(next_date)
+        if (start - day).days > STALE_INTERVALS * interval_days:
+            continue
+        while day <= start:
+            day = step(day, cadence)
+        while day <= end:
+            events.append((day.isoformat(), series_id, description, account_id, amount))
+            day = step(day, cadence)
+    events.sort()
+    balance = sum(balances_by_account.values())
+    rows = []
+    for event in events:
+        balance += event[4]
+        rows.append(event + (round(balance, 2),))
+    return rows
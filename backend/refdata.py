@@ -0,0 +1,123 @@
+"""
+Process-wide cache of the reference tables.
+
+Accounts, categories, currencies, classifications and credit cards change
+rarely but are resolved by id or name all the time, once per line during an
+import. ReferenceData keeps them in memory, indexed by id and by name, one
+instance per database file (for_path).
+
+Triggers on the five tables bump a counter in reference_version on every
+insert, update or delete, whichever process or connection writes. Each
+lookup reads that single row and rebuilds the snapshot lazily when it moved,
+so a lookup costs one primary-key read instead of a scan by name. Code that
+resolves many names takes one snapshot() and uses it throughout.
+
+Rows are kept exactly as `SELECT *` returns them, so cached lookups return
+what the queries they replace did. Where names repeat, the lowest id wins,
+as the first row of a scan did.
+"""
+import os
+import threading
+
+TABLES = {
+    "accounts": "accounts",
+    "categories": "cat",
+    "currencies": "currency",
+    "classifications": "classifications",
+    "credit_cards": "ccards",
+}
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS reference_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO reference_version (id, version) VALUES (1, 0)",
+] + [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS reference_version_{table}_{event.lower()}
+    AFTER {event} ON {table}
+    BEGIN
+        UPDATE reference_version SET version = version + 1 WHERE id = 1;
+    END
+    """
+    for table in TABLES.values() for event in ("INSERT", "UPDATE", "DELETE")
+]
+
+
+def create_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+class Table:
+    """Rows of one reference table by id and, where rows have one, by name"""
+
+    def __init__(self, rows, named=True):
+        self.rows = rows
+        self.by_id = {row[0]: row for row in rows}
+        self.by_name = {}
+        if named:
+            for row in rows:
+                self.by_name.setdefault(row[1], row)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def name(self, id):
+        row = self.by_id.get(id)
+        return row[1] if row else None
+
+    def id(self, name):
+        row = self.by_name.get(name)
+        return row[0] if row else None
+
+
+class Snapshot:
+    def __init__(self, conn, version):
+        self.version = version
+        tables = {key: conn.execute(f"SELECT * FROM {table} ORDER BY id").fetchall() for key, table in TABLES.items()}
+        self.accounts = Table(tables["accounts"])
+        self.categories = Table(tables["categories"])
+        self.currencies = Table(tables["currencies"])
+        self.classifications = Table(tables["classifications"])
+        # ccards rows are (id, account_id, credit_limit, close_day, due_day)
+        self.credit_cards = Table(tables["credit_cards"], named=False)
+        self.credit_cards_by_account = {}
+        for row in tables["credit_cards"]:
+            self.credit_cards_by_account.setdefault(row[1], row)
+
+
+class ReferenceData:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = None
+
+    def snapshot(self, conn):
+        """Current Snapshot, rebuilt when the reference tables changed since it was taken"""
+        version = conn.execute("SELECT version FROM reference_version WHERE id = 1").fetchone()[0]
+        current = self.current
+        if current is not None and current.version == version:
+            return current
+        if conn.in_transaction:
+            # Uncommitted changes may still roll back: never share them, but
+            # keep them for the rest of this connection's transaction
+            private = getattr(conn, "reference_snapshot", None)
+            if private is None or private.version != version:
+                private = Snapshot(conn, version)
+                try:
+                    conn.reference_snapshot = private
+                except AttributeError:
+                    pass
+            return private
+        with self.lock:
+            if self.current is None or self.current.version != version:
+                self.current = Snapshot(conn, version)
+            return self.current
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def for_path(path):
+    """The ReferenceData shared by every connection to the database at `path`"""
+    with _caches_lock:
+        return _caches.setdefault(os.path.abspath(path), ReferenceData())
@@ -0,0 +1,125 @@
+import gzip
+
+import orjson
+from fastapi.responses import ORJSONResponse, Response
+
+
+def rows_to_records(rows, fields):
+    """Turn result rows into a list of dicts keyed by field name"""
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def rows_to_columns(rows, fields):
+    """
+    Turn result rows into parallel arrays, one per field
+
+    Args:
+        rows: Sequence of tuples as returned by cursor.fetchall()
+        fields: Field names, in the same order as the selected columns
+
+    Returns:
+        Dict mapping each field name to the list of its values
+    """
+    if not rows:
+        return {field: [] for field in fields}
+    return {field: list(column) for field, column in zip(fields, zip(*rows))}
+
+
+def rows_payload(rows, fields, columnar=False):
+    """Shape result rows either as records (the default) or as columns"""
+    if columnar:
+        return rows_to_columns(rows, fields)
+    return rows_to_records(rows, fields)
+
+
+def is_columnar(response_format):
+    """True when the client asked for the columnar format (?format=columnar)"""
+    return response_format == "columnar"
+
+
+def fast_json(payload):
+    """
+    Serialize a payload straight to an orjson response.
+
+    Returning a Response from a route skips FastAPI's jsonable_encoder pass,
+    which is where most of the time goes for large lists of plain rows.
+    """
+    return ORJSONResponse(payload)
+
+
+# Bodies smaller than this are not worth compressing (matches GZipMiddleware)
+GZIP_MINIMUM_SIZE = 1000
+
+
+class ConditionalCache:
+    """
+    Rendered bodies of versioned endpoints, served with strong ETags.
+
+    The ETag is derived from the table version counters, so both the 304 check
+    and a repeat 200 are answered from memory without opening a connection.
+    Bodies are gzip-compressed once per version rather than once per request.
+    """
+
+    def __init__(self, versions):
+        self.versions = versions
+        self._entries = {}
+
+    def respond(self, request, key, tables, loader):
+        """
+        Serve a versioned payload with If-None-Match handling
+
+        Args:
+            request: Incoming request (for If-None-Match / Accept-Encoding)
+            key: Cache key, unique per route and representation
+            tables: Tables the payload is read from
+            loader: Callable returning the payload dict; payloads containing
+                an "error" key are returned as-is and never cached
+
+        Returns:
+            A 304 response, or a 200 response carrying the ETag
+        """
+        etag = '"' + self.versions.tag(tables) + '"'
+        gzip_etag = etag[:-1] + '-gzip"'
+        accepts_gzip = "gzip" in request.headers.get("accept-encoding", "")
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            matched = match_etag(if_none_match, (etag, gzip_etag))
+            if matched:
+                headers = cache_headers(matched)
+                headers["Vary"] = "Accept-Encoding"
+                return Response(status_code=304, headers=headers)
+
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != etag:
+            payload = loader()
+            if "error" in payload:
+                return ORJSONResponse(payload)
+            body = orjson.dumps(payload)
+            compressed = gzip.compress(body) if len(body) >= GZIP_MINIMUM_SIZE else None
+            entry = (etag, body, compressed)
+            self._entries[key] = entry
+
+        if accepts_gzip and entry[2] is not None:
+            headers = cache_headers(gzip_etag)
+            headers["Content-Encoding"] = "gzip"
+            headers["Vary"] = "Accept-Encoding"
+            return Response(entry[2], media_type="application/json", headers=headers)
+        return Response(entry[1], media_type="application/json", headers=cache_headers(etag))
+
+
+def match_etag(if_none_match, etags):
+    """Return the first of `etags` named by an If-None-Match header, if any"""
+    if if_none_match.strip() == "*":
+        return etags[0]
+    candidates = {candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")}
+    for etag in etags:
+        if etag in candidates:
+            return etag
+    return None
+
+
+def cache_headers(etag):
+    # no-cache makes browsers revalidate every time, which is what turns
+    # repeat fetches into 304s. GZipMiddleware adds Vary to identity bodies.
+    return {"ETag": etag, "Cache-Control": "no-cache"}
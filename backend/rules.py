@@ -0,0 +1,278 @@
+"""
+Automatic classification rules.
+
+A rule in classification_rules assigns its classification_id to a line
+when all of its conditions hold: `keyword` (case-insensitive substring of
+the description), `pattern` (case-insensitive regular expression searched
+in the description), `account_id` and the min_amount..max_amount range of
+the line's debit or credit. Unset conditions always hold. When several
+rules match, the highest priority wins, then the oldest rule.
+
+The enabled rules compile into a RuleSet that looks at each description
+once, not rule by rule:
+
+- every keyword goes into one alternation, longest first, wrapped in a
+  lookahead so finditer reports the longest keyword starting at each
+  position. The shorter keywords that are a prefix of it match there too,
+  which gives every keyword contained in the description in one pass (the
+  dictionary links of an Aho-Corasick automaton, precomputed).
+- every pattern goes into one combined regex used as a prefilter. Only
+  descriptions it matches are searched with the individual patterns.
+  Patterns that would change meaning or fail to compile once joined (a
+  backreference, a group name another pattern uses, global flags) stay
+  out of it and are searched on their own instead.
+
+The rules whose text conditions hold are remembered per distinct
+description, so repeated descriptions only check accounts and amounts.
+
+Rules are applied when imported lines are stored (Database.
+insert_orphan_transaction) and, on demand, to existing lines by apply().
+"""
+import collections
+import functools
+import re
+
+import bulk
+import periods
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS classification_rules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        priority INTEGER NOT NULL DEFAULT 0,
+        keyword TEXT,
+        pattern TEXT,
+        account_id INTEGER,
+        min_amount REAL,
+        max_amount REAL,
+        classification_id INTEGER NOT NULL,
+        enabled INTEGER NOT NULL DEFAULT 1,
+        FOREIGN KEY (account_id) REFERENCES accounts (id),
+        FOREIGN KEY (classification_id) REFERENCES classifications (id)
+    )
+    """,
+]
+
+RULE_FIELDS = ("id", "name", "priority", "keyword", "pattern", "account_id", "min_amount", "max_amount",
+               "classification_id", "enabled")
+Rule = collections.namedtuple("Rule", RULE_FIELDS)
+
+# Distinct descriptions whose keyword and pattern matches a RuleSet remembers
+TEXT_CACHE_SIZE = 65536
+# Lines read and written per batch by apply()
+BATCH_SIZE = 10000
+# Backreference or conditional on a group; group numbers shift once patterns are joined
+BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+
+def create_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+    # Imported lines carry the classification a rule gave them until they are turned into a transaction
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(orphan_transaction_lines)").fetchall()]
+    if columns and "classification_id" not in columns:
+        cursor.execute("ALTER TABLE orphan_transaction_lines ADD COLUMN classification_id INTEGER")
+
+
+def validate(rule):
+    """
+    Check a rule dict before it is stored
+
+    Raises:
+        ValueError: no classification, no condition at all, a bad regular
+            expression or an empty amount range
+    """
+    if rule.get('classification_id') is None:
+        raise ValueError("classification_id is required")
+    if not any(rule.get(key) not in (None, "") for key in ("keyword", "pattern", "account_id", "min_amount",
+                                                            "max_amount")):
+        raise ValueError("A rule needs at least one condition")
+    if rule.get('pattern'):
+        try:
+            re.compile(rule['pattern'])
+        except re.error as e:
+            raise ValueError(f"Invalid pattern: {e}")
+    if rule.get('min_amount') is not None and rule.get('max_amount') is not None \
+            and float(rule['min_amount']) > float(rule['max_amount']):
+        raise ValueError("min_amount is larger than max_amount")
+
+
+class RuleSet:
+    def __init__(self, rules):
+        # Evaluation order: highest priority first, then oldest
+        self.rules = sorted((rule for rule in rules if rule.enabled), key=lambda rule: (-rule.priority, rule.id))
+        self.keyword_rules = collections.defaultdict(list)
+        self.patterns = {}
+        self.unconditional = []
+        for rank, rule in enumerate(self.rules):
+            if rule.keyword:
+                self.keyword_rules[rule.keyword.lower()].append(rank)
+            if rule.pattern:
+                self.patterns[rank] = re.compile(rule.pattern, re.IGNORECASE)
+            if not rule.keyword and not rule.pattern:
+                self.unconditional.append(rank)
+
+        keywords = sorted(self.keyword_rules, key=len, reverse=True)
+        self.keyword_matcher = None
+        if keywords:
+            self.keyword_matcher = re.compile("(?=(" + "|".join(map(re.escape, keywords)) + "))")
+        # Longest keyword at a position -> every keyword matching there
+        self.prefixes = {keyword: [other for other in keywords if keyword.startswith(other)] for keyword in keywords}
+        self.pattern_filter, self.separate_patterns = self.combine_patterns()
+        # Imported and historical descriptions repeat a lot, so their text matches are remembered
+        self.seen = {}
+
+    def combine_patterns(self):
+        """
+        (prefilter regex or None, ranks of the patterns left out of it)
+        """
+        joined, separate, names = [], [], set()
+        for rank, compiled in self.patterns.items():
+            pattern = self.rules[rank].pattern
+            try:
+                # Global flags are only allowed at the very start of a whole expression
+                re.compile(f"(?:{pattern})")
+            except re.error:
+                separate.append(rank)
+                continue
+            if BACKREFERENCE.search(pattern) or names & set(compiled.groupindex):
+                separate.append(rank)
+                continue
+            names.update(compiled.groupindex)
+            joined.append(pattern)
+        if not joined:
+            return None, separate
+        try:
+            return re.compile("|".join(f"(?:{pattern})" for pattern in joined), re.IGNORECASE), separate
+        except re.error:
+            return None, list(self.patterns)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def text_matches(self, description):
+        """Ranks of the rules whose keyword and pattern hold for a description, in evaluation order"""
+        matches = self.seen.get(description)
+        if matches is not None:
+            return matches
+        keywords = set()
+        if self.keyword_matcher is not None:
+            for found in self.keyword_matcher.finditer(description.lower()):
+                keywords.update(self.prefixes[found.group(1)])
+        candidates = set(self.unconditional)
+        for keyword in keywords:
+            candidates.update(self.keyword_rules[keyword])
+        # When no pattern can match, pattern rules are out before any of them is tried
+        if (self.pattern_filter is not None and self.pattern_filter.search(description)) or \
+                any(self.patterns[rank].search(description) for rank in self.separate_patterns):
+            candidates.update(self.patterns)
+        matches = tuple(rank for rank in sorted(candidates)
+                        if (not self.rules[rank].keyword or self.rules[rank].keyword.lower() in keywords)
+                        and (not self.rules[rank].pattern or self.patterns[rank].search(description)))
+        if len(self.seen) >= TEXT_CACHE_SIZE:
+            self.seen.clear()
+        self.seen[description] = matches
+        return matches
+
+    def match(self, description, account_id=None, amount=None):
+        """The winning Rule for a line, or None"""
+        for rank in self.text_matches(description or ""):
+            rule = self.rules[rank]
+            if rule.account_id is not None and rule.account_id != account_id:
+                continue
+            if rule.min_amount is not None and (amount is None or amount < rule.min_amount):
+                continue
+            if rule.max_amount is not None and (amount is None or amount > rule.max_amount):
+                continue
+            return rule
+        return None
+
+    def classify(self, description, account_id=None, amount=None):
+        """Classification id the rules give a line, or None"""
+        rule = self.match(description, account_id, amount)
+        return rule.classification_id if rule else None
+
+
+@functools.lru_cache(maxsize=8)
+def compile_rules(rows):
+    return RuleSet(Rule(*row) for row in rows)
+
+
+def load(conn):
+    """RuleSet of the stored rules; compiled once per distinct set of rules"""
+    rows = conn.execute(f"SELECT {', '.join(RULE_FIELDS)} FROM classification_rules ORDER BY id").fetchall()
+    return compile_rules(tuple(rows))
+
+
+def line_amount(debit, credit):
+    return (debit or 0) + (credit or 0)
+
+
+def apply(conn, filters=None, overwrite=False, dry_run=False, check=None):
+    """
+    Classify existing transaction lines with the rules and commit
+
+    Lines in closed periods are left alone. Without `overwrite` only
+    unclassified lines are considered; a line no rule matches keeps its
+    classification either way.
+
+    Args:
+        filters: Optional bulk.py filter narrowing the lines
+        check: Called between batches (JobContext.check for background jobs)
+
+    Returns:
+        {"lines": lines examined, "classified": lines changed (or that would
+        change), "rules": {rule id: lines}, "dry_run": dry_run}
+    """
+    clauses, params = [], []
+    if filters:
+        condition, params = bulk.line_condition(filters)
+        clauses.append(f"({condition})")
+    if not overwrite:
+        clauses.append("classification_id IS NULL")
+    through = periods.closed_through(conn)
+    if through is not None:
+        clauses.append("date(date) > ?")
+        params = params + [through]
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+    try:
+        if not dry_run:
+            # Nothing may change between reading the lines and writing their classification
+            conn.execute("BEGIN IMMEDIATE")
+        ruleset = load(conn)
+        examined = 0
+        by_rule = collections.Counter()
+        updates = []
+        if len(ruleset):
+            cursor = conn.execute(f"""
+                SELECT id, (SELECT description FROM transactions t WHERE t.id = transaction_lines.transaction_id),
+                       account_id, debit, credit, classification_id
+                FROM transaction_lines
+                {where}
+            """, params)
+            while True:
+                rows = cursor.fetchmany(BATCH_SIZE)
+                if not rows:
+                    break
+                if check:
+                    check()
+                examined += len(rows)
+                for line_id, description, account_id, debit, credit, current in rows:
+                    rule = ruleset.match(description, account_id, line_amount(debit, credit))
+                    if rule is not None and rule.classification_id != current:
+                        updates.append((rule.classification_id, line_id))
+                        by_rule[rule.id] += 1
+        if not dry_run:
+            for start in range(0, len(updates), BATCH_SIZE):
+                if check:
+                    check()
+                conn.executemany("UPDATE transaction_lines SET classification_id = ? WHERE id = ?",
+                                 updates[start:start + BATCH_SIZE])
+            conn.commit()
+    except BaseException:
+        if not dry_run:
+            conn.rollback()
+        raise
+    return {"lines": examined, "classified": len(updates), "rules": dict(by_rule), "dry_run": dry_run}
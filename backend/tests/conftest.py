@@ -0,0 +1,92 @@
+"""
+Shared fixtures for the backend tests.
+
+The app is imported once per session. Its default ledger (FINANCE_DB) is a
+generated 10k-line ledger that only the query-plan audit uses; every other
+test gets its own copy of that ledger in FINANCE_LEDGER_DIR and reaches it
+with the X-Ledger header, so tests never see each other's writes.
+
+Run from the backend directory:
+    python -m pytest -q
+"""
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="finance-tests-")
+LEDGER_DIR = os.path.join(WORKDIR, "ledgers")
+_names = itertools.count(1)
+
+
+def pytest_configure(config):
+    os.makedirs(LEDGER_DIR, exist_ok=True)
+    os.environ["FINANCE_DB"] = os.path.join(WORKDIR, "default.db")
+    os.environ["FINANCE_LEDGER_DIR"] = LEDGER_DIR
+    os.environ.pop("FINANCE_WORKERS", None)
+    # database.py opens finance.db in the working directory on import
+    os.chdir(WORKDIR)
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+
+
+class Ledger:
+    """A test's own ledger file, named for the X-Ledger header"""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+
+@pytest.fixture(scope="session", autouse=True)
+def workdir():
+    yield WORKDIR
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def source_ledger():
+    from benchmarks.ledger import SIZES, generate_ledger
+
+    path = os.path.join(WORKDIR, "source.db")
+    generate_ledger(path, SIZES["10k"])
+    return path
+
+
+@pytest.fixture(scope="session")
+def api(source_ledger):
+    """The main module, serving a copy of the source ledger as its default ledger"""
+    shutil.copyfile(source_ledger, os.environ["FINANCE_DB"])
+    import main
+    main.prepare_database()
+    return main
+
+
+@pytest.fixture
+def ledger(source_ledger):
+    name = f"test{next(_names)}"
+    path = os.path.join(LEDGER_DIR, f"{name}.db")
+    shutil.copyfile(source_ledger, path)
+    return Ledger(name, path)
+
+
+@pytest.fixture
+def client(api, ledger):
+    """Client of the app for this test's ledger (the app's lifespan is not run)"""
+    from fastapi.testclient import TestClient
+
+    return TestClient(api.app, headers={"X-Ledger": ledger.name})
+
+
+@pytest.fixture
+def db(ledger):
+    """Database on this test's ledger, with the whole schema created"""
+    from database import Database
+
+    database = Database(ledger.path)
+    yield database
+    database.close_connection()
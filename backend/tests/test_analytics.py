@@ -0,0 +1,85 @@
+import os
+import sqlite3
+
+import analytics
+
+
+def sql_totals(conn, key, where="1"):
+    return {row[0]: row[1:] for row in conn.execute(f"""
+        SELECT {key}, CAST(ROUND(TOTAL(MAX(COALESCE(debit, 0) - COALESCE(credit, 0), 0)) * 100) AS INTEGER),
+               CAST(ROUND(TOTAL(MAX(COALESCE(credit, 0) - COALESCE(debit, 0), 0)) * 100) AS INTEGER), COUNT(*)
+        FROM transaction_lines WHERE {where} GROUP BY 1
+    """)}
+
+
+def cached_totals(columns, by, mask=None):
+    keys, debit, credit, lines = analytics.group_totals(columns, by, columns.select() if mask is None else mask)
+    return {key: (d, c, n) for key, d, c, n in zip(keys.tolist(), debit.tolist(), credit.tolist(), lines.tolist())}
+
+
+def test_totals_match_sql_after_incremental_refreshes(db, tmp_path):
+    conn = db.conn
+    cache = analytics.ColumnCache(str(tmp_path / "analytics"))
+    columns = cache.refresh(conn)
+    assert cached_totals(columns, "account") == sql_totals(conn, "account_id")
+
+    conn.execute("UPDATE transaction_lines SET debit = debit + 1 WHERE id % 97 = 0 AND debit > 0")
+    conn.execute("UPDATE transaction_lines SET classification_id = NULL WHERE id % 89 = 0")
+    conn.execute("DELETE FROM transaction_lines WHERE id % 101 = 0")
+    conn.execute("""
+        INSERT INTO transaction_lines (transaction_id, account_id, debit, credit, date)
+        SELECT transaction_id, account_id, credit, debit, '2026-01-15' FROM transaction_lines WHERE id % 50 = 0
+    """)
+    conn.commit()
+    columns = cache.refresh(conn)
+    assert cached_totals(columns, "account") == sql_totals(conn, "account_id")
+    assert cached_totals(columns, "classification") == sql_totals(conn, "COALESCE(classification_id, -1)")
+    mask = columns.select("2024-03-01", "2024-05-31")
+    assert cached_totals(columns, "transaction", mask) == \
+        sql_totals(conn, "transaction_id", "date >= '2024-03-01' AND date <= '2024-05-31'")
+
+
+def test_totals_route_agrees_with_sql(client, ledger):
+    totals = client.get("/api/analytics/totals", params={"group_by": "month", "date_from": "2023-01-01",
+                                                       "date_to": "2023-12-31"}).json()["totals"]
+    with sqlite3.connect(ledger.path) as conn:
+        expected = sql_totals(conn, "substr(date, 1, 7)", "date >= '2023-01-01' AND date <= '2023-12-31'")
+    assert {row["label"]: (round(row["debit"] * 100), round(row["credit"] * 100), row["lines"])
+            for row in totals} == expected
+
+
+def test_readers_keep_the_columns_they_mapped(db, tmp_path):
+    conn = db.conn
+    cache = analytics.ColumnCache(str(tmp_path / "analytics"))
+    assert cache.latest(conn) == (None, False)
+    held = cache.refresh(conn)
+    assert cache.latest(conn) == (held, True)
+    amounts, live = held.amount.copy(), held.live.copy()
+
+    conn.execute("UPDATE transaction_lines SET debit = debit + 1 WHERE id % 7 = 0 AND debit > 0")
+    conn.execute("DELETE FROM transaction_lines WHERE id % 11 = 0")
+    conn.commit()
+    logged = conn.execute("SELECT COUNT(*) FROM analytics_line_changes").fetchone()[0]
+    changes = conn.total_changes
+    # Behind the ledger, but served as they are and without writing
+    assert cache.latest(conn) == (held, False)
+    assert conn.total_changes == changes
+    assert conn.execute("SELECT COUNT(*) FROM analytics_line_changes").fetchone()[0] == logged
+
+    refreshed = cache.refresh(conn)
+    assert (held.amount == amounts).all() and (held.live == live).all()
+    assert not (refreshed.amount == amounts).all() and not (refreshed.live == live).all()
+    assert cache.latest(conn) == (refreshed, True)
+    assert len([name for name in os.listdir(cache.directory) if name.endswith(".npy")]) == len(analytics.ARRAYS)
+
+
+def test_reads_queue_the_refresh_instead_of_writing(api, client, ledger, monkeypatch):
+    assert client.get("/api/analytics/totals").json()["stale"] is False
+    with sqlite3.connect(ledger.path) as conn:
+        conn.execute("UPDATE transaction_lines SET debit = debit + 1 WHERE id = (SELECT MAX(id) FROM transaction_lines)")
+    queued = []
+    monkeypatch.setattr(api.job_queue, "submit", lambda name, params: queued.append(name) or ({"id": None}, False))
+    assert client.get("/api/analytics/totals").json()["stale"] is True
+    assert queued == ["refresh-analytics"]
+    with sqlite3.connect(ledger.path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM analytics_line_changes").fetchone()[0] == 1
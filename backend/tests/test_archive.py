@@ -0,0 +1,57 @@
+import datetime
+import sqlite3
+
+import pytest
+
+import archive
+import periods
+
+
+def archive_2019(ledger):
+    with sqlite3.connect(ledger.path) as conn:
+        periods.close_periods(conn, datetime.date(2019, 12, 31))
+        return archive.archive_year(conn, 2019)
+
+
+def accounts(client, as_of):
+    return client.get("/api/reports/trial-balance", params={"as_of": as_of}).json()["accounts"]
+
+
+def test_unclosed_year_is_not_archived(db):
+    with pytest.raises(ValueError):
+        archive.archive_year(db.conn, 2019)
+
+
+def test_archived_lines_still_count_everywhere(api, ledger, client):
+    with sqlite3.connect(ledger.path) as conn:
+        transaction_id = conn.execute(
+            "SELECT transaction_id FROM transaction_lines WHERE date < '2019-06-01' ORDER BY id").fetchone()[0]
+    transactions = client.get("/api/transactions", params={"limit": 20, "skip": 0}).json()
+    last_page = client.get("/api/transactions", params={"limit": 20, "skip": transactions["total"] - 20}).json()
+    lines = client.get(f"/api/transactions/{transaction_id}/lines").json()
+    trial_balance = accounts(client, "2025-12-31")
+    mid_2019 = accounts(client, "2019-06-30")
+
+    moved = archive_2019(ledger)
+    assert moved["transactions"] > 0
+    with sqlite3.connect(ledger.path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM transaction_lines WHERE date < '2019-12-01'").fetchone()[0] == 0
+        assert archive.lines_table(conn, "2020-01-01") == "transaction_lines"
+
+    assert client.get("/api/transactions", params={"limit": 20, "skip": 0}).json() == transactions
+    assert client.get("/api/transactions",
+                      params={"limit": 20, "skip": transactions["total"] - 20}).json() == last_page
+    assert client.get(f"/api/transactions/{transaction_id}/lines").json() == lines
+    assert accounts(client, "2025-12-31") == trial_balance
+    assert accounts(client, "2019-06-30") == mid_2019
+
+
+def test_archived_transactions_cannot_change(ledger, client):
+    with sqlite3.connect(ledger.path) as conn:
+        transaction_id = conn.execute(
+            "SELECT transaction_id FROM transaction_lines WHERE date < '2019-06-01' ORDER BY id").fetchone()[0]
+    archive_2019(ledger)
+    assert client.patch(f"/api/transactions/{transaction_id}", json={"description": "changed"}).status_code == 409
+    assert client.delete(f"/api/transactions/{transaction_id}").status_code == 409
+    assert client.delete("/api/periods/2019-12-31").status_code == 409
+    assert client.delete("/api/periods/2019-07-31").status_code == 409
@@ -0,0 +1,68 @@
+import sqlite3
+
+import pytest
+
+import backup
+
+
+def contents(path):
+    with sqlite3.connect(path) as conn:
+        return {table: conn.execute(f"SELECT * FROM {table} ORDER BY 1").fetchall()
+                for table in ("transactions", "transaction_lines", "accounts")}
+
+
+@pytest.mark.parametrize("kind", backup.KINDS)
+def test_backup_is_a_sound_copy(ledger, tmp_path, kind):
+    result = backup.run_backup(ledger.path, kind, directory=str(tmp_path), pages=64, pause=0)
+    assert result["error"] is None
+    [taken] = backup.list_backups(ledger.path, str(tmp_path))
+    assert (taken["kind"], taken["path"]) == (kind, result["path"])
+    assert backup.integrity_problems(taken["path"]) == []
+    assert contents(taken["path"]) == contents(ledger.path)
+
+
+def test_restore_brings_the_backup_back(ledger, tmp_path):
+    saved = contents(ledger.path)
+    path = backup.run_backup(ledger.path, directory=str(tmp_path), pause=0)["path"]
+    with sqlite3.connect(ledger.path) as conn:
+        conn.execute("DELETE FROM transaction_lines WHERE date >= '2025-01-01'")
+    backup.restore(path, ledger.path)
+    assert contents(ledger.path) == saved
+
+
+def test_damaged_backup_is_not_restored(ledger, tmp_path):
+    path = backup.run_backup(ledger.path, directory=str(tmp_path), pause=0)["path"]
+    with open(path, "r+b") as damaged:
+        damaged.seek(4096 * 3)
+        damaged.write(b"\xff" * 4096 * 4)
+    saved = contents(ledger.path)
+    with pytest.raises(ValueError):
+        backup.restore(path, ledger.path)
+    assert contents(ledger.path) == saved
+
+
+def test_pruning_keeps_the_newest(ledger, tmp_path):
+    stem = ledger.name
+    for taken in ("20240101T000000", "20240102T000000", "20240103T000000"):
+        (tmp_path / f"{stem}-{taken}-online.db").write_bytes(b"")
+    (tmp_path / "other-20240101T000000-online.db").write_bytes(b"")
+    assert backup.prune_backups(ledger.path, 2, str(tmp_path)) == [f"{stem}-20240101T000000-online.db"]
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "other-20240101T000000-online.db", f"{stem}-20240102T000000-online.db", f"{stem}-20240103T000000-online.db"]
+
+
+def test_restore_invalidates_what_a_running_server_cached(client, ledger, tmp_path):
+    import analytics
+
+    cache = analytics.ColumnCache(str(tmp_path / "analytics"))
+    with sqlite3.connect(ledger.path) as conn:
+        analytics.create_schema(conn.cursor())
+        cache.refresh(conn)
+    etag = client.get("/api/currencies").headers["etag"]
+    path = backup.run_backup(ledger.path, directory=str(tmp_path / "backups"), pause=0)["path"]
+
+    backup.restore(path, ledger.path)
+    assert client.get("/api/currencies", headers={"If-None-Match": etag}).status_code == 200
+    with sqlite3.connect(ledger.path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM analytics_cache").fetchone()[0] == 0
+        assert cache.latest(conn)[1] is False
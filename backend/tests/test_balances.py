@@ -0,0 +1,98 @@
+import datetime
+import sqlite3
+
+import pytest
+
+import balances
+
+
+def line_totals(conn, as_of):
+    return {account_id: (round(debit, 2), round(credit, 2)) for account_id, debit, credit in conn.execute("""
+        SELECT account_id, TOTAL(debit), TOTAL(credit) FROM transaction_lines WHERE date < ? GROUP BY account_id
+    """, (balances.next_day(as_of),))}
+
+
+def trial_balance_totals(conn, as_of):
+    rows, _ = balances.trial_balance(conn, as_of)
+    return {row[0]: (row[4], row[5]) for row in rows}
+
+
+@pytest.mark.parametrize("as_of", [datetime.date(2021, 6, 15), datetime.date(2025, 12, 31)])
+def test_trial_balance_matches_the_lines_with_and_without_checkpoints(db, as_of):
+    conn = db.conn
+    assert trial_balance_totals(conn, as_of) == line_totals(conn, as_of)
+    balances.refresh_checkpoints(conn, as_of)
+    assert trial_balance_totals(conn, as_of) == line_totals(conn, as_of)
+
+
+def test_back_dated_write_drops_later_checkpoints(db):
+    conn = db.conn
+    balances.refresh_checkpoints(conn, datetime.date(2025, 11, 30))
+    account_id = conn.execute("SELECT account_id FROM transaction_lines LIMIT 1").fetchone()[0]
+    conn.execute("""
+        INSERT INTO transaction_lines (transaction_id, account_id, debit, date) VALUES (1, ?, 1000, '2022-03-10')
+    """, (account_id,))
+    conn.commit()
+    assert conn.execute("SELECT MAX(as_of) FROM balance_checkpoints").fetchone()[0] == "2022-02-28"
+    assert balances.checkpoints_stale(conn, datetime.date(2025, 11, 30))
+    day = datetime.date(2025, 6, 30)
+    balance = balances.account_balance(conn, account_id, day)
+    assert (balance["total_debit"], balance["total_credit"]) == line_totals(conn, day)[account_id]
+
+
+def test_checkpoints_stale_until_refreshed(db):
+    through = datetime.date(2024, 12, 31)
+    assert balances.checkpoints_stale(db.conn, through)
+    assert balances.refresh_checkpoints(db.conn, through) > 0
+    assert not balances.checkpoints_stale(db.conn, through)
+
+
+def test_balance_reads_do_not_write(api, client, ledger, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(api.job_queue, "submit", lambda name, params: submitted.append((name, params)))
+    conn = sqlite3.connect(ledger.path)
+    account_id = conn.execute("SELECT MIN(account_id) FROM transaction_lines").fetchone()[0]
+    assert client.get("/api/reports/trial-balance").status_code == 200
+    assert client.get(f"/api/accounts/{account_id}/balance").status_code == 200
+    assert conn.execute("SELECT COUNT(*) FROM balance_checkpoints").fetchone()[0] == 0
+    conn.close()
+    assert submitted and all(name == "refresh-checkpoints" for name, _ in submitted)
+
+
+def test_refresh_job_writes_the_checkpoints(api, ledger):
+    with api.ledger_pool.using(ledger.name):
+        assert api.refresh_checkpoints_job(None, through="2024-12-31")["checkpoints_written"] > 0
+        conn = api.get_db_connection()
+        try:
+            assert not balances.checkpoints_stale(conn, datetime.date(2024, 12, 31))
+        finally:
+            conn.close()
+
+
+def test_register_pages_add_up_to_the_whole_register(client, ledger):
+    with sqlite3.connect(ledger.path) as conn:
+        account_id = conn.execute(
+            "SELECT account_id FROM transaction_lines GROUP BY 1 ORDER BY COUNT(*) LIMIT 1").fetchone()[0]
+        expected, balance = [], 0.0
+        for line_id, debit, credit in conn.execute("""
+            SELECT id, debit, credit FROM transaction_lines WHERE account_id = ? ORDER BY date, id
+        """, (account_id,)):
+            balance += (debit or 0) - (credit or 0)
+            expected.append((line_id, round(balance, 2)))
+
+    seen, cursor = [], None
+    while True:
+        page = client.get(f"/api/accounts/{account_id}/register",
+                          params={"limit": 7, **({"cursor": cursor} if cursor else {})}).json()
+        if seen:
+            assert page["opening_balance"] == pytest.approx(seen[-1][1])
+        seen += [(line["id"], line["balance"]) for line in page["lines"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert [line_id for line_id, _ in seen] == [line_id for line_id, _ in expected]
+    assert [balance for _, balance in seen] == pytest.approx([balance for _, balance in expected])
+
+
+def test_register_rejects_a_malformed_cursor(client):
+    assert client.get("/api/accounts/1/register", params={"cursor": "not a cursor"}).status_code == 400
@@ -0,0 +1,30 @@
+import pytest
+
+
+@pytest.mark.parametrize("section, path, key", [
+    ("accounts", "/api/accounts", "accounts"),
+    ("accounts_detailed", "/api/accounts/detailed", "accounts"),
+    ("currencies", "/api/currencies", "currencies"),
+    ("classifications", "/api/classifications", "classifications"),
+    ("categories", "/api/categories", "categories"),
+])
+def test_sections_match_the_reference_routes(client, section, path, key):
+    assert client.get("/api/bootstrap").json()["sections"][section] == client.get(path).json()[key]
+
+
+def test_known_sections_are_skipped_until_they_change(client):
+    first = client.get("/api/bootstrap").json()
+    assert first["unchanged"] == []
+    known = ",".join(f"{name}:{version}" for name, version in first["versions"].items())
+    assert client.get("/api/bootstrap", params={"versions": known}).json()["sections"] == {}
+
+    assert client.post("/api/categories", json={"name": "Test category"}).status_code == 200
+    changed = client.get("/api/bootstrap", params={"versions": known}).json()
+    assert set(changed["sections"]) == {"categories", "accounts", "accounts_detailed"}
+    assert "Test category" in [category["name"] for category in changed["sections"]["categories"]]
+    assert client.get("/api/bootstrap", params={"versions": known}).json()["versions"] == changed["versions"]
+
+
+def test_whole_payload_is_served_with_an_etag(client):
+    etag = client.get("/api/bootstrap").headers["etag"]
+    assert client.get("/api/bootstrap", headers={"If-None-Match": etag}).status_code == 304
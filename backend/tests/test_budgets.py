@@ -0,0 +1,151 @@
+import datetime
+import sqlite3
+
+import pytest
+
+import budgets
+
+
+def maintained(conn):
+    return {row[:3]: (round(row[3], 2), round(row[4], 2), row[5]) for row in conn.execute(
+        "SELECT month, classification_id, account_id, debit, credit, lines FROM line_month_totals WHERE lines > 0")}
+
+
+def recomputed(conn):
+    return {row[:3]: (round(row[3], 2), round(row[4], 2), row[5]) for row in conn.execute("""
+        SELECT substr(date, 1, 7), COALESCE(classification_id, 0), COALESCE(account_id, 0),
+               TOTAL(debit), TOTAL(credit), COUNT(*)
+        FROM transaction_lines WHERE date IS NOT NULL GROUP BY 1, 2, 3
+    """)}
+
+
+def test_triggers_keep_the_month_totals_current(db):
+    conn = db.conn
+    assert maintained(conn) == recomputed(conn)
+
+    conn.execute("UPDATE transaction_lines SET debit = debit + 2.5 WHERE id % 37 = 0 AND debit > 0")
+    conn.execute("UPDATE transaction_lines SET date = '2026-02-10' WHERE id % 41 = 0")
+    conn.execute("UPDATE transaction_lines SET classification_id = NULL WHERE id % 43 = 0")
+    conn.execute("UPDATE transaction_lines SET account_id = 1 WHERE id % 47 = 0")
+    conn.execute("DELETE FROM transaction_lines WHERE id % 53 = 0")
+    conn.execute("""
+        INSERT INTO transaction_lines (transaction_id, account_id, debit, credit, date, classification_id)
+        SELECT transaction_id, account_id, credit, debit, '2026-03-01', classification_id
+        FROM transaction_lines WHERE id % 59 = 0
+    """)
+    conn.commit()
+    assert maintained(conn) == recomputed(conn)
+
+    expected = maintained(conn)
+    budgets.rebuild(conn)
+    assert maintained(conn) == expected
+
+
+@pytest.fixture
+def target(ledger):
+    """(classification id, account id) with the most lines in 2024-05, and their net that month"""
+    with sqlite3.connect(ledger.path) as conn:
+        classification_id, account_id = conn.execute("""
+            SELECT classification_id, account_id FROM transaction_lines
+            WHERE date LIKE '2024-05-%' AND classification_id IS NOT NULL AND account_id IS NOT NULL
+            GROUP BY 1, 2 ORDER BY COUNT(*) DESC LIMIT 1
+        """).fetchone()
+        net = conn.execute("""
+            SELECT TOTAL(debit) - TOTAL(credit) FROM transaction_lines
+            WHERE date LIKE '2024-05-%' AND classification_id = ?
+        """, (classification_id,)).fetchone()[0]
+    return classification_id, account_id, round(net, 2)
+
+
+def test_status_reports_the_months_actuals(client, target):
+    classification_id, account_id, net = target
+    budget = client.post("/api/budgets", json={"period": "2024-05", "classification_id": classification_id,
+                                               "amount": 100}).json()["budget"]
+    client.post("/api/budgets", json={"period": "2024-05", "classification_id": classification_id,
+                                      "account_id": account_id, "amount": 50})
+
+    status = client.get("/api/budgets/2024-05/status").json()
+    assert len(status["budgets"]) == 2
+    row = next(row for row in status["budgets"] if row["id"] == budget["id"])
+    assert row["actual"] == net
+    assert row["remaining"] == round(100 - net, 2)
+    assert client.get("/api/budgets/2024-06/status").json()["budgets"] == []
+
+
+def test_budgets_are_validated_and_unique_per_target(client, target):
+    classification_id = target[0]
+    budget = {"period": "2024-05", "classification_id": classification_id, "amount": 100}
+    for invalid in ({**budget, "period": "2024-13"}, {**budget, "amount": 0}, {"period": "2024-05", "amount": 10},
+                    {**budget, "classification_id": 999999}):
+        assert client.post("/api/budgets", json=invalid).status_code == 400
+    assert client.get("/api/budgets/May/status").status_code == 400
+
+    budget_id = client.post("/api/budgets", json=budget).json()["budget"]["id"]
+    assert client.post("/api/budgets", json=budget).status_code == 409
+    assert client.put(f"/api/budgets/{budget_id}", json={**budget, "amount": 250}).status_code == 200
+    assert client.get("/api/budgets", params={"period": "2024-05"}).json()["budgets"] == [
+        {"id": budget_id, "period": "2024-05", "classification_id": classification_id, "account_id": None,
+         "amount": 250.0}]
+    assert client.delete(f"/api/budgets/{budget_id}").status_code == 200
+    assert client.delete(f"/api/budgets/{budget_id}").status_code == 404
+    assert client.put(f"/api/budgets/{budget_id}", json=budget).status_code == 404
+
+
+def test_a_target_taken_past_the_check_is_a_conflict(api, client, target, monkeypatch):
+    budget = {"period": "2024-05", "classification_id": target[0], "amount": 100}
+    assert client.post("/api/budgets", json=budget).status_code == 200
+    # As when a concurrent request wrote the same target after this one checked
+    monkeypatch.setattr(api, "budget_values", lambda conn, data, budget_id=None: (
+        data["period"], data.get("classification_id"), data.get("account_id"), float(data["amount"])))
+    assert client.post("/api/budgets", json=budget).status_code == 409
+    assert len(client.get("/api/budgets", params={"period": "2024-05"}).json()["budgets"]) == 1
+    assert client.get("/api/budgets", params={"period": "2024-5"}).status_code == 400
+
+
+def day(text):
+    return text and datetime.date.fromisoformat(text)
+
+
+def brute_force_report(conn, date_from, date_to, granularity, classification_id=None):
+    period = budgets.GRANULARITIES[granularity].format(month="substr(date, 1, 7)")
+    key, where, params = "COALESCE(classification_id, 0)", "date >= ? AND date <= ?", [date_from or "",
+                                                                                       date_to or "9999-12-31"]
+    if classification_id is not None:
+        key, where = "COALESCE(account_id, 0)", where + " AND COALESCE(classification_id, 0) = ?"
+        params.append(classification_id)
+    return [(label, target or None, round(debit, 2), round(credit, 2), lines) for label, target, debit, credit, lines
+            in conn.execute(f"""
+                SELECT {period}, {key}, TOTAL(debit), TOTAL(credit), COUNT(*) FROM transaction_lines
+                WHERE {where} GROUP BY 1, 2 ORDER BY 1, 2
+            """, params)]
+
+
+@pytest.mark.parametrize("date_from, date_to, granularity", [
+    ("2023-01-01", "2023-12-31", "month"),
+    ("2023-02-14", "2023-11-03", "month"),
+    ("2023-02-14", "2023-02-20", "month"),
+    ("2022-05-31", "2024-06-01", "quarter"),
+    (None, "2021-03-15", "year"),
+    ("2024-07-02", None, "quarter"),
+    (None, None, "year"),
+])
+def test_report_matches_grouping_the_lines(db, date_from, date_to, granularity):
+    conn = db.conn
+    conn.execute("DELETE FROM transaction_lines WHERE id % 61 = 0")
+    conn.execute("UPDATE transaction_lines SET classification_id = NULL WHERE id % 67 = 0")
+    conn.commit()
+    rows = budgets.classification_report(conn, db.reference_data(), day(date_from), day(date_to), granularity)
+    assert [row[:2] + row[3:] for row in rows] == brute_force_report(conn, date_from, date_to, granularity)
+
+    classification_id = rows[0][1] or 0
+    rows = budgets.classification_report(conn, db.reference_data(), day(date_from), day(date_to), granularity,
+                                         classification_id)
+    assert [row[:2] + row[3:] for row in rows] == \
+        brute_force_report(conn, date_from, date_to, granularity, classification_id)
+
+
+def test_report_route_checks_its_dates(client):
+    assert client.get("/api/reports/classifications", params={"from": "2023-05-01", "to": "2023-04-01"}) \
+        .status_code == 400
+    assert client.get("/api/reports/classifications", params={"from": "May"}).status_code == 400
+    assert client.get("/api/reports/classifications", params={"granularity": "week"}).status_code == 400
@@ -0,0 +1,61 @@
+import datetime
+
+import pytest
+
+import bulk
+import periods
+
+
+def test_reclassify_changes_only_matching_lines(db):
+    conn = db.conn
+    account_id = conn.execute(
+        "SELECT account_id FROM transaction_lines GROUP BY 1 ORDER BY COUNT(*) DESC").fetchone()[0]
+    classification_id = conn.execute("SELECT MAX(id) FROM classifications").fetchone()[0]
+    selected = {"account_id": account_id, "date_from": "2024-01-01", "date_to": "2024-06-30"}
+    preview = bulk.reclassify(conn, selected, classification_id, dry_run=True)
+    result = bulk.reclassify(conn, selected, classification_id)
+    assert result["lines"] == preview["lines"] > 0
+    assert conn.execute("""
+        SELECT COUNT(*) FROM transaction_lines
+        WHERE account_id = ? AND date >= '2024-01-01' AND date < '2024-07-01' AND classification_id IS NOT ?
+    """, (account_id, classification_id)).fetchone()[0] == 0
+    assert bulk.reclassify(conn, selected, classification_id)["lines"] == 0
+
+
+def test_empty_filter_is_refused(db):
+    with pytest.raises(ValueError):
+        bulk.reclassify(db.conn, {}, None)
+    with pytest.raises(ValueError):
+        bulk.delete_transactions(db.conn, {"colour": "red"}, dry_run=True)
+
+
+@pytest.mark.parametrize("dry_run", [True, False])
+def test_closed_periods_are_refused_in_dry_runs_too(db, dry_run):
+    conn = db.conn
+    periods.close_periods(conn, datetime.date(2019, 3, 31), today=datetime.date(2019, 4, 1))
+    selected = {"date_from": "2019-03-01", "date_to": "2019-04-30"}
+    with pytest.raises(bulk.ClosedPeriodError):
+        bulk.reclassify(conn, selected, None, dry_run=dry_run)
+    with pytest.raises(bulk.ClosedPeriodError):
+        bulk.delete_transactions(conn, selected, dry_run=dry_run)
+    assert bulk.delete_transactions(conn, {"date_from": "2019-04-01", "date_to": "2019-04-30"},
+                                    dry_run=dry_run)["transactions"] > 0
+
+
+def test_delete_removes_whole_transactions(db):
+    conn = db.conn
+    selected = {"date_from": "2025-12-01"}
+    preview = bulk.delete_transactions(conn, selected, dry_run=True)
+    result = bulk.delete_transactions(conn, selected)
+    assert (result["transactions"], result["lines"]) == (preview["transactions"], preview["lines"])
+    assert conn.execute("""
+        SELECT COUNT(*) FROM transaction_lines WHERE transaction_id IN (SELECT value FROM json_each(?))
+    """, (str(result["deleted"]),)).fetchone()[0] == 0
+
+
+def test_dry_run_in_closed_period_is_409(client):
+    assert client.post("/api/periods/close", json={"through": "2019-01-31"}).status_code == 200
+    classification_id = client.get("/api/classifications").json()["classifications"][0]["id"]
+    response = client.post("/api/transaction-lines/reclassify", json={
+        "filter": {"date_to": "2019-01-31"}, "classification_id": classification_id, "dry_run": True})
+    assert response.status_code == 409
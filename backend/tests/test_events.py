@@ -0,0 +1,67 @@
+import asyncio
+
+import orjson
+
+import events
+
+
+def parse(frame):
+    fields = dict(line.split(": ", 1) for line in frame.strip().split("\n"))
+    return int(fields["id"]), fields["event"], orjson.loads(fields["data"])
+
+
+def test_changes_are_coalesced_into_one_message():
+    async def scenario():
+        broker = events.ChangeBroker()
+        stream = broker.stream()
+        assert await anext(stream) == "retry: 3000\n\n"
+        receiving = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        broker.publish_transaction(1, "created", {7: 100.0, 8: -100.0})
+        broker.publish_transaction(1, "updated", {7: -40.0, 8: 40.0})
+        broker.publish_tables({"accounts": 3})
+        frame = await asyncio.wait_for(receiving, 1)
+        await stream.aclose()
+        assert broker.subscribers == 0
+        return frame
+
+    sequence, name, message = parse(asyncio.run(scenario()))
+    assert (sequence, name) == (1, "changes")
+    assert message == {"transactions": [{"id": 1, "action": "created"}, {"id": 1, "action": "updated"}],
+                       "truncated": False, "accounts": {"7": 60.0, "8": -60.0}, "tables": {"accounts": 3}}
+
+
+def test_reconnecting_clients_get_what_they_missed():
+    async def scenario():
+        broker = events.ChangeBroker()
+        broker.bind(asyncio.get_running_loop())
+        broker.subscribers = 1
+        for transaction_id in range(3):
+            broker.publish_transaction(transaction_id, "created", {1: 1.0})
+            await asyncio.sleep(events.COALESCE_SECONDS * 2)
+        broker.subscribers = 0
+        replay = broker.stream(last_event_id=1)
+        await anext(replay)
+        missed = await anext(replay)
+        await replay.aclose()
+        stale = broker.stream(last_event_id=99)
+        await anext(stale)
+        reset = await anext(stale)
+        await stale.aclose()
+        return missed, reset
+
+    missed, reset = asyncio.run(scenario())
+    assert [parse(frame)[2]["transactions"][0]["id"] for frame in missed.split("\n\n") if frame] == [1, 2]
+    assert parse(reset)[:2] == (3, "reset")
+
+
+def test_nothing_is_kept_without_subscribers():
+    broker = events.ChangeBroker()
+    broker.publish_transaction(1, "created", {1: 1.0})
+    assert broker.pending is None and broker.sequence == 0
+
+
+def test_line_deltas_net_debits_against_credits():
+    old = events.line_deltas([(1, 50, None), (2, None, 50)])
+    new = events.line_deltas([{"account_id": 1, "debit": 80}, {"account_id": 3, "credit": 80}])
+    assert events.difference(new, old) == {1: 30.0, 2: 50.0, 3: -80.0}
@@ -0,0 +1,70 @@
+import fingerprints
+
+
+def statement(conn):
+    account_id = conn.execute("SELECT MIN(id) FROM accounts").fetchone()[0]
+    return [
+        {"description": "Coffee", "account_id": account_id, "debit": 3.5, "date": "2025-03-01"},
+        {"description": "coffee ", "account_id": account_id, "debit": 3.5, "date": "2025-03-01"},
+        {"description": "Coffee", "account_id": account_id, "debit": 3.5, "date": "2025-03-02"},
+        {"description": "Salary", "account_name": "Unknown bank", "credit": 1000, "date": "2025-03-25"},
+    ]
+
+
+def forget_fingerprints(conn):
+    """Take the ledger back to before fingerprints: no fingerprint or date on the orphan lines"""
+    conn.execute("DROP INDEX idx_orphan_transaction_lines_fingerprint")
+    conn.execute("ALTER TABLE orphan_transaction_lines DROP COLUMN fingerprint")
+    conn.execute("ALTER TABLE orphan_transaction_lines DROP COLUMN date")
+
+
+def test_identical_lines_of_one_statement_are_told_apart():
+    lines = [{"description": "Coffee", "account_id": 1, "debit": 3.5, "date": "2025-03-01"}] * 2
+    first, second = fingerprints.fingerprint_lines(lines)
+    assert first != second
+    assert fingerprints.fingerprint_lines(lines[:1]) == [first]
+    assert fingerprints.fingerprint_lines([dict(lines[0], date="2025-03-02")]) != [first]
+
+
+def test_reimported_statement_is_skipped(db):
+    lines = statement(db.conn)
+    first = db.import_orphan_transaction("march.csv", lines)
+    assert (first["inserted"], first["duplicates"]) == (4, [])
+    again = db.import_orphan_transaction("march-again.csv", lines + [dict(lines[0], date="2025-03-03")])
+    assert again["inserted"] == 1
+    assert [duplicate["index"] for duplicate in again["duplicates"]] == [0, 1, 2, 3]
+    assert db.import_orphan_transaction("march.csv", lines)["orphan_transaction_id"] is None
+
+
+def test_backfill_matches_dated_imports(db):
+    lines = statement(db.conn)
+    orphan_transaction_id = db.import_orphan_transaction("march.csv", lines)["orphan_transaction_id"]
+    query = "SELECT fingerprint FROM orphan_transaction_lines WHERE orphan_transaction_id = ? ORDER BY id"
+    stored = db.conn.execute(query, (orphan_transaction_id,)).fetchall()
+    db.conn.execute("DROP INDEX idx_orphan_transaction_lines_fingerprint")
+    db.conn.execute("ALTER TABLE orphan_transaction_lines DROP COLUMN fingerprint")
+    fingerprints.create_schema(db.conn.cursor())
+    assert db.conn.execute(query, (orphan_transaction_id,)).fetchall() == stored
+
+
+def test_backfill_dates_consumed_lines_by_their_transaction(db):
+    conn = db.conn
+    transaction_id, account_id, debit, line_date = conn.execute("""
+        SELECT transaction_id, account_id, debit, date FROM transaction_lines WHERE debit > 0 ORDER BY id LIMIT 1
+    """).fetchone()
+    forget_fingerprints(conn)
+    conn.execute("INSERT INTO orphan_transactions (reference, import_date, status) VALUES ('old.csv', '', 'new')")
+    orphan_transaction_id = conn.execute("SELECT MAX(id) FROM orphan_transactions").fetchone()[0]
+    conn.execute("""
+        INSERT INTO orphan_transaction_lines (orphan_transaction_id, description, account_id, debit, status,
+                                              transaction_id)
+        VALUES (?, 'Groceries', ?, ?, 'consumed', ?)
+    """, (orphan_transaction_id, account_id, debit, transaction_id))
+    fingerprints.create_schema(conn.cursor())
+    conn.commit()
+
+    line = {"description": "Groceries", "account_id": account_id, "debit": debit, "date": line_date}
+    result = db.import_orphan_transaction("old-again.csv", [line])
+    assert result["orphan_transaction_id"] is None
+    assert conn.execute("SELECT date FROM orphan_transaction_lines WHERE id = ?",
+                        (result["duplicates"][0]["line_id"],)).fetchone()[0] == line_date
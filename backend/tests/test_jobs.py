@@ -0,0 +1,173 @@
+import datetime
+import os
+import threading
+import time
+
+import orjson
+import pytest
+
+import jobs
+from versions import TableVersions
+
+
+@pytest.fixture
+def job_queue(tmp_path):
+    queue = jobs.JobQueue(str(tmp_path / "jobs.db"), TableVersions(), workers=1)
+    yield queue
+    queue.stop()
+
+
+def wait(queue, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job["status"] in jobs.FINISHED:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_results_are_cached_until_their_tables_change(job_queue):
+    runs = []
+
+    @job_queue.register("total", tables=("transaction_lines",))
+    def total(context, scale):
+        runs.append(scale)
+        return {"total": 10 * scale}
+
+    job, existing = job_queue.submit("total", {"scale": 2})
+    assert not existing
+    assert wait(job_queue, job["id"])["status"] == jobs.DONE
+    assert job_queue.result(job["id"])[1].content == orjson.dumps({"total": 20})
+
+    assert job_queue.submit("total", {"scale": 2}) == (job_queue.get(job["id"]), True)
+    assert not job_queue.submit("total", {"scale": 3})[1]
+    job_queue.versions.bump("accounts")
+    assert job_queue.submit("total", {"scale": 2})[1]
+    job_queue.versions.bump("transaction_lines")
+    again, existing = job_queue.submit("total", {"scale": 2})
+    assert not existing
+    wait(job_queue, again["id"])
+    assert runs.count(2) == 2
+
+
+def test_running_job_stops_when_cancelled(job_queue):
+    started = threading.Event()
+
+    @job_queue.register("slow", cacheable=False)
+    def slow(context):
+        started.set()
+        while True:
+            context.check()
+            time.sleep(0.01)
+
+    job, _ = job_queue.submit("slow", {})
+    queued, _ = job_queue.submit("slow", {})
+    assert started.wait(5)
+    assert job_queue.cancel(queued["id"]) == jobs.CANCELLED
+    assert job_queue.cancel(job["id"]) == jobs.RUNNING
+    assert wait(job_queue, job["id"])["status"] == jobs.CANCELLED
+    assert job_queue.result(queued["id"]) == (jobs.CANCELLED, None)
+    assert job_queue.cancel("no-such-job") is None
+
+
+def test_failures_are_recorded(job_queue):
+    @job_queue.register("broken")
+    def broken(context):
+        raise RuntimeError("no data")
+
+    job, _ = job_queue.submit("broken", {})
+    assert wait(job_queue, job["id"])["error"] == "RuntimeError: no data"
+    with pytest.raises(KeyError):
+        job_queue.submit("unknown", {})
+
+
+def test_jobs_of_a_previous_process_are_failed_on_start(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    first = jobs.JobQueue(path, TableVersions(), workers=0)
+    first.register("total")(lambda context: {})
+    job, _ = first.submit("total", {})
+    with first.connect() as conn:
+        conn.execute("UPDATE jobs SET owner = '1:gone'")
+    second = jobs.JobQueue(path, TableVersions(), workers=0)
+    second.start()
+    assert second.get(job["id"])["status"] == jobs.FAILED
+
+
+def test_cancel_through_another_process_stops_a_running_job(job_queue, monkeypatch):
+    monkeypatch.setattr(jobs, "CANCEL_POLL_INTERVAL", 0.01)
+    started = threading.Event()
+
+    @job_queue.register("slow", cacheable=False)
+    def slow(context):
+        started.set()
+        while True:
+            context.check()
+            time.sleep(0.01)
+
+    job, _ = job_queue.submit("slow", {})
+    assert started.wait(5)
+    other = jobs.JobQueue(job_queue.path, TableVersions(), workers=0)
+    assert other.cancel(job["id"]) == jobs.RUNNING
+    assert wait(job_queue, job["id"])["status"] == jobs.CANCELLED
+
+
+def test_resolved_params_are_part_of_the_cache_key(job_queue):
+    today = ["2026-03-31"]
+
+    @job_queue.register("dated", resolve=lambda params: {**params, "today": today[0]})
+    def dated(context, today):
+        return {"today": today}
+
+    job, _ = job_queue.submit("dated", {})
+    assert job["params"] == {"today": "2026-03-31"}
+    wait(job_queue, job["id"])
+    assert job_queue.submit("dated", {})[1]
+    today[0] = "2026-04-01"
+    again, existing = job_queue.submit("dated", {})
+    assert not existing
+    wait(job_queue, again["id"])
+    assert job_queue.result(again["id"])[1].content == orjson.dumps({"today": "2026-04-01"})
+
+
+def test_file_results_are_removed_with_their_job(job_queue, monkeypatch):
+    @job_queue.register("file", cacheable=False)
+    def file(context, fail=False):
+        path = context.result_path(".txt")
+        with open(path, "w") as output:
+            output.write("rows")
+        if fail:
+            raise RuntimeError("disk full")
+        return jobs.JobResult(None, "text/plain", "rows.txt", path=path)
+
+    job, _ = job_queue.submit("file", {})
+    wait(job_queue, job["id"])
+    result = job_queue.result(job["id"])[1]
+    with open(result.path) as f:
+        assert f.read() == "rows"
+
+    broken, _ = job_queue.submit("file", {"fail": True})
+    wait(job_queue, broken["id"])
+    assert os.listdir(job_queue.results_dir) == [os.path.basename(result.path)]
+
+    monkeypatch.setattr(jobs, "KEEP_FINISHED", 1)
+    wait(job_queue, job_queue.submit("file", {"fail": True})[0]["id"])
+    assert os.listdir(job_queue.results_dir) == []
+
+
+def test_export_is_served_from_its_file(api, client, ledger):
+    job = client.post("/api/jobs", json={"kind": "export-transactions", "params": {"date_from": "2024-05-01",
+                                                                                   "date_to": "2024-05-31"}}).json()
+    with api.ledger_pool.using(ledger.name):
+        assert api.job_queue.wait(job["job"]["id"], 30)["status"] == jobs.DONE
+    response = client.get(f"/api/jobs/{job['job']['id']}/result")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = response.text.splitlines()
+    assert rows[0].startswith("line_id,") and len(rows) > 1
+    assert all(",2024-05-" in row for row in rows[1:])
+
+    trial_balance = client.post("/api/jobs", json={"kind": "trial-balance", "params": {}}).json()["job"]
+    assert trial_balance["params"] == {"as_of": datetime.date.today().isoformat()}
+    with api.ledger_pool.using(ledger.name):
+        assert api.job_queue.wait(trial_balance["id"], 30)["status"] == jobs.DONE
@@ -0,0 +1,37 @@
+import os
+import shutil
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+@pytest.mark.parametrize("method, path", [
+    ("get", "/api/accounts/999999/balance"),
+    ("get", "/api/accounts/999999/register"),
+    ("get", "/api/accounts/999999/classifications"),
+    ("post", "/api/accounts/999999/classifications/1"),
+    ("delete", "/api/accounts/999999/classifications/1"),
+    ("put", "/api/transactions/999999"),
+    ("delete", "/api/periods/2019-01-31"),
+])
+def test_failed_requests_return_their_connection(api, ledger, client, method, path):
+    client.get("/api/periods")
+    pooled = api.ledger_pool.get(ledger.name)
+    idle = len(pooled.idle)
+    for _ in range(3):
+        response = client.request(method, path, json={"description": "x", "currency_id": 1, "lines": []})
+        assert response.status_code in (200, 404)
+    assert (len(pooled.idle), len(pooled.leased)) == (idle, 0)
+
+
+def test_unknown_ledger_is_404(api):
+    response = TestClient(api.app, headers={"X-Ledger": "no-such-ledger"}).get("/api/periods")
+    assert response.status_code == 404
+
+
+def test_ledgers_are_kept_apart(ledger, client):
+    other = f"{ledger.name}-other"
+    shutil.copyfile(ledger.path, os.path.join(os.path.dirname(ledger.path), f"{other}.db"))
+    assert client.post("/api/periods/close", json={"through": "2019-01-31"}).status_code == 200
+    assert client.get("/api/periods").json()["closed_through"] == "2019-01-31"
+    assert client.get(f"/ledgers/{other}/api/periods").json()["closed_through"] is None
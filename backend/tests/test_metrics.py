@@ -0,0 +1,65 @@
+import re
+import sqlite3
+import time
+
+import metrics
+
+
+def sample(text, name, **labels):
+    """Value of the metric line `name` carrying all of `labels`, or None"""
+    for line in text.splitlines():
+        if line.startswith(name + "{") and all(f'{key}="{value}"' in line for key, value in labels.items()):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+def test_literals_do_not_split_statements():
+    first, kind = metrics.statement_identity("SELECT * FROM accounts WHERE id = 12 AND name = 'it''s'")
+    assert kind == "SELECT"
+    assert metrics.statement_identity("SELECT * FROM accounts\n  WHERE id = 7 AND name = 'x'")[0] == first
+    assert metrics.statement_identity("PRAGMA table_info(accounts)")[1] == "OTHER"
+
+
+def test_requests_and_their_sql_are_counted_by_route_template(client):
+    before = client.get("/api/metrics").text
+    for transaction_id in (1, 2, 3):
+        assert client.get(f"/api/transactions/{transaction_id}/lines").status_code == 200
+    text = client.get("/api/metrics").text
+    route = "/api/transactions/{transaction_id}/lines"
+    counted = sample(text, "finance_http_requests_total", route=route, method="GET", status="200")
+    assert counted - (sample(before, "finance_http_requests_total", route=route, status="200") or 0) == 3
+    assert sample(text, "finance_sql_statements_total", route=route, kind="SELECT") >= 3
+    assert sample(text, "finance_http_request_duration_seconds_count", route=route) >= 3
+    assert re.search(r'finance_sql_statement_info\{statement="\w+",sql="SELECT .*tl\.transaction_id = \?', text)
+
+
+def test_background_work_is_tracked_under_its_label(api, ledger):
+    conn = api.ledger_pool.connect(api.ledger_pool.get(ledger.name))
+    try:
+        with metrics.track("test-label"):
+            conn.execute("SELECT COUNT(*) FROM transactions").fetchone()
+    finally:
+        conn.close()
+    assert sample(metrics.render(), "finance_sql_statements_total", route="test-label", kind="SELECT") >= 1
+
+
+def test_executemany_is_one_statement_and_cheap_to_instrument():
+    rows = [(number, f"row {number}", number / 2) for number in range(100_000)]
+
+    def insert_time(factory):
+        conn = sqlite3.connect(":memory:", factory=factory)
+        try:
+            conn.execute("CREATE TABLE numbers (id INTEGER, name TEXT, half REAL)")
+            start = time.perf_counter()
+            conn.executemany("INSERT INTO numbers VALUES (?, ?, ?)", rows)
+            conn.commit()
+            return time.perf_counter() - start
+        finally:
+            conn.close()
+
+    with metrics.track("test-executemany") as stats:
+        instrumented = min(insert_time(metrics.InstrumentedConnection) for _ in range(3))
+    plain = min(insert_time(sqlite3.Connection) for _ in range(3))
+    # Per attempt: CREATE, INSERT, COMMIT
+    assert stats.statements == 9
+    assert instrumented < plain * 2 + 0.05
@@ -0,0 +1,60 @@
+import datetime
+import sqlite3
+
+import pytest
+
+import balances
+import periods
+
+
+def test_close_freezes_the_trial_balance(db):
+    conn = db.conn
+    closed = periods.close_periods(conn, datetime.date(2019, 3, 31), today=datetime.date(2019, 3, 15))
+    assert closed == ["2019-01-31", "2019-02-28", "2019-03-31"]
+    as_of = datetime.date(2019, 3, 20)
+    rows, period_end = periods.trial_balance(conn, as_of)
+    assert period_end == "2019-02-28"
+    assert rows == balances.trial_balance(conn, as_of)[0]
+
+
+def test_close_rejects_later_months(db):
+    with pytest.raises(ValueError, match="after the current one"):
+        periods.close_periods(db.conn, datetime.date(2019, 4, 30), today=datetime.date(2019, 3, 15))
+    with pytest.raises(ValueError, match="month end"):
+        periods.close_periods(db.conn, datetime.date(2019, 3, 15), today=datetime.date(2019, 3, 15))
+    assert periods.closed_through(db.conn) is None
+
+
+def test_closed_lines_cannot_change(db):
+    conn = db.conn
+    periods.close_periods(conn, datetime.date(2019, 6, 30), today=datetime.date(2019, 7, 1))
+    line_id, account_id = conn.execute(
+        "SELECT id, account_id FROM transaction_lines WHERE date < '2019-06-30' LIMIT 1").fetchone()
+    with pytest.raises(sqlite3.DatabaseError, match="closed period"):
+        conn.execute("UPDATE transaction_lines SET debit = 1 WHERE id = ?", (line_id,))
+    with pytest.raises(sqlite3.DatabaseError, match="closed period"):
+        conn.execute("INSERT INTO transaction_lines (transaction_id, account_id, debit, date) VALUES (1, ?, 5, "
+                     "'2019-05-05')", (account_id,))
+    conn.rollback()
+    assert periods.reopen_periods(conn, "2019-01-31")[-1] == "2019-06-30"
+    conn.execute("UPDATE transaction_lines SET debit = 1 WHERE id = ?", (line_id,))
+
+
+def test_close_and_reopen_bump_versions(api, client, ledger):
+    versions = api.ledger_pool.get(ledger.name).versions
+    bumped = []
+    versions.listen(bumped.append)
+    before = versions.get("closed_periods")
+    response = client.post("/api/periods/close", json={"through": "2019-02-28"})
+    assert response.status_code == 200
+    assert versions.get("closed_periods") == before + 1
+    assert client.delete("/api/periods/2019-02-28").status_code == 200
+    assert versions.get("closed_periods") == before + 2
+    assert all("closed_periods" in tables for tables in bumped)
+
+
+def test_close_of_a_future_month_is_400(client):
+    future = periods.month_end(datetime.date.today() + datetime.timedelta(days=40))
+    response = client.post("/api/periods/close", json={"through": future.isoformat()})
+    assert response.status_code == 400
+    assert client.get("/api/periods").json()["closed_through"] is None
@@ -0,0 +1,26 @@
+from benchmarks import query_plans
+
+
+def test_no_new_scans_on_hot_paths(api):
+    statements, findings = query_plans.run_audit(api.app, api.DB_PATH)
+    accepted = query_plans.load_baseline(query_plans.BASELINE_PATH)
+    new = [finding for finding in findings
+           if query_plans.is_hot(finding) and not query_plans.is_accepted(finding, accepted)]
+    assert statements
+    assert not new, "\n".join(f"SCAN {finding['table']} in {finding['statement']} from "
+                              f"{', '.join(finding['sources'])}: {finding['suggestion']}" for finding in new)
+
+
+def test_keywords_before_a_parenthesis_are_not_functions():
+    info = {"name": "line_month_totals", "columns": ["month", "classification_id"], "indexes": {}, "rows": 5000}
+    sql = ("SELECT target FROM ( SELECT month, classification_id AS target FROM line_month_totals ) "
+           "WHERE target IN (SELECT classification_id FROM budgets) AND EXISTS (SELECT month FROM periods)")
+    suggestion = query_plans.analyze_scan(sql, "line_month_totals", "line_month_totals", info, True)
+    assert suggestion.startswith("no filter on this table")
+
+
+def test_wrapping_function_blocks_the_index():
+    info = {"name": "line_month_totals", "columns": ["month"], "indexes": {}, "rows": 5000}
+    sql = "SELECT * FROM line_month_totals WHERE substr(month, ?, ?) LIKE ?"
+    suggestion = query_plans.analyze_scan(sql, "line_month_totals", "line_month_totals", info, True)
+    assert suggestion == "not indexable: substr(month) (an expression index or a stored column would be needed)"
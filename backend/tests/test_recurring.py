@@ -0,0 +1,78 @@
+import threading
+
+import recurring
+
+
+def add_rent(conn, months=12):
+    """A monthly rent paid from a cash account, the last payment in December 2025"""
+    cash = min(recurring.cash_account_ids(conn))
+    expense = conn.execute(
+        "SELECT a.id FROM accounts a JOIN cat c ON a.cat_id = c.id WHERE c.name LIKE '%expense%'").fetchone()[0]
+    currency_id = conn.execute("SELECT MIN(id) FROM currency").fetchone()[0]
+    for month in range(13 - months, 13):
+        transaction_id = conn.execute("INSERT INTO transactions (description, currency_id) VALUES ('Rent', ?)",
+                                      (currency_id,)).lastrowid
+        conn.executemany("""
+            INSERT INTO transaction_lines (transaction_id, account_id, debit, credit, date) VALUES (?, ?, ?, ?, ?)
+        """, [(transaction_id, expense, 1200, None, f"2025-{month:02d}-01"),
+              (transaction_id, cash, None, 1200, f"2025-{month:02d}-01")])
+    conn.commit()
+
+
+def stored_series(conn):
+    return sorted(recurring.series(conn))
+
+
+def test_incremental_detection_matches_a_rebuild(db):
+    conn = db.conn
+    add_rent(conn, months=6)
+    recurring.detect(conn)
+    assert stored_series(conn)
+    add_rent(conn, months=3)
+    conn.execute("""
+        UPDATE transaction_lines SET date = date(date, '+1 month')
+        WHERE transaction_id IN (SELECT id FROM transactions ORDER BY id DESC LIMIT 40)
+    """)
+    conn.execute("""
+        UPDATE transactions SET description = description || ' changed'
+        WHERE id IN (SELECT id FROM transactions ORDER BY id LIMIT 40)
+    """)
+    conn.execute("""
+        DELETE FROM transaction_lines
+        WHERE transaction_id IN (SELECT id FROM transactions ORDER BY id LIMIT 5 OFFSET 100)
+    """)
+    conn.commit()
+    assert recurring.detect(conn)["rebuilt"] is False
+    incremental = stored_series(conn)
+    assert recurring.detect(conn, full=True)["rebuilt"] is True
+    assert stored_series(conn) == incremental
+    assert recurring.detect(conn) == {"transactions": 0, "series": 0, "rebuilt": False}
+
+
+def test_reads_serve_stale_series_while_a_job_detects(api, db, ledger, client, monkeypatch):
+    detect, submit = recurring.detect, api.job_queue.submit
+    detected, jobs = [], []
+
+    def detect_in(conn, full=False):
+        detected.append(threading.current_thread().name)
+        return detect(conn, full)
+
+    def submit_and_record(name, params):
+        job, existing = submit(name, params)
+        jobs.append(job["id"])
+        return job, existing
+
+    add_rent(db.conn)
+    monkeypatch.setattr(recurring, "detect", detect_in)
+    monkeypatch.setattr(api.job_queue, "submit", submit_and_record)
+    first = client.get("/api/recurring").json()
+    assert first["stale"] is True
+    assert client.get("/api/forecast").status_code == 200
+    with api.ledger_pool.using(ledger.name):
+        for job_id in jobs:
+            assert api.job_queue.wait(job_id, 30)["status"] == "done"
+    assert detected and all(name.startswith("job-worker") for name in detected)
+
+    current = client.get("/api/recurring").json()
+    assert current["stale"] is False
+    assert "Rent" in [series["description"] for series in current["series"]]
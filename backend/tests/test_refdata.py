@@ -0,0 +1,39 @@
+import sqlite3
+
+import refdata
+
+
+def test_snapshot_is_reused_until_a_reference_table_changes(db, ledger):
+    cache = refdata.ReferenceData()
+    first = cache.snapshot(db.conn)
+    assert cache.snapshot(db.conn) is first
+
+    # A write from another connection is seen through the version row
+    with sqlite3.connect(ledger.path) as other:
+        other.execute("UPDATE accounts SET name = 'Renamed' WHERE id = 1")
+    second = cache.snapshot(db.conn)
+    assert second is not first
+    assert second.accounts.name(1) == "Renamed"
+    assert second.accounts.id("Renamed") == 1
+
+
+def test_uncommitted_changes_are_not_shared(db, ledger):
+    cache = refdata.ReferenceData()
+    committed = cache.snapshot(db.conn)
+    with sqlite3.connect(ledger.path) as other:
+        other.execute("INSERT INTO classifications (name) VALUES ('Pending')")
+        assert cache.snapshot(other).classifications.id("Pending") is not None
+        other.rollback()
+    assert cache.snapshot(db.conn) is committed
+    assert committed.classifications.id("Pending") is None
+
+
+def test_lowest_id_wins_for_repeated_names(db):
+    conn = db.conn
+    category_id, currency_id = conn.execute("SELECT cat_id, default_currency_id FROM accounts WHERE id = 1").fetchone()
+    conn.executemany("INSERT INTO accounts (name, cat_id, default_currency_id) VALUES ('Twin', ?, ?)",
+                     [(category_id, currency_id)] * 2)
+    conn.commit()
+    twins = [row[0] for row in conn.execute("SELECT id FROM accounts WHERE name = 'Twin' ORDER BY id")]
+    assert db.get_account_id("Twin") == twins[0]
+    assert db.reference_data().accounts.by_id[twins[1]][1] == "Twin"
@@ -0,0 +1,55 @@
+import pytest
+
+from responses import rows_payload
+
+
+def test_columns_hold_the_records_values():
+    rows = [(1, "a", None), (2, "b", 3.5)]
+    fields = ("id", "name", "amount")
+    assert rows_payload(rows, fields) == [{"id": 1, "name": "a", "amount": None},
+                                          {"id": 2, "name": "b", "amount": 3.5}]
+    assert rows_payload(rows, fields, columnar=True) == {"id": [1, 2], "name": ["a", "b"], "amount": [None, 3.5]}
+    assert rows_payload([], fields, columnar=True) == {"id": [], "name": [], "amount": []}
+
+
+@pytest.mark.parametrize("path, key", [
+    ("/api/transactions?limit=50", "transactions"),
+    ("/api/transactions/1/lines", "lines"),
+    ("/api/accounts", "accounts"),
+    ("/api/accounts/detailed", "accounts"),
+])
+def test_columnar_format_transposes_the_records(client, path, key):
+    records = client.get(path).json()[key]
+    separator = "&" if "?" in path else "?"
+    columns = client.get(f"{path}{separator}format=columnar").json()[key]
+    assert records
+    rebuilt = [dict(zip(columns, values)) for values in zip(*columns.values())]
+    assert len(rebuilt) == len(records)
+    for record, row in zip(records, rebuilt):
+        # Records leave out the fields that do not apply to them (the credit card ones); columns hold None
+        assert row == dict(dict.fromkeys(row), **record)
+
+
+def test_reference_data_revalidates_until_it_changes(client):
+    first = client.get("/api/currencies")
+    etag = first.headers["etag"]
+    assert first.headers["cache-control"] == "no-cache"
+    unchanged = client.get("/api/currencies", headers={"If-None-Match": etag})
+    assert (unchanged.status_code, unchanged.content) == (304, b"")
+    assert client.get("/api/currencies", headers={"If-None-Match": f'W/{etag}, "other"'}).status_code == 304
+
+    assert client.post("/api/currencies", json={"name": "XTS", "exchange_rate": 1}).status_code == 200
+    changed = client.get("/api/currencies", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+    assert "XTS" in [currency["name"] for currency in changed.json()["currencies"]]
+
+
+def test_compressed_and_identity_bodies_have_their_own_etags(client):
+    plain = client.get("/api/accounts", headers={"Accept-Encoding": "identity"})
+    compressed = client.get("/api/accounts", headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert compressed.headers["etag"] == plain.headers["etag"][:-1] + '-gzip"'
+    assert compressed.json() == plain.json()
+    for etag in (plain.headers["etag"], compressed.headers["etag"]):
+        assert client.get("/api/accounts", headers={"If-None-Match": etag}).status_code == 304
@@ -0,0 +1,83 @@
+import pytest
+
+import rules
+
+
+def rule(rule_id, classification_id, keyword=None, pattern=None, priority=0, account_id=None, min_amount=None,
+         max_amount=None, enabled=1):
+    return rules.Rule(rule_id, f"rule {rule_id}", priority, keyword, pattern, account_id, min_amount, max_amount,
+                      classification_id, enabled)
+
+
+def test_priority_then_age_wins():
+    ruleset = rules.RuleSet([rule(1, 10, keyword="uber"), rule(2, 20, keyword="uber eats", priority=5),
+                             rule(3, 30, keyword="uber")])
+    assert ruleset.classify("UBER EATS order") == 20
+    assert ruleset.classify("Uber trip") == 10
+
+
+def test_keywords_contained_in_longer_keywords_match():
+    ruleset = rules.RuleSet([rule(1, 10, keyword="shell"), rule(2, 20, keyword="shell oil", min_amount=500, priority=1)])
+    assert ruleset.classify("SHELL OIL 123", amount=600) == 20
+    assert ruleset.classify("SHELL OIL 123", amount=50) == 10
+
+
+def test_account_amount_and_disabled_conditions():
+    ruleset = rules.RuleSet([rule(1, 10, pattern=r"rent\b", account_id=7), rule(2, 20, keyword="rent", enabled=0),
+                             rule(3, 30, max_amount=5)])
+    assert ruleset.classify("Rent March", account_id=7, amount=900) == 10
+    assert ruleset.classify("Rent March", account_id=8, amount=900) is None
+    assert ruleset.classify("anything", amount=3) == 30
+
+
+@pytest.mark.parametrize("patterns, description, expected", [
+    # The same group name in two rules
+    ([r"(?P<x>uber)", r"(?P<x>careem)"], "CAREEM ride", 2),
+    # Global flags, allowed only at the start of a whole expression
+    ([r"(?i)netflix", r"spotify"], "Netflix.com", 1),
+    # Backreferences whose group numbers would shift
+    ([r"(ab)", r"(z)\1"], "pizza", 2),
+    ([r"(?P<letter>q)(?P=letter)", r"x"], "aqq", 1),
+    ([r"(a)?(?(1)b|c)", r"x"], "c", 1),
+])
+def test_patterns_that_cannot_be_joined_still_match(patterns, description, expected):
+    ruleset = rules.RuleSet([rule(number, number, pattern=pattern) for number, pattern in enumerate(patterns, 1)])
+    assert ruleset.classify(description) == expected
+    assert ruleset.classify("0000") is None
+
+
+def test_validate_rejects_bad_rules():
+    with pytest.raises(ValueError, match="Invalid pattern"):
+        rules.validate({"classification_id": 1, "pattern": "(unclosed"})
+    with pytest.raises(ValueError, match="condition"):
+        rules.validate({"classification_id": 1})
+    with pytest.raises(ValueError, match="larger"):
+        rules.validate({"classification_id": 1, "min_amount": 10, "max_amount": 5})
+
+
+def test_clashing_rules_keep_the_routes_and_imports_working(client, ledger):
+    classifications = client.get("/api/classifications").json()["classifications"]
+    first, second = (classification["id"] for classification in classifications[:2])
+    for pattern, classification_id in ((r"(?P<x>uber)", first), (r"(?P<x>careem)", second)):
+        assert client.post("/api/classification-rules",
+                           json={"pattern": pattern, "classification_id": classification_id}).status_code == 200
+    response = client.post("/api/classification-rules/test", json={"description": "Careem 123"})
+    assert response.status_code == 200
+    assert response.json()["classification_id"] == second
+    response = client.post("/api/classification-rules/apply", json={"filter": {"date_from": "2025-01-01"},
+                                                                      "dry_run": True})
+    assert response.status_code == 200
+
+    from database import Database
+    database = Database(ledger.path)
+    try:
+        orphan_transaction_id = database.insert_orphan_transaction("rules.csv", [
+            {"description": "UBER trip", "account_id": 1, "debit": 12.5},
+            {"description": "careem", "account_id": 1, "debit": 20},
+        ])
+        stored = database.conn.execute("""
+            SELECT classification_id FROM orphan_transaction_lines WHERE orphan_transaction_id = ? ORDER BY id
+        """, (orphan_transaction_id,)).fetchall()
+    finally:
+        database.close_connection()
+    assert [row[0] for row in stored] == [first, second]
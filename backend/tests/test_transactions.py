@@ -0,0 +1,72 @@
+import sqlite3
+
+import pytest
+
+
+def stored_lines(ledger, transaction_id):
+    with sqlite3.connect(ledger.path) as conn:
+        return conn.execute("""
+            SELECT id, account_id, debit, credit, date, classification_id FROM transaction_lines
+            WHERE transaction_id = ? ORDER BY id
+        """, (transaction_id,)).fetchall()
+
+
+@pytest.fixture
+def transaction(client):
+    response = client.post("/api/transactions", json={"description": "Groceries", "currency_id": 1, "lines": [
+        {"account_id": 1, "debit": 50, "date": "2025-06-01"},
+        {"account_id": 2, "debit": 25, "date": "2025-06-01"},
+        {"account_id": 3, "credit": 75, "date": "2025-06-01"},
+    ]})
+    return response.json()["id"]
+
+
+def as_submitted(lines):
+    return [{"account_id": account_id, "debit": debit, "credit": credit, "date": date,
+             "classification_id": classification_id} for _, account_id, debit, credit, date, classification_id in lines]
+
+
+def test_resubmitting_the_same_lines_writes_nothing(client, ledger, transaction):
+    before = stored_lines(ledger, transaction)
+    result = client.put(f"/api/transactions/{transaction}", json={
+        "description": "Groceries", "currency_id": 1, "lines": list(reversed(as_submitted(before)))}).json()
+    assert result["transaction_changed"] is False
+    assert result["lines"] == {"inserted": [], "updated": [], "deleted": [], "unchanged": [line[0] for line in before]}
+    assert stored_lines(ledger, transaction) == before
+
+
+def test_editing_one_line_keeps_the_other_ids(client, ledger, transaction):
+    before = stored_lines(ledger, transaction)
+    lines = as_submitted(before)
+    lines[1]["debit"], lines[2]["credit"] = 30, 80
+    del lines[0]
+    result = client.put(f"/api/transactions/{transaction}", json={
+        "description": "Groceries and more", "currency_id": 1, "lines": lines}).json()
+    assert result["transaction_changed"] is True
+    assert result["lines"]["deleted"] == [before[0][0]]
+    assert result["lines"]["updated"] == [before[1][0], before[2][0]]
+    assert [line[0] for line in stored_lines(ledger, transaction)] == [before[1][0], before[2][0]]
+
+
+def test_patch_changes_only_the_named_fields(client, ledger, transaction):
+    before = stored_lines(ledger, transaction)
+    result = client.patch(f"/api/transactions/{transaction}", json={"lines": [
+        {"id": before[0][0], "debit": 45}, {"id": before[1][0]}, {"id": before[2][0], "credit": 70}]}).json()
+    assert result["transaction_changed"] is False
+    assert result["lines"]["updated"] == [before[0][0], before[2][0]]
+    assert result["lines"]["unchanged"] == [before[1][0]]
+    after = stored_lines(ledger, transaction)
+    assert after[0] == before[0][:2] + (45.0,) + before[0][3:]
+    assert after[1] == before[1]
+
+    result = client.patch(f"/api/transactions/{transaction}", json={"lines": [
+        {"id": before[0][0]}, {"id": before[2][0]}, {"account_id": 2, "debit": 25, "date": "2025-06-01"}]}).json()
+    assert result["lines"]["deleted"] == [before[1][0]]
+    assert len(result["lines"]["inserted"]) == 1
+
+
+def test_foreign_and_repeated_line_ids_are_refused(client, ledger, transaction):
+    line_id = stored_lines(ledger, transaction)[0][0]
+    assert client.patch(f"/api/transactions/{transaction}", json={"lines": [{"id": 1}]}).status_code == 400
+    assert client.patch(f"/api/transactions/{transaction}",
+                        json={"lines": [{"id": line_id}, {"id": line_id}]}).status_code == 400
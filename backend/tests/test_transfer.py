@@ -0,0 +1,80 @@
+import csv
+import io
+
+import pytest
+
+import transfer
+
+
+def exported(conn):
+    output = io.StringIO()
+    transfer.write_csv(transfer.export_rows(conn, by_transaction=True), output)
+    return output.getvalue()
+
+
+def without_ids(text):
+    """Export rows without line_id and transaction_id, the transactions in order"""
+    return [row[2:] for row in csv.reader(io.StringIO(text))]
+
+
+def interrupt(position, size, counters):
+    """Progress callback stopping the import after its first chunk, as Ctrl-C would"""
+    raise KeyboardInterrupt
+
+
+@pytest.fixture
+def export(db, tmp_path):
+    """The ledger exported to a file, then emptied of transactions"""
+    path = tmp_path / "ledger.csv"
+    path.write_text(exported(db.conn), newline="")
+    db.conn.execute("DELETE FROM transaction_lines")
+    db.conn.execute("DELETE FROM transactions")
+    db.conn.commit()
+    return str(path)
+
+
+def test_export_imports_back_as_the_same_transactions(db, export):
+    with open(export, newline="") as f:
+        original = f.read()
+    result = transfer.import_file(db.conn, db.reference, export, workers=1, chunk_bytes=64 * 1024)
+    assert result["skipped"] == 0
+    assert result["lines"] == original.count("\n") - 1
+    assert without_ids(exported(db.conn)) == without_ids(original)
+
+    again = transfer.import_file(db.conn, db.reference, export, workers=1)
+    assert again["already_imported"] is True
+    assert db.conn.execute("SELECT COUNT(*) FROM transaction_lines").fetchone()[0] == result["lines"]
+
+
+def test_interrupted_import_resumes_where_it_stopped(db, export):
+    with pytest.raises(KeyboardInterrupt):
+        transfer.import_file(db.conn, db.reference, export, workers=1, chunk_bytes=64 * 1024, progress=interrupt)
+    stored = db.conn.execute("SELECT COUNT(*) FROM transaction_lines").fetchone()[0]
+
+    result = transfer.import_file(db.conn, db.reference, export, workers=1, chunk_bytes=64 * 1024)
+    assert result["resumed"] is True
+    assert 0 < stored < result["lines"]
+    with open(export, newline="") as f:
+        assert without_ids(exported(db.conn)) == without_ids(f.read())
+
+
+def test_changed_file_is_not_resumed(db, export):
+    with pytest.raises(KeyboardInterrupt):
+        transfer.import_file(db.conn, db.reference, export, workers=1, chunk_bytes=64 * 1024, progress=interrupt)
+    with open(export, "a", newline="") as f:
+        f.write("999999,999999,2025-12-31,Late,USD,Cash,1,,\n")
+    with pytest.raises(ValueError, match="changed since the import"):
+        transfer.import_file(db.conn, db.reference, export, workers=1)
+    assert transfer.import_file(db.conn, db.reference, export, workers=1, restart=True)["resumed"] is False
+
+
+def test_statement_lines_are_imported_once_as_orphans(db, tmp_path):
+    path = tmp_path / "statement.csv"
+    path.write_text("date,description,amount\n2025-03-01,Coffee,-4.50\n2025-03-01,Coffee,-4.50\n"
+                    "2025-03-02,Salary,2000\n")
+    account = db.conn.execute("SELECT name FROM accounts ORDER BY id LIMIT 1").fetchone()[0]
+    first = transfer.import_file(db.conn, db.reference, str(path), target="orphans", account=account, workers=1)
+    assert (first["lines"], first["duplicates"]) == (3, 0)
+    second = transfer.import_file(db.conn, db.reference, str(path), target="orphans", account=account, workers=1,
+                                  restart=True)
+    assert (second["lines"], second["duplicates"]) == (0, 3)
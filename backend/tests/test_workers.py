@@ -0,0 +1,88 @@
+import sqlite3
+
+import pytest
+
+import versions
+import workers
+
+
+@pytest.fixture
+def counters(ledger):
+    """Two SharedTableVersions on one ledger, as two worker processes keep them"""
+    first, second = versions.SharedTableVersions(ledger.path), versions.SharedTableVersions(ledger.path)
+    yield first, second
+    first.close()
+    second.close()
+
+
+def test_bumps_are_seen_by_every_process(counters):
+    first, second = counters
+    heard = []
+    second.listen(heard.append)
+    before = second.tag(("accounts", "cat"))
+    assert first.tag(("accounts", "cat")) == before
+
+    first.bump("accounts")
+    after = second.tag(("accounts", "cat"))
+    assert after != before
+    assert after == first.tag(("accounts", "cat"))
+    assert heard == [{"accounts": first.get("accounts")}]
+    assert second.tag(("cat",)) == first.tag(("cat",))
+
+
+def test_rotating_the_epoch_invalidates_every_tag(counters, ledger):
+    first, second = counters
+    before = second.tag(("accounts",))
+    with sqlite3.connect(ledger.path) as conn:
+        versions.rotate_epoch(conn)
+    assert second.tag(("accounts",)) != before
+    assert first.tag(("accounts",)) == second.tag(("accounts",))
+
+
+def test_write_lock_excludes_other_holders(tmp_path):
+    path = str(tmp_path / "write.lock")
+    holder, other = workers.FileLock(path), workers.FileLock(path)
+    try:
+        with holder:
+            assert not other.acquire(blocking=False)
+        assert other.acquire(blocking=False)
+        other.release()
+    finally:
+        holder.close()
+        other.close()
+
+
+def test_single_process_counters_pick_up_bumps_from_other_processes(ledger):
+    watched = versions.WatchedTableVersions(ledger.path)
+    try:
+        heard = []
+        watched.listen(heard.append)
+        before = watched.tag(("accounts", "cat"))
+        watched.bump("cat")
+        local = watched.tag(("accounts", "cat"))
+        assert local != before
+
+        # As cli.py announces what it wrote
+        other = versions.SharedTableVersions(ledger.path)
+        try:
+            other.bump("accounts")
+        finally:
+            other.close()
+        assert watched.tag(("accounts", "cat")) not in (before, local)
+        assert heard == [{"cat": 1}, {"accounts": 1}]
+
+        tag = watched.tag(("accounts",))
+        with sqlite3.connect(ledger.path) as conn:
+            versions.rotate_epoch(conn)
+        assert watched.tag(("accounts",)) != tag
+    finally:
+        watched.close()
+
+
+def test_server_etags_change_when_another_process_announces(client, ledger):
+    import cli
+
+    etag = client.get("/api/currencies").headers["etag"]
+    assert client.get("/api/currencies", headers={"If-None-Match": etag}).status_code == 304
+    cli.announce(ledger.path, "currency")
+    assert client.get("/api/currencies", headers={"If-None-Match": etag}).status_code == 200
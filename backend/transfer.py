@@ -0,0 +1,644 @@
+"""
+Bulk import and export of transaction lines, straight against the database
+(the command-line tool, cli.py, is their front end).
+
+import_file() reads CSV or OFX files of any size. The file is cut into
+chunks of about CHUNK_BYTES ending on a record boundary (the end of a CSV
+line, the start of an OFX <STMTTRN>), and a pool of worker processes parses
+them. The calling process is the only writer: it takes the parsed chunks in
+file order, resolves names through the reference data, and stores each one
+with a few executemany() statements in a single database transaction.
+
+That transaction also records in import_checkpoints how far into the file
+the import got. Running an interrupted import again on the same, unchanged
+file resumes after the last chunk committed: nothing is stored twice and
+nothing is lost.
+
+Targets:
+
+- transactions: CSV lines with the same transaction_id, one after the other,
+  make one transaction, as the export writes them (the ids themselves are
+  not kept). A statement (OFX, or CSV without transaction_id) needs a contra
+  account: each of its lines becomes a transaction of two lines, one on the
+  statement's account and the opposite one on the contra account. A
+  transaction with a line in a closed period, an unknown name or an
+  unreadable value is skipped as a whole and reported.
+- orphans: all lines of the file go into one orphan transaction, classified
+  by the rules and fingerprinted as Database.import_orphan_transaction does
+  (fingerprints.py), so lines imported before, from this statement or an
+  overlapping one, are left out.
+
+CSV columns are found by the header row: date, description, account, debit
+and credit or a signed amount (positive is a debit), currency,
+classification and transaction_id; others are ignored. Quoted values should
+not span lines, as a chunk boundary may fall inside them.
+"""
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import datetime
+import hashlib
+import os
+import re
+import signal
+
+import archive
+import balances
+import fingerprints
+import periods
+import rules
+
+TARGETS = ("transactions", "orphans")
+FORMATS = ("csv", "ofx")
+CHUNK_BYTES = 4 * 1024 * 1024
+# Bytes of the file hashed into its signature, besides its size
+SIGNATURE_BYTES = 1024 * 1024
+OFX_RECORD = b"<STMTTRN>"
+OFX_END = re.compile(r"</STMTTRN>|</BANKTRANLIST>", re.IGNORECASE)
+OFX_TAG = re.compile(r"<(\w+)>([^<\r\n]*)")
+
+EXPORT_FIELDS = ("line_id", "transaction_id", "date", "description", "currency", "account", "debit", "credit",
+                 "classification")
+EXPORT_BATCH = 5000
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS import_checkpoints (
+        source TEXT NOT NULL,
+        target TEXT NOT NULL,
+        signature TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        line_number INTEGER NOT NULL,
+        lines INTEGER NOT NULL DEFAULT 0,
+        transactions INTEGER NOT NULL DEFAULT 0,
+        duplicates INTEGER NOT NULL DEFAULT 0,
+        skipped INTEGER NOT NULL DEFAULT 0,
+        orphan_transaction_id INTEGER,
+        started_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        finished_at TEXT,
+        PRIMARY KEY (source, target)
+    )
+    """,
+]
+CHECKPOINT_FIELDS = ("source", "target", "signature", "position", "line_number", "lines", "transactions",
+                     "duplicates", "skipped", "orphan_transaction_id", "started_at", "updated_at", "finished_at")
+# Counters kept in a checkpoint and returned by import_file()
+COUNTERS = ("lines", "transactions", "duplicates", "skipped")
+
+# One parsed line; `group` is its transaction_id (CSV) or FITID (OFX), `line`
+# its line number counted from the chunk start, `error` why it is unusable
+Record = collections.namedtuple("Record", ("line", "position", "group", "date", "description", "account", "debit",
+                                           "credit", "currency", "classification", "error"))
+
+
+def create_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+def now():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def parse_day(text, date_format=None):
+    """ISO date of a CSV date (YYYY-MM-DD, or `date_format` for strptime) or an OFX one (YYYYMMDD...)"""
+    text = text.strip()
+    if date_format:
+        return datetime.datetime.strptime(text, date_format).date().isoformat()
+    if len(text) >= 8 and text[:8].isdigit():
+        return datetime.date(int(text[:4]), int(text[4:6]), int(text[6:8])).isoformat()
+    # fromisoformat() only validates here: the text is ISO already
+    datetime.date.fromisoformat(text[:10])
+    return text[:10]
+
+
+def parse_amount(text):
+    text = text.strip().replace(",", "")
+    return float(text) if text else None
+
+
+def sides(debit, credit):
+    """(debit, credit) with negative amounts moved to the other side and the empty side None"""
+    net = (debit or 0) - (credit or 0)
+    if debit is not None and credit is not None:
+        return (net, None) if net >= 0 else (None, -net)
+    if (debit or 0) < 0 or (credit or 0) < 0:
+        return (net, None) if net >= 0 else (None, -net)
+    return debit, credit
+
+
+def signature(path):
+    """Size and leading bytes of a file, which a resumed import must find unchanged"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        digest.update(f.read(SIGNATURE_BYTES))
+    return f"{os.path.getsize(path)}:{digest.hexdigest()}"
+
+
+def read_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+def csv_header(path, encoding):
+    """(column name -> index, offset of the first data line) of a CSV file"""
+    with open(path, "rb") as f:
+        first = f.readline()
+    names = next(csv.reader([first.decode(encoding).lstrip("\ufeff")]), [])
+    columns = {}
+    for index, name in enumerate(names):
+        columns.setdefault(name.strip().lower(), index)
+    if "date" not in columns or not ({"debit", "credit", "amount"} & set(columns)):
+        raise ValueError("CSV needs a header row with a date column and debit/credit or amount columns")
+    return columns, len(first)
+
+
+def ofx_header(path, encoding):
+    """(ACCTID, CURDEF and the like from before the first <STMTTRN>, its offset) of an OFX file"""
+    with open(path, "rb") as f:
+        head = b""
+        while OFX_RECORD not in head:
+            block = f.read(64 * 1024)
+            if not block:
+                break
+            head += block
+    index = head.find(OFX_RECORD)
+    start = index if index >= 0 else os.path.getsize(path)
+    text = head[:start].decode(encoding, errors="replace")
+    return {tag.upper(): value.strip() for tag, value in OFX_TAG.findall(text)}, start
+
+
+def chunk_ranges(path, start, end, chunk_bytes, boundary):
+    """
+    (start, end) byte ranges of about `chunk_bytes` covering [start, end);
+    each but the last ends right after a newline (boundary b"\\n") or right
+    before the next `boundary`
+    """
+    with open(path, "rb") as f:
+        while start < end:
+            stop = start + chunk_bytes
+            if stop >= end:
+                stop = end
+            else:
+                f.seek(stop)
+                tail = b""
+                while True:
+                    block = f.read(64 * 1024)
+                    if not block:
+                        stop = end
+                        break
+                    window = tail + block
+                    index = window.find(boundary)
+                    if index >= 0:
+                        stop = f.tell() - len(window) + index + (len(boundary) if boundary == b"\n" else 0)
+                        break
+                    # A boundary may straddle two blocks
+                    tail = window[len(window) - len(boundary) + 1:]
+                stop = min(stop, end)
+            yield start, stop
+            start = stop
+
+
+# Columns parse_csv() reads, in the order it unpacks them
+CSV_COLUMNS = ("transaction_id", "date", "description", "account", "debit", "credit", "amount", "currency",
+               "classification")
+
+
+def parse_csv(path, start, end, options):
+    """Records of the CSV lines in [start, end) and the number of lines there"""
+    lines = read_range(path, start, end).splitlines(keepends=True)
+    offsets = [start]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    columns, encoding, date_format = options["columns"], options["encoding"], options["date_format"]
+    indexes = [columns.get(name, -1) for name in CSV_COLUMNS]
+    width = max(indexes) + 1
+    records = []
+    reader = csv.reader(line.decode(encoding, errors="replace") for line in lines)
+    first = 0
+    for row in reader:
+        number, first = first + 1, reader.line_num
+        if len(row) < width:
+            if not any(value.strip() for value in row):
+                continue
+            row += [""] * (width - len(row))
+        group, day, description, account, debit, credit, amount, currency, classification = (
+            row[index].strip() if index >= 0 else "" for index in indexes)
+        try:
+            day = parse_day(day, date_format)
+            if amount and not debit and not credit:
+                amount = parse_amount(amount)
+                debit, credit = (amount, None) if amount >= 0 else (None, -amount)
+            else:
+                debit, credit = parse_amount(debit), parse_amount(credit)
+                if debit is None and credit is None:
+                    raise ValueError("no amount")
+                debit, credit = sides(debit, credit)
+        except ValueError as e:
+            records.append(Record(number, offsets[number - 1], group, None, description, account, None, None,
+                                  currency, classification, f"{e}"))
+            continue
+        records.append(Record(number, offsets[number - 1], group, day, description, account, debit, credit,
+                              currency, classification, None))
+    return records, len(lines)
+
+
+def parse_ofx(path, start, end, options):
+    """Records of the <STMTTRN> aggregates in [start, end) and the number of lines there"""
+    data = read_range(path, start, end)
+    encoding, header = options["encoding"], options["header"]
+    account, currency = header.get("ACCTID", ""), header.get("CURDEF", "")
+    records = []
+    number, counted = 1, 0
+    index = data.find(OFX_RECORD)
+    while index >= 0:
+        following = data.find(OFX_RECORD, index + len(OFX_RECORD))
+        block = data[index + len(OFX_RECORD):following if following >= 0 else len(data)].decode(encoding,
+                                                                                                 errors="replace")
+        closing = OFX_END.search(block)
+        if closing:
+            block = block[:closing.start()]
+        tags = {tag.upper(): value.strip() for tag, value in OFX_TAG.findall(block)}
+        number += data.count(b"\n", counted, index)
+        counted = index
+        description = " - ".join(dict.fromkeys(value for value in (tags.get("NAME") or tags.get("PAYEE"),
+                                                                    tags.get("MEMO")) if value))
+        record = Record(number, start + index, tags.get("FITID", ""), None, description, account, None, None,
+                        currency, "", None)
+        try:
+            amount = parse_amount(tags.get("TRNAMT", ""))
+            if amount is None:
+                raise ValueError("no TRNAMT")
+            debit, credit = (amount, None) if amount >= 0 else (None, -amount)
+            records.append(record._replace(date=parse_day(tags.get("DTPOSTED", "")), debit=debit, credit=credit))
+        except ValueError as e:
+            records.append(record._replace(error=f"{e}"))
+        index = following
+    return records, data.count(b"\n")
+
+
+def ignore_interrupts():
+    """Leave Ctrl-C to the writer, which stops the pool"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def parsed_chunks(parse, path, ranges, options, workers):
+    """(start, end, parse result) of every range in order, parsed by `workers` processes"""
+    if workers <= 1:
+        for start, end in ranges:
+            yield start, end, parse(path, start, end, options)
+        return
+    pool = concurrent.futures.ProcessPoolExecutor(workers, initializer=ignore_interrupts)
+    try:
+        pending = collections.deque()
+        for start, end in ranges:
+            pending.append((start, end, pool.submit(parse, path, start, end, options)))
+            # Parse ahead of the writer, but not the whole file into memory
+            if len(pending) > 2 * workers:
+                start, end, future = pending.popleft()
+                yield start, end, future.result()
+        while pending:
+            start, end, future = pending.popleft()
+            yield start, end, future.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class FileImport:
+    """One import_file() run; the writer side of the pipeline"""
+
+    def __init__(self, conn, reference_data, source, target, account, contra, currency, reference, skip):
+        self.conn = conn
+        self.reference_data = reference_data
+        self.source = source
+        self.target = target
+        self.account = account
+        self.contra = contra
+        self.currency = currency
+        self.reference = reference
+        self.skip = skip
+        self.checkpoint = None
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.statement = fingerprints.Statement()
+        # Lines of the transaction still being read, carried over to the next chunk
+        self.group = []
+
+    def load_checkpoint(self):
+        row = self.conn.execute(f"SELECT {', '.join(CHECKPOINT_FIELDS)} FROM import_checkpoints "
+                                f"WHERE source = ? AND target = ?", (self.source, self.target)).fetchone()
+        self.checkpoint = dict(zip(CHECKPOINT_FIELDS, row)) if row else None
+        if self.checkpoint:
+            self.counters = {name: self.checkpoint[name] for name in COUNTERS}
+        return self.checkpoint
+
+    def save_checkpoint(self, file_signature, position, line_number, finished=False):
+        """Record progress (inside the chunk's transaction)"""
+        checkpoint = self.checkpoint or {"source": self.source, "target": self.target, "started_at": now(),
+                                         "orphan_transaction_id": None}
+        checkpoint.update(self.counters, signature=file_signature, position=position, line_number=line_number,
+                          updated_at=now(), finished_at=now() if finished else None)
+        self.conn.execute(f"INSERT OR REPLACE INTO import_checkpoints ({', '.join(CHECKPOINT_FIELDS)}) "
+                          f"VALUES ({', '.join('?' * len(CHECKPOINT_FIELDS))})",
+                          [checkpoint[name] for name in CHECKPOINT_FIELDS])
+        self.checkpoint = checkpoint
+
+    def account_id(self, snapshot, name):
+        account_id = snapshot.accounts.id(name)
+        if account_id is None:
+            raise ValueError(f"unknown account '{name}'")
+        return account_id
+
+    def named_id(self, table, name, kind):
+        if not name:
+            return None
+        found = table.id(name)
+        if found is None:
+            raise ValueError(f"unknown {kind} '{name}'")
+        return found
+
+    def transaction(self, snapshot, records, closed_through):
+        """(description, currency id, line rows without transaction id) of the records of one transaction"""
+        for record in records:
+            if record.error:
+                raise ValueError(record.error)
+            if closed_through is not None and record.date <= closed_through:
+                raise ValueError(f"books are closed through {closed_through}")
+        lines = []
+        for record in records:
+            account_id = self.account_id(snapshot, self.account or record.account)
+            classification_id = self.named_id(snapshot.classifications, record.classification, "classification")
+            lines.append((account_id, record.debit, record.credit, record.date, classification_id))
+            if self.contra is not None:
+                lines.append((self.contra, record.credit, record.debit, record.date, None))
+        currency = self.currency or next((record.currency for record in records if record.currency), None)
+        if currency:
+            currency_id = self.named_id(snapshot.currencies, currency, "currency")
+        else:
+            # The first line's account's default currency
+            currency_id = snapshot.accounts.by_id[lines[0][0]][3]
+            if currency_id is None:
+                raise ValueError("no currency")
+        return records[0].description, currency_id, lines
+
+    def transactions(self, records, closed_through, last):
+        """Transactions complete in `records` (plus the carried-over group); the rest is carried over"""
+        snapshot = self.reference_data.snapshot(self.conn)
+        complete = []
+        groups = [[record] for record in records] if self.contra is not None else None
+        if groups is None:
+            groups = []
+            for record in records:
+                if self.group and record.group != self.group[0].group:
+                    groups.append(self.group)
+                    self.group = []
+                self.group.append(record)
+            if last and self.group:
+                groups.append(self.group)
+                self.group = []
+        for group in groups:
+            try:
+                complete.append(self.transaction(snapshot, group, closed_through))
+            except ValueError as e:
+                self.counters["skipped"] += 1
+                self.skip(group[0].line, f"transaction skipped: {e}")
+        return complete
+
+    def write_transactions(self, complete):
+        next_id = self.conn.execute("""
+            SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'transactions'), 0),
+                       COALESCE((SELECT MAX(id) FROM transactions), 0)) + 1
+        """).fetchone()[0]
+        transaction_rows, line_rows = [], []
+        for transaction_id, (description, currency_id, lines) in enumerate(complete, next_id):
+            transaction_rows.append((transaction_id, description, currency_id))
+            line_rows.extend((transaction_id,) + line for line in lines)
+        self.conn.executemany("INSERT INTO transactions (id, description, currency_id) VALUES (?, ?, ?)",
+                              transaction_rows)
+        self.conn.executemany("""
+            INSERT INTO transaction_lines (transaction_id, account_id, debit, credit, date, classification_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, line_rows)
+        self.counters["transactions"] += len(transaction_rows)
+        self.counters["lines"] += len(line_rows)
+
+    def orphan_lines(self, records):
+        """Line dicts of the usable records, as Database.import_orphan_transaction takes them"""
+        snapshot = self.reference_data.snapshot(self.conn)
+        lines = []
+        for record in records:
+            if record.error:
+                self.counters["skipped"] += 1
+                self.skip(record.line, f"line skipped: {record.error}")
+                continue
+            name = self.account or record.account
+            account_id = snapshot.accounts.id(name) if name else None
+            classification_id = snapshot.classifications.id(record.classification) if record.classification \
+                else None
+            lines.append({"description": record.description, "account_id": account_id,
+                          "account_name": name if account_id is None else None, "debit": record.debit,
+                          "credit": record.credit, "date": record.date, "classification_id": classification_id})
+        return lines
+
+    def write_orphans(self, lines):
+        line_fingerprints = self.statement.fingerprints(lines)
+        existing = fingerprints.duplicates(self.conn, line_fingerprints)
+        self.counters["duplicates"] += len(existing)
+        fresh = [(line, fingerprint) for line, fingerprint in zip(lines, line_fingerprints)
+                 if fingerprint not in existing]
+        if not fresh:
+            return
+        orphan_transaction_id = self.checkpoint and self.checkpoint["orphan_transaction_id"]
+        if orphan_transaction_id is None:
+            cursor = self.conn.execute(
+                "INSERT INTO orphan_transactions (reference, import_date, status) VALUES (?, ?, 'new')",
+                (self.reference, now())
+            )
+            orphan_transaction_id = cursor.lastrowid
+            self.checkpoint = self.checkpoint or {"source": self.source, "target": self.target, "started_at": now()}
+            self.checkpoint["orphan_transaction_id"] = orphan_transaction_id
+        ruleset = rules.load(self.conn)
+        rows = []
+        for line, fingerprint in fresh:
+            classification_id = line["classification_id"]
+            if classification_id is None:
+                classification_id = ruleset.classify(line["description"], line["account_id"],
+                                                     rules.line_amount(line["debit"], line["credit"]))
+            notes = f"{fingerprints.ACCOUNT_NAME_NOTE}{line['account_name']}" if line["account_name"] else None
+            rows.append((orphan_transaction_id, line["description"], line["account_id"], line["debit"],
+                         line["credit"], notes, classification_id, line["date"], fingerprint))
+        self.conn.executemany("""
+            INSERT INTO orphan_transaction_lines
+            (orphan_transaction_id, description, account_id, debit, credit, status, notes, classification_id,
+             date, fingerprint)
+            VALUES (?, ?, ?, ?, ?, 'new', ?, ?, ?, ?)
+        """, rows)
+        self.counters["lines"] += len(rows)
+
+
+def import_file(conn, reference_data, path, target="transactions", file_format=None, account=None, contra=None,
+                currency=None, reference=None, date_format=None, encoding="utf-8", workers=None,
+                chunk_bytes=CHUNK_BYTES, restart=False, progress=None, skip=None):
+    """
+    Import a CSV or OFX file into transactions or orphan lines, resuming an
+    interrupted import of the same file (see the module docstring)
+
+    Args:
+        conn: Connection to the ledger, committed chunk by chunk
+        reference_data: refdata.ReferenceData of the ledger
+        file_format: csv or ofx (default: by extension)
+        account: Name of the account of every line (default: the CSV account
+            column, or the OFX ACCTID)
+        contra: Account name balancing each statement line (transactions only)
+        currency: Currency name of every transaction (default: the currency
+            column, the OFX CURDEF, or the account's default currency)
+        reference: Reference of the orphan transaction (default: file name)
+        workers: Parser processes (default: one per core)
+        restart: Forget an unfinished or finished earlier import of the file
+        progress: Called as progress(position, size, counters) after every chunk
+        skip: Called as skip(line number, reason) for every line or
+            transaction left out
+
+    Returns:
+        Counters (lines, transactions, duplicates, skipped), plus `resumed`
+        and `already_imported`
+
+    Raises:
+        ValueError: unusable options, or the file changed since the import
+            that is to be resumed
+    """
+    if target not in TARGETS:
+        raise ValueError(f"target must be one of {', '.join(TARGETS)}")
+    file_format = file_format or ("ofx" if os.path.splitext(path)[1].lower() in (".ofx", ".qfx") else "csv")
+    if file_format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    source = os.path.abspath(path)
+    size = os.path.getsize(path)
+    file_signature = signature(path)
+    options = {"encoding": encoding, "date_format": date_format}
+    if file_format == "csv":
+        options["columns"], data_start = csv_header(path, encoding)
+        parse, boundary, first_line = parse_csv, b"\n", 1
+        grouped = "transaction_id" in options["columns"]
+    else:
+        options["header"], data_start = ofx_header(path, encoding)
+        first_line = read_range(path, 0, data_start).count(b"\n")
+        parse, boundary, grouped = parse_ofx, OFX_RECORD, False
+
+    run = FileImport(conn, reference_data, source, target, account, None, currency,
+                     reference or os.path.basename(path), skip or (lambda line, reason: None))
+    snapshot = reference_data.snapshot(conn)
+    if target == "transactions":
+        if contra:
+            run.contra = run.account_id(snapshot, contra)
+        elif not grouped:
+            raise ValueError("Statement lines need a contra account to become transactions")
+        if account or file_format == "ofx":
+            run.account = account or options["header"].get("ACCTID", "")
+            run.account_id(snapshot, run.account)
+    else:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(orphan_transaction_lines)").fetchall()]
+        if "notes" not in columns:
+            conn.execute("ALTER TABLE orphan_transaction_lines ADD COLUMN notes TEXT")
+            conn.commit()
+
+    checkpoint = run.load_checkpoint()
+    if checkpoint is not None:
+        if restart:
+            conn.execute("DELETE FROM import_checkpoints WHERE source = ? AND target = ?", (source, target))
+            conn.commit()
+            run.checkpoint, run.counters, checkpoint = None, dict.fromkeys(COUNTERS, 0), None
+        elif checkpoint["signature"] != file_signature:
+            raise ValueError(f"{path} changed since the import that stopped at byte {checkpoint['position']}; "
+                             f"pass restart to import it from the start")
+        elif checkpoint["finished_at"]:
+            return dict(run.counters, resumed=False, already_imported=True)
+    position = checkpoint["position"] if checkpoint else data_start
+    line_number = checkpoint["line_number"] if checkpoint else first_line
+    workers = workers or os.cpu_count() or 1
+
+    if target == "orphans" and position > data_start:
+        # Fingerprint ordinals count from the start of the statement
+        ranges = chunk_ranges(path, data_start, position, chunk_bytes, boundary)
+        with contextlib.closing(parsed_chunks(parse, path, ranges, options, workers)) as chunks:
+            for _, _, (records, _) in chunks:
+                run.statement.fingerprints(run.orphan_lines([record for record in records if not record.error]))
+
+    chunks = parsed_chunks(parse, path, chunk_ranges(path, position, size, chunk_bytes, boundary), options, workers)
+    with contextlib.closing(chunks):
+        for start, end, (records, line_count) in chunks:
+            records = [record._replace(line=record.line + line_number) for record in records]
+            last = end >= size
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if target == "transactions":
+                    complete = run.transactions(records, periods.closed_through(conn), last)
+                    run.write_transactions(complete)
+                else:
+                    run.write_orphans(run.orphan_lines(records))
+                # A transaction carried over to the next chunk is read again on resume
+                resume_at = run.group[0].position if run.group else end
+                resume_line = run.group[0].line - 1 if run.group else line_number + line_count
+                run.save_checkpoint(file_signature, resume_at, resume_line, finished=last)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            line_number += line_count
+            if progress is not None:
+                progress(end, size, run.counters)
+    if position >= size:
+        # Nothing (more) to read: still remember the file as imported
+        run.save_checkpoint(file_signature, size, line_number, finished=True)
+        conn.commit()
+    return dict(run.counters, resumed=checkpoint is not None, already_imported=False)
+
+
+def export_rows(conn, date_from=None, date_to=None, by_transaction=False):
+    """
+    Cursor over every transaction line (archived years included) as
+    EXPORT_FIELDS rows, in date order or with the lines of each transaction
+    together (which import_file() reads back as whole transactions)
+    """
+    end = balances.next_day(balances.parse_date(date_to)) if date_to else None
+    lines, transactions = archive.tables(conn, date_from, end)
+    order = "tl.transaction_id, tl.id" if by_transaction else "tl.date, tl.id"
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT tl.id, tl.transaction_id, tl.date, t.description, COALESCE(cu.name, 'USD'), a.name,
+               tl.debit, tl.credit, c.name
+        FROM {lines} tl
+        JOIN {transactions} t ON t.id = tl.transaction_id
+        LEFT JOIN currency cu ON t.currency_id = cu.id
+        LEFT JOIN accounts a ON tl.account_id = a.id
+        LEFT JOIN classifications c ON tl.classification_id = c.id
+        WHERE tl.date >= ? AND tl.date < ?
+        ORDER BY {order}
+    """, (date_from or "", end or "9999-12-31"))
+    return cursor
+
+
+def write_csv(cursor, output, check=None, progress=None):
+    """
+    Write the rows of an export_rows() cursor to `output` as CSV, EXPORT_BATCH
+    at a time; returns the number of rows
+
+    Args:
+        check: Called before every batch (JobContext.check for background jobs)
+        progress: Called with the number of rows written after every batch
+    """
+    writer = csv.writer(output)
+    writer.writerow(EXPORT_FIELDS)
+    count = 0
+    while True:
+        if check is not None:
+            check()
+        rows = cursor.fetchmany(EXPORT_BATCH)
+        if not rows:
+            return count
+        writer.writerows(rows)
+        count += len(rows)
+        if progress is not None:
+            progress(count)
@@ -0,0 +1,203 @@
+import json
+import sqlite3
+import threading
+import uuid
+
+
+class TableVersions:
+    """
+    In-process change counters, one per table.
+
+    Write endpoints bump the tables they touched after committing; readers
+    combine the counters of the tables they depend on into a version tag. A
+    tag can therefore be checked without touching SQLite at all.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._listeners = []
+        # Distinguishes tags issued before and after a restart
+        self.epoch = uuid.uuid4().hex[:12]
+
+    def bump(self, *tables):
+        """Record that the given tables changed"""
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+            bumped = {table: self._versions[table] for table in tables}
+        for listener in self._listeners:
+            listener(bumped)
+
+    def listen(self, listener):
+        """Call listener({table: new version}) after every bump"""
+        self._listeners.append(listener)
+
+    def get(self, table):
+        return self._versions.get(table, 0)
+
+    def tag(self, tables):
+        """Version tag covering all of the given tables"""
+        return self.epoch + "-" + ".".join(str(self.get(table)) for table in tables)
+
+    def sync(self):
+        """Counters only change in this process"""
+
+    def close(self):
+        pass
+
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS table_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS version_epoch (id INTEGER PRIMARY KEY CHECK (id = 1), epoch TEXT NOT NULL)",
+    "INSERT OR IGNORE INTO version_epoch (id, epoch) VALUES (1, lower(hex(randomblob(6))))",
+]
+
+
+def create_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+def connect(path):
+    """Autocommit connection of a counters object to the shared counters"""
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    create_schema(conn)
+    return conn
+
+
+def read_counters(conn):
+    """(epoch, {table: version}) of the shared counters, read in one transaction"""
+    conn.execute("BEGIN")
+    try:
+        versions = dict(conn.execute("SELECT name, version FROM table_versions").fetchall())
+        epoch = conn.execute("SELECT epoch FROM version_epoch WHERE id = 1").fetchone()[0]
+    finally:
+        conn.execute("COMMIT")
+    return epoch, versions
+
+
+def rotate_epoch(conn):
+    """Invalidate every tag issued from the shared counters (for writers that do not bump them)"""
+    conn.execute("UPDATE version_epoch SET epoch = lower(hex(randomblob(6))) WHERE id = 1")
+
+
+class SharedTableVersions(TableVersions):
+    """
+    TableVersions kept in the database, so every process serving it issues
+    the same tags (multi-worker mode, see workers.py)
+
+    bump() increments the counters in the table_versions table. Before a
+    tag is built, sync() asks its own connection for PRAGMA data_version,
+    which only moves when another connection committed, and rereads the
+    counters then; counters bumped by other processes are passed to the
+    listeners like local bumps. The epoch is shared as well; every process
+    replaces it when it first prepares the database (rotate_epoch()), since
+    writes made while nobody kept the counters are unaccounted for.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._conn = None
+        self._data_version = None
+
+    def connection(self):
+        """Own autocommit connection (lock held)"""
+        if self._conn is None:
+            self._conn = connect(self.path)
+        return self._conn
+
+    def sync(self):
+        """Pick up counters bumped elsewhere; one PRAGMA when nothing was committed meanwhile"""
+        with self._lock:
+            conn = self.connection()
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            self._data_version = data_version
+            self.epoch, versions = read_counters(conn)
+            changed = {table: version for table, version in versions.items() if self._versions.get(table) != version}
+            self._versions = versions
+        if changed:
+            for listener in self._listeners:
+                listener(changed)
+
+    def bump(self, *tables):
+        with self._lock:
+            conn = self.connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("""
+                    INSERT INTO table_versions (name, version) VALUES (?, 1)
+                    ON CONFLICT (name) DO UPDATE SET version = version + 1
+                """, [(table,) for table in tables])
+                bumped = dict(conn.execute("""
+                    SELECT name, version FROM table_versions WHERE name IN (SELECT value FROM json_each(?))
+                """, (json.dumps(tables),)).fetchall())
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            self._versions.update(bumped)
+        for listener in self._listeners:
+            listener(bumped)
+
+    def tag(self, tables):
+        self.sync()
+        return super().tag(tables)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class WatchedTableVersions(TableVersions):
+    """
+    In-process counters that also pick up the shared counters bumped by
+    other processes writing the database, such as cli.py or a backup
+    restore next to a single-process server
+
+    bump() stays in memory. Before a tag is built, sync() asks its own
+    connection for PRAGMA data_version and, only when something was
+    committed since, rereads the shared counters: every table whose shared
+    counter moved is bumped here, and a new shared epoch (rotate_epoch())
+    replaces this one, so no tag issued before matches.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._conn = None
+        self._data_version = None
+        self._shared = None
+
+    def sync(self):
+        with self._lock:
+            if self._conn is None:
+                self._conn = connect(self.path)
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            self._data_version = data_version
+            previous, self._shared = self._shared, read_counters(self._conn)
+            if previous is None:
+                return
+            epoch, versions = self._shared
+            if epoch != previous[0]:
+                self.epoch = uuid.uuid4().hex[:12]
+            changed = [table for table, version in versions.items() if previous[1].get(table) != version]
+        if changed:
+            self.bump(*changed)
+
+    def tag(self, tables):
+        self.sync()
+        return super().tag(tables)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
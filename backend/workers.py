@@ -0,0 +1,160 @@
+"""
+Multi-worker mode: several server processes on the same ledgers.
+
+Start the server with FINANCE_WORKERS set to its process count, e.g.
+
+    FINANCE_WORKERS=4 uvicorn main:app --workers 4
+
+Every cache in a process is then kept coherent with writes made by the
+others:
+
+- Ledgers run in WAL mode, so readers in one process never wait for a
+  writer in another.
+- Table version counters (versions.py) are kept in the ledger itself
+  (SharedTableVersions). Each worker notices foreign commits with
+  `PRAGMA data_version` on a connection of its own, which costs one
+  in-memory check when nothing changed, and only then rereads the counters.
+  ETags, cached bodies and job cache keys are therefore the same in every
+  worker, and counters bumped elsewhere reach this worker's /api/events
+  subscribers as table versions (transaction events stay with the worker
+  that made them; clients refetch on the table versions).
+- Reference data (refdata.py), balances, periods and recurring series
+  already validate against rows in the database, and the analytics cache
+  rereads its state file under a file lock before every refresh.
+- Requests that may write (POST, PUT, PATCH, DELETE) are funnelled through
+  a per-ledger file lock (WriteFunnel): one writes at a time across all
+  processes and the others queue on the lock, instead of racing for
+  SQLite's write lock and backing off.
+- Scheduled backups run in whichever process holds the scheduler lock
+  (leader()), and the job queue only fails jobs left behind by processes
+  that are gone.
+
+Without FINANCE_WORKERS, or with 1, nothing of this is switched on; the
+counters stay in memory and only watch the ledger's shared ones for bumps
+by other processes such as cli.py (versions.WatchedTableVersions).
+File locks need fcntl; elsewhere they only exclude threads of one process.
+"""
+import os
+import threading
+
+import anyio
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+WORKERS = int(os.environ.get("FINANCE_WORKERS", "1"))
+SHARED = WORKERS > 1
+WRITE_METHODS = frozenset(("POST", "PUT", "PATCH", "DELETE"))
+# How often idle workers look for foreign writes to announce on /api/events
+SYNC_SECONDS = 0.5
+
+
+class FileLock:
+    """Exclusive lock across threads and processes, held on `path` (created if missing)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    def acquire(self, blocking=True):
+        if not self.lock.acquire(blocking):
+            return False
+        try:
+            if self.file is None:
+                self.file = open(self.path, "a+b")
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock.release()
+            return False
+        except BaseException:
+            self.lock.release()
+            raise
+        return True
+
+    def release(self):
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.lock.release()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class WriteFunnel:
+    """Pure ASGI middleware holding the ledger's write lock while a write request runs"""
+
+    def __init__(self, app, pool):
+        self.app = app
+        self.pool = pool
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in WRITE_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        lock = self.pool.current().write_lock
+        await anyio.to_thread.run_sync(lock.acquire)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            lock.release()
+
+
+_leader_lock = None
+
+
+def leader(db_path):
+    """
+    Whether this process runs the once-per-deployment chores (scheduled
+    backups); the first process to ask keeps the role for its lifetime
+    """
+    global _leader_lock
+    if not SHARED:
+        return True
+    if _leader_lock is None:
+        lock = FileLock(os.path.splitext(db_path)[0] + "-leader.lock")
+        if not lock.acquire(blocking=False):
+            lock.close()
+            return False
+        _leader_lock = lock
+    return True
+
+
+class SyncThread:
+    """Announces foreign writes to the /api/events subscribers of idle workers"""
+
+    def __init__(self, pool, interval=SYNC_SECONDS):
+        self.pool = pool
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="version-sync", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for ledger in self.pool.subscribed():
+                try:
+                    ledger.versions.sync()
+                except Exception as e:
+                    print(f"Version sync of ledger '{ledger.name}' failed: {type(e).__name__}: {e}")